@@ -0,0 +1,206 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# asyncio integration for the libusb Oscilloscope (Python 3.5+):
+#
+#     async with AsyncOscilloscope(scope) as ascope:
+#         await ascope.set_sample_rate(0x10)
+#         async with ascope.stream(0x8000, max_buffered=16, overrun=DROP_OLDEST) as blocks:
+#             async for ch1_data, ch2_data in blocks:
+#                 ...
+#
+# The USB events are handled on the scope's event thread (see Oscilloscope.start_event_thread), never on the event
+# loop. Blocks are handed over to the loop through a bounded buffer, and the blocking control requests run in an
+# executor.
+
+import asyncio
+import collections
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Overrun policies, for when the consumer falls behind and the buffer is full.
+DROP_OLDEST = 'drop_oldest'  # Discard the oldest buffered block to make room for the new one.
+DROP_NEWEST = 'drop_newest'  # Discard the new block.
+STOP = 'stop'                # Stop the stream. The buffered blocks are still delivered, then OverrunError is raised.
+OVERRUN_POLICIES = (DROP_OLDEST, DROP_NEWEST, STOP)
+
+
+class OverrunError(Exception):
+    """
+    Raised by a stream with the STOP overrun policy, once the consumer fell behind.
+    """
+
+
+class AsyncStream(object):
+    """
+    An async iterator over the (ch1_data, ch2_data) blocks of a running capture. The capture is started on the first
+    iteration and runs until aclose(), so use the stream in an async with block when leaving the loop early.
+    """
+
+    def __init__(self, scope, data_size, max_buffered=8, overrun=DROP_OLDEST, outstanding_transfers=3,
+                 executor=None, **read_options):
+        """
+        :param scope: An Oscilloscope with an open handle and firmware loaded.
+        :param data_size: The block size, as for read_async.
+        :param max_buffered: (OPTIONAL) The most blocks to buffer for a slow consumer. Default: 8
+        :param overrun: (OPTIONAL) What to do when the buffer is full, one of OVERRUN_POLICIES. Default: DROP_OLDEST
+        :param outstanding_transfers: (OPTIONAL) The number of transfers in flight, as for read_async. Default: 3
+        :param executor: (OPTIONAL) The executor to run the blocking start and stop requests in. Default: The loop's
+                         default executor.
+        :param read_options: (OPTIONAL) raw, as_numpy or as_volts, as for read_async. zero_copy is not supported,
+                             since blocks outlive the callback.
+        """
+        assert overrun in OVERRUN_POLICIES, "Unknown overrun policy {}.".format(overrun)
+        assert max_buffered > 0, "max_buffered must be positive."
+        assert not read_options.get('zero_copy'), "zero_copy is not supported by streams."
+        self.scope = scope
+        self.data_size = data_size
+        self.max_buffered = max_buffered
+        self.overrun = overrun
+        self.outstanding_transfers = outstanding_transfers
+        self.executor = executor
+        self.read_options = read_options
+        self.shutdown_event = None
+        # Number of blocks received, and dropped (or, with STOP, refused) because the buffer was full.
+        self.received = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._blocks = collections.deque()
+        self._loop = None
+        self._waiter = None
+        self._overrun = False
+        self._closed = False
+
+    def _on_block(self, ch1_data, ch2_data):
+        """
+        The read_async callback, run on the USB event thread.
+        """
+        if self.read_options.get('raw'):
+            # Raw single channel iso blocks may point into the transfer buffer, which is reused on resubmission.
+            ch1_data, ch2_data = bytes(ch1_data), bytes(ch2_data)
+        with self._lock:
+            if self._closed or self._overrun:
+                return
+            self.received += 1
+            if len(self._blocks) >= self.max_buffered:
+                self.dropped += 1
+                if self.overrun == DROP_NEWEST:
+                    return
+                elif self.overrun == DROP_OLDEST:
+                    self._blocks.popleft()
+                    self._blocks.append((ch1_data, ch2_data))
+                else:
+                    self._overrun = True
+                    self.shutdown_event.set()
+            else:
+                self._blocks.append((ch1_data, ch2_data))
+            waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            self._loop.call_soon_threadsafe(_wake, waiter)
+
+    def _run_blocking(self, function, *args):
+        return self._loop.run_in_executor(self.executor, functools.partial(function, *args))
+
+    async def start(self):
+        """
+        Start the async read on the scope's event thread and start capturing. Called by the first iteration.
+        """
+        if self.shutdown_event is not None:
+            return
+        self._loop = asyncio.get_event_loop()
+        self.shutdown_event = self.scope.read_async(self._on_block, self.data_size,
+                                                    outstanding_transfers=self.outstanding_transfers,
+                                                    event_thread=True, **self.read_options)
+        await self._run_blocking(self.scope.start_capture)
+
+    async def aclose(self):
+        """
+        Stop the async read and the capture. Blocks still buffered are discarded.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._blocks.clear()
+            waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            _wake(waiter)
+        if self.shutdown_event is not None:
+            self.shutdown_event.set()
+            await self._run_blocking(self.scope.stop_capture)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.shutdown_event is None:
+            await self.start()
+        while True:
+            with self._lock:
+                if self._blocks:
+                    return self._blocks.popleft()
+                if self._closed:
+                    raise StopAsyncIteration
+                if self._overrun:
+                    raise OverrunError("Stream stopped after the consumer fell {} blocks behind.".format(
+                        self.max_buffered))
+                waiter = self._waiter = self._loop.create_future()
+            await waiter
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class AsyncOscilloscope(object):
+    """
+    Coroutine versions of the Oscilloscope control requests. They run in a single worker thread, so they never block
+    the event loop and are issued to the scope in order. Leaving an async with block closes the scope handle.
+    """
+    BLOCKING_METHODS = ('setup', 'open_handle', 'close_handle', 'flash_firmware', 'set_interface',
+                        'set_sample_rate', 'set_num_channels', 'set_ch1_voltage_range', 'set_ch2_voltage_range',
+                        'start_capture', 'stop_capture', 'read_data', 'get_calibration_values',
+                        'set_calibration_values', 'load_calibration', 'read_eeprom', 'write_eeprom')
+
+    def __init__(self, scope, executor=None):
+        """
+        :param scope: The Oscilloscope to control.
+        :param executor: (OPTIONAL) The executor to run the requests in. Default: A new single thread executor.
+        """
+        self.scope = scope
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=1)
+
+    def __getattr__(self, name):
+        if name not in self.BLOCKING_METHODS:
+            raise AttributeError(name)
+        method = getattr(self.scope, name)
+
+        async def run_in_executor(*args, **kwargs):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+        run_in_executor.__name__ = name
+        run_in_executor.__doc__ = method.__doc__
+        return run_in_executor
+
+    def stream(self, data_size, max_buffered=8, overrun=DROP_OLDEST, outstanding_transfers=3, **read_options):
+        """
+        Stream blocks from the scope, see AsyncStream.
+        :return: An AsyncStream, to use with async for (and optionally async with).
+        """
+        return AsyncStream(self.scope, data_size, max_buffered, overrun, outstanding_transfers, self.executor,
+                           **read_options)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close_handle()
+        self.executor.shutdown(wait=False)
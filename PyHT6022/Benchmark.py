@@ -0,0 +1,472 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# End-to-end acquisition benchmarks for the libusb Oscilloscope, against a real scope or a simulated one:
+#
+#     python -m PyHT6022.Benchmark --simulated --output results.json
+#     python -m PyHT6022.Benchmark --simulated --baseline results.json
+#
+# Every scenario records throughput, per-block latency percentiles, CPU time, allocations and gaps. The results are
+# written as JSON and can be compared against a stored baseline to catch regressions between versions.
+#
+# With --processing, the signal processing stages which run on the event thread are benchmarked as well, on
+# synthetic samples, each against the sample rate it has to keep up with, and so are recording to disk and the
+# realtime pacing of a replay.
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from PyHT6022.LibUsbScope import Oscilloscope, SampleConversion
+from PyHT6022.SimulatedScope import SimulatedUSBContext, SimulatedDevice
+
+# Conversion modes, as (name, read_data/build_data_reader/read_async keyword arguments).
+CONVERSIONS = [('raw', {'raw': True}),
+               ('array', {}),
+               ('numpy', {'as_numpy': True}),
+               ('volts', {'as_volts': True})]
+
+
+def percentile(sorted_values, fraction):
+    """
+    :param sorted_values: A sorted list of numbers.
+    :param fraction: The percentile as fraction, 0.0 - 1.0.
+    :return: The nearest rank percentile, or None for an empty list.
+    """
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def processing_stages(num_samples=1 << 22):
+    """
+    The signal processing stages which have to keep up with the scope, on synthetic samples. Requires NumPy. The stages
+    are built one at a time, so only the samples of one are kept in memory.
+    :param num_samples: (OPTIONAL) The number of samples (per channel) to process in each stage. Default: 4 Mi
+    :return: A generator of (name, sample rate to keep up with or None for latency only, samples per channel, function,
+             list of argument tuples, one call each) per stage.
+    """
+    import numpy as np
+    from PyHT6022.ChannelDelay import ChannelDelayEstimator
+    from PyHT6022.ChannelMath import ChannelMath
+    from PyHT6022.Envelope import EnvelopeDecimator
+    from PyHT6022.Filters import FIRFilter, SOSFilter, fir_lowpass, butterworth
+    from PyHT6022.Histogram import ADCHistogram
+    from PyHT6022.Measurements import WaveformMeasurements
+    from PyHT6022.Overview import OverviewWriter
+    from PyHT6022.Spectrum import SpectrumAnalyzer
+    from PyHT6022.Trigger import TriggerEngine, EdgeTrigger
+
+    rng = np.random.RandomState(0)
+    noise = rng.randint(0, 256, (2, num_samples)).astype(np.uint8)
+    interleaved = noise.T.ravel()
+
+    def channel_blocks(block_size, num_channels=2):
+        return [tuple(noise[:num_channels, start:start + block_size])
+                for start in range(0, num_samples, block_size)]
+
+    def interleaved_blocks(block_size):
+        return [(interleaved[start:start + block_size],) for start in range(0, len(interleaved), block_size)]
+
+    yield ('envelope', 24e6, num_samples, EnvelopeDecimator(1000, keep=False).feed, channel_blocks(0x8000))
+    overview = OverviewWriter(None, 2, num_samples)
+    yield ('overview', 24e6, num_samples, overview.feed_interleaved, interleaved_blocks(0x10000))
+    # Drawing a trace, zooming in by a factor of two at a time.
+    yield ('overview_query', None, 0, lambda start, stop: overview.query(start, stop, 1920),
+           [(1000, 1000 + (num_samples >> zoom)) for zoom in range(20)])
+    sine = np.round(128 + 100 * np.sin(2 * np.pi / 24 * np.arange(num_samples)) + rng.normal(0, 3, num_samples))
+    sine = np.clip(sine, 0, 255).astype(np.uint8)
+    yield ('spectrum', 24e6, num_samples, SpectrumAnalyzer(24e6, fft_size=4096).feed,
+           [(sine[start:start + 0x10000],) for start in range(0, num_samples, 0x10000)])
+    engine = TriggerEngine(EdgeTrigger(128, hysteresis=4), pre_trigger=1000, post_trigger=3000, num_channels=1,
+                           holdoff=0)
+    yield ('trigger', 24e6, num_samples, engine.feed,
+           [(sine[start:start + 0x10000],) for start in range(0, num_samples, 0x10000)])
+    pulses = np.where(np.arange(num_samples) % 240 < 100, 200, 60).astype(np.uint8)
+    yield ('measurements', 24e6, num_samples, WaveformMeasurements(sample_rate=24e6).feed,
+           [(pulses[start:start + 0x10000],) for start in range(0, num_samples, 0x10000)])
+    yield ('filter_fir', 24e6, num_samples, FIRFilter(fir_lowpass(1e6, 24e6, 101), volts_per_count=0.01).feed,
+           channel_blocks(0x10000, 1))
+    yield ('filter_iir', 16e6, num_samples, SOSFilter(butterworth(6, 1e6, 16e6), volts_per_count=0.01).feed,
+           channel_blocks(0x10000, 1))
+    out = np.empty(0x8000, dtype=np.float32)
+    math = ChannelMath('CH1 * CH2')
+    yield ('channel_math', 24e6, num_samples, lambda data: math.convert(data, out=out), interleaved_blocks(0x10000))
+    estimator = ChannelDelayEstimator(16e6, fft_size=4096)
+    yield ('channel_delay', 16e6, num_samples, estimator.feed, channel_blocks(0x8000))
+    yield ('channel_delay_estimate', None, 0, estimator.delay, [()])
+    yield ('histogram', 24e6, num_samples, ADCHistogram(24e6, window=0.1).feed, channel_blocks(0x20000))
+
+
+def gc_collections():
+    return sum(generation['collections'] for generation in gc.get_stats()) if hasattr(gc, 'get_stats') else 0
+
+
+class AcquisitionBenchmark(object):
+    def __init__(self, scope, duration=1.0, trace_allocations=False):
+        """
+        :param scope: An Oscilloscope with an open handle and firmware loaded.
+        :param duration: (OPTIONAL) Seconds to run each async scenario for. Default: 1.0
+        :param trace_allocations: (OPTIONAL) Trace Python memory allocations with tracemalloc. This slows everything
+                                  down, but gives the allocated bytes per scenario. Default: Off
+        """
+        self.scope = scope
+        self.duration = duration
+        self.trace_allocations = trace_allocations and tracemalloc is not None
+        self.results = []
+
+    def gap_count(self, tracker_before):
+        """
+        :param tracker_before: The gap_tracker of the scope before the scenario.
+        :return: The number of gaps in the samples of the scenario, from the gap tracker of its async read, or None
+                 if it did not read asynchronously (the synchronous reads do not know about gaps).
+        """
+        tracker = self.scope.gap_tracker
+        return None if tracker is None or tracker is tracker_before else len(tracker.gaps)
+
+    def measure(self, name, parameters, run):
+        """
+        Run one scenario and record its result.
+        :param name: The scenario name, which identifies it when comparing with a baseline.
+        :param parameters: A dict describing the scenario.
+        :param run: A function running the scenario, returning (bytes transferred, list of per block latencies).
+        :return: The result dict.
+        """
+        gc.collect()
+        if self.trace_allocations:
+            tracemalloc.start()
+        tracker_before = self.scope.gap_tracker
+        collections_before = gc_collections()
+        cpu_start, wall_start = time.process_time(), time.time()
+        num_bytes, latencies = run()
+        cpu_time, wall_time = time.process_time() - cpu_start, time.time() - wall_start
+        result = {'name': name,
+                  'parameters': parameters,
+                  'bytes': num_bytes,
+                  'blocks': len(latencies),
+                  'wall_time': wall_time,
+                  'cpu_time': cpu_time,
+                  'cpu_load': cpu_time / wall_time if wall_time else None,
+                  'throughput_mb_s': num_bytes / wall_time / 1e6 if wall_time else None,
+                  'gc_collections': gc_collections() - collections_before,
+                  'gaps': self.gap_count(tracker_before)}
+        latencies = sorted(latencies)
+        for label, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)):
+            value = percentile(latencies, fraction)
+            result['latency_{}_ms'.format(label)] = None if value is None else value * 1e3
+        if self.trace_allocations:
+            _, result['allocated_peak_bytes'] = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        self.results.append(result)
+        return result
+
+    def prepare(self, num_channels, alt):
+        """
+        Configure the scope for a scenario and do a short warm-up read, so that settling after the change is not
+        measured.
+        """
+        scope = self.scope
+        scope.set_interface(0)
+        scope.set_num_channels(num_channels)
+        scope.read_data(0x400, raw=True)
+        scope.set_interface(alt)
+
+    def run_read_data(self, data_size, num_channels, conversion, iterations=20):
+        """
+        Benchmark read_data, which starts and stops a capture for every read.
+        """
+        name, options = conversion
+        scope = self.scope
+        self.prepare(num_channels, 0)
+
+        def run():
+            latencies = []
+            for _ in range(iterations):
+                start = time.time()
+                scope.read_data(data_size, **options)
+                latencies.append(time.time() - start)
+            return iterations * data_size * num_channels, latencies
+        return self.measure('read_data/{}/{}ch/{:x}'.format(name, num_channels, data_size),
+                            {'method': 'read_data', 'conversion': name, 'num_channels': num_channels,
+                             'data_size': data_size}, run)
+
+    def run_data_reader(self, data_size, num_channels, conversion, iterations=20):
+        """
+        Benchmark the closure from build_data_reader, reading from a running capture.
+        """
+        name, options = conversion
+        scope = self.scope
+        self.prepare(num_channels, 0)
+        reader = scope.build_data_reader(**options)
+
+        def run():
+            latencies = []
+            scope.start_capture()
+            for _ in range(iterations):
+                start = time.time()
+                reader(data_size)
+                latencies.append(time.time() - start)
+            scope.stop_capture()
+            return iterations * data_size * num_channels, latencies
+        return self.measure('build_data_reader/{}/{}ch/{:x}'.format(name, num_channels, data_size),
+                            {'method': 'build_data_reader', 'conversion': name, 'num_channels': num_channels,
+                             'data_size': data_size}, run)
+
+    def run_read_async(self, iso, data_size, num_channels, conversion, outstanding_transfers, zero_copy=False):
+        """
+        Benchmark read_async for self.duration seconds, polling from this thread.
+        """
+        name, options = conversion
+        scope = self.scope
+        self.prepare(num_channels, 1 if iso else 0)
+
+        def run():
+            counters = {'bytes': 0, 'last': None}
+            latencies = []
+
+            def callback(ch1_data, ch2_data):
+                now = time.time()
+                counters['bytes'] += len(ch1_data) + len(ch2_data)
+                if counters['last'] is not None:
+                    latencies.append(now - counters['last'])
+                counters['last'] = now
+
+            shutdown_event = scope.read_async(callback, data_size, outstanding_transfers=outstanding_transfers,
+                                              zero_copy=zero_copy, **options)
+            scope.start_capture()
+            start = time.time()
+            while time.time() - start < self.duration:
+                scope.poll()
+            shutdown_event.set()
+            scope.poll()
+            scope.stop_capture()
+            return counters['bytes'], latencies
+        return self.measure('read_async/{}/{}{}/{}ch/ot{}'.format('iso' if iso else 'bulk', name,
+                                                                  '/zero_copy' if zero_copy else '', num_channels,
+                                                                  outstanding_transfers),
+                            {'method': 'read_async', 'iso': iso, 'conversion': name, 'zero_copy': zero_copy,
+                             'num_channels': num_channels, 'data_size': data_size,
+                             'outstanding_transfers': outstanding_transfers}, run)
+
+    def run_record(self, num_channels=1, file_format='raw'):
+        """
+        Benchmark recording to a file with CaptureRecorder for self.duration seconds, from the iso interface.
+        """
+        from PyHT6022.CaptureRecorder import CaptureRecorder
+        scope = self.scope
+        self.prepare(num_channels, 1)
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'capture.' + {'wav': 'wav', 'capture': 'ht6022'}.get(file_format, 'raw'))
+        # Room for twice the samples the scope delivers in the time.
+        max_samples = int(2 * self.duration * scope.sample_rate_hz(scope.sample_rate_index))
+
+        def run():
+            recorder = CaptureRecorder(scope, filename, max_samples, file_format)
+            recorder.record(self.duration)
+            return recorder.written, []
+        try:
+            return self.measure('record/{}/{}ch'.format(file_format, num_channels),
+                                {'method': 'record', 'file_format': file_format, 'num_channels': num_channels}, run)
+        finally:
+            shutil.rmtree(directory)
+
+    def run_replay(self, sample_rate_index=0x14, num_channels=2, data_size=0x2000):
+        """
+        Benchmark the realtime pacing of a looped Replay for self.duration seconds. It is read from its own scope,
+        the result says how close the replay came to the sample rate of the recording (pace 1.0).
+        """
+        from PyHT6022.Replay import replay_scope
+        sample_rate = Oscilloscope.sample_rate_hz(sample_rate_index)
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'capture.raw')
+        # A tenth of a second of samples, which loops.
+        with open(filename, 'wb') as f:
+            f.write(bytearray(i & 0xff for i in range(int(sample_rate / 10) * num_channels)))
+        replay = replay_scope(filename, realtime=True, loop=True, num_channels=num_channels,
+                              sample_rate_index=sample_rate_index)
+
+        def run():
+            counters = {'last': None}
+            latencies = []
+
+            def callback(data, _):
+                now = time.time()
+                if counters['last'] is not None:
+                    latencies.append(now - counters['last'])
+                counters['last'] = now
+
+            shutdown_event = replay.read_async(callback, data_size, interleaved=True)
+            replay.start_capture()
+            start = time.time()
+            while time.time() - start < self.duration:
+                replay.poll()
+            shutdown_event.set()
+            replay.poll()
+            replay.stop_capture()
+            return replay.gap_tracker.received_bytes, latencies
+        try:
+            result = self.measure('replay/realtime/{}ch/{:x}'.format(num_channels, sample_rate_index),
+                                  {'method': 'replay', 'sample_rate': sample_rate, 'num_channels': num_channels,
+                                   'data_size': data_size}, run)
+        finally:
+            replay.close_handle()
+            shutil.rmtree(directory)
+        # The gaps of the replay are counted by its own scope.
+        result['gaps'] = len(replay.gap_tracker.gaps)
+        result['samples_per_s'] = result['bytes'] / num_channels / result['wall_time'] if result['wall_time'] else None
+        result['pace'] = None if result['samples_per_s'] is None else result['samples_per_s'] / sample_rate
+        return result
+
+    def run_processing(self, name, sample_rate, num_samples, function, arguments):
+        """
+        Benchmark a signal processing stage, see processing_stages. The result says whether the stage keeps up with
+        its sample rate.
+        """
+        def run():
+            num_bytes = 0
+            latencies = []
+            for args in arguments:
+                start = time.time()
+                function(*args)
+                latencies.append(time.time() - start)
+                num_bytes += sum(getattr(arg, 'nbytes', 0) for arg in args)
+            return num_bytes, latencies
+        result = self.measure('processing/' + name, {'method': 'processing', 'stage': name,
+                                                     'sample_rate': sample_rate, 'num_samples': num_samples}, run)
+        result['samples_per_s'] = num_samples / result['wall_time'] if num_samples and result['wall_time'] else None
+        result['keeps_up'] = None if sample_rate is None or result['samples_per_s'] is None else \
+            result['samples_per_s'] >= sample_rate
+        return result
+
+    def run_all(self, data_sizes=(0x8000, 0x100000), outstanding_transfers=(3, 10), async_data_size=6 * 1024 * 8):
+        """
+        Run the full matrix of scenarios.
+        :return: The list of result dicts.
+        """
+        conversions = [conversion for conversion in CONVERSIONS
+                       if SampleConversion is not None or conversion[0] in ('raw', 'array')]
+        channel_counts = (1, 2) if self.scope.supports_single_channel else (2,)
+        for num_channels in channel_counts:
+            for conversion in conversions:
+                for data_size in data_sizes:
+                    self.run_read_data(data_size, num_channels, conversion)
+                    self.run_data_reader(data_size, num_channels, conversion)
+                for iso in (False, True):
+                    for transfers in outstanding_transfers:
+                        self.run_read_async(iso, async_data_size, num_channels, conversion, transfers)
+                    self.run_read_async(iso, async_data_size, num_channels, conversion, outstanding_transfers[-1],
+                                        zero_copy=True)
+        return self.results
+
+    def run_all_processing(self, num_samples=1 << 22):
+        """
+        Run recording, realtime replay and every signal processing stage.
+        :return: The list of result dicts.
+        """
+        self.run_record()
+        self.run_replay()
+        for stage in processing_stages(num_samples):
+            self.run_processing(*stage)
+        return self.results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compare benchmark results with a baseline run.
+    :param results: The current result dicts.
+    :param baseline: The baseline result dicts.
+    :param tolerance: (OPTIONAL) The relative throughput drop that counts as regression. Default: 0.1 (10%)
+    :return: A list of (name, baseline MB/s, current MB/s, relative change, regressed) tuples for the scenarios in
+             both runs.
+    """
+    baseline_by_name = dict((result['name'], result) for result in baseline)
+    comparison = []
+    for result in results:
+        base = baseline_by_name.get(result['name'])
+        if not base or not base['throughput_mb_s'] or result['throughput_mb_s'] is None:
+            continue
+        change = result['throughput_mb_s'] / base['throughput_mb_s'] - 1.0
+        comparison.append((result['name'], base['throughput_mb_s'], result['throughput_mb_s'], change,
+                           change < -tolerance))
+    return comparison
+
+
+def build_scope(simulated=False, realtime=False, sample_rate_index=24):
+    """
+    Open the scope to benchmark, flashing the firmware if needed.
+    """
+    if simulated:
+        scope = Oscilloscope(context=SimulatedUSBContext(SimulatedDevice(firmware_loaded=True, realtime=realtime)))
+    else:
+        scope = Oscilloscope()
+    assert scope.setup(), "No scope found."
+    scope.open_handle()
+    if not scope.is_device_firmware_present:
+        scope.flash_firmware()
+    else:
+        scope.supports_single_channel = True
+    scope.set_sample_rate(sample_rate_index)
+    return scope
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Hantek 6022BE acquisition paths.')
+    parser.add_argument('--simulated', action='store_true', help='Use a simulated scope instead of hardware.')
+    parser.add_argument('--realtime', action='store_true', help='Pace the simulated scope by its sample rate.')
+    parser.add_argument('--sample-rate', type=int, default=24, help='Sample rate index. Default: 24')
+    parser.add_argument('--duration', type=float, default=1.0, help='Seconds per async scenario. Default: 1.0')
+    parser.add_argument('--trace-allocations', action='store_true', help='Trace allocations with tracemalloc.')
+    parser.add_argument('--processing', action='store_true',
+                        help='Also benchmark recording, replay and the signal processing stages (requires NumPy).')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare against the results in this JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative slowdown counted as regression.')
+    args = parser.parse_args(argv)
+
+    scope = build_scope(args.simulated, args.realtime, args.sample_rate)
+    benchmark = AcquisitionBenchmark(scope, duration=args.duration, trace_allocations=args.trace_allocations)
+    try:
+        benchmark.run_all()
+        if args.processing:
+            benchmark.run_all_processing()
+    finally:
+        scope.close_handle()
+    for result in benchmark.results:
+        print("{:<48} {:>10.2f} MB/s  p99 {:>8.3f} ms  cpu {:>5.0%}  gaps {}{}".format(
+            result['name'], result['throughput_mb_s'] or 0.0, result['latency_p99_ms'] or 0.0,
+            result['cpu_load'] or 0.0, result['gaps'], '  TOO SLOW' if result.get('keeps_up') is False else ''))
+
+    report = {'python': sys.version,
+              'platform': platform.platform(),
+              'simulated': args.simulated,
+              'sample_rate_index': args.sample_rate,
+              'timestamp': time.time(),
+              'results': benchmark.results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    regressions = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        print("-" * 40)
+        for name, base, current, change, regressed in compare(benchmark.results, baseline, args.tolerance):
+            regressions += regressed
+            print("{:<48} {:>10.2f} -> {:>10.2f} MB/s ({:+.1%}){}".format(name, base, current, change,
+                                                                         '  REGRESSION' if regressed else ''))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
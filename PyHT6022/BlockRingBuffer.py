@@ -0,0 +1,113 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+import threading
+import time
+
+
+class BufferOverrunError(Exception):
+    """
+    Raised by Oscilloscope.iter_blocks when the consumer fell behind and samples had to be dropped.
+    """
+
+
+class BlockRingBuffer(object):
+    """
+    A preallocated ring buffer between the USB event thread (writing whatever the transfers return) and a consumer
+    reading fixed size blocks. Nothing is allocated per block: the consumer gets memoryviews into the ring, and the
+    writer never waits. If the ring is full, the incoming data is dropped and recorded in overrun_log instead of
+    growing the buffer.
+    """
+
+    def __init__(self, block_size, num_blocks):
+        """
+        :param block_size: The size of the blocks handed to the consumer, in bytes.
+        :param num_blocks: The number of blocks the ring holds.
+        """
+        assert block_size > 0 and num_blocks > 1, "The ring must hold at least two blocks."
+        self.block_size = block_size
+        self.capacity = block_size * num_blocks
+        self.buffer = bytearray(self.capacity)
+        self.view = memoryview(self.buffer)
+        self.condition = threading.Condition()
+        # Absolute byte positions. The consumer owns [read_position, read_position + block_size) while it looks at
+        # its current block, the writer owns everything from write_position up to the next unread byte.
+        self.write_position = 0
+        self.read_position = 0
+        self.holding = False
+        self.closed = False
+        # (write position, bytes dropped there) for every overrun, oldest first.
+        self.overrun_log = []
+        self.overruns = 0
+        self.dropped_bytes = 0
+        self._next_overrun = 0
+
+    def write(self, data):
+        """
+        Append data to the ring, run on the USB event thread.
+        :param data: A buffer (e.g. a memoryview of a completed transfer).
+        :return: True if the data was stored, False if it was dropped because the consumer is behind.
+        """
+        length = len(data)
+        with self.condition:
+            if self.closed:
+                return False
+            if length > self.capacity - (self.write_position - self.read_position):
+                self.overruns += 1
+                self.dropped_bytes += length
+                if self.overrun_log and self.overrun_log[-1][0] == self.write_position:
+                    self.overrun_log[-1] = (self.write_position, self.overrun_log[-1][1] + length)
+                else:
+                    self.overrun_log.append((self.write_position, length))
+                self.condition.notify()
+                return False
+            position = self.write_position
+        # The consumer never reads past write_position, so this region can be filled without holding the lock.
+        start = position % self.capacity
+        first = min(length, self.capacity - start)
+        self.view[start:start + first] = data[:first]
+        if first < length:
+            self.view[:length - first] = data[first:]
+        with self.condition:
+            self.write_position = position + length
+            self.condition.notify()
+        return True
+
+    def read_block(self, timeout=None):
+        """
+        Release the previous block and wait for the next one.
+        :param timeout: (OPTIONAL) The longest time to wait, in seconds. Default: Wait until a block is ready.
+        :return: (block, dropped bytes) with a memoryview of the block, valid until the next call, and the number of
+                 bytes dropped right before or inside it (0 if the block holds contiguous samples). (None, 0) if the
+                 ring was closed, or the timeout expired.
+        """
+        block_size = self.block_size
+        with self.condition:
+            if self.holding:
+                self.read_position += block_size
+                self.holding = False
+            deadline = None if timeout is None else time.time() + timeout
+            while not self.closed and self.write_position - self.read_position < block_size:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None, 0
+                self.condition.wait(remaining)
+            if self.write_position - self.read_position < block_size:
+                return None, 0
+            position = self.read_position
+            dropped = 0
+            # Report the overruns which happened inside this block (or before it).
+            while (self._next_overrun < len(self.overrun_log) and
+                   self.overrun_log[self._next_overrun][0] < position + block_size):
+                dropped += self.overrun_log[self._next_overrun][1]
+                self._next_overrun += 1
+            self.holding = True
+        start = position % self.capacity
+        return self.view[start:start + block_size], dropped
+
+    def close(self):
+        """
+        Stop accepting data and wake up the consumer. Blocks already complete can still be read.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
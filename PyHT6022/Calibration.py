@@ -0,0 +1,90 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# The 6022BE keeps 32 bytes of calibration data in its EEPROM (see Oscilloscope.CALIBRATION_EEPROM_OFFSET).
+# They are the ADC counts the scope reads with its input at 0V, one byte per channel, for each of the 8 gain steps
+# of the stock software (20mV/div ... 5V/div), first for the normal sample rates and then for the fast ones:
+#
+#     byte  0 -  15: [gain step 0 CH1, gain step 0 CH2, gain step 1 CH1, ..., gain step 7 CH2], normal sample rates
+#     byte 16 -  31: the same, for the fast sample rates (30 MS/s and up)
+#
+# A perfectly centered channel reads 128. Bytes reading 0x00 or 0xff were never programmed and are ignored.
+
+
+class CalibrationModel(object):
+    # The voltage range index (as given to set_ch1_voltage_range) used for each gain step of the stock software.
+    GAIN_STEP_RANGES = (0x0a, 0x0a, 0x0a, 0x05, 0x02, 0x01, 0x01, 0x01)
+    # Sample rate indexes which use the second half of the calibration block.
+    FAST_SAMPLE_RATES = (30, 48)
+    UNPROGRAMMED_VALUES = (0x00, 0xff)
+
+    def __init__(self, offsets=None, gains=None):
+        """
+        :param offsets: (OPTIONAL) A dict of {(channel, voltage_range, fast): offset} zero offsets in ADC counts.
+        :param gains: (OPTIONAL) A dict of {(channel, voltage_range): gain} gain correction factors. The EEPROM block
+                      holds no gain information, so these default to 1.0 unless set with set_gain.
+        """
+        self.offsets = offsets or {}
+        self.gains = gains or {}
+
+    @classmethod
+    def from_eeprom(cls, cal_values):
+        """
+        Decode the calibration block read from the scope EEPROM.
+        :param cal_values: The 32 calibration values, as returned by Oscilloscope.get_calibration_values.
+        :return: A CalibrationModel with the zero offsets of both channels for every voltage range.
+        """
+        cal_values = bytearray(cal_values)
+        assert len(cal_values) == 32, "Expected 32 calibration bytes, got {}.".format(len(cal_values))
+        offsets = {}
+        for fast in (False, True):
+            for step, voltage_range in enumerate(cls.GAIN_STEP_RANGES):
+                for channel in (1, 2):
+                    key = (channel, voltage_range, fast)
+                    value = cal_values[16 * fast + 2 * step + channel - 1]
+                    # Several gain steps share one voltage range, the first programmed one wins.
+                    if key not in offsets and value not in cls.UNPROGRAMMED_VALUES:
+                        offsets[key] = value - 128
+        return cls(offsets)
+
+    def offset(self, channel, voltage_range, sample_rate_index=None):
+        """
+        :param channel: The channel, 1 or 2.
+        :param voltage_range: The voltage range index set on the channel.
+        :param sample_rate_index: (OPTIONAL) The sample rate index set on the scope. Default: a normal sample rate.
+        :return: The zero offset of the channel in ADC counts, 0 if it is not calibrated.
+        """
+        fast = sample_rate_index in self.FAST_SAMPLE_RATES
+        return self.offsets.get((channel, voltage_range, fast), 0)
+
+    def gain(self, channel, voltage_range):
+        """
+        :param channel: The channel, 1 or 2.
+        :param voltage_range: The voltage range index set on the channel.
+        :return: The gain correction factor of the channel, 1.0 if it is not calibrated.
+        """
+        return self.gains.get((channel, voltage_range), 1.0)
+
+    def set_gain(self, channel, voltage_range, gain):
+        """
+        Set the gain correction for a channel and voltage range, e.g. measured against a reference voltage.
+        :param channel: The channel, 1 or 2.
+        :param voltage_range: The voltage range index set on the channel.
+        :param gain: The factor to multiply the (offset corrected) voltages with.
+        """
+        self.gains[(channel, voltage_range)] = gain
+
+    def conversion_table(self, channel, voltage_range, sample_rate_index=None, probe_multiplier=1, dtype='float32'):
+        """
+        Look up the conversion table of a channel with its offset and gain correction folded in, so corrected
+        voltages cost no more than uncorrected ones. Requires NumPy.
+        :param channel: The channel, 1 or 2.
+        :param voltage_range: The voltage range index set on the channel.
+        :param sample_rate_index: (OPTIONAL) The sample rate index set on the scope. Default: a normal sample rate.
+        :param probe_multiplier: (OPTIONAL) An additional multiplicative factor for the probe. Default: 1
+        :param dtype: (OPTIONAL) The float type of the table. Default: float32
+        :return: A read-only array of 256 corrected voltages, indexed by ADC count.
+        """
+        from PyHT6022 import SampleConversion
+        return SampleConversion.conversion_table(voltage_range, probe_multiplier, dtype,
+                                                 offset=self.offset(channel, voltage_range, sample_rate_index),
+                                                 gain=self.gain(channel, voltage_range))
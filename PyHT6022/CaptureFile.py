@@ -0,0 +1,307 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# A chunked capture container, which keeps the metadata raw and WAV files lose, and can be read at any time offset
+# without reading the whole file. All numbers are little endian.
+#
+#     file header    64 bytes: magic "HT6022CF", version, channels, samples per chunk, index offset (0 while writing)
+#     chunk 0        64 byte chunk header + samples per chunk * channels bytes of interleaved ADC counts
+#     chunk 1        ...
+#     index          magic "HTINDEX\0", number of chunks, then (start sample, samples, flags) per chunk
+#
+# Chunks are fixed size, so chunk n starts at byte 64 + n * chunk size. Each chunk header holds the absolute index of
+# its first sample, the host time it was received at, and the scope settings it was captured with. Samples within a
+# chunk are always contiguous: a gap in the capture closes the chunk early (partial chunks are padded), and the next
+# chunk records the number of missing samples. Files which were never closed have no index, but can still be read by
+# scanning the chunk headers.
+
+import struct
+import time
+
+import numpy as np
+
+FILE_MAGIC = b'HT6022CF'
+INDEX_MAGIC = b'HTINDEX\x00'
+CHUNK_MAGIC = b'CHNK'
+VERSION = 1
+FILE_HEADER = struct.Struct('<8sHHIQ')
+FILE_HEADER_SIZE = 64
+CHUNK_HEADER = struct.Struct('<4sHHQIIddBBB')
+CHUNK_HEADER_SIZE = 64
+INDEX_HEADER = struct.Struct('<8sQ')
+INDEX_ENTRY = struct.Struct('<QII')
+
+# Chunk flags.
+GAP_BEFORE = 0x01  # Samples are missing between the previous chunk and this one.
+PARTIAL = 0x02     # The chunk holds fewer than samples per chunk, the rest is padding.
+
+# The chunk header as NumPy record, to decode all headers of a file at once.
+CHUNK_HEADER_DTYPE = np.dtype({'names': ['magic', 'flags', 'num_channels', 'start_sample', 'num_samples',
+                                         'missing_samples', 'timestamp', 'sample_rate', 'sample_rate_index',
+                                         'ch1_voltage_range', 'ch2_voltage_range'],
+                               'formats': ['S4', '<u2', '<u2', '<u8', '<u4', '<u4', '<f8', '<f8', 'u1', 'u1', 'u1'],
+                               'offsets': [0, 4, 6, 8, 16, 20, 24, 32, 40, 41, 42],
+                               'itemsize': CHUNK_HEADER_SIZE})
+# The index entries as NumPy record, to read the index of a closed file at once.
+INDEX_ENTRY_DTYPE = np.dtype([('start_sample', '<u8'), ('num_samples', '<u4'), ('flags', '<u4')])
+
+
+class CaptureFileWriter(object):
+    """
+    Writes a capture file, one chunk at a time. Only one chunk is kept in memory.
+    """
+
+    def __init__(self, filename, num_channels=2, chunk_samples=1 << 18, sample_rate=0.0, sample_rate_index=0,
+                 voltage_ranges=(0x01, 0x01)):
+        """
+        :param filename: The file to write to. It is overwritten.
+        :param num_channels: (OPTIONAL) The number of interleaved channels. Default: 2
+        :param chunk_samples: (OPTIONAL) The number of samples (per channel) in each chunk. Default: 256 Ki
+        :param sample_rate: (OPTIONAL) The sample rate per channel, in samples per second. Default: Unknown (0)
+        :param sample_rate_index: (OPTIONAL) The sample rate index set on the scope. Default: Unknown (0)
+        :param voltage_ranges: (OPTIONAL) The voltage range indexes of CH1 and CH2. Default: (0x01, 0x01)
+        """
+        self.num_channels = num_channels
+        self.chunk_samples = chunk_samples
+        self.chunk_bytes = chunk_samples * num_channels
+        self.sample_rate = sample_rate
+        self.sample_rate_index = sample_rate_index
+        self.voltage_ranges = tuple(voltage_ranges)
+        self.next_sample = 0
+        self.index = []
+        self._file = open(filename, 'wb')
+        self._file.write(FILE_HEADER.pack(FILE_MAGIC, VERSION, num_channels, chunk_samples, 0).ljust(FILE_HEADER_SIZE,
+                                                                                                    b'\x00'))
+        self._chunk = bytearray(CHUNK_HEADER_SIZE + self.chunk_bytes)
+        self._chunk_view = memoryview(self._chunk)
+        self._fill = 0
+        self._chunk_start = 0
+        self._chunk_timestamp = None
+        self._missing = 0
+
+    @classmethod
+    def from_scope(cls, scope, filename, chunk_samples=1 << 18):
+        """
+        Create a writer with the current settings of an Oscilloscope.
+        """
+        return cls(filename, scope.num_channels, chunk_samples, scope.sample_rate_hz(scope.sample_rate_index),
+                   scope.sample_rate_index, (scope.ch1_voltage_range, scope.ch2_voltage_range))
+
+    def update_settings(self, sample_rate=None, sample_rate_index=None, voltage_ranges=None):
+        """
+        Record changed scope settings. They apply from the next chunk on, so call this at a gap or chunk boundary.
+        """
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if sample_rate_index is not None:
+            self.sample_rate_index = sample_rate_index
+        if voltage_ranges is not None:
+            self.voltage_ranges = tuple(voltage_ranges)
+
+    def write(self, data, sample_offset=None, timestamp=None):
+        """
+        Append interleaved samples.
+        :param data: The raw interleaved ADC counts, as anything supporting the buffer protocol.
+        :param sample_offset: (OPTIONAL) The absolute index of the first sample, e.g. from read_async with
+                              sample_offsets. If it is past the end of the previous data, the samples in between are
+                              recorded as gap. Default: Right after the previous data.
+        :param timestamp: (OPTIONAL) The host time the data was received at. Default: Now
+        """
+        data = memoryview(data)
+        length = len(data)
+        assert length % self.num_channels == 0, "Partial samples can not be written."
+        if sample_offset is not None and sample_offset != self.next_sample:
+            assert sample_offset > self.next_sample, "Samples can only be appended."
+            if self._fill:
+                self._flush_chunk()
+            self._missing += sample_offset - self.next_sample
+            self.next_sample = sample_offset
+        position = 0
+        while position < length:
+            if not self._fill:
+                self._chunk_start = self.next_sample
+                self._chunk_timestamp = time.time() if timestamp is None else timestamp
+            count = min(length - position, self.chunk_bytes - self._fill)
+            start = CHUNK_HEADER_SIZE + self._fill
+            self._chunk_view[start:start + count] = data[position:position + count]
+            self._fill += count
+            position += count
+            self.next_sample += count // self.num_channels
+            if self._fill == self.chunk_bytes:
+                self._flush_chunk()
+
+    def _flush_chunk(self):
+        num_samples = self._fill // self.num_channels
+        flags = (GAP_BEFORE if self._missing else 0) | (PARTIAL if num_samples < self.chunk_samples else 0)
+        CHUNK_HEADER.pack_into(self._chunk, 0, CHUNK_MAGIC, flags, self.num_channels, self._chunk_start, num_samples,
+                               self._missing, self._chunk_timestamp, self.sample_rate, self.sample_rate_index,
+                               self.voltage_ranges[0], self.voltage_ranges[1])
+        if num_samples < self.chunk_samples:
+            # Pad with the midscale value (0V), so the padding is harmless when looking at whole chunks.
+            self._chunk_view[CHUNK_HEADER_SIZE + self._fill:] = b'\x80' * (self.chunk_bytes - self._fill)
+        self._file.write(self._chunk)
+        self.index.append((self._chunk_start, num_samples, flags))
+        self._fill = 0
+        self._missing = 0
+
+    def close(self):
+        """
+        Write the last (partial) chunk and the index.
+        """
+        if self._file is None:
+            return
+        if self._fill:
+            self._flush_chunk()
+        index_offset = self._file.tell()
+        self._file.write(INDEX_HEADER.pack(INDEX_MAGIC, len(self.index)))
+        self._file.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in self.index))
+        self._file.seek(0)
+        self._file.write(FILE_HEADER.pack(FILE_MAGIC, VERSION, self.num_channels, self.chunk_samples, index_offset))
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CaptureFileReader(object):
+    """
+    Memory maps a capture file. Sample ranges are returned as NumPy views into the map whenever they lie within one
+    chunk, nothing is read until it is used.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: The capture file to read.
+        """
+        self.filename = filename
+        self.map = np.memmap(filename, dtype=np.uint8, mode='r')
+        magic, version, num_channels, chunk_samples, index_offset = FILE_HEADER.unpack_from(self.map, 0)
+        assert magic == FILE_MAGIC, "{} is not a capture file.".format(filename)
+        assert version == VERSION, "Unsupported capture file version {}.".format(version)
+        self.num_channels = num_channels
+        self.chunk_samples = chunk_samples
+        chunk_dtype = np.dtype([('header', CHUNK_HEADER_DTYPE),
+                                ('data', np.uint8, (chunk_samples, num_channels))])
+        end = index_offset or len(self.map)
+        num_chunks = (end - FILE_HEADER_SIZE) // chunk_dtype.itemsize
+        self.chunks = np.ndarray((num_chunks,), chunk_dtype, self.map, FILE_HEADER_SIZE)
+        if index_offset:
+            # Closed: the index has the layout of all chunks, so no chunk header is read until it is used.
+            index_magic, num_chunks = INDEX_HEADER.unpack_from(self.map, index_offset)
+            assert index_magic == INDEX_MAGIC, "{} has a broken index.".format(filename)
+            index = np.ndarray((num_chunks,), INDEX_ENTRY_DTYPE, self.map, index_offset + INDEX_HEADER.size)
+            self.chunks = self.chunks[:num_chunks]
+        else:
+            # Never closed: scan the chunk headers and keep the chunks which were written completely.
+            valid = self.chunks['header']['magic'] == CHUNK_MAGIC
+            num_chunks = int(np.argmin(valid)) if not valid.all() else num_chunks
+            self.chunks = self.chunks[:num_chunks]
+            index = self.chunks['header']
+        self.headers = self.chunks['header']
+        # (num_chunks, chunk_samples, num_channels) views of all samples.
+        self.data = self.chunks['data']
+        self.start_samples = index['start_sample'].astype(np.int64)
+        self.num_samples = index['num_samples'].astype(np.int64)
+        self.flags = index['flags'].astype(np.uint32)
+        self.contiguous = bool(num_chunks == 0 or (
+            np.all(self.start_samples == np.arange(num_chunks) * chunk_samples) and
+            np.all(self.num_samples[:-1] == chunk_samples)))
+
+    def __len__(self):
+        """
+        :return: The number of chunks.
+        """
+        return len(self.chunks)
+
+    @property
+    def end_sample(self):
+        """
+        :return: The absolute index after the last sample.
+        """
+        return int(self.start_samples[-1] + self.num_samples[-1]) if len(self.chunks) else 0
+
+    def chunk_index(self, sample_index):
+        """
+        Find the chunk holding a sample, in O(1) for files without gaps.
+        :param sample_index: The absolute sample index.
+        :return: The chunk number, or -1 if the sample is in a gap or outside the capture.
+        """
+        if self.contiguous:
+            chunk = sample_index // self.chunk_samples
+        else:
+            chunk = int(np.searchsorted(self.start_samples, sample_index, side='right')) - 1
+        if 0 <= chunk < len(self.chunks) and sample_index < self.start_samples[chunk] + self.num_samples[chunk]:
+            return chunk
+        return -1
+
+    def read(self, start, stop, fill=128):
+        """
+        :param start: The absolute index of the first sample.
+        :param stop: The absolute index after the last sample.
+        :param fill: (OPTIONAL) The value for samples in gaps. Default: 128 (0V)
+        :return: A (num_channels, stop - start) uint8 array. It is a read-only view into the file if the range lies
+                 within one chunk, otherwise a copy.
+        """
+        chunk = self.chunk_index(start)
+        if chunk >= 0 and stop <= self.start_samples[chunk] + self.num_samples[chunk]:
+            offset = start - self.start_samples[chunk]
+            return self.data[chunk, offset:offset + stop - start].T
+        samples = np.full((self.num_channels, stop - start), fill, dtype=np.uint8)
+        for chunk_start, chunk_samples in self.iter_chunks(start, stop):
+            samples[:, chunk_start - start:chunk_start - start + chunk_samples.shape[1]] = chunk_samples
+        return samples
+
+    def iter_chunks(self, start=0, stop=None):
+        """
+        Iterate over the samples in a range without copying.
+        :param start: (OPTIONAL) The absolute index of the first sample. Default: 0
+        :param stop: (OPTIONAL) The absolute index after the last sample. Default: The end of the capture.
+        :return: A generator of (absolute index of the first sample, (num_channels, N) view) per chunk.
+        """
+        stop = self.end_sample if stop is None else stop
+        first = int(np.searchsorted(self.start_samples + self.num_samples, start, side='right'))
+        for chunk in range(first, len(self.chunks)):
+            chunk_start = self.start_samples[chunk]
+            if chunk_start >= stop:
+                break
+            begin = max(start, chunk_start)
+            end = min(stop, chunk_start + self.num_samples[chunk])
+            yield int(begin), self.data[chunk, begin - chunk_start:end - chunk_start].T
+
+    def gaps(self):
+        """
+        :return: A list of (sample index, missing samples) per gap.
+        """
+        missing = self.headers['missing_samples']
+        return [(int(self.start_samples[chunk] - missing[chunk]), int(missing[chunk]))
+                for chunk in np.flatnonzero(self.flags & GAP_BEFORE)]
+
+    def settings(self, sample_index):
+        """
+        :param sample_index: An absolute sample index.
+        :return: A dict of the scope settings the sample was captured with, taken from its chunk header (or the
+                 preceding one, for samples in a gap).
+        """
+        chunk = max(0, int(np.searchsorted(self.start_samples, sample_index, side='right')) - 1)
+        header = self.headers[chunk]
+        return {'sample_rate': float(header['sample_rate']),
+                'sample_rate_index': int(header['sample_rate_index']),
+                'voltage_ranges': (int(header['ch1_voltage_range']), int(header['ch2_voltage_range'])),
+                'num_channels': int(header['num_channels']),
+                'timestamp': float(header['timestamp'])}
+
+    def close(self):
+        """
+        Drop the references to the memory map. It is unmapped once the views returned earlier are gone, too.
+        """
+        self.chunks = self.headers = self.data = None
+        self.map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
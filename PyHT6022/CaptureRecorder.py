@@ -0,0 +1,251 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# Streams a capture straight to disk, instead of collecting the blocks in memory first:
+#
+#     with CaptureRecorder(scope, "capture.wav", max_samples=int(60 * 24e6)) as recorder:
+#         recorder.wait(60)
+#
+# The file is preallocated at its maximum size and memory mapped. The USB callback only queues the completed transfer
+# buffers (zero copy), a writer thread copies them into the map and hands the buffers back for resubmission, so disk
+# latency never delays the event thread. At close the header is fixed up and the file truncated to the data written.
+# The 'capture' format (see CaptureFile) is written in chunks instead, keeping the settings and gaps of the capture.
+# With overview, the writer thread also builds the multi-resolution overview of the recording (see Overview) next to
+# it, for drawing any part of it quickly.
+
+import collections
+import mmap
+import threading
+import time
+from struct import pack
+
+WAV_HEADER_SIZE = 44
+# The data size field of a WAV file is 32 bits.
+WAV_MAX_DATA_SIZE = 0xffffffff - WAV_HEADER_SIZE
+
+
+def wav_header(data_size, num_channels, sample_rate):
+    """
+    :param data_size: The size of the sample data in bytes.
+    :param num_channels: The number of interleaved channels.
+    :param sample_rate: The sample rate per channel.
+    :return: The 44 byte header of an unsigned 8 bit PCM WAV file.
+    """
+    sample_rate = int(sample_rate)
+    return (b"RIFF" + pack("<L", WAV_HEADER_SIZE + data_size - 8) + b"WAVE" +
+            b"fmt " + pack("<LHHLLHH", 16, 1, num_channels, sample_rate, sample_rate * num_channels, num_channels, 8) +
+            b"data" + pack("<L", data_size))
+
+
+class CaptureRecorder(object):
+    FORMATS = ('raw', 'wav', 'capture')
+    EXTENSIONS = {'.wav': 'wav', '.ht6022': 'capture'}
+
+    def __init__(self, scope, filename, max_samples, file_format=None, block_size=0x10000, outstanding_transfers=32,
+                 wav_sample_rate=None, overview=False):
+        """
+        :param scope: An Oscilloscope with an open handle, set up for the capture (interface, channels, rate, ranges).
+        :param filename: The file to write to. It is overwritten.
+        :param max_samples: The most samples (per channel) to record. The file is preallocated for this many, and the
+                            recording stops by itself when it is full.
+        :param file_format: (OPTIONAL) 'raw' for just the interleaved ADC counts, 'wav' for an 8 bit WAV file with one
+                            track per channel, or 'capture' for the chunked format of CaptureFile (requires NumPy to
+                            read). Default: By the extension of filename (.wav, .ht6022), 'raw' otherwise.
+        :param block_size: (OPTIONAL) The transfer size in bytes, as data_size for read_async. Default: 64 KiB
+        :param outstanding_transfers: (OPTIONAL) The number of transfer buffers. Buffers waiting for the writer are
+                                      not resubmitted, so these also absorb disk latency. Default: 32
+        :param wav_sample_rate: (OPTIONAL) The sample rate to put in the WAV header, e.g. a lower one so audio tools
+                                can zoom in far enough. Default: The sample rate of the scope.
+        :param overview: (OPTIONAL) Build the overview of the recording while writing it, into filename + '.ovr'.
+                         Requires NumPy. Default: Off
+        """
+        if file_format is None:
+            file_format = self.EXTENSIONS.get(filename[filename.rfind('.'):].lower(), 'raw')
+        assert file_format in self.FORMATS, "Unknown file format {}.".format(file_format)
+        self.scope = scope
+        self.filename = filename
+        self.file_format = file_format
+        self.num_channels = scope.num_channels
+        self.sample_rate = scope.sample_rate_hz(scope.sample_rate_index)
+        self.wav_sample_rate = wav_sample_rate or self.sample_rate
+        self.capacity = max_samples * self.num_channels
+        self.header_size = WAV_HEADER_SIZE if file_format == 'wav' else 0
+        assert file_format != 'wav' or self.capacity <= WAV_MAX_DATA_SIZE, "Too long for a WAV file, use raw."
+        self.max_samples = max_samples
+        self.overview = overview
+        self.block_size = block_size
+        self.outstanding_transfers = outstanding_transfers
+        self.written = 0
+        # Bytes which did not fit into the file any more.
+        self.truncated = 0
+        self.full = threading.Event()
+        self.shutdown_event = None
+        self._file = None
+        self._map = None
+        self._capture_file = None
+        self._overview = None
+        self._gap_cursor = 0
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._writer = None
+
+    def _open(self):
+        if self.overview:
+            from PyHT6022.Overview import OverviewWriter, OVERVIEW_SUFFIX
+            self._overview = OverviewWriter(self.filename + OVERVIEW_SUFFIX, self.num_channels, self.max_samples)
+        if self.file_format == 'capture':
+            from PyHT6022.CaptureFile import CaptureFileWriter
+            self._capture_file = CaptureFileWriter.from_scope(self.scope, self.filename)
+            return
+        self._file = open(self.filename, 'w+b')
+        self._file.truncate(self.header_size + self.capacity)
+        self._map = mmap.mmap(self._file.fileno(), self.header_size + self.capacity)
+        if self.header_size:
+            # Valid for the full size until fixed up, in case the recording is never closed.
+            self._map[:self.header_size] = wav_header(self.capacity, self.num_channels, self.wav_sample_rate)
+
+    def _on_block(self, data, _, sample_offset):
+        """
+        The read_async callback, run on the USB event thread. It only queues the buffer.
+        """
+        with self._condition:
+            if not self._stopping:
+                self._queue.append((data, sample_offset, time.time()))
+                self._condition.notify()
+                return
+        self.scope.release_buffer(data)
+
+    def _write_blocks(self):
+        """
+        The writer thread, copying the queued blocks into the file.
+        """
+        capture_file = self._capture_file
+        view = memoryview(self._map) if capture_file is None else None
+        position = self.header_size
+        end = self.header_size + self.capacity
+        queue, condition = self._queue, self._condition
+        release_buffer = self.scope.release_buffer
+        while True:
+            with condition:
+                while not queue and not self._stopping:
+                    condition.wait()
+                if not queue:
+                    break
+                data, sample_offset, timestamp = queue.popleft()
+            length = min(len(data), end - position)
+            if capture_file is not None:
+                # Once full, the blocks still in flight are only counted as truncated.
+                if length:
+                    self._write_capture(data[:length], sample_offset, timestamp)
+            else:
+                view[position:position + length] = data[:length]
+                if self._overview is not None:
+                    # Raw and WAV files have no gaps, the overview follows the file.
+                    self._overview.feed_interleaved(data[:length])
+            position += length
+            self.written = position - self.header_size
+            self.truncated += len(data) - length
+            release_buffer(data)
+            if position == end and not self.full.is_set():
+                self.full.set()
+                self.shutdown_event.set()
+        if view is not None:
+            view.release()
+
+    def _write_capture(self, data, sample_offset, timestamp):
+        """
+        Write a block to the capture file, split at the gaps of lost packets inside it. Zero copy iso blocks have
+        their packets closed up, so only the gap map of the read tells where samples are missing.
+        """
+        gaps = self.scope.gap_tracker.gaps
+        num_channels = self.num_channels
+        # The gaps are appended in order, so those before this block can be skipped for good.
+        while self._gap_cursor < len(gaps) and gaps[self._gap_cursor][0] <= sample_offset:
+            self._gap_cursor += 1
+        position = 0
+        while self._gap_cursor < len(gaps):
+            gap_index, missing = gaps[self._gap_cursor]
+            length = (gap_index - sample_offset) * num_channels
+            if position + length >= len(data):
+                break
+            self._write_chunk(data[position:position + length], sample_offset, timestamp)
+            position += length
+            sample_offset = gap_index + missing
+            self._gap_cursor += 1
+        self._write_chunk(data[position:], sample_offset, timestamp)
+
+    def _write_chunk(self, data, sample_offset, timestamp):
+        self._capture_file.write(data, sample_offset, timestamp)
+        if self._overview is not None:
+            self._overview.feed_interleaved(data, sample_offset)
+
+    def start(self):
+        """
+        Open the file, start the writer thread and start capturing.
+        :return: True if successful.
+        """
+        assert self._writer is None, "The recorder was already started."
+        self._open()
+        self.shutdown_event = self.scope.read_async(self._on_block, self.block_size, self.outstanding_transfers,
+                                                    zero_copy=True, auto_release=False, interleaved=True,
+                                                    event_thread=True, sample_offsets=True)
+        self._writer = threading.Thread(target=self._write_blocks, name='CaptureRecorder')
+        self._writer.daemon = True
+        self._writer.start()
+        self.scope.start_capture()
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Wait for the file to fill up.
+        :param timeout: (OPTIONAL) The longest time to wait, in seconds. Default: Until the file is full.
+        :return: True if the file is full.
+        """
+        return self.full.wait(timeout)
+
+    def close(self):
+        """
+        Stop capturing, write everything received so far, fix up the header and truncate the file to its content.
+        :return: The number of samples (per channel) recorded.
+        """
+        if self._writer is None:
+            return 0
+        self.shutdown_event.set()
+        self.scope.stop_capture()
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._writer.join()
+        self._writer = None
+        if self._overview is not None:
+            self._overview.close()
+        if self._capture_file is not None:
+            self._capture_file.close()
+            return self.written // self.num_channels
+        if self.header_size:
+            self._map[:self.header_size] = wav_header(self.written, self.num_channels, self.wav_sample_rate)
+        self._map.flush()
+        self._map.close()
+        self._file.truncate(self.header_size + self.written)
+        self._file.close()
+        return self.written // self.num_channels
+
+    def record(self, duration=None):
+        """
+        Record until the file is full or for a given time.
+        :param duration: (OPTIONAL) The time to record for, in seconds. Default: Until the file is full.
+        :return: The number of samples (per channel) recorded.
+        """
+        self.start()
+        try:
+            self.wait(duration)
+        finally:
+            samples = self.close()
+        return samples
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
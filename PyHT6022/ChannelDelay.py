@@ -0,0 +1,216 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# Delay and phase between the two channels, from a cross-spectrum averaged over the read_async blocks:
+#
+#     estimator = ChannelDelayEstimator.from_scope(scope, fft_size=8192)
+#     scope.read_async(estimator, 0x10000, as_numpy=True, event_thread=True, sample_offsets=True)
+#     ...
+#     print(estimator.delay(), estimator.phase(1e3, degrees=True))
+#
+# Both channels are cut into the same overlapping segments, which have their mean removed, are windowed and are
+# transformed with one batched real FFT per block. The cross-spectrum conj(CH1) * CH2 and the power spectra of both
+# channels are averaged like in the SpectrumAnalyzer, so an estimate costs no more than reading off the averages:
+# the delay is the peak of the inverse FFT of the cross-spectrum (the cross-correlation), sinc interpolated by zero
+# padding and refined by a parabola through the highest three points, and the phase at a frequency is the angle of
+# its bin. Windows come from the Spectrum window cache, and the FFT sizes are fixed, so NumPy reuses its FFT plans.
+# A positive delay means CH2 lags CH1, so CH2 then has a negative phase relative to CH1.
+
+import numpy as np
+
+from PyHT6022.SampleConversion import as_uint8_array
+from PyHT6022.Spectrum import LINEAR, EXPONENTIAL, window
+
+
+class ChannelDelayEstimator(object):
+    """
+    Averages the cross-spectrum of CH1 and CH2 of the read_async stream, for their delay, phase and coherence.
+    """
+
+    def __init__(self, sample_rate, fft_size=4096, window_name='hann', overlap=0.5, averaging=LINEAR, alpha=0.1,
+                 max_delay=None, upsample=16):
+        """
+        :param sample_rate: The sample rate per channel, in samples per second.
+        :param fft_size: (OPTIONAL) The samples per segment. Delays must be well below it. Default: 4096
+        :param window_name: (OPTIONAL) The window, one of Spectrum.WINDOWS. Default: 'hann'
+        :param overlap: (OPTIONAL) The fraction of each segment overlapping the next one. Default: 0.5
+        :param averaging: (OPTIONAL) LINEAR to average all segments equally, or EXPONENTIAL. Default: LINEAR
+        :param alpha: (OPTIONAL) The weight of each new segment with EXPONENTIAL averaging. Default: 0.1
+        :param max_delay: (OPTIONAL) The largest delay searched for, in samples either way. Default: fft_size / 4
+        :param upsample: (OPTIONAL) The interpolation factor of the cross-correlation before the peak is refined.
+                         Default: 16
+        """
+        assert 0 <= overlap < 1, "The overlap must be below 1."
+        assert averaging in (LINEAR, EXPONENTIAL), "Unknown averaging {}.".format(averaging)
+        self.sample_rate = float(sample_rate)
+        self.fft_size = fft_size
+        self.window_name = window_name
+        self.window = window(window_name, fft_size)[0]
+        self.hop = max(1, int(round(fft_size * (1 - overlap))))
+        self.averaging = averaging
+        self.alpha = alpha
+        self.max_delay = fft_size // 4 if max_delay is None else int(max_delay)
+        assert 0 < self.max_delay < fft_size // 2, "The delay window must be below half the FFT size."
+        self.upsample = int(upsample)
+        self.frequencies = np.fft.rfftfreq(fft_size, 1.0 / self.sample_rate)
+        # The correlation lags around zero, in upsampled points.
+        reach = self.max_delay * self.upsample
+        self._lags = np.arange(-reach, reach + 1)
+        self.reset()
+
+    @classmethod
+    def from_scope(cls, scope, **kwargs):
+        """
+        Create an estimator for the channels of an Oscilloscope, at its current sample rate.
+        """
+        sample_rate = scope.sample_rate_hz(scope.sample_rate_index)
+        return cls(sample_rate, **kwargs)
+
+    def reset(self):
+        """
+        Forget the averaged spectra and the buffered samples.
+        """
+        self.sample_position = 0
+        self.segments = 0
+        self.gaps = 0
+        # The averaged CH1 power, CH2 power and cross-spectrum.
+        self._spectra = np.zeros((3, len(self.frequencies)), dtype=np.complex128)
+        self._batch = np.zeros((2, len(self.frequencies)), dtype=np.float32)
+        self._pending = np.zeros((2, 0), dtype=np.float32)
+
+    def skip_to(self, sample_position):
+        """
+        Continue after a gap in the stream. Segments can not span the gap, so the buffered samples are dropped.
+        :param sample_position: The absolute index of the next sample.
+        """
+        self.gaps += 1
+        self.sample_position = sample_position
+        self._pending = self._pending[:, :0]
+
+    def feed(self, ch1_data, ch2_data=None, sample_offset=None):
+        """
+        Add the next block of both channels, e.g. as the callback of read_async.
+        :param ch1_data: The next CH1 samples (bytes, array or NumPy array of ADC counts or volts).
+        :param ch2_data: The CH2 samples of the same block.
+        :param sample_offset: (OPTIONAL) The absolute index of the first sample, as passed by read_async with
+                              sample_offsets. Default: Contiguous
+        :return: The number of segments added to the average.
+        """
+        assert ch2_data is not None and len(ch2_data) == len(ch1_data), "Both channels are needed."
+        if sample_offset is not None and sample_offset != self.sample_position:
+            self.skip_to(sample_offset)
+        length = len(ch1_data)
+        self.sample_position += length
+        pending = self._pending.shape[1]
+        samples = np.empty((2, pending + length), dtype=np.float32)
+        samples[:, :pending] = self._pending
+        for row, data in enumerate((ch1_data, ch2_data)):
+            samples[row, pending:] = data if isinstance(data, np.ndarray) else as_uint8_array(data)
+        count = (samples.shape[1] - self.fft_size) // self.hop + 1 if samples.shape[1] >= self.fft_size else 0
+        if count:
+            row_stride, stride = samples.strides
+            segments = np.lib.stride_tricks.as_strided(samples, (2, count, self.fft_size),
+                                                       (row_stride, self.hop * stride, stride), writeable=False)
+            windowed = segments * self.window
+            # Removing the mean of each segment keeps offsets out of the correlation.
+            windowed -= segments.mean(axis=2, keepdims=True, dtype=np.float32) * self.window
+            ch1, ch2 = np.fft.rfft(windowed, axis=2)
+            weights = self._weights(count)
+            np.dot(weights, ch1.real ** 2 + ch1.imag ** 2, out=self._batch[0])
+            np.dot(weights, ch2.real ** 2 + ch2.imag ** 2, out=self._batch[1])
+            ch1 = np.conj(ch1, out=ch1)
+            ch1 *= ch2
+            self._spectra[:2] += self._batch
+            self._spectra[2] += np.dot(weights, ch1)
+            self.segments += count
+        self._pending = samples[:, count * self.hop:].copy()
+        return count
+
+    __call__ = feed
+
+    def _weights(self, count):
+        """
+        :return: The weight of each segment of the next batch in the average, after decaying the average so far with
+                 EXPONENTIAL averaging.
+        """
+        if self.averaging == LINEAR:
+            return np.ones(count, dtype=np.float32)
+        decay = 1.0 - self.alpha
+        weights = self.alpha * decay ** np.arange(count - 1, -1, -1)
+        if self.segments:
+            self._spectra *= decay ** count
+        else:
+            # The exponential average starts with the first segment.
+            weights[0] = decay ** (count - 1)
+        return weights.astype(np.float32)
+
+    @property
+    def cross_spectrum(self):
+        """
+        :return: The averaged cross-spectrum conj(CH1) * CH2 of the windowed segments, one value per frequency.
+        """
+        return self._spectra[2] / self.segments if self.averaging == LINEAR and self.segments else self._spectra[2]
+
+    def coherence(self):
+        """
+        :return: The magnitude squared coherence of the channels per frequency, from 0 (unrelated) to 1 (the same
+                 signal, up to a linear filter). It needs several segments to mean anything.
+        """
+        ch1, ch2, cross = self._spectra
+        with np.errstate(divide='ignore', invalid='ignore'):
+            coherence = (cross.real ** 2 + cross.imag ** 2) / (ch1.real * ch2.real)
+        return np.nan_to_num(coherence)
+
+    def correlation(self, phat=False):
+        """
+        :param phat: (OPTIONAL) Whiten the cross-spectrum first (generalized cross-correlation with phase transform),
+                     which sharpens the peak for broadband signals. Default: Off
+        :return: (lags in samples, cross-correlation) within max_delay, upsampled by the upsample factor.
+        """
+        cross = self.cross_spectrum
+        if phat:
+            magnitude = np.abs(cross)
+            cross = np.divide(cross, magnitude, out=np.zeros_like(cross), where=magnitude > 0)
+        size = self.fft_size * self.upsample
+        correlation = np.fft.irfft(cross, size)
+        # Negative lags wrap around to the end.
+        reach = len(self._lags) // 2
+        correlation = np.concatenate((correlation[size - reach:], correlation[:reach + 1]))
+        return self._lags / float(self.upsample), correlation
+
+    def delay_samples(self, phat=False):
+        """
+        :param phat: (OPTIONAL) Use the phase transform, see correlation(). Default: Off
+        :return: The delay of CH2 after CH1 in samples, with sub-sample resolution, or None before the first segment.
+        """
+        if not self.segments:
+            return None
+        lags, correlation = self.correlation(phat)
+        peak = int(np.argmax(correlation))
+        shift = 0.0
+        if 0 < peak < len(correlation) - 1:
+            left, centre, right = correlation[peak - 1:peak + 2]
+            curvature = left - 2 * centre + right
+            if curvature < 0:
+                shift = 0.5 * (left - right) / curvature
+        return float(lags[peak] + shift / self.upsample)
+
+    def delay(self, phat=False):
+        """
+        :param phat: (OPTIONAL) Use the phase transform, see correlation(). Default: Off
+        :return: The delay of CH2 after CH1 in seconds, or None before the first segment.
+        """
+        samples = self.delay_samples(phat)
+        return None if samples is None else samples / self.sample_rate
+
+    def phase(self, frequency, degrees=False):
+        """
+        :param frequency: The frequency in Hz, e.g. of a test tone. The nearest bin is used.
+        :param degrees: (OPTIONAL) Return degrees instead of radians. Default: Off
+        :return: The phase of CH2 relative to CH1 at the frequency, from -pi to pi, or None before the first segment.
+        """
+        if not self.segments:
+            return None
+        index = int(round(frequency * self.fft_size / self.sample_rate))
+        assert 0 <= index < len(self.frequencies), "The frequency is above the Nyquist frequency."
+        phase = float(np.angle(self._spectra[2, index]))
+        return np.degrees(phase) if degrees else phase
@@ -0,0 +1,175 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# Channel math in the conversion pass: a derived trace such as the differential CH1 - CH2 or the power CH1 * CH2 is
+# computed straight from the raw interleaved samples, without per channel voltage arrays:
+#
+#     power = ChannelMath('CH1 * CH2 * 10', scope=scope, probe_multipliers=(10, 1))
+#     scope.read_async(power.callback(show), 0x10000, interleaved=True, sample_offsets=True)
+#
+# A sample of the derived trace only depends on the two ADC counts of the sample, so the expression is evaluated once
+# for all 256 x 256 pairs of counts, with the conversion table of each channel (calibrated, if the scope's calibration
+# is loaded). Converting a block is then a single table gather: the interleaved CH1, CH2 bytes read as little endian
+# 16 bit values are the index CH2 * 256 + CH1 into the table. The table is rebuilt when a voltage range changes.
+# Expressions use CH1, CH2, numbers, + - * / ** and abs, min, max, sqrt, exp and log.
+
+import ast
+
+import numpy as np
+
+from PyHT6022.SampleConversion import as_uint8_array, conversion_table
+
+FUNCTIONS = {'abs': np.abs, 'min': np.minimum, 'max': np.maximum, 'sqrt': np.sqrt, 'exp': np.exp, 'log': np.log}
+CHANNELS = ('CH1', 'CH2')
+
+_OPERATORS = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.divide, ast.Pow: np.power}
+
+
+def compile_expression(expression):
+    """
+    Parse a channel math expression.
+    :param expression: The expression, e.g. 'CH1 - CH2'.
+    :return: (function, channels): the expression as a function of the CH1 and CH2 voltages (NumPy arrays, which
+             broadcast), and the set of the channels it uses.
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode='eval').body
+    except SyntaxError as error:
+        raise ValueError("Invalid channel math expression {!r}: {}".format(expression, error))
+    channels = set()
+
+    def build(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and \
+                not isinstance(node.value, bool):
+            value = float(node.value)
+            return lambda ch1, ch2: value
+        if isinstance(node, ast.Name) and node.id in CHANNELS:
+            channels.add(node.id)
+            return (lambda ch1, ch2: ch1) if node.id == 'CH1' else (lambda ch1, ch2: ch2)
+        if isinstance(node, ast.BinOp) and type(node.op) in _OPERATORS:
+            operator, left, right = _OPERATORS[type(node.op)], build(node.left), build(node.right)
+            return lambda ch1, ch2: operator(left(ch1, ch2), right(ch1, ch2))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            operand = build(node.operand)
+            if isinstance(node.op, ast.UAdd):
+                return operand
+            return lambda ch1, ch2: np.negative(operand(ch1, ch2))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and \
+                not node.keywords:
+            function = FUNCTIONS[node.func.id]
+            # The functions are ufuncs, which know their number of arguments.
+            if len(node.args) != function.nin:
+                raise ValueError("{}() takes {} argument{}, not {}, in channel math expression {!r}.".format(
+                    node.func.id, function.nin, 's' if function.nin != 1 else '', len(node.args), expression))
+            arguments = [build(argument) for argument in node.args]
+            return lambda ch1, ch2: function(*[argument(ch1, ch2) for argument in arguments])
+        raise ValueError("Unsupported element {!r} in channel math expression {!r}.".format(
+            ast.dump(node), expression))
+
+    return build(tree), channels
+
+
+class ChannelMath(object):
+    """
+    A derived trace of one or both channels, converted from raw samples with one lookup per sample.
+    """
+
+    def __init__(self, expression, scope=None, voltage_ranges=(1, 1), probe_multipliers=(1, 1), dtype=np.float32):
+        """
+        :param expression: The expression, e.g. 'CH1 - CH2' or '(CH1 - 2.5) * 4'.
+        :param scope: (OPTIONAL) An Oscilloscope, whose current voltage ranges (and calibration) are used for each
+                      conversion. Default: Use voltage_ranges
+        :param voltage_ranges: (OPTIONAL) The voltage range index of CH1 and CH2, without a scope. Default: (1, 1)
+        :param probe_multipliers: (OPTIONAL) The probe multiplier of CH1 and CH2. Default: (1, 1)
+        :param dtype: (OPTIONAL) The float type of the derived trace. Default: float32
+        """
+        self.expression = expression
+        self.function, self.channels = compile_expression(expression)
+        self.scope = scope
+        self.voltage_ranges = tuple(voltage_ranges)
+        self.probe_multipliers = tuple(probe_multipliers)
+        self.dtype = np.dtype(dtype)
+        self._tables = None
+        self._lookup = None
+
+    def channel_tables(self):
+        """
+        :return: The conversion tables of CH1 and CH2 for the current settings.
+        """
+        if self.scope is not None:
+            return tuple(self.scope.conversion_table(channel, probe_multiplier, np.float64)
+                         for channel, probe_multiplier in zip((1, 2), self.probe_multipliers))
+        return tuple(conversion_table(voltage_range, probe_multiplier, np.float64)
+                     for voltage_range, probe_multiplier in zip(self.voltage_ranges, self.probe_multipliers))
+
+    def lookup_table(self):
+        """
+        :return: The derived value for every pair of ADC counts, as a read-only (256, 256) array indexed by
+                 [CH2 count, CH1 count], or a (256,) array indexed by the count if only CH1 is used.
+        """
+        tables = self.channel_tables()
+        if self._lookup is None or any(table is not cached for table, cached in zip(tables, self._tables)):
+            ch1, ch2 = tables
+            if 'CH2' in self.channels:
+                ch1, ch2 = ch1[None, :], ch2[:, None]
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                values = self.function(ch1, ch2)
+            shape = (256, 256) if 'CH2' in self.channels else (256,)
+            lookup = np.empty(shape, dtype=self.dtype)
+            lookup[...] = values
+            lookup.flags.writeable = False
+            self._tables, self._lookup = tables, lookup
+        return self._lookup
+
+    def convert(self, data, num_channels=2, out=None):
+        """
+        Compute the derived trace of a raw buffer, as read from the scope.
+        :param data: The raw samples, interleaved CH1, CH2, ... if num_channels is 2 (bytes, array or NumPy array).
+        :param num_channels: (OPTIONAL) The number of channels the data was captured with. Default: 2
+        :param out: (OPTIONAL) A preallocated array of the dtype to write the trace to.
+        :return: The derived trace, one value per sample of each channel.
+        """
+        samples = as_uint8_array(data)
+        lookup = self.lookup_table()
+        if num_channels == 1:
+            assert 'CH2' not in self.channels, "The expression needs CH2, which was not captured."
+            return lookup.take(samples, out=out, mode='clip')
+        samples = samples[:len(samples) & ~1]
+        if lookup.ndim == 1:
+            return lookup.take(samples[::2], out=out, mode='clip')
+        if samples.flags.c_contiguous:
+            # CH1 in the low byte and CH2 in the high byte of each little endian pair.
+            indexes = samples.view('<u2')
+        else:
+            indexes = samples[0::2] | (samples[1::2].astype(np.uint16) << 8)
+        return lookup.reshape(-1).take(indexes, out=out, mode='clip')
+
+    def evaluate(self, ch1_data, ch2_data=None, out=None):
+        """
+        Compute the derived trace of separate CH1 and CH2 samples, e.g. as read with as_numpy.
+        :param ch1_data: The CH1 ADC counts.
+        :param ch2_data: (OPTIONAL) The CH2 ADC counts, if the expression uses CH2.
+        :param out: (OPTIONAL) A preallocated array of the dtype to write the trace to.
+        :return: The derived trace.
+        """
+        lookup = self.lookup_table()
+        ch1 = as_uint8_array(ch1_data)
+        if lookup.ndim == 1:
+            return lookup.take(ch1, out=out, mode='clip')
+        assert ch2_data is not None and len(ch2_data), "The expression needs CH2, which was not captured."
+        indexes = as_uint8_array(ch2_data).astype(np.uint16) << 8
+        indexes |= ch1
+        return lookup.reshape(-1).take(indexes, out=out, mode='clip')
+
+    def callback(self, consumer, num_channels=None):
+        """
+        Wrap a consumer of the derived trace as a callback for read_async with interleaved=True.
+        :param consumer: Called as consumer(trace) for each block, or consumer(trace, sample_offset) with sample_offsets.
+        :param num_channels: (OPTIONAL) The number of channels captured. Default: The scope's, or 2 without a scope
+        :return: The callback.
+        """
+        if num_channels is None:
+            num_channels = self.scope.num_channels if self.scope is not None else 2
+
+        def convert_block(data, _, *sample_offset):
+            consumer(self.convert(data, num_channels), *sample_offset)
+        return convert_block
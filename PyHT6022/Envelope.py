@@ -0,0 +1,215 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# Min/max (peak detect) decimation of the sample stream, to display or keep long captures at a fraction of the data:
+#
+#     decimator = EnvelopeDecimator.for_rate(scope.sample_rate_hz(scope.sample_rate_index), 10e3, num_channels=1)
+#     scope.read_async(decimator, 0x8000, as_numpy=True, event_thread=True, sample_offsets=True)
+#     ...
+#     first_bucket, mins, maxs = decimator.envelope()
+#
+# Every factor samples are reduced to their minimum and maximum, so narrow glitches survive which plain decimation
+# would drop or alias. It works on the raw ADC counts (or any other dtype), with one reshape and reduction per block,
+# and the partial bucket at the end of a block is carried over to the next one. Buckets are aligned to the absolute
+# sample index: a gap in the stream leaves empty buckets, whose min is above their max.
+
+import numpy as np
+
+from PyHT6022.SampleConversion import as_uint8_array
+
+
+def empty_bucket(dtype):
+    """
+    :param dtype: The sample type.
+    :return: (min, max) of a bucket without samples, which are neutral when merged with any sample.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return np.inf, -np.inf
+    info = np.iinfo(dtype)
+    return info.max, info.min
+
+
+def minmax(samples, factor):
+    """
+    One shot min/max decimation of a whole capture.
+    :param samples: A (N,) or (num_channels, N) array.
+    :param factor: The samples per bucket.
+    :return: (mins, maxs) arrays with one value per bucket. A partial bucket at the end is included.
+    """
+    samples = np.asarray(samples)
+    length = samples.shape[-1]
+    full = length // factor * factor
+    body = samples[..., :full].reshape(samples.shape[:-1] + (-1, factor))
+    mins, maxs = body.min(axis=-1), body.max(axis=-1)
+    if full < length:
+        mins = np.concatenate((mins, samples[..., full:].min(axis=-1)[..., None]), axis=-1)
+        maxs = np.concatenate((maxs, samples[..., full:].max(axis=-1)[..., None]), axis=-1)
+    return mins, maxs
+
+
+class EnvelopeDecimator(object):
+    """
+    Streaming min/max decimation of the read_async blocks, per channel.
+    """
+
+    def __init__(self, factor, num_channels=2, keep=True, max_buckets=None, on_envelope=None):
+        """
+        :param factor: The samples per bucket.
+        :param num_channels: (OPTIONAL) The number of channels the read delivers, 1 or 2. Default: 2
+        :param keep: (OPTIONAL) Keep the buckets, for envelope(). Default: On
+        :param max_buckets: (OPTIONAL) Only keep (at least) the newest max_buckets buckets. Default: All
+        :param on_envelope: (OPTIONAL) Called as on_envelope(first bucket index, mins, maxs) with the (num_channels, N)
+                            buckets completed by each block.
+        """
+        assert factor >= 1, "A bucket needs at least one sample."
+        assert num_channels in (1, 2), "Only one or two channels are supported."
+        self.factor = int(factor)
+        self.num_channels = num_channels
+        self.keep = keep
+        self.max_buckets = max_buckets
+        self.on_envelope = on_envelope
+        self.dtype = None
+        self.reset()
+
+    @classmethod
+    def for_rate(cls, sample_rate, output_rate, num_channels=2, **kwargs):
+        """
+        Create a decimator producing (about) output_rate buckets per second.
+        :param sample_rate: The sample rate per channel, e.g. from sample_rate_hz.
+        :param output_rate: The buckets per second wanted.
+        """
+        return cls(max(1, int(round(sample_rate / output_rate))), num_channels, **kwargs)
+
+    def reset(self):
+        """
+        Start over at sample 0.
+        """
+        self.sample_position = 0
+        # The absolute index of the next bucket to complete.
+        self.bucket_position = 0
+        self._partial_min = self._partial_max = None
+        self._blocks = []
+        self._kept = 0
+
+    def _start(self, dtype):
+        self.dtype = np.dtype(dtype)
+        low, high = empty_bucket(dtype)
+        self._empty = (np.full(self.num_channels, low, dtype), np.full(self.num_channels, high, dtype))
+        self._partial_min, self._partial_max = self._empty[0].copy(), self._empty[1].copy()
+
+    def _emit(self, first_bucket, mins, maxs):
+        if self.keep and mins.shape[1]:
+            self._blocks.append((mins, maxs))
+            self._kept += mins.shape[1]
+            while self.max_buckets is not None and self._kept - self._blocks[0][0].shape[1] >= self.max_buckets:
+                self._kept -= self._blocks.pop(0)[0].shape[1]
+        if self.on_envelope is not None and mins.shape[1]:
+            self.on_envelope(first_bucket, mins, maxs)
+
+    def skip_to(self, sample_position):
+        """
+        Continue after a gap in the stream: the partial bucket is closed, and the buckets without samples are empty.
+        :param sample_position: The absolute index of the next sample.
+        :return: (first bucket index, mins, maxs) of the buckets completed.
+        """
+        assert sample_position >= self.sample_position, "The stream can not go back."
+        first = self.bucket_position
+        count = sample_position // self.factor - first
+        mins = np.empty((self.num_channels, count), self.dtype)
+        maxs = np.empty((self.num_channels, count), self.dtype)
+        if count:
+            mins[:, 0], maxs[:, 0] = self._partial_min, self._partial_max
+            mins[:, 1:] = self._empty[0][:, None]
+            maxs[:, 1:] = self._empty[1][:, None]
+            self._partial_min[:], self._partial_max[:] = self._empty
+        self.sample_position = sample_position
+        self.bucket_position += count
+        self._emit(first, mins, maxs)
+        return first, mins, maxs
+
+    def feed(self, ch1_data, ch2_data=None, sample_offset=None):
+        """
+        Decimate the next block, e.g. as the callback of read_async.
+        :param ch1_data: The next CH1 samples (bytes, array or NumPy array).
+        :param ch2_data: (OPTIONAL) The CH2 samples of the same block, if num_channels is 2.
+        :param sample_offset: (OPTIONAL) The absolute index of the first sample, as passed by read_async with
+                              sample_offsets. Default: Contiguous
+        :return: (first bucket index, mins, maxs) with the (num_channels, N) buckets completed by this block.
+        """
+        channels = [ch1_data if isinstance(ch1_data, np.ndarray) else as_uint8_array(ch1_data)]
+        if self.num_channels == 2:
+            channels.append(ch2_data if isinstance(ch2_data, np.ndarray) else as_uint8_array(ch2_data))
+        if self.dtype is None:
+            self._start(channels[0].dtype)
+        gap = None
+        if sample_offset is not None and sample_offset != self.sample_position:
+            gap = self.skip_to(sample_offset)
+        length = min(len(samples) for samples in channels)
+        factor = self.factor
+        fill = self.sample_position % factor
+        # The samples completing the partial bucket, the whole buckets, and the start of the next partial bucket.
+        head = min((factor - fill) % factor, length)
+        full = (length - head) // factor
+        body_end = head + full * factor
+        completed = int(fill > 0 and fill + head == factor)
+        first = self.bucket_position
+        mins = np.empty((self.num_channels, completed + full), self.dtype)
+        maxs = np.empty((self.num_channels, completed + full), self.dtype)
+        for channel, samples in enumerate(channels):
+            if head:
+                self._partial_min[channel] = min(self._partial_min[channel], samples[:head].min())
+                self._partial_max[channel] = max(self._partial_max[channel], samples[:head].max())
+            if full:
+                body = samples[head:body_end].reshape(full, factor)
+                body.min(axis=1, out=mins[channel, completed:])
+                body.max(axis=1, out=maxs[channel, completed:])
+        if completed:
+            mins[:, 0], maxs[:, 0] = self._partial_min, self._partial_max
+            self._partial_min[:], self._partial_max[:] = self._empty
+        if body_end < length:
+            for channel, samples in enumerate(channels):
+                self._partial_min[channel] = samples[body_end:length].min()
+                self._partial_max[channel] = samples[body_end:length].max()
+        self.sample_position += length
+        self.bucket_position += completed + full
+        self._emit(first, mins, maxs)
+        if gap is not None and gap[1].shape[1]:
+            return gap[0], np.concatenate((gap[1], mins), axis=1), np.concatenate((gap[2], maxs), axis=1)
+        return first, mins, maxs
+
+    __call__ = feed
+
+    def flush(self):
+        """
+        Complete the partial bucket, e.g. at the end of a capture.
+        :return: (first bucket index, mins, maxs) of the bucket, if there was one.
+        """
+        if self.dtype is None or not self.sample_position % self.factor:
+            return self._no_buckets()
+        next_bucket = (self.sample_position // self.factor + 1) * self.factor
+        return self.skip_to(next_bucket)
+
+    def _no_buckets(self):
+        empty = np.zeros((self.num_channels, 0), self.dtype or np.uint8)
+        return self.bucket_position, empty, empty
+
+    def envelope(self):
+        """
+        :return: (first bucket index, mins, maxs) of the kept buckets, oldest first.
+        """
+        if not self._blocks:
+            return self._no_buckets()
+        if len(self._blocks) > 1:
+            self._blocks = [(np.concatenate([mins for mins, _ in self._blocks], axis=1),
+                             np.concatenate([maxs for _, maxs in self._blocks], axis=1))]
+        mins, maxs = self._blocks[0]
+        return self.bucket_position - mins.shape[1], mins, maxs
+
+    def times(self, first_bucket, count, sample_rate):
+        """
+        :param first_bucket: The index of the first bucket.
+        :param count: The number of buckets.
+        :param sample_rate: The sample rate per channel.
+        :return: The time of the start of each bucket, in seconds since the start of the capture.
+        """
+        return (np.arange(first_bucket, first_bucket + count) * self.factor) / float(sample_rate)
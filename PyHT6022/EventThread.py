@@ -0,0 +1,150 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+import atexit
+import threading
+import time
+import weakref
+
+import usb1
+
+
+class AsyncRead(object):
+    """
+    The transfers of one read_async call, together with the shutdown event that stops them.
+    """
+
+    def __init__(self, shutdown_event, transfers):
+        self.shutdown_event = shutdown_event
+        self.transfers = transfers
+        self.shutdown_time = None
+        self.cancelled = False
+
+    def in_flight(self):
+        """
+        :return: The transfers which are still submitted (owned by libusb).
+        """
+        return [transfer for transfer in self.transfers if transfer.isSubmitted()]
+
+    def cancel_in_flight(self):
+        """
+        Cancel all submitted transfers. Their callbacks run with a cancelled status on the next event handling.
+        """
+        for transfer in self.in_flight():
+            try:
+                transfer.cancel()
+            except usb1.USBError:
+                # It completed in the meantime.
+                pass
+        self.cancelled = True
+
+
+class AsyncReadSet(object):
+    """
+    The async reads of one scope, which have not been reaped yet.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reads = []
+
+    def __len__(self):
+        return len(self._reads)
+
+    def add(self, shutdown_event, transfers):
+        """
+        Track the transfers of a new async read.
+        :param shutdown_event: The shutdown event returned to the caller of read_async.
+        :param transfers: The transfers submitted for the read.
+        """
+        with self.lock:
+            self._reads.append(AsyncRead(shutdown_event, transfers))
+
+    def shutdown(self):
+        """
+        Set the shutdown event of every read, so no transfer is resubmitted any more.
+        """
+        with self.lock:
+            for read in self._reads:
+                read.shutdown_event.set()
+
+    def reap(self, grace_period):
+        """
+        Forget the reads which are shut down and have no transfers in flight any more. Transfers still in flight
+        grace_period seconds after their shutdown event was set (e.g. bulk transfers after stop_capture) are cancelled.
+        :param grace_period: Seconds to wait for in flight transfers to complete by themselves.
+        :return: The number of reads left.
+        """
+        now = time.time()
+        with self.lock:
+            remaining = []
+            for read in self._reads:
+                if not read.shutdown_event.is_set():
+                    remaining.append(read)
+                    continue
+                if read.shutdown_time is None:
+                    read.shutdown_time = now
+                if read.in_flight():
+                    if not read.cancelled and now - read.shutdown_time >= grace_period:
+                        read.cancel_in_flight()
+                    remaining.append(read)
+            self._reads = remaining
+            return len(remaining)
+
+
+class USBEventThread(threading.Thread):
+    """
+    Handles libusb events for the async reads of a scope, so nobody needs to call poll(). Events are handled with a
+    timeout instead of busy polling, and the thread exits by itself once every read has been shut down and all of
+    its transfers have been reaped.
+    """
+
+    def __init__(self, context, reads, timeout=0.1, grace_period=0.5):
+        """
+        :param context: The USB context of the scope.
+        :param reads: The AsyncReadSet of the scope.
+        :param timeout: (OPTIONAL) The longest time to block waiting for events, in seconds. This bounds how long
+                        shutdown takes to notice. Default: 0.1 s
+        :param grace_period: (OPTIONAL) Seconds to let in flight transfers complete after a shutdown before cancelling
+                             them. Default: 0.5 s
+        """
+        threading.Thread.__init__(self, name='USBEventThread')
+        self.daemon = True
+        self.context = context
+        self.reads = reads
+        self.timeout = timeout
+        self.grace_period = grace_period
+        self.exiting = False
+        _event_threads.add(self)
+
+    def run(self):
+        handle_events = self.context.handleEventsTimeout
+        reads = self.reads
+        while True:
+            handle_events(self.timeout)
+            if not reads.reap(self.grace_period):
+                with reads.lock:
+                    # Check again under the lock, a new read may have come in.
+                    if not len(reads):
+                        self.exiting = True
+                        return
+
+    def claim(self):
+        """
+        Make sure this thread will handle a newly added read.
+        :return: True if the thread is running and will handle it, False if it is exiting and a new thread is needed.
+        """
+        with self.reads.lock:
+            return self.is_alive() and not self.exiting
+
+
+# The running event threads, which are shut down at exit while they still can: daemon threads are frozen during
+# interpreter shutdown, so reaping their transfers from Oscilloscope.__del__ would never finish.
+_event_threads = weakref.WeakSet()
+
+
+@atexit.register
+def _stop_event_threads():
+    for event_thread in list(_event_threads):
+        if event_thread.is_alive():
+            event_thread.reads.shutdown()
+            event_thread.join(event_thread.grace_period + event_thread.timeout + 1.0)
@@ -0,0 +1,406 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# Streaming digital filters for the read_async blocks: FIR filters by overlap-save FFT convolution, optionally
+# decimating in polyphase form, and IIR filters as cascaded second-order sections:
+#
+#     lowpass = FIRFilter.from_scope(scope, fir_lowpass(100e3, scope.sample_rate_hz(scope.sample_rate_index)),
+#                                    decimation=10)
+#     scope.read_async(lowpass, 0x10000, as_numpy=True, event_thread=True, sample_offsets=True)
+#
+#     notch = SOSFilter(biquad(NOTCH, 50, 100e3, q=30))
+#
+# The filters take the raw ADC counts: the volts per count are folded into the coefficients and the offset into a
+# constant, so there is no separate conversion pass. The filter state (the last input samples, the IIR section
+# outputs) is kept between blocks, so the output does not depend on the block size, and starts at 0V. Decimated outputs
+# are aligned to the absolute sample index: output m is the filtered sample m * decimation. The designs only need
+# NumPy: windowed sinc FIR filters, and RBJ biquads and Butterworth cascades for IIR filters.
+
+import numpy as np
+
+from PyHT6022.SampleConversion import as_uint8_array
+from PyHT6022.Spectrum import WINDOWS
+
+LOWPASS = 'lowpass'
+HIGHPASS = 'highpass'
+BANDPASS = 'bandpass'
+NOTCH = 'notch'
+
+
+def _sinc_lowpass(cutoff, sample_rate, taps, window_name):
+    assert taps % 2, "Use an odd number of taps, for a whole number of samples delay."
+    assert 0 < cutoff < sample_rate / 2.0, "The cutoff must be between 0 and the Nyquist frequency."
+    n = np.arange(taps) - (taps - 1) / 2.0
+    return np.sinc(2.0 * cutoff / sample_rate * n) * WINDOWS[window_name](taps)
+
+
+def fir_lowpass(cutoff, sample_rate, taps=101, window_name='hamming'):
+    """
+    A linear phase windowed sinc low-pass filter, with unity gain at DC.
+    :param cutoff: The -6dB frequency in Hz.
+    :param sample_rate: The sample rate in samples per second.
+    :param taps: (OPTIONAL) The (odd) filter length. The transition band is about 3.3 * sample_rate / taps wide with
+                 the Hamming window. Default: 101
+    :param window_name: (OPTIONAL) The window, one of Spectrum.WINDOWS. Default: 'hamming'
+    :return: The filter taps.
+    """
+    taps = _sinc_lowpass(cutoff, sample_rate, taps, window_name)
+    return taps / taps.sum()
+
+
+def fir_highpass(cutoff, sample_rate, taps=101, window_name='hamming'):
+    """
+    A linear phase high-pass filter: the spectral inversion of fir_lowpass.
+    """
+    taps = -fir_lowpass(cutoff, sample_rate, taps, window_name)
+    taps[len(taps) // 2] += 1
+    return taps
+
+
+def fir_bandpass(low, high, sample_rate, taps=101, window_name='hamming'):
+    """
+    A linear phase band-pass filter, with unity gain at the center of the band.
+    :param low: The lower -6dB frequency in Hz.
+    :param high: The upper -6dB frequency in Hz.
+    """
+    assert low < high, "The band must not be empty."
+    band = _sinc_lowpass(high, sample_rate, taps, window_name) * (2.0 * high / sample_rate) - \
+        _sinc_lowpass(low, sample_rate, taps, window_name) * (2.0 * low / sample_rate)
+    center = np.exp(-2j * np.pi * (low + high) / 2.0 / sample_rate * np.arange(len(band)))
+    return band / abs(np.dot(band, center))
+
+
+def fir_bandstop(low, high, sample_rate, taps=101, window_name='hamming'):
+    """
+    A linear phase band-stop filter: the spectral inversion of fir_bandpass, with unity gain at DC.
+    """
+    band = _sinc_lowpass(high, sample_rate, taps, window_name) * (2.0 * high / sample_rate) - \
+        _sinc_lowpass(low, sample_rate, taps, window_name) * (2.0 * low / sample_rate)
+    taps = -band
+    taps[len(taps) // 2] += 1
+    return taps / taps.sum()
+
+
+def biquad(kind, frequency, sample_rate, q=0.7071067811865476):
+    """
+    A second-order section from the RBJ audio EQ cookbook.
+    :param kind: LOWPASS, HIGHPASS, BANDPASS (unity gain at the center) or NOTCH.
+    :param frequency: The cutoff or center frequency in Hz.
+    :param sample_rate: The sample rate in samples per second.
+    :param q: (OPTIONAL) The quality factor: the center frequency over the bandwidth for BANDPASS and NOTCH.
+              Default: 1/sqrt(2), Butterworth
+    :return: A (1, 6) array with the section [b0, b1, b2, 1, a1, a2].
+    """
+    assert 0 < frequency < sample_rate / 2.0, "The frequency must be between 0 and the Nyquist frequency."
+    w0 = 2 * np.pi * frequency / sample_rate
+    cos_w0 = np.cos(w0)
+    alpha = np.sin(w0) / (2 * q)
+    if kind == LOWPASS:
+        b = [(1 - cos_w0) / 2, 1 - cos_w0, (1 - cos_w0) / 2]
+    elif kind == HIGHPASS:
+        b = [(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2]
+    elif kind == BANDPASS:
+        b = [alpha, 0, -alpha]
+    elif kind == NOTCH:
+        b = [1, -2 * cos_w0, 1]
+    else:
+        raise ValueError("Unknown filter kind {}.".format(kind))
+    a0 = 1 + alpha
+    return np.array([[b[0] / a0, b[1] / a0, b[2] / a0, 1.0, -2 * cos_w0 / a0, (1 - alpha) / a0]])
+
+
+def butterworth(order, cutoff, sample_rate, kind=LOWPASS):
+    """
+    A Butterworth low-pass or high-pass filter as cascaded second-order sections (bilinear transform).
+    :param order: The filter order.
+    :param cutoff: The -3dB frequency in Hz.
+    :param sample_rate: The sample rate in samples per second.
+    :param kind: (OPTIONAL) LOWPASS or HIGHPASS. Default: LOWPASS
+    :return: An (N, 6) array of sections, as for SOSFilter.
+    """
+    assert kind in (LOWPASS, HIGHPASS), "Butterworth filters are low-pass or high-pass."
+    # The pole pairs are at these angles from the negative real axis, and an odd order adds a real pole.
+    angles = (2 * np.arange(order // 2) + 1 + order % 2) * np.pi / (2 * order)
+    sections = [biquad(kind, cutoff, sample_rate, 1 / (2 * np.cos(angle))) for angle in angles]
+    if order % 2:
+        k = np.tan(np.pi * cutoff / sample_rate)
+        if kind == LOWPASS:
+            b = [k / (1 + k), k / (1 + k), 0.0]
+        else:
+            b = [1 / (1 + k), -1 / (1 + k), 0.0]
+        sections.append(np.array([b + [1.0, (k - 1) / (k + 1), 0.0]]))
+    return np.concatenate(sections)
+
+
+def frequency_response(coefficients, frequencies, sample_rate):
+    """
+    :param coefficients: FIR taps, or an (N, 6) array of second-order sections.
+    :param frequencies: The frequencies in Hz.
+    :param sample_rate: The sample rate in samples per second.
+    :return: The complex gain at the frequencies.
+    """
+    z = np.exp(-2j * np.pi * np.asarray(frequencies, dtype=np.float64) / sample_rate)
+    coefficients = np.asarray(coefficients, dtype=np.float64)
+    if coefficients.ndim == 1:
+        return np.polyval(coefficients[::-1], z)
+    response = np.ones_like(z)
+    for b0, b1, b2, a0, a1, a2 in coefficients:
+        response *= (b0 + b1 * z + b2 * z * z) / (a0 + a1 * z + a2 * z * z)
+    return response
+
+
+class _StreamingFilter(object):
+    """
+    The block handling shared by the filters: channel selection, gaps, the input conversion and decimation.
+    """
+
+    def __init__(self, decimation, volts_per_count, offset, channel):
+        assert channel in (1, 2), "The channel must be 1 or 2."
+        assert decimation >= 1, "The decimation must be at least 1."
+        self.decimation = int(decimation)
+        self.volts_per_count = volts_per_count
+        self.offset = offset
+        self.channel = channel
+        # Raw input y = (x - offset) * scale: the state starts at the offset, i.e. 0V.
+        self._scale = volts_per_count if volts_per_count is not None else 1.0
+        self._zero = float(offset) if volts_per_count is not None else 0.0
+
+    @classmethod
+    def from_scope(cls, scope, coefficients, channel=1, probe_multiplier=1, **kwargs):
+        """
+        Create a filter for a channel of an Oscilloscope, taking its raw ADC counts and producing volts, with its
+        current voltage range and calibration.
+        """
+        offset, volts_per_count = scope.channel_scale(channel, probe_multiplier)
+        return cls(coefficients, volts_per_count=volts_per_count, offset=offset, channel=channel, **kwargs)
+
+    def reset(self):
+        """
+        Start over at sample 0, with the filter at rest.
+        """
+        self.sample_position = 0
+        self.gaps = 0
+        self._restart()
+
+    def skip_to(self, sample_position):
+        """
+        Continue after a gap in the stream. The filter restarts at rest, as if the gap was 0V.
+        :param sample_position: The absolute index of the next sample.
+        """
+        self.gaps += 1
+        self.sample_position = sample_position
+        self._restart()
+
+    @property
+    def output_position(self):
+        """
+        :return: The index of the next output sample, at the decimated rate.
+        """
+        return -(-self.sample_position // self.decimation)
+
+    def feed(self, ch1_data, ch2_data=None, sample_offset=None):
+        """
+        Filter the next block, e.g. as the callback of read_async.
+        :param ch1_data: The next CH1 samples (bytes, array or NumPy array).
+        :param ch2_data: (OPTIONAL) The CH2 samples of the same block.
+        :param sample_offset: (OPTIONAL) The absolute index of the first sample, as passed by read_async with
+                              sample_offsets. Default: Contiguous
+        :return: The float32 filtered (and decimated) samples of the block, starting at output_position before the
+                 call.
+        """
+        data = ch1_data if self.channel == 1 else ch2_data
+        samples = data if isinstance(data, np.ndarray) else as_uint8_array(data)
+        if sample_offset is not None and sample_offset != self.sample_position:
+            self.skip_to(sample_offset)
+        output = self._filter(samples)
+        self.sample_position += len(samples)
+        return output
+
+    __call__ = feed
+
+
+class FIRFilter(_StreamingFilter):
+    """
+    An FIR filter applied by overlap-save FFT convolution, optionally keeping only every decimation-th output. With
+    decimation, the input is split into decimation phases which are convolved with the matching phases of the taps at
+    the output rate, so the cost drops with the decimation.
+    """
+
+    def __init__(self, taps, decimation=1, volts_per_count=None, offset=128, channel=1, fft_size=None):
+        """
+        :param taps: The filter taps, e.g. from fir_lowpass.
+        :param decimation: (OPTIONAL) Keep every decimation-th output. The taps should be a low-pass filter below
+                           sample_rate / (2 * decimation) then. Default: 1 (off)
+        :param volts_per_count: (OPTIONAL) The voltage step of one ADC count, to filter raw data into volts. Default:
+                                Output in the units of the data
+        :param offset: (OPTIONAL) The ADC count of 0V, with volts_per_count. Default: 128
+        :param channel: (OPTIONAL) The channel to filter, 1 or 2. Default: 1
+        :param fft_size: (OPTIONAL) The FFT size at the output rate. Default: A power of 2 of at least 8 times the
+                         taps per phase
+        """
+        super(FIRFilter, self).__init__(decimation, volts_per_count, offset, channel)
+        self.taps = np.asarray(taps, dtype=np.float64)
+        self.delay = (len(self.taps) - 1) / 2.0
+        # The taps of phase q act on the input phase (D - q) % D, one output sample later for q > 0.
+        decimation = self.decimation
+        phases = -(-len(self.taps) // decimation)
+        padded = np.zeros(phases * decimation)
+        padded[:len(self.taps)] = self.taps * self._scale
+        phase_taps = np.zeros((decimation, phases + (decimation > 1)))
+        phase_taps[0, :phases] = padded[0::decimation]
+        for q in range(1, decimation):
+            phase_taps[q, 1:] = padded[q::decimation]
+        self.phase_length = phase_taps.shape[1]
+        self.fft_size = fft_size or max(256, 1 << int(np.ceil(np.log2(8 * self.phase_length))))
+        assert self.fft_size > self.phase_length, "The FFT must be longer than the taps per phase."
+        self._hop = self.fft_size - self.phase_length + 1
+        # The input phase each row of the transformed taps is multiplied with.
+        self._spectra = np.fft.rfft(phase_taps[(decimation - np.arange(decimation)) % decimation], self.fft_size)
+        self._constant = self._zero * self._scale * self.taps.sum()
+        self.reset()
+
+    def _restart(self):
+        # The input from the history of the next output sample on, which starts at a multiple of the decimation.
+        start = (self.output_position - (self.phase_length - 1)) * self.decimation
+        self._pending = np.full(self.sample_position - start, self._zero, dtype=np.float32)
+
+    def _filter(self, samples):
+        decimation = self.decimation
+        pending = np.concatenate((self._pending, samples.astype(np.float32)))
+        # An output only needs the input up to its own sample, the first of its group.
+        groups = -(-len(pending) // decimation)
+        count = groups - (self.phase_length - 1)
+        if count <= 0:
+            self._pending = pending
+            return np.zeros(0, dtype=np.float32)
+        # The input phases, as rows at the output rate.
+        segments = -(-count // self._hop)
+        length = (segments - 1) * self._hop + self.fft_size
+        rows = np.zeros((length, decimation), dtype=np.float32)
+        rows.reshape(-1)[:len(pending)] = pending
+        rows = rows.T
+        stride = rows.strides
+        windows = np.lib.stride_tricks.as_strided(rows, (decimation, segments, self.fft_size),
+                                                  (stride[0], self._hop * stride[1], stride[1]), writeable=False)
+        spectra = np.fft.rfft(windows, axis=2)
+        spectra *= self._spectra[:, None, :]
+        filtered = np.fft.irfft(spectra.sum(axis=0), self.fft_size, axis=1)[:, self.phase_length - 1:]
+        output = filtered.reshape(-1)[:count].astype(np.float32)
+        output -= np.float32(self._constant)
+        self._pending = pending[count * decimation:]
+        return output
+
+
+class SOSFilter(_StreamingFilter):
+    """
+    An IIR filter of cascaded second-order sections, optionally keeping only every decimation-th output.
+    The recursion is solved a chunk of samples at a time, for the whole cascade at once: the response of a chunk is
+    the FFT convolution of its input with the impulse response of the cascade, plus the responses to the state at its
+    start, i.e. the last two inputs and the last two outputs of each section. The states at the chunk boundaries follow
+    from a scan over the chunks with powers of the chunk's state transition.
+    """
+
+    def __init__(self, sos, decimation=1, volts_per_count=None, offset=128, channel=1, chunk_size=256):
+        """
+        :param sos: An (N, 6) array of second-order sections [b0, b1, b2, a0, a1, a2], e.g. from butterworth.
+        :param decimation: (OPTIONAL) Keep every decimation-th output. Default: 1 (off)
+        :param volts_per_count: (OPTIONAL) The voltage step of one ADC count, to filter raw data into volts. Default:
+                                Output in the units of the data
+        :param offset: (OPTIONAL) The ADC count of 0V, with volts_per_count. Default: 128
+        :param channel: (OPTIONAL) The channel to filter, 1 or 2. Default: 1
+        :param chunk_size: (OPTIONAL) The samples per chunk of the recursion. Default: 256
+        """
+        super(SOSFilter, self).__init__(decimation, volts_per_count, offset, channel)
+        sos = np.array(sos, dtype=np.float64, ndmin=2)
+        assert sos.shape[1] == 6, "Each section needs six coefficients."
+        sos[:, :3] /= sos[:, 3:4]
+        sos[:, 4:] /= sos[:, 3:4]
+        sos[:, 3] = 1
+        poles = np.concatenate([np.roots(section[3:]) for section in sos])
+        assert np.all(np.abs(poles) < 1), "The filter is unstable."
+        self.sos = sos
+        self.chunk_size = chunk_size
+        self._responses = self._simulate(sos, chunk_size, self._scale)
+        self._impulse = np.fft.rfft(self._responses[-1, 0, 2:], 2 * chunk_size)
+        self._free = self._responses[-1, 1:, 2:]
+        self._chunk_end = self._end_state(chunk_size)
+        self.reset()
+
+    @staticmethod
+    def _simulate(sos, length, scale):
+        """
+        Run the cascade for length samples, for a unit impulse at rest and for each unit state.
+        :return: A (sections, 1 + states, 2 + length) array of the outputs of each section, after their two outputs
+                 before the start.
+        """
+        count = len(sos)
+        states = 2 + 2 * count
+        inputs = np.zeros((1 + states, 2 + length))
+        inputs[0, 2] = 1.0
+        inputs[1, 1] = 1.0
+        inputs[2, 0] = 1.0
+        responses = np.zeros((count, 1 + states, 2 + length))
+        for index, (b0, b1, b2, _, a1, a2) in enumerate(sos):
+            if index == 0:
+                b0, b1, b2 = b0 * scale, b1 * scale, b2 * scale
+            outputs = responses[index]
+            outputs[3 + 2 * index, 1] = 1.0
+            outputs[4 + 2 * index, 0] = 1.0
+            outputs[:, 2:] = b0 * inputs[:, 2:] + b1 * inputs[:, 1:-1] + b2 * inputs[:, :-2]
+            for n in range(2, length + 2):
+                outputs[:, n] -= a1 * outputs[:, n - 1] + a2 * outputs[:, n - 2]
+            inputs = outputs
+        return responses
+
+    def _end_state(self, length):
+        """
+        :param length: The samples of a chunk.
+        :return: (gain, transition) giving the state after a chunk as input.dot(gain) + transition.dot(state before).
+        """
+        responses = self._responses
+        states = responses.shape[1] - 1
+        gain = np.zeros((length, states))
+        transition = np.zeros((states, states))
+        # The last two inputs.
+        gain[length - 1, 0] = 1.0
+        if length > 1:
+            gain[length - 2, 1] = 1.0
+        else:
+            transition[1, 0] = 1.0
+        # The last two outputs of each section.
+        for index in range(len(responses)):
+            for column, end in ((2 + 2 * index, length + 1), (3 + 2 * index, length)):
+                gain[:end - 1, column] = responses[index, 0, 2:end + 1][::-1]
+                transition[column] = responses[index, 1:, end]
+        return gain, transition
+
+    def _restart(self):
+        self._state = np.zeros(self._responses.shape[1] - 1)
+
+    def _filter(self, samples):
+        length = len(samples)
+        if not length:
+            return np.zeros(0, dtype=np.float32)
+        size = self.chunk_size
+        chunks = -(-length // size)
+        padded = np.zeros((chunks, size))
+        padded.reshape(-1)[:length] = samples
+        padded.reshape(-1)[:length] -= self._zero
+        forced = np.fft.irfft(np.fft.rfft(padded, 2 * size, axis=1) * self._impulse, 2 * size, axis=1)[:, :size]
+        gain, transition = self._chunk_end
+        ends = padded.dot(gain)
+        last = length - (chunks - 1) * size
+        if last < size:
+            last_gain, last_transition = self._end_state(last)
+            ends[-1] = padded[-1, :last].dot(last_gain)
+        # The state at the start of each chunk: state[c + 1] = ends[c] + transition.dot(state[c]), as a scan which
+        # adds the sum over twice as many chunks back each step.
+        states = np.concatenate(([self._state], ends))
+        power, distance = transition.T, 1
+        while distance < len(states):
+            states[distance:] += states[:-distance].dot(power)
+            power, distance = power.dot(power), distance * 2
+        starts = states[:-1]
+        self._state = states[-1] if last == size else ends[-1] + last_transition.dot(starts[-1])
+        output = (forced + starts.dot(self._free)).reshape(-1)[:length]
+        start = (-self.sample_position) % self.decimation
+        return output[start::self.decimation].astype(np.float32)
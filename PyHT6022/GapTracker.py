@@ -0,0 +1,113 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+
+class GapTracker(object):
+    """
+    Keeps the timebase of an async read: a running counter of the samples (per channel) received or lost so far, and
+    a gap map of where samples went missing. Isochronous packets which complete with an error status carry no data,
+    but the scope sampled it all the same, so each of them advances the counter by a full packet. Without this,
+    every lost microframe would silently shift all later samples back in time.
+    """
+
+    def __init__(self, num_channels=2, packet_size=None):
+        """
+        :param num_channels: (OPTIONAL) The number of channels interleaved in the data. Default: 2
+        :param packet_size: (OPTIONAL) The isochronous packet size in bytes, which is the data assumed lost with each
+                            failed packet. Default: None (bulk)
+        """
+        self.num_channels = num_channels
+        self.packet_size = packet_size
+        self.reset()
+
+    def reset(self):
+        """
+        Start counting from sample 0 again.
+        """
+        self.byte_position = 0
+        # (sample index, missing samples) for every gap, oldest first. Consecutive lost packets are one gap.
+        self.gaps = []
+        self.packets = 0
+        self.lost_packets = 0
+        self.short_packets = 0
+        self.failed_transfers = 0
+        self.received_bytes = 0
+        self.lost_bytes = 0
+
+    @property
+    def sample_position(self):
+        """
+        :return: The absolute index of the next sample (per channel).
+        """
+        return self.byte_position // self.num_channels
+
+    def iso_packet(self, status, actual_length, length=None):
+        """
+        Count an isochronous packet.
+        :param status: The status of the packet, 0 (completed) if it was received.
+        :param actual_length: The number of bytes received.
+        :param length: (OPTIONAL) The size of the packet slot. Default: packet_size
+        :return: The sample index of the first sample in the packet's data.
+        """
+        self.packets += 1
+        if status:
+            self.lost_packets += 1
+            self.lost(length or self.packet_size)
+        elif actual_length < (length or self.packet_size):
+            # Short packets are normal at low sample rates, when the FIFO holds less than a packet per microframe.
+            self.short_packets += 1
+        return self.received(actual_length)
+
+    def received(self, num_bytes):
+        """
+        Count received data.
+        :param num_bytes: The number of bytes received.
+        :return: The sample index of the first sample in the data.
+        """
+        sample_index = self.byte_position // self.num_channels
+        self.byte_position += num_bytes
+        self.received_bytes += num_bytes
+        return sample_index
+
+    def lost(self, num_bytes):
+        """
+        Count data the scope sampled, but which never arrived.
+        :param num_bytes: The number of bytes lost.
+        """
+        sample_index = self.byte_position // self.num_channels
+        missing = num_bytes // self.num_channels
+        if self.gaps and self.gaps[-1][0] + self.gaps[-1][1] == sample_index:
+            self.gaps[-1] = (self.gaps[-1][0], self.gaps[-1][1] + missing)
+        else:
+            self.gaps.append((sample_index, missing))
+        self.byte_position += num_bytes
+        self.lost_bytes += num_bytes
+
+    def failed_transfer(self):
+        """
+        Count a transfer which completed with an error status.
+        """
+        self.failed_transfers += 1
+
+    def gap_map(self, sample_rate=None):
+        """
+        :param sample_rate: (OPTIONAL) The sample rate in samples per second, to convert the gaps to seconds.
+        :return: A list of (sample index, missing samples) per gap, or (start time, missing time) in seconds if
+                 sample_rate is given.
+        """
+        if sample_rate is None:
+            return list(self.gaps)
+        return [(sample_index / float(sample_rate), missing / float(sample_rate)) for sample_index, missing in self.gaps]
+
+    def counters(self):
+        """
+        :return: A dict of the aggregate counters.
+        """
+        return {'samples': self.sample_position,
+                'packets': self.packets,
+                'lost_packets': self.lost_packets,
+                'short_packets': self.short_packets,
+                'failed_transfers': self.failed_transfers,
+                'received_bytes': self.received_bytes,
+                'lost_bytes': self.lost_bytes,
+                'gaps': len(self.gaps),
+                'missing_samples': sum(missing for _, missing in self.gaps)}
@@ -0,0 +1,181 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# Full rate histograms and statistics of the ADC counts of both channels, at the cost of one bincount per channel and
+# block:
+#
+#     histogram = ADCHistogram.from_scope(scope, window=1.0)
+#     scope.read_async(histogram, 0x10000, as_numpy=True, event_thread=True, sample_offsets=True)
+#     ...
+#     print(histogram.statistics(1)['rms'], histogram.clipping(1))
+#
+# The samples are 8 bit, so the 256 bin histogram of a channel holds all there is to its amplitude distribution:
+# count, min, max, mean, RMS and standard deviation follow from it exactly, without converting any sample to float.
+# Besides the cumulative histograms, the stream is cut into slices of window / slices seconds by absolute sample index,
+# and the histograms of the slices within the window are kept with their running sum, for a view of the last window
+# seconds which is updated by adding the newest and subtracting the expired slices. Counts at the ADC codes 0 and 255
+# are clipped samples: the signal exceeds the voltage range, and a coarser range is needed.
+
+import collections
+
+import numpy as np
+
+from PyHT6022.SampleConversion import as_uint8_array
+
+CODES = np.arange(256, dtype=np.float64)
+
+
+def histogram_statistics(counts, volts_per_count=None, offset=128):
+    """
+    The statistics of samples from their histogram.
+    :param counts: The number of samples at each ADC count, 256 values.
+    :param volts_per_count: (OPTIONAL) The voltage step of one ADC count, for values in volts. Default: In counts
+    :param offset: (OPTIONAL) The ADC count of 0V, with volts_per_count. Default: 128
+    :return: A dict of count, min, max, mean, rms and std, the latter all None without samples, and clipped, the
+             fraction of the samples at the lowest or highest ADC count.
+    """
+    count = int(counts.sum())
+    if not count:
+        return dict(dict.fromkeys(('min', 'max', 'mean', 'rms', 'std')), count=0, clipped=0.0)
+    if volts_per_count is None:
+        offset, volts_per_count = 0, 1.0
+    values = (CODES - offset) * volts_per_count
+    present = np.flatnonzero(counts)
+    mean = float(np.dot(counts, values)) / count
+    mean_square = float(np.dot(counts, values * values)) / count
+    return {'count': count, 'min': float(values[present[0]]), 'max': float(values[present[-1]]), 'mean': mean,
+            'rms': np.sqrt(mean_square), 'std': np.sqrt(max(mean_square - mean * mean, 0.0)),
+            'clipped': float(counts[0] + counts[255]) / count}
+
+
+class ADCHistogram(object):
+    """
+    Histograms of the ADC counts of each channel of the read_async stream, cumulative and over a sliding window.
+    """
+
+    def __init__(self, sample_rate, window=1.0, slices=10, volts_per_count=None, offset=128):
+        """
+        :param sample_rate: The sample rate per channel, in samples per second.
+        :param window: (OPTIONAL) The length of the sliding window, in seconds. Default: 1 s
+        :param slices: (OPTIONAL) The number of steps the window moves in, the newest of which is being filled.
+                       Default: 10
+        :param volts_per_count: (OPTIONAL) The voltage step of one ADC count of (CH1, CH2), for statistics in volts.
+                                Default: In counts
+        :param offset: (OPTIONAL) The ADC count of 0V of (CH1, CH2), or of both, with volts_per_count. Default: 128
+        """
+        assert slices >= 1, "The window needs at least one slice."
+        self.sample_rate = float(sample_rate)
+        self.window = window
+        self.slices = int(slices)
+        self.slice_size = max(1, int(round(window * self.sample_rate / self.slices)))
+        self.volts_per_count = tuple(volts_per_count) if volts_per_count is not None else (None, None)
+        self.offset = tuple(offset) if hasattr(offset, '__len__') else (offset, offset)
+        self.reset()
+
+    @classmethod
+    def from_scope(cls, scope, probe_multipliers=(1, 1), **kwargs):
+        """
+        Create histograms for the channels of an Oscilloscope, with its current sample rate, voltage ranges and
+        calibration.
+        """
+        sample_rate = scope.sample_rate_hz(scope.sample_rate_index)
+        offsets, volts_per_count = zip(*(scope.channel_scale(channel, probe_multiplier)
+                                         for channel, probe_multiplier in zip((1, 2), probe_multipliers)))
+        return cls(sample_rate, volts_per_count=volts_per_count, offset=offsets, **kwargs)
+
+    def reset(self):
+        """
+        Forget all counts, e.g. after changing a voltage range.
+        """
+        self.sample_position = 0
+        self.gaps = 0
+        self.cumulative = np.zeros((2, 256), dtype=np.int64)
+        self.windowed = np.zeros((2, 256), dtype=np.int64)
+        # [slice index, counts] of the slices in the window, oldest first.
+        self._slices = collections.deque()
+
+    def skip_to(self, sample_position):
+        """
+        Continue after a gap in the stream. The window keeps its time span, so it holds fewer samples for a while.
+        :param sample_position: The absolute index of the next sample.
+        """
+        self.gaps += 1
+        self.sample_position = sample_position
+        self._expire(sample_position // self.slice_size)
+
+    def _expire(self, newest):
+        """
+        Drop the slices which are out of the window when slice newest is being filled.
+        """
+        slices = self._slices
+        while slices and slices[0][0] <= newest - self.slices:
+            self.windowed -= slices.popleft()[1]
+
+    def feed(self, ch1_data, ch2_data=None, sample_offset=None):
+        """
+        Add the next block, e.g. as the callback of read_async.
+        :param ch1_data: The next CH1 samples (bytes, array or NumPy array of ADC counts).
+        :param ch2_data: (OPTIONAL) The CH2 samples of the same block, if captured.
+        :param sample_offset: (OPTIONAL) The absolute index of the first sample, as passed by read_async with
+                              sample_offsets. Default: Contiguous
+        """
+        channels = [(row, data if isinstance(data, np.ndarray) else as_uint8_array(data))
+                    for row, data in enumerate((ch1_data, ch2_data)) if data is not None and len(data)]
+        if not channels:
+            return
+        if sample_offset is not None and sample_offset != self.sample_position:
+            self.skip_to(sample_offset)
+        start, length = self.sample_position, len(channels[0][1])
+        position = start
+        while position < start + length:
+            index = position // self.slice_size
+            stop = min((index + 1) * self.slice_size, start + length)
+            self._expire(index)
+            if not self._slices or self._slices[-1][0] != index:
+                self._slices.append([index, np.zeros((2, 256), dtype=np.int64)])
+            counts = self._slices[-1][1]
+            for row, samples in channels:
+                block_counts = np.bincount(samples[position - start:stop - start], minlength=256)
+                counts[row] += block_counts
+                self.windowed[row] += block_counts
+                self.cumulative[row] += block_counts
+            position = stop
+        self.sample_position = start + length
+
+    __call__ = feed
+
+    def counts(self, channel=1, windowed=False):
+        """
+        :param channel: (OPTIONAL) The channel, 1 or 2. Default: 1
+        :param windowed: (OPTIONAL) Count the samples in the sliding window only. Default: All samples
+        :return: The number of samples at each ADC count, 256 values.
+        """
+        assert channel in (1, 2), "The channel must be 1 or 2."
+        return (self.windowed if windowed else self.cumulative)[channel - 1]
+
+    def statistics(self, channel=1, windowed=False):
+        """
+        :param channel: (OPTIONAL) The channel, 1 or 2. Default: 1
+        :param windowed: (OPTIONAL) Over the samples in the sliding window only. Default: All samples
+        :return: The statistics of the channel, see histogram_statistics, in volts with volts_per_count.
+        """
+        return histogram_statistics(self.counts(channel, windowed), self.volts_per_count[channel - 1],
+                                    self.offset[channel - 1])
+
+    def clipping(self, channel=1, windowed=True):
+        """
+        :param channel: (OPTIONAL) The channel, 1 or 2. Default: 1
+        :param windowed: (OPTIONAL) Over the samples in the sliding window only. Default: On
+        :return: (fraction of samples at the lowest ADC count, fraction at the highest), 0 without samples.
+        """
+        counts = self.counts(channel, windowed)
+        count = max(int(counts.sum()), 1)
+        return float(counts[0]) / count, float(counts[255]) / count
+
+    def is_clipping(self, channel=1, threshold=1e-4, windowed=True):
+        """
+        :param channel: (OPTIONAL) The channel, 1 or 2. Default: 1
+        :param threshold: (OPTIONAL) The fraction of clipped samples above which the range is too small. Default: 1e-4
+        :param windowed: (OPTIONAL) Over the samples in the sliding window only. Default: On
+        :return: True if the signal exceeds the voltage range of the channel.
+        """
+        return sum(self.clipping(channel, windowed)) > threshold
@@ -9,9 +9,36 @@ import libusb1
 import threading
 from struct import pack
 
+from PyHT6022.HantekFirmware import default_firmware, fx2_ihex_to_control_packets
+from PyHT6022.TransferBufferPool import TransferBufferPool
+from PyHT6022.Calibration import CalibrationModel
+from PyHT6022.EventThread import AsyncReadSet, USBEventThread
+from PyHT6022.BlockRingBuffer import BlockRingBuffer, BufferOverrunError
+from PyHT6022.GapTracker import GapTracker
+
+try:
+    from PyHT6022 import SampleConversion
+except ImportError:
+    # NumPy is optional, it is only needed for the as_numpy and as_volts read modes.
+    SampleConversion = None
+
 isPython3 = '3' == sys.version[0]
 
-from PyHT6022.HantekFirmware import default_firmware, fx2_ihex_to_control_packets
+# The array conversion tables of scale_read_data without NumPy, by (voltage_range, probe_multiplier).
+_scale_tables = {}
+
+
+def skip_cancelled(transfer_callback):
+    """
+    Wrap an async transfer callback, so that it is not called for transfers cancelled by reap_transfers.
+    """
+    cancelled = libusb1.LIBUSB_TRANSFER_CANCELLED
+
+    def completion_callback(transfer):
+        if transfer.getStatus() != cancelled:
+            transfer_callback(transfer)
+    return completion_callback
+
 
 class Oscilloscope(object):
     NO_FIRMWARE_VENDOR_ID = 0x04B4
@@ -50,26 +77,48 @@ class Oscilloscope(object):
                     0x14: ("200 KS/s", 200e3),
                     0x32: ("500 KS/s", 500e3),
                     0x01: ("1 MS/s", 1e6),
+                    0x02: ("2 MS/s", 2e6),
                     0x04: ("4 MS/s", 4e6),
                     0x08: ("8 MS/s", 8e6),
+                    0x0C: ("12 MS/s", 12e6),
                     0x10: ("16 MS/s", 16e6),
-                    0x30: ("24 MS/s", 24e6)}
+                    0x18: ("24 MS/s", 24e6),
+                    0x1E: ("30 MS/s", 30e6),
+                    0x30: ("48 MS/s", 48e6)}
 
     VOLTAGE_RANGES = {0x01: ('+/- 5V', 0.0390625, 2.5),
                       0x02: ('+/- 2.5V', 0.01953125, 1.25),
                       0x05: ('+/- 1V', 0.0078125, 0.5),
                       0x0a: ('+/- 500mV', 0.00390625, 0.25)}
 
-    def __init__(self, scope_id=0):
+    def __init__(self, scope_id=0, context=None):
+        """
+        :param scope_id: (OPTIONAL) The id of the scope to use. Default: 0
+        :param context: (OPTIONAL) The USB context to look for the scope in, e.g. a SimulatedUSBContext from
+                        PyHT6022.SimulatedScope to run without hardware. Default: A new usb1.USBContext
+        """
         self.device = None
         self.device_handle = None
-        self.context = usb1.USBContext()
+        self.context = context if context is not None else usb1.USBContext()
         self.is_device_firmware_present = False
         self.supports_single_channel = False
         self.is_iso = False
         self.packetsize = None
         self.num_channels = 2
         self.scope_id = scope_id
+        self.transfer_buffer_pool = None
+        self.block_ring_buffer = None
+        # The sample counter and gap map of the last async read.
+        self.gap_tracker = None
+        # The transfers of all async reads which have not been reaped yet, and the thread handling their events.
+        self.async_reads = AsyncReadSet()
+        self.event_thread = None
+        # Device settings as last set through this object (the firmware defaults until then).
+        self.sample_rate_index = 0x01
+        self.ch1_voltage_range = 0x01
+        self.ch2_voltage_range = 0x01
+        # The decoded EEPROM calibration, once loaded with load_calibration. Used by the as_volts conversions.
+        self.calibration = None
 
     def setup(self):
         """
@@ -111,6 +160,7 @@ class Oscilloscope(object):
         """
         if not self.device_handle:
             return True
+        self.reap_transfers()
         if release_interface:
             self.device_handle.releaseInterface(0)
         self.device_handle.close()
@@ -123,6 +173,38 @@ class Oscilloscope(object):
     def poll(self):
         self.context.handleEvents()
 
+    def start_event_thread(self, timeout=0.1):
+        """
+        Handle the USB events of the async reads on a dedicated thread, instead of calling poll() in a loop. The thread
+        blocks in libusb for up to timeout seconds at a time instead of spinning, and exits by itself once every
+        async read has been shut down and reaped. read_async(event_thread=True) starts it automatically.
+        :param timeout: (OPTIONAL) The longest time to block waiting for events, in seconds. Default: 0.1 s
+        :return: The running USBEventThread.
+        """
+        if self.event_thread is None or not self.event_thread.claim():
+            self.event_thread = USBEventThread(self.context, self.async_reads, timeout=timeout)
+            self.event_thread.start()
+        return self.event_thread
+
+    def reap_transfers(self, grace_period=0.5):
+        """
+        Shut down all async reads and wait until all of their transfers have completed or been cancelled. This is done
+        by close_handle, so the handle is never closed with transfers in flight.
+        :param grace_period: (OPTIONAL) Seconds to let in flight transfers complete before cancelling them.
+                             Default: 0.5 s
+        :return: True once everything has been reaped.
+        """
+        self.async_reads.shutdown()
+        event_thread = self.event_thread
+        if event_thread is not None and event_thread.is_alive():
+            # Bounded, since a daemon thread never finishes while the interpreter shuts down. Whatever it leaves is
+            # reaped below.
+            event_thread.join(grace_period + 1.0)
+        while self.async_reads.reap(grace_period):
+            self.context.handleEventsTimeout(0.1)
+        self.event_thread = None
+        return True
+
     def flash_firmware(self, firmware=default_firmware, supports_single_channel=True, timeout=60):
         """
         Flash scope firmware to the target scope device. This needs to occur once when the device is first attached,
@@ -190,7 +272,7 @@ class Oscilloscope(object):
                                                         b'\x00', timeout=timeout)
         assert bytes_written == 1
         if not to_ihex:
-            return ''.join(firmware_chunk_list)
+            return b''.join(firmware_chunk_list)
         else:
             lines = []
             for i, chunk in enumerate(firmware_chunk_list):
@@ -225,8 +307,23 @@ class Oscilloscope(object):
         :param timeout: (OPTIONAL) A timeout for the transfer. Default: 0 (No timeout)
         :return: True if successful. May assert or raise various libusb errors if something went wrong.
         """
-        cal_list = cal_list if isinstance(cal_list, basestring) else array.array('c', cal_list).tostring()
-        return self.write_eeprom(self.CALIBRATION_EEPROM_OFFSET, cal_list, timeout=timeout)
+        cal_list = bytes(bytearray(cal_list))
+        result = self.write_eeprom(self.CALIBRATION_EEPROM_OFFSET, cal_list, timeout=timeout)
+        if self.calibration is not None:
+            self.calibration = CalibrationModel.from_eeprom(cal_list)
+        return result
+
+    def load_calibration(self, refresh=False, timeout=0):
+        """
+        Read and decode the calibration values from the oscilloscope, once. Afterwards, the as_volts read modes and
+        scale_channel_data correct the zero offset (and gain, if set) of each channel and voltage range for free.
+        :param refresh: (OPTIONAL) Read the calibration values again, even if they were read before. Default: Off
+        :param timeout: (OPTIONAL) A timeout for the transfer. Default: 0 (No timeout)
+        :return: The CalibrationModel of this scope, which is cached in the calibration attribute.
+        """
+        if self.calibration is None or refresh:
+            self.calibration = CalibrationModel.from_eeprom(self.get_calibration_values(timeout=timeout))
+        return self.calibration
 
     def read_eeprom(self, offset, length, timeout=0):
         """
@@ -280,12 +377,17 @@ class Oscilloscope(object):
                                                         b'\x00', timeout=timeout)
         return bytes_written == 1
 
-    def read_data(self, data_size=0x400, raw=False, timeout=0):
+    def read_data(self, data_size=0x400, raw=False, timeout=0, as_numpy=False, as_volts=False):
         """
         Read both channel's ADC data from the device. No trigger support, you need to do this in software.
         :param data_size: (OPTIONAL) The number of data points for each channel to retrieve. Default: 0x400 points.
         :param raw: (OPTIONAL) Return the raw bytestrings from the scope. Default: Off
         :param timeout: (OPTIONAL) The timeout for each bulk transfer from the scope. Default: 0 (No timeout)
+        :param as_numpy: (OPTIONAL) Return NumPy uint8 arrays which are views into the transfer buffer (no copy).
+                         With two channels, this is a single (2, N) array which unpacks into CH1 and CH2. Requires
+                         NumPy. Default: Off
+        :param as_volts: (OPTIONAL) Return NumPy float32 arrays of voltages, converted in one vectorized pass using
+                         the voltage ranges last set on each channel. Requires NumPy. Default: Off
         :return: If raw, two bytestrings are returned, the first for CH1, the second for CH2. If raw is off, two
                  lists are returned (by iterating over the bytestrings and converting to ordinals). The lists contain
                  the ADC value measured at that time, which should be between 0 - 255.
@@ -302,19 +404,23 @@ class Oscilloscope(object):
         self.start_capture()
         data = self.device_handle.bulkRead(0x86, data_size, timeout=timeout)
         self.stop_capture()
+        if as_numpy or as_volts:
+            return self.build_numpy_converter(as_volts)(data)
         if self.num_channels == 2:
             chdata = data[::2], data[1::2]
         else:
-            chdata = data, ''
+            chdata = data, b''
         if raw:
             return chdata
         else:
             return array.array('B', chdata[0]), array.array('B', chdata[1])
 
-    def build_data_reader(self, raw=False):
+    def build_data_reader(self, raw=False, as_numpy=False, as_volts=False):
         """
         Build a (slightly) more optimized reader closure, for (slightly) better performance.
         :param raw: (OPTIONAL) Return the raw bytestrings from the scope. Default: Off
+        :param as_numpy: (OPTIONAL) Return NumPy uint8 views, as in read_data. Default: Off
+        :param as_volts: (OPTIONAL) Return NumPy float32 voltages, as in read_data. Default: Off
         :return: A fast_read_data function, which behaves much like the read_data function. The fast_read_data
                  function returned takes two parameters:
                  :param data_size: Number of data points to return (1 point <-> 1 byte).
@@ -329,14 +435,21 @@ class Oscilloscope(object):
             assert self.open_handle()
         scope_bulk_read = self.device_handle.bulkRead
         array_builder = array.array
-        if self.num_channels == 1 and raw:
+        if as_numpy or as_volts:
+            converter = self.build_numpy_converter(as_volts)
+            num_channels = self.num_channels
+
+            def fast_read_data(data_size, timeout=0):
+                data = scope_bulk_read(0x86, data_size * num_channels, timeout)
+                return converter(data)
+        elif self.num_channels == 1 and raw:
             def fast_read_data(data_size, timeout=0):
                 data = scope_bulk_read(0x86, data_size, timeout)
-                return data, ''
+                return data, b''
         elif self.num_channels == 1 and not raw:
             def fast_read_data(data_size, timeout=0):
                 data = scope_bulk_read(0x86, data_size, timeout)
-                return array_builder('B', data), array_builder('B', '')
+                return array_builder('B', data), array_builder('B', b'')
         elif self.num_channels == 2 and raw:
             def fast_read_data(data_size, timeout=0):
                 data_size <<= 0x1
@@ -352,6 +465,86 @@ class Oscilloscope(object):
             assert False
         return fast_read_data
 
+    def build_numpy_converter(self, as_volts=False, copy=False):
+        """
+        Build the function used by the NumPy read modes to turn a raw transfer buffer into per channel arrays.
+        :param as_volts: (OPTIONAL) Convert to float32 voltages, using the voltage ranges set at the time of each
+                         conversion. Otherwise return uint8 ADC counts. Default: Off
+        :param copy: (OPTIONAL) Copy the uint8 samples out of the buffer, for buffers which are about to be reused.
+                     Default: Off
+        :return: A converter function taking the raw data and returning a (CH1, CH2) pair of arrays. With two
+                 channels this is a single (2, N) array, with one channel the CH2 array is empty.
+        """
+        if SampleConversion is None:
+            raise ImportError("NumPy is required for the as_numpy and as_volts read modes.")
+        deinterleave = SampleConversion.deinterleave
+        apply_tables = SampleConversion.apply_tables
+        conversion_table = self.conversion_table
+        num_channels = self.num_channels
+        channels = (1, 2)[:num_channels]
+
+        if as_volts:
+            def converter(data):
+                samples = deinterleave(data, num_channels)
+                volts = apply_tables(samples, [conversion_table(channel) for channel in channels])
+                return volts if num_channels == 2 else (volts[0], volts[0][:0])
+        else:
+            def converter(data):
+                samples = deinterleave(data, num_channels)
+                if copy:
+                    samples = samples.copy()
+                return samples if num_channels == 2 else (samples[0], samples[0][:0])
+        return converter
+
+    def conversion_table(self, channel, probe_multiplier=1, dtype='float32'):
+        """
+        Look up the conversion table for a channel at its current voltage range, including the calibration
+        correction if load_calibration was called. Requires NumPy.
+        :param channel: The channel, 1 or 2.
+        :param probe_multiplier: (OPTIONAL) An additonal multiplictive factor for changing the probe impedance.
+                                 Default: 1
+        :param dtype: (OPTIONAL) The float type of the table. Default: float32
+        :return: A read-only NumPy array of 256 voltages, indexed by ADC count.
+        """
+        if SampleConversion is None:
+            raise ImportError("NumPy is required for conversion tables.")
+        voltage_range = self.ch1_voltage_range if channel == 1 else self.ch2_voltage_range
+        if self.calibration is not None:
+            return self.calibration.conversion_table(channel, voltage_range, self.sample_rate_index,
+                                                     probe_multiplier, dtype)
+        return SampleConversion.conversion_table(voltage_range, probe_multiplier, dtype)
+
+    def channel_scale(self, channel, probe_multiplier=1):
+        """
+        The linear mapping of the conversion table of a channel, for processing that works on raw ADC counts: the
+        same voltage range and calibration correction (if load_calibration was called), as two numbers.
+        :param channel: The channel, 1 or 2.
+        :param probe_multiplier: (OPTIONAL) An additonal multiplictive factor for changing the probe impedance.
+                                 Default: 1
+        :return: (the ADC count of 0V, the voltage step of one ADC count).
+        """
+        voltage_range = self.ch1_voltage_range if channel == 1 else self.ch2_voltage_range
+        volts_per_count = (5.0 * probe_multiplier) / (voltage_range << 7)
+        if self.calibration is None:
+            return 128, volts_per_count
+        return (128 + self.calibration.offset(channel, voltage_range, self.sample_rate_index),
+                volts_per_count * self.calibration.gain(channel, voltage_range))
+
+    def scale_channel_data(self, read_data, channel, probe_multiplier=1, out=None, dtype='float32'):
+        """
+        Like scale_read_data, but for a channel at its current voltage range and with the calibration correction
+        applied if load_calibration was called. Requires NumPy.
+        :param read_data: The points of the channel returned from the read_data functions.
+        :param channel: The channel the data was read from, 1 or 2.
+        :param probe_multiplier: (OPTIONAL) An additonal multiplictive factor for changing the probe impedance.
+                                 Default: 1
+        :param out: (OPTIONAL) A preallocated float NumPy array of the same length to write the voltages into.
+        :param dtype: (OPTIONAL) The float type of the result, if out is not given. Default: float32
+        :return: A NumPy array of corrected voltages (out, if given).
+        """
+        table = self.conversion_table(channel, probe_multiplier, dtype if out is None else out.dtype)
+        return table.take(SampleConversion.as_uint8_array(read_data), out=out, mode='clip')
+
     def set_interface(self, alt):
         """
         Set the alternative interface (bulk or iso) to use.  This is only
@@ -375,87 +568,197 @@ class Oscilloscope(object):
         self.packetsize = ((maxpacketsize >> 11)+1) * (maxpacketsize & 0x7ff)
         return True
 
-    def read_async_iso(self, callback, packets, outstanding_transfers, raw):
+    def build_splitter(self, raw=False):
         """
-        Internal function to read from isochronous channel.  External
-        users should call read_async.
+        Build the function used by the async reads to split raw data into the two channels, for the modes without
+        NumPy. It is the counterpart of build_numpy_converter.
+        :param raw: (OPTIONAL) Split into bytestrings instead of arrays of bytes. Default: Off
+        :return: A function taking the raw data and returning a (CH1, CH2) pair.
         """
         array_builder = array.array
-        shutdown_event = threading.Event()
-        shutdown_is_set = shutdown_event.is_set
         if self.num_channels == 1 and raw:
-            def transfer_callback(iso_transfer):
-                for (status, data) in iso_transfer.iterISO():
-                    callback(data, '')
-                if not shutdown_is_set():
-                    iso_transfer.submit()
+            def splitter(data):
+                return data, b''
         elif self.num_channels == 1 and not raw:
-            def transfer_callback(iso_transfer):
-                for (status, data) in iso_transfer.iterISO():
-                    callback(array_builder('B', data), [])
-                if not shutdown_is_set():
-                    iso_transfer.submit()
+            def splitter(data):
+                return array_builder('B', data), []
         elif self.num_channels == 2 and raw:
+            def splitter(data):
+                return data[::2], data[1::2]
+        elif self.num_channels == 2 and not raw:
+            def splitter(data):
+                return array_builder('B', data[::2]), array_builder('B', data[1::2])
+        else:
+            assert False
+        return splitter
+
+    def read_async_iso(self, callback, packets, outstanding_transfers, raw, converter=None, sample_offsets=False):
+        """
+        Internal function to read from isochronous channel.  External
+        users should call read_async.
+        """
+        shutdown_event = threading.Event()
+        shutdown_is_set = shutdown_event.is_set
+        split = converter or self.build_splitter(raw)
+        iso_packet = self.gap_tracker.iso_packet
+        if sample_offsets:
             def transfer_callback(iso_transfer):
                 for (status, data) in iso_transfer.iterISO():
-                    callback(data[::2], data[1::2])
+                    ch1_data, ch2_data = split(data)
+                    callback(ch1_data, ch2_data, iso_packet(status, len(data)))
                 if not shutdown_is_set():
                     iso_transfer.submit()
-        elif self.num_channels == 2 and not raw:
+        else:
             def transfer_callback(iso_transfer):
                 for (status, data) in iso_transfer.iterISO():
-                    callback(array_builder('B', data[::2]), array_builder('B', data[1::2]))
+                    iso_packet(status, len(data))
+                    callback(*split(data))
                 if not shutdown_is_set():
                     iso_transfer.submit()
-        else:
-            assert False
+        transfers = []
         for _ in range(outstanding_transfers):
             transfer = self.device_handle.getTransfer(iso_packets=packets)
-            transfer.setIsochronous(0x82, (packets*self.packetsize), callback=transfer_callback)
+            transfer.setIsochronous(0x82, (packets*self.packetsize), callback=skip_cancelled(transfer_callback))
+            transfer.submit()
+            transfers.append(transfer)
+        self.async_reads.add(shutdown_event, transfers)
+        return shutdown_event
+
+    def read_async_iso_zero_copy(self, callback, packets, outstanding_transfers, auto_release, converter=None,
+                                 sample_offsets=False):
+        """
+        Internal function to read from isochronous channel into a pool of preallocated buffers.  External
+        users should call read_async.
+        """
+        shutdown_event = threading.Event()
+        pool = TransferBufferPool(outstanding_transfers, packets*self.packetsize, shutdown_event)
+        self.transfer_buffer_pool = pool
+        hold, release = pool.hold, pool.release
+        num_channels = self.num_channels
+        iso_packet = self.gap_tracker.iso_packet
+
+        def transfer_callback(iso_transfer):
+            buffer = iso_transfer.getUserData()
+            view = memoryview(buffer)
+            # Packets shorter than their slot leave holes in the buffer, close them up in place so the consumer
+            # gets one contiguous block. In the common case (all packets full) nothing is moved.
+            length = position = 0
+            sample_offset = None
+            for setup in iso_transfer.getISOSetupList():
+                actual_length = setup['actual_length']
+                packet_offset = iso_packet(setup['status'], actual_length, setup['length'])
+                if sample_offset is None:
+                    sample_offset = packet_offset
+                if position != length:
+                    view[length:length + actual_length] = view[position:position + actual_length]
+                length += actual_length
+                position += setup['length']
+            view = view[:length]
+            hold(buffer)
+            if converter is not None:
+                ch1_data, ch2_data = converter(view)
+            elif num_channels == 2:
+                ch1_data, ch2_data = view[::2], view[1::2]
+            else:
+                ch1_data, ch2_data = view, view[0:0]
+            if sample_offsets:
+                callback(ch1_data, ch2_data, sample_offset)
+            else:
+                callback(ch1_data, ch2_data)
+            if auto_release:
+                release(buffer)
+
+        transfers = []
+        for buffer in pool:
+            transfer = self.device_handle.getTransfer(iso_packets=packets)
+            transfer.setIsochronous(0x82, buffer, callback=skip_cancelled(transfer_callback), user_data=buffer)
+            pool.attach(buffer, transfer)
             transfer.submit()
+            transfers.append(transfer)
+        self.async_reads.add(shutdown_event, transfers)
         return shutdown_event
 
-    def read_async_bulk(self, callback, packets, outstanding_transfers, raw):
+    def read_async_bulk(self, callback, packets, outstanding_transfers, raw, converter=None, sample_offsets=False):
         """
         Internal function to read from bulk channel.  External
         users should call read_async.
         """
-        array_builder = array.array
         shutdown_event = threading.Event()
         shutdown_is_set = shutdown_event.is_set
-        if self.num_channels == 1 and raw:
-            def transfer_callback(bulk_transfer):
-                data = bulk_transfer.getBuffer()[0:bulk_transfer.getActualLength()]
-                callback(data, '')
-                if not shutdown_is_set():
-                    bulk_transfer.submit()
-        elif self.num_channels == 1 and not raw:
-            def transfer_callback(bulk_transfer):
-                data = bulk_transfer.getBuffer()[0:bulk_transfer.getActualLength()]
-                callback(array_builder('B', data), [])
-                if not shutdown_is_set():
-                    bulk_transfer.submit()
-        elif self.num_channels == 2 and raw:
-            def transfer_callback(bulk_transfer):
-                data = bulk_transfer.getBuffer()[0:bulk_transfer.getActualLength()]
-                callback(data[::2], data[1::2])
-                if not shutdown_is_set():
-                    bulk_transfer.submit()
-        elif self.num_channels == 2 and not raw:
-            def transfer_callback(bulk_transfer):
-                data = bulk_transfer.getBuffer()[0:bulk_transfer.getActualLength()]
-                callback(array_builder('B', data[::2]), array_builder('B', data[1::2]))
-                if not shutdown_is_set():
-                    bulk_transfer.submit()
-        else:
-            assert False
+        split = converter or self.build_splitter(raw)
+        tracker = self.gap_tracker
+        received, failed_transfer = tracker.received, tracker.failed_transfer
+        completed = libusb1.LIBUSB_TRANSFER_COMPLETED
+
+        def transfer_callback(bulk_transfer):
+            if bulk_transfer.getStatus() != completed:
+                failed_transfer()
+            length = bulk_transfer.getActualLength()
+            ch1_data, ch2_data = split(bulk_transfer.getBuffer()[0:length])
+            sample_offset = received(length)
+            if sample_offsets:
+                callback(ch1_data, ch2_data, sample_offset)
+            else:
+                callback(ch1_data, ch2_data)
+            if not shutdown_is_set():
+                bulk_transfer.submit()
+        transfers = []
         for _ in range(outstanding_transfers):
             transfer = self.device_handle.getTransfer(iso_packets=packets)
-            transfer.setBulk(0x86, (packets*self.packetsize), callback=transfer_callback)
+            transfer.setBulk(0x86, (packets*self.packetsize), callback=skip_cancelled(transfer_callback))
             transfer.submit()
+            transfers.append(transfer)
+        self.async_reads.add(shutdown_event, transfers)
         return shutdown_event
 
-    def read_async(self, callback, data_size, outstanding_transfers=3, raw=False):
+    def read_async_bulk_zero_copy(self, callback, packets, outstanding_transfers, auto_release, converter=None,
+                                  sample_offsets=False):
+        """
+        Internal function to read from bulk channel into a pool of preallocated buffers.  External
+        users should call read_async.
+        """
+        shutdown_event = threading.Event()
+        pool = TransferBufferPool(outstanding_transfers, packets*self.packetsize, shutdown_event)
+        self.transfer_buffer_pool = pool
+        hold, release = pool.hold, pool.release
+        num_channels = self.num_channels
+        tracker = self.gap_tracker
+        received, failed_transfer = tracker.received, tracker.failed_transfer
+        completed = libusb1.LIBUSB_TRANSFER_COMPLETED
+
+        def transfer_callback(bulk_transfer):
+            if bulk_transfer.getStatus() != completed:
+                failed_transfer()
+            buffer = bulk_transfer.getUserData()
+            length = bulk_transfer.getActualLength()
+            view = memoryview(buffer)[0:length]
+            sample_offset = received(length)
+            hold(buffer)
+            if converter is not None:
+                ch1_data, ch2_data = converter(view)
+            elif num_channels == 2:
+                ch1_data, ch2_data = view[::2], view[1::2]
+            else:
+                ch1_data, ch2_data = view, view[0:0]
+            if sample_offsets:
+                callback(ch1_data, ch2_data, sample_offset)
+            else:
+                callback(ch1_data, ch2_data)
+            if auto_release:
+                release(buffer)
+
+        transfers = []
+        for buffer in pool:
+            transfer = self.device_handle.getTransfer(iso_packets=packets)
+            transfer.setBulk(0x86, buffer, callback=skip_cancelled(transfer_callback), user_data=buffer)
+            pool.attach(buffer, transfer)
+            transfer.submit()
+            transfers.append(transfer)
+        self.async_reads.add(shutdown_event, transfers)
+        return shutdown_event
+
+    def read_async(self, callback, data_size, outstanding_transfers=3, raw=False, zero_copy=False, auto_release=True,
+                   as_numpy=False, as_volts=False, event_thread=False, sample_offsets=False, interleaved=False):
         """
         Read both channel's ADC data from the device asynchronously. No trigger support, you need to do this in software.
         The function returns immediately but the data is then sent asynchronously to the callback function whenever it
@@ -466,51 +769,199 @@ class Oscilloscope(object):
         :param int outstanding_transfers: (OPTIONAL) The number of transfers sent to the kernel at the same time to
                 improve gapless sampling.  The higher, the more likely it works, but the more resources it will take.
         :param raw: (OPTIONAL) Whether the samples should be returned as raw string (8-bit data) or as an array of bytes.
+        :param zero_copy: (OPTIONAL) Read into a pool of preallocated buffers owned by the scope (see
+                          transfer_buffer_pool) and hand the callback memoryviews into the completed transfer's buffer
+                          instead of copies. The views are only valid until the buffer is released. With isochronous
+                          transfers, the callback receives one block per transfer instead of one per packet.
+                          raw is ignored in this mode.  Default: Off
+        :param auto_release: (OPTIONAL) Only used with zero_copy. If on, the buffer is released and the transfer
+                             resubmitted as soon as the callback returns. If off, the consumer must hand the views
+                             back with release_buffer before the transfer is resubmitted.  Default: On
+        :param as_numpy: (OPTIONAL) Pass NumPy uint8 arrays to the callback. Combined with zero_copy these are views
+                         into the transfer buffer, otherwise they are copies. Requires NumPy. Default: Off
+        :param as_volts: (OPTIONAL) Pass NumPy float32 voltages to the callback, converted using the voltage ranges
+                         set on each channel. Requires NumPy. Default: Off
+        :param event_thread: (OPTIONAL) Handle the USB events on a dedicated thread (see start_event_thread), so
+                             there is no need to call poll(). The callback then runs on that thread. Default: Off
+        :param sample_offsets: (OPTIONAL) Pass the absolute index of the first sample of each block as third argument
+                               to the callback. Lost isochronous packets are counted, so the index stays accurate
+                               across gaps. See gap_tracker for the gap map. Default: Off
+        :param interleaved: (OPTIONAL) Pass the raw samples of both channels, still interleaved, as the first argument
+                            to the callback and an empty block as the second, e.g. to write them to a file as they
+                            are. Takes precedence over raw, as_numpy and as_volts. Default: Off
         :return: Returns a shutdown event handle if successful (and then calls the callback asynchronously).
                  Call set() on the returned event to stop sampling.
         """
         # data_size to packets
         packets = (data_size + self.packetsize-1)//self.packetsize
-        if self.is_iso:
-            return self.read_async_iso(callback, packets, outstanding_transfers, raw)
+        converter = None
+        if interleaved:
+            def converter(data):
+                return data, data[0:0]
+        elif as_numpy or as_volts:
+            converter = self.build_numpy_converter(as_volts, copy=not zero_copy)
+        self.gap_tracker = GapTracker(self.num_channels, self.packetsize if self.is_iso else None)
+        if zero_copy and self.is_iso:
+            shutdown_event = self.read_async_iso_zero_copy(callback, packets, outstanding_transfers, auto_release,
+                                                           converter, sample_offsets)
+        elif zero_copy:
+            shutdown_event = self.read_async_bulk_zero_copy(callback, packets, outstanding_transfers, auto_release,
+                                                            converter, sample_offsets)
+        elif self.is_iso:
+            shutdown_event = self.read_async_iso(callback, packets, outstanding_transfers, raw, converter,
+                                                 sample_offsets)
+        else:
+            shutdown_event = self.read_async_bulk(callback, packets, outstanding_transfers, raw, converter,
+                                                  sample_offsets)
+        if event_thread:
+            self.start_event_thread()
+        return shutdown_event
+
+    def iter_blocks(self, block_size, max_buffered=16, outstanding_transfers=3, raw=False, as_numpy=False,
+                    as_volts=False, raise_on_overrun=True, timeout=None):
+        """
+        Capture continuously and yield fixed size blocks, for pull style pipelines:
+
+            for ch1_data, ch2_data in scope.iter_blocks(0x10000):
+                ...
+
+        The transfers are handled on the event thread (see start_event_thread) and copied into a preallocated ring
+        buffer of max_buffered blocks, so a slow consumer never delays resubmitting them. If the consumer falls
+        further behind than that, new data is dropped instead of buffered. The capture is started by the first block
+        and stopped when the generator is closed.
+        :param block_size: The number of samples per channel in each block.
+        :param max_buffered: (OPTIONAL) The number of blocks the ring buffer holds, at least 2. Default: 16
+        :param outstanding_transfers: (OPTIONAL) The number of transfers in flight, as for read_async. Default: 3
+        :param raw: (OPTIONAL) Yield memoryviews into the ring buffer, instead of arrays of bytes. They are only valid
+                    until the next block is requested. Default: Off
+        :param as_numpy: (OPTIONAL) Yield NumPy uint8 arrays, which are views into the ring buffer and only valid until
+                         the next block is requested. Requires NumPy. Default: Off
+        :param as_volts: (OPTIONAL) Yield NumPy float32 voltages, as for read_async. Requires NumPy. Default: Off
+        :param raise_on_overrun: (OPTIONAL) Raise BufferOverrunError when the block would contain a gap because data
+                                 was dropped. If off, overruns are only counted in block_ring_buffer.overruns.
+                                 Default: On
+        :param timeout: (OPTIONAL) Stop when no block arrived for this many seconds. Default: Wait forever
+        :return: A generator of (ch1_data, ch2_data) pairs.
+        """
+        num_channels = self.num_channels
+        block_bytes = block_size * num_channels
+        ring = BlockRingBuffer(block_bytes, max_buffered)
+        self.block_ring_buffer = ring
+        packets = (block_bytes + self.packetsize-1)//self.packetsize
+        assert packets * self.packetsize <= ring.capacity, "max_buffered is too small for the transfer size."
+        if as_numpy or as_volts:
+            split = self.build_numpy_converter(as_volts)
         else:
-            return self.read_async_bulk(callback, packets, outstanding_transfers, raw)
+            split = self.build_splitter(raw)
+
+        def write_transfer(data, _):
+            ring.write(data)
+        shutdown_event = self.read_async(write_transfer, block_bytes, outstanding_transfers, zero_copy=True,
+                                         interleaved=True, event_thread=True)
+        self.start_capture()
+        try:
+            while True:
+                block, dropped = ring.read_block(timeout)
+                if block is None:
+                    return
+                if dropped and raise_on_overrun:
+                    raise BufferOverrunError("Dropped {} bytes, the consumer is too slow.".format(dropped))
+                ch1_data, ch2_data = split(block)
+                yield ch1_data, ch2_data
+        finally:
+            shutdown_event.set()
+            ring.close()
+            self.stop_capture()
+
+    def stream(self, data_size, max_buffered=8, overrun='drop_oldest', outstanding_transfers=3, **read_options):
+        """
+        Stream blocks to an asyncio coroutine (Python 3.5+):
+
+            async with scope.stream(0x8000) as blocks:
+                async for ch1_data, ch2_data in blocks:
+                    ...
+
+        The USB events are handled on the event thread, and blocks are buffered until the consumer takes them. For
+        async versions of the other requests, see PyHT6022.AsyncScope.AsyncOscilloscope.
+        :param data_size: The block size, as for read_async.
+        :param max_buffered: (OPTIONAL) The most blocks to buffer for a slow consumer. Default: 8
+        :param overrun: (OPTIONAL) What to do when the buffer is full: 'drop_oldest', 'drop_newest' or 'stop' (which
+                        ends the stream with an OverrunError). Default: 'drop_oldest'
+        :param outstanding_transfers: (OPTIONAL) The number of transfers in flight, as for read_async. Default: 3
+        :param read_options: (OPTIONAL) raw, as_numpy or as_volts, as for read_async.
+        :return: A PyHT6022.AsyncScope.AsyncStream.
+        """
+        from PyHT6022.AsyncScope import AsyncStream
+        return AsyncStream(self, data_size, max_buffered, overrun, outstanding_transfers, **read_options)
+
+    def release_buffer(self, block):
+        """
+        Hand a block received from a zero_copy read_async back to the transfer buffer pool, so that its transfer can be
+        resubmitted. The block must not be used afterwards.
+        :param block: Either of the blocks (memoryviews or NumPy arrays) the callback received for this block.
+        :return: True if the transfer was resubmitted, False if the buffer was not held or sampling was shut down.
+        """
+        return self.transfer_buffer_pool.release(block)
 
     @staticmethod
-    def scale_read_data(read_data, voltage_range, probe_multiplier=1):
+    def scale_read_data(read_data, voltage_range, probe_multiplier=1, out=None, dtype=None):
         """
-        Convenience function for converting data read from the scope to nicely scaled voltages.
-        :param list read_data: The list of points returned from the read_data functions.
+        Convenience function for converting data read from the scope to nicely scaled voltages. The conversion is a
+        lookup into a cached 256 entry table per (voltage_range, probe_multiplier), done for the whole buffer at once
+        when NumPy is available.
+        :param list read_data: The list of points returned from the read_data functions. Any raw bytestring or
+                               NumPy uint8 array from the scope works as well.
         :param int voltage_range: The voltage range current set for the channel.
         :param int probe_multiplier: (OPTIONAL) An additonal multiplictive factor for changing the probe impedance.
                                  Default: 1
-        :return: A list of correctly scaled voltages for the data.
+        :param out: (OPTIONAL) A preallocated float32 or float64 NumPy array of the same length to write the
+                    voltages into. Requires NumPy.
+        :param dtype: (OPTIONAL) The float type of the returned NumPy array, if read_data is a NumPy array and out is
+                      not given. Default: float32
+        :return: A list of correctly scaled voltages for the data. If read_data is a NumPy array or out is given, a
+                 NumPy array (out, if given) is returned instead.
         """
-        scale_factor = (5.0 * probe_multiplier)/(voltage_range << 7)
-        return [(datum - 128)*scale_factor for datum in read_data]
+        if SampleConversion is not None:
+            if out is not None or hasattr(read_data, '__array_interface__'):
+                return SampleConversion.scale_samples(read_data, voltage_range, probe_multiplier, out=out,
+                                                      dtype=dtype or 'float32')
+            return SampleConversion.scale_samples(read_data, voltage_range, probe_multiplier,
+                                                  dtype='float64').tolist()
+        assert out is None, "NumPy is required for out."
+        table = _scale_tables.get((voltage_range, probe_multiplier))
+        if table is None:
+            scale_factor = (5.0 * probe_multiplier)/(voltage_range << 7)
+            table = _scale_tables[(voltage_range, probe_multiplier)] = [(datum - 128)*scale_factor
+                                                                        for datum in range(256)]
+        return [table[datum] for datum in read_data]
 
     @staticmethod
     def voltage_to_adc(voltage, voltage_range, probe_multiplier=1):
         """
         Convenience function for analog voltages into the ADC count the scope would see.
-        :param float voltage: The analog voltage to convert.
+        :param float voltage: The analog voltage to convert. May also be a list or NumPy array of voltages, if NumPy is
+                              available, e.g. to compute several trigger thresholds at once.
         :param int voltage_range: The voltage range current set for the channel.
         :param int probe_multiplier: (OPTIONAL) An additonal multiplictive factor for changing the probe impedance.
                                  Default: 1
-        :return: The corresponding ADC count.
+        :return: The corresponding ADC count (a float64 NumPy array for array input).
         """
+        if SampleConversion is not None and hasattr(voltage, '__len__'):
+            return SampleConversion.voltage_to_adc(voltage, voltage_range, probe_multiplier)
         return voltage*(voltage_range << 7)/(5.0 * probe_multiplier) + 128
 
     @staticmethod
     def adc_to_voltage(adc_count, voltage_range, probe_multiplier=1):
         """
         Convenience function for converting an ADC count from the scope to a nicely scaled voltage.
-        :param int adc_count: The scope ADC count.
+        :param int adc_count: The scope ADC count. May also be a list or NumPy array of counts, if NumPy is available.
         :param int voltage_range: The voltage range current set for the channel.
         :param int probe_multiplier: (OPTIONAL) An additonal multiplictive factor for changing the probe impedance.
                                  Default: 1
-        :return: The analog voltage corresponding to that ADC count.
+        :return: The analog voltage corresponding to that ADC count (a float64 NumPy array for array input).
         """
+        if SampleConversion is not None and hasattr(adc_count, '__len__'):
+            return SampleConversion.adc_to_voltage(adc_count, voltage_range, probe_multiplier)
         return (adc_count - 128)*(5.0 * probe_multiplier)/(voltage_range << 7)
 
     def set_sample_rate(self, rate_index, timeout=0):
@@ -542,8 +993,18 @@ class Oscilloscope(object):
                                                         self.SET_SAMPLE_RATE_VALUE, self.SET_SAMPLE_RATE_INDEX,
                                                         pack("B", rate_index), timeout=timeout)
         assert bytes_written == 0x01
+        self.sample_rate_index = rate_index
         return True
 
+    @classmethod
+    def sample_rate_hz(cls, rate_index):
+        """
+        :param rate_index: A sample rate index of the custom firmware, as given to set_sample_rate.
+        :return: The sample rate per channel in samples per second, from SAMPLE_RATES.
+        """
+        assert rate_index in cls.SAMPLE_RATES, "Unsupported sample rate index {}.".format(rate_index)
+        return cls.SAMPLE_RATES[rate_index][1]
+
     def convert_sampling_rate_to_measurement_times(self, num_points, rate_index):
         """
         Convenience method for converting a sampling rate index into a list of times from beginning of data collection
@@ -597,6 +1058,7 @@ class Oscilloscope(object):
                                                         self.SET_CH1_VR_VALUE, self.SET_CH1_VR_INDEX,
                                                         pack("B", range_index), timeout=timeout)
         assert bytes_written == 0x01
+        self.ch1_voltage_range = range_index
         return True
 
     def set_ch2_voltage_range(self, range_index, timeout=0):
@@ -620,4 +1082,5 @@ class Oscilloscope(object):
                                                         self.SET_CH2_VR_VALUE, self.SET_CH2_VR_INDEX,
                                                         pack("B", range_index), timeout=timeout)
         assert bytes_written == 0x01
+        self.ch2_voltage_range = range_index
         return True
@@ -0,0 +1,400 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# Continuous waveform measurements over the read_async blocks, with a few whole-block NumPy passes per block:
+#
+#     measurements = WaveformMeasurements.from_scope(scope, channel=1)
+#     scope.read_async(measurements, 0x10000, as_numpy=True, event_thread=True, sample_offsets=True)
+#     ...
+#     results = measurements.results()
+#     print(results['frequency'], results['duty_cycle'], results['rise_time']['mean'])
+#
+# Edges are found with a comparator with hysteresis around the middle between the base and top levels of the signal,
+# and interpolated between the samples. Periods, pulse widths and the duty cycle follow from consecutive edges. Rise and
+# fall times are the interpolated times from 10% to 90% of the amplitude and back, overshoot and undershoot are the
+# extremes of the high and low parts of the signal beyond the top and base levels. The state (comparator, last edges,
+# open transitions and pulses) is kept between blocks, so the results do not depend on the block size. The levels are
+# estimated from the histogram of the first block, unless given.
+
+import numpy as np
+
+from PyHT6022.SampleConversion import as_uint8_array
+from PyHT6022.Trigger import Hysteresis
+
+TIMES = ('period', 'high_width', 'low_width', 'rise_time', 'fall_time')
+RATIOS = ('overshoot', 'undershoot')
+
+
+def estimate_levels(samples):
+    """
+    Estimate the base and top levels of a two-level signal: its most common values below and above the middle of its
+    range.
+    :param samples: An array of samples.
+    :return: (base, top), equal for a flat signal.
+    """
+    samples = np.asarray(samples)
+    if samples.dtype == np.uint8:
+        counts, values = np.bincount(samples, minlength=256), np.arange(256.0)
+    else:
+        counts, edges = np.histogram(samples, 256)
+        values = (edges[:-1] + edges[1:]) / 2
+    present = np.flatnonzero(counts)
+    middle = (values[present[0]] + values[present[-1]]) / 2.0
+    below = values <= middle
+    base = values[below][np.argmax(counts[below])]
+    top = values[~below][np.argmax(counts[~below])] if counts[~below].any() else base
+    return float(base), float(top)
+
+
+class RunningStatistics(object):
+    """
+    Count, mean, standard deviation, minimum and maximum of a stream of values, and the newest values themselves.
+    """
+
+    def __init__(self, history=100000):
+        """
+        :param history: (OPTIONAL) Keep (at least) the newest history values, for distributions. Default: 100000
+        """
+        self.history = history
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self._kept = []
+        self._kept_count = 0
+
+    def add(self, values):
+        if not len(values):
+            return
+        self.count += len(values)
+        self.total += float(values.sum())
+        self.total_squares += float(np.dot(values, values))
+        self.minimum = min(self.minimum, float(values.min()))
+        self.maximum = max(self.maximum, float(values.max()))
+        if self.history:
+            self._kept.append(values)
+            self._kept_count += len(values)
+            while self._kept_count - len(self._kept[0]) >= self.history:
+                self._kept_count -= len(self._kept.pop(0))
+
+    @property
+    def values(self):
+        """
+        :return: The kept values, oldest first.
+        """
+        if len(self._kept) > 1:
+            self._kept = [np.concatenate(self._kept)]
+        return self._kept[0] if self._kept else np.zeros(0)
+
+    def summary(self, scale=1.0):
+        """
+        :param scale: (OPTIONAL) A positive factor to apply, e.g. from samples to seconds. Default: 1
+        :return: A dict of count, mean, std, min and max, the latter all None without values.
+        """
+        if not self.count:
+            return {'count': 0, 'mean': None, 'std': None, 'min': None, 'max': None}
+        mean = self.total / self.count
+        variance = max(self.total_squares / self.count - mean ** 2, 0.0)
+        return {'count': self.count, 'mean': mean * scale, 'std': np.sqrt(variance) * scale,
+                'min': self.minimum * scale, 'max': self.maximum * scale}
+
+
+class WaveformMeasurements(object):
+    """
+    Measures one channel of the read_async stream continuously.
+    """
+
+    def __init__(self, levels=None, hysteresis=0.1, sample_rate=None, volts_per_count=None, offset=128, channel=1,
+                 history=100000):
+        """
+        :param levels: (OPTIONAL) The (base, top) levels of the signal, in the units of the data. Default: Estimated
+                       from the first block.
+        :param hysteresis: (OPTIONAL) The width of the comparator's band around the middle level, as a fraction of the
+                           amplitude. Default: 0.1
+        :param sample_rate: (OPTIONAL) The sample rate, to report times in seconds. Default: Times in samples
+        :param volts_per_count: (OPTIONAL) The voltage step of one ADC count, to report voltages of raw data in volts.
+                                Default: Voltages in the units of the data
+        :param offset: (OPTIONAL) The ADC count of 0V, with volts_per_count. Default: 128
+        :param channel: (OPTIONAL) The channel to measure, 1 or 2. Default: 1
+        :param history: (OPTIONAL) The number of values of each quantity kept for distributions. Default: 100000
+        """
+        assert channel in (1, 2), "The channel must be 1 or 2."
+        assert 0 <= hysteresis < 0.8, "The hysteresis must stay within the 10% - 90% band."
+        self.given_levels = levels
+        self.hysteresis = hysteresis
+        self.sample_rate = sample_rate
+        self.volts_per_count = volts_per_count
+        self.offset = offset
+        self.channel = channel
+        self.history = history
+        self.reset()
+
+    @classmethod
+    def from_scope(cls, scope, channel=1, probe_multiplier=1, **kwargs):
+        """
+        Create measurements for a channel of an Oscilloscope, in seconds and volts for its current settings and
+        calibration.
+        """
+        offset, volts_per_count = scope.channel_scale(channel, probe_multiplier)
+        return cls(sample_rate=scope.sample_rate_hz(scope.sample_rate_index), volts_per_count=volts_per_count,
+                   offset=offset, channel=channel, **kwargs)
+
+    def reset(self):
+        """
+        Forget all measurements, e.g. after changing the scope settings.
+        """
+        self.levels = None
+        self.comparator = None
+        self.sample_position = 0
+        self.gaps = 0
+        self.statistics = dict((name, RunningStatistics(self.history)) for name in TIMES + RATIOS)
+        self._value_counts = np.zeros(256, dtype=np.int64)
+        self._count = 0
+        self._total = self._total_squares = 0.0
+        self._minimum, self._maximum = np.inf, -np.inf
+        if self.given_levels is not None:
+            self.set_levels(*self.given_levels)
+        self._restart()
+
+    def _restart(self):
+        """
+        Drop the state carried between blocks, at the start and after a gap.
+        """
+        if self.comparator is not None:
+            self.comparator.reset()
+        # The last sample before the block, the time of the last rising edge, and the time and direction of the last
+        # edge of either kind.
+        self._previous = None
+        self._last_rising = None
+        self._last_edge = None
+        # The unfinished high or low part of the signal, as (high, maximum, minimum).
+        self._part = None
+        # The last sample outside the 10% - 90% band, as (-1 below or 1 above, time it was left or None).
+        self._outside = None
+
+    def set_levels(self, base, top):
+        """
+        Set the base and top levels of the signal, which the thresholds derive from.
+        """
+        assert top > base, "The top level must be above the base level."
+        self.levels = (float(base), float(top))
+        amplitude = top - base
+        middle = (base + top) / 2.0
+        self.comparator = Hysteresis(middle + amplitude * self.hysteresis / 2, middle - amplitude * self.hysteresis / 2)
+        self.low_threshold = base + 0.1 * amplitude
+        self.high_threshold = base + 0.9 * amplitude
+
+    def skip_to(self, sample_position):
+        """
+        Continue after a gap in the stream. Periods, pulses and transitions spanning the gap are not measured.
+        :param sample_position: The absolute index of the next sample.
+        """
+        self.gaps += 1
+        self.sample_position = sample_position
+        self._restart()
+
+    def feed(self, ch1_data, ch2_data=None, sample_offset=None):
+        """
+        Measure the next block, e.g. as the callback of read_async.
+        :param ch1_data: The next CH1 samples (bytes, array or NumPy array).
+        :param ch2_data: (OPTIONAL) The CH2 samples of the same block.
+        :param sample_offset: (OPTIONAL) The absolute index of the first sample, as passed by read_async with
+                              sample_offsets. Default: Contiguous
+        """
+        data = ch1_data if self.channel == 1 else ch2_data
+        samples = data if isinstance(data, np.ndarray) else as_uint8_array(data)
+        if sample_offset is not None and sample_offset != self.sample_position:
+            self.skip_to(sample_offset)
+        if not len(samples):
+            return
+        self._accumulate(samples)
+        if self.levels is None:
+            base, top = estimate_levels(samples)
+            if top > base:
+                self.set_levels(base, top)
+        if self.levels is not None:
+            self._measure_edges(samples)
+            self._measure_transitions(samples)
+        self._previous = samples[-1]
+        self.sample_position += len(samples)
+
+    __call__ = feed
+
+    def _accumulate(self, samples):
+        if samples.dtype == np.uint8:
+            self._value_counts += np.bincount(samples, minlength=256)
+            return
+        self._count += len(samples)
+        self._total += float(samples.sum(dtype=np.float64))
+        self._total_squares += float(np.dot(samples.astype(np.float64), samples))
+        self._minimum = min(self._minimum, float(samples.min()))
+        self._maximum = max(self._maximum, float(samples.max()))
+
+    def _crossing(self, samples, indexes, level):
+        """
+        :return: The interpolated absolute times at which the signal crosses level, between the sample before each
+                 index (the last one of the previous block for index 0) and the sample at it.
+        """
+        after = samples[indexes].astype(np.float64)
+        before = samples[np.maximum(indexes - 1, 0)].astype(np.float64)
+        if len(indexes) and indexes[0] == 0:
+            before[0] = after[0] if self._previous is None else self._previous
+        step = after - before
+        fraction = np.where(step != 0, (level - before) / np.where(step != 0, step, 1), 1.0)
+        return self.sample_position + indexes - 1 + np.clip(fraction, 0.0, 1.0)
+
+    def _measure_edges(self, samples):
+        """
+        Periods, pulse widths, overshoot and undershoot, from the edges found by the comparator.
+        """
+        comparator = self.comparator
+        rising, falling = comparator.transitions(samples)
+        rising_times = self._crossing(samples, rising, comparator.upper)
+        falling_times = self._crossing(samples, falling, comparator.lower)
+        if len(rising_times):
+            if self._last_rising is not None:
+                self.statistics['period'].add(np.diff(rising_times, prepend=self._last_rising))
+            else:
+                self.statistics['period'].add(np.diff(rising_times))
+            self._last_rising = rising_times[-1]
+        order = np.argsort(np.concatenate((rising, falling)), kind='stable')
+        edges = np.concatenate((rising, falling))[order]
+        times = np.concatenate((rising_times, falling_times))[order]
+        is_rising = np.concatenate((np.ones(len(rising), bool), np.zeros(len(falling), bool)))[order]
+        if len(edges):
+            # The time from each edge to the next one is a high pulse after a rising edge, and a low one after a
+            # falling edge.
+            if self._last_edge is not None:
+                widths = np.diff(times, prepend=self._last_edge[0])
+                after_rising = np.concatenate(([self._last_edge[1]], is_rising[:-1]))
+            else:
+                widths, after_rising = np.diff(times), is_rising[:-1]
+            self.statistics['high_width'].add(widths[after_rising])
+            self.statistics['low_width'].add(widths[~after_rising])
+            self._last_edge = (times[-1], bool(is_rising[-1]))
+        self._measure_extremes(samples, edges, is_rising)
+
+    def _measure_extremes(self, samples, edges, is_rising):
+        """
+        The extremes of the parts of the signal between the edges. A part is measured once it is complete, i.e. from
+        an edge to the next one.
+        """
+        # The parts before the first edge, between the edges and after the last one.
+        starts = np.concatenate(([0], edges))
+        maxima = np.maximum.reduceat(samples, starts).astype(np.float64)
+        minima = np.minimum.reduceat(samples, starts).astype(np.float64)
+        if len(edges) and edges[0] == 0:
+            maxima[0], minima[0] = -np.inf, np.inf
+        if self._part is not None:
+            maxima[0] = max(maxima[0], self._part[1])
+            minima[0] = min(minima[0], self._part[2])
+        if not len(edges):
+            if self._part is not None:
+                self._part = (self._part[0], maxima[0], minima[0])
+            return
+        high = np.concatenate(([self._part is not None and self._part[0]], is_rising))
+        complete = np.arange(0 if self._part is not None else 1, len(edges))
+        base, top = self.levels
+        amplitude = top - base
+        finished = complete[high[complete]]
+        self.statistics['overshoot'].add(np.maximum(maxima[finished] - top, 0) * (100.0 / amplitude))
+        finished = complete[~high[complete]]
+        self.statistics['undershoot'].add(np.maximum(base - minima[finished], 0) * (100.0 / amplitude))
+        self._part = (bool(high[-1]), maxima[-1], minima[-1])
+
+    def _measure_transitions(self, samples):
+        """
+        Rise and fall times: from leaving the 10% level of the amplitude to reaching the 90% level without returning
+        in between (and back), interpolated at the thresholds.
+        """
+        low, high = self.low_threshold, self.high_threshold
+        if self._outside is not None and self._outside[1] is None:
+            # The previous block ended outside the band: it was left towards the first sample of this block.
+            level = self._outside[0]
+            self._outside = (level, self._crossing(samples, np.zeros(1, np.int64), high if level > 0 else low)[0])
+        codes = (samples >= high).view(np.int8) - (samples < low).view(np.int8)
+        outside = np.flatnonzero(codes)
+        if not len(outside):
+            return
+        levels = codes[outside]
+        carried = self._outside is not None
+        if carried:
+            levels = np.concatenate(([self._outside[0]], levels))
+            outside = np.concatenate(([-1], outside))
+        # A transition leaves one side of the band at the sample before a change of side, and reaches the other one at
+        # the sample after it. Only those are interpolated.
+        changes = np.flatnonzero(levels[1:] != levels[:-1])
+        rising = levels[changes] < 0
+        thresholds = np.where(rising, low, high)
+        exits = self._crossing(samples, outside[changes] + 1, thresholds)
+        if carried and len(changes) and changes[0] == 0:
+            exits[0] = self._outside[1]
+        entries = self._crossing(samples, outside[changes + 1], np.where(rising, high, low))
+        durations = entries - exits
+        self.statistics['rise_time'].add(durations[rising])
+        self.statistics['fall_time'].add(durations[~rising])
+        last, level = int(outside[-1]), int(levels[-1])
+        if last < len(samples) - 1:
+            exit_time = self._crossing(samples, np.array([last + 1]), high if level > 0 else low)[0]
+        else:
+            exit_time = None
+        self._outside = (level, exit_time)
+
+    def _convert(self, value):
+        if self.volts_per_count is None:
+            return value
+        return (value - self.offset) * self.volts_per_count
+
+    def results(self):
+        """
+        :return: A dict of the measurements so far:
+                 - frequency (in Hz with sample_rate, else per sample) and duty_cycle (0 - 1),
+                 - mean, rms, min, max, peak_to_peak and the (base, top) levels, in volts with volts_per_count, else in
+                   the units of the data,
+                 - summaries (dicts of count, mean, std, min and max) of period, high_width, low_width, rise_time and
+                   fall_time, in seconds with sample_rate, else in samples, and of overshoot and undershoot, in % of
+                   the amplitude.
+        """
+        time_scale = 1.0 / self.sample_rate if self.sample_rate else 1.0
+        results = dict((name, self.statistics[name].summary(time_scale)) for name in TIMES)
+        results.update((name, self.statistics[name].summary()) for name in RATIOS)
+        periods, highs = self.statistics['period'], self.statistics['high_width']
+        results['frequency'] = periods.count / (periods.total * time_scale) if periods.count else None
+        results['duty_cycle'] = (highs.total / highs.count) / (periods.total / periods.count) \
+            if periods.count and highs.count else None
+        results['levels'] = tuple(self._convert(level) for level in self.levels) if self.levels else None
+        results.update(self._amplitudes())
+        return results
+
+    def _amplitudes(self):
+        """
+        :return: The mean, RMS, extremes and peak to peak voltage of all samples.
+        """
+        counts = self._value_counts
+        values = np.arange(256.0)
+        count = int(counts.sum()) + self._count
+        if not count:
+            return dict.fromkeys(('mean', 'rms', 'min', 'max', 'peak_to_peak'))
+        total = float(np.dot(counts, values)) + self._total
+        total_squares = float(np.dot(counts, values * values)) + self._total_squares
+        present = np.flatnonzero(counts)
+        minimum = min(float(present[0]), self._minimum) if len(present) else self._minimum
+        maximum = max(float(present[-1]), self._maximum) if len(present) else self._maximum
+        mean = total / count
+        offset = self.offset if self.volts_per_count is not None else 0.0
+        scale = abs(self.volts_per_count) if self.volts_per_count is not None else 1.0
+        mean_square = total_squares / count - 2 * offset * mean + offset * offset
+        return {'mean': self._convert(mean), 'rms': np.sqrt(max(mean_square, 0.0)) * scale,
+                'min': self._convert(minimum), 'max': self._convert(maximum),
+                'peak_to_peak': (maximum - minimum) * scale}
+
+    def distribution(self, name, bins=50):
+        """
+        :param name: One of the measured quantities, e.g. 'high_width'.
+        :param bins: (OPTIONAL) The number of bins or the bin edges, as for numpy.histogram. Default: 50
+        :return: (counts, bin edges) of the kept values, in seconds with sample_rate for times.
+        """
+        values = self.statistics[name].values
+        if name in TIMES and self.sample_rate:
+            values = values / float(self.sample_rate)
+        return np.histogram(values, bins)
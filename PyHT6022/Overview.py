@@ -0,0 +1,399 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# A multi-resolution overview (mipmap) of a recording, to draw any part of a long capture without reading all of it:
+#
+#     with CaptureRecorder(scope, "capture.ht6022", max_samples=int(3600 * 24e6), overview=True) as recorder:
+#         recorder.wait(3600)
+#     overview = OverviewReader("capture.ht6022.ovr", CaptureFileReader("capture.ht6022"))
+#     mins, maxs, means = overview.query(start, stop, pixel_width=1920)
+#
+# Level 0 holds the min, max and mean of every base_factor samples, and each further level reduces the one below by
+# factor, up to a single bucket for the whole capture. The levels are built incrementally from the read_async blocks,
+# carrying the partial bucket of every level over to the next block, so they are complete as soon as the recording
+# is. A query picks the coarsest level with at least one bucket per pixel, so it touches a few buckets per pixel no
+# matter how long the range is. All numbers are little endian.
+#
+#     header         64 bytes: magic "HT6022OV", version, channels, levels, factor, base factor, samples
+#     level table    (offset, capacity, count) per level
+#     levels         capacity buckets of (min, max, mean) per channel each
+#
+# Min and max are ADC counts, the mean is in 1/256 ADC counts. Buckets are aligned to the absolute sample index, so
+# a gap in the capture leaves empty buckets, whose min is above their max. They do not count towards the means of the
+# levels above or of queries.
+
+import struct
+
+import numpy as np
+
+from PyHT6022.SampleConversion import as_uint8_array
+
+FILE_MAGIC = b'HT6022OV'
+VERSION = 1
+FILE_HEADER = struct.Struct('<8sHHHHIQ')
+HEADER_SIZE = 64
+LEVEL_ENTRY = struct.Struct('<QQQ')
+OVERVIEW_SUFFIX = '.ovr'
+BUCKET_DTYPE = np.dtype([('min', 'u1'), ('max', 'u1'), ('mean', '<u2')])
+# The mean is stored in fixed point, with 8 fractional bits.
+MEAN_SCALE = 256
+# Min, max and mean of a bucket without samples, and the types they are computed in.
+EMPTY_BUCKET = (255, 0, 128 * MEAN_SCALE)
+BUCKET_TYPES = (np.uint8, np.uint8, np.uint64)
+
+
+def reduce_buckets(samples, factor, ufunc, dtype=None):
+    """
+    Reduce every factor rows of an array with a ufunc, e.g. np.minimum. The buckets are halved while their size is
+    even, with one elementwise operation on contiguous halves each, which is far faster than reducing along an axis.
+    :param samples: A C contiguous (N * factor, num_channels) array.
+    :param factor: The rows per bucket.
+    :param ufunc: The binary ufunc to reduce with.
+    :param dtype: (OPTIONAL) The type to compute in, e.g. a wider one for sums. Default: The type of samples
+    :return: The (N, num_channels) array of the reduced buckets.
+    """
+    full, num_channels = len(samples) // factor, samples.shape[1]
+    rows = samples.reshape(full, factor * num_channels)
+    while factor % 2 == 0:
+        half = factor // 2 * num_channels
+        rows = ufunc(rows[:, :half], rows[:, half:], dtype=dtype)
+        factor //= 2
+    if factor == 1:
+        return rows if dtype is None else rows.astype(dtype, copy=False)
+    return ufunc.reduce(rows.reshape(full, factor, num_channels), axis=1, dtype=dtype)
+
+
+class Overview(object):
+    """
+    The levels of an overview, and queries on them.
+    """
+
+    def __init__(self, levels, counts, num_channels, factor, base_factor, reader=None):
+        """
+        :param levels: One (capacity, num_channels) BUCKET_DTYPE array per level.
+        :param counts: The number of valid buckets of each level.
+        :param num_channels: The number of channels.
+        :param factor: The reduction between levels.
+        :param base_factor: The samples per bucket of level 0.
+        :param reader: (OPTIONAL) A CaptureFileReader of the capture, for queries finer than level 0.
+        """
+        self.levels = levels
+        self.counts = counts
+        self.num_channels = num_channels
+        self.factor = factor
+        self.base_factor = base_factor
+        self.reader = reader
+
+    def bucket_size(self, level):
+        """
+        :return: The samples per bucket of a level.
+        """
+        return self.base_factor * self.factor ** level
+
+    def level(self, index):
+        """
+        :param index: The level.
+        :return: The (count, num_channels) array of its valid buckets, with the fields min, max and mean.
+        """
+        return self.levels[index][:self.counts[index]]
+
+    def choose_level(self, start, stop, pixel_width):
+        """
+        :return: The coarsest level with at least one bucket per pixel, or -1 if even level 0 is too coarse.
+        """
+        samples_per_pixel = float(stop - start) / pixel_width
+        level = -1
+        while level + 1 < len(self.levels) and self.bucket_size(level + 1) <= samples_per_pixel:
+            level += 1
+        return level
+
+    def query(self, start, stop, pixel_width, channel=1):
+        """
+        Reduce a range of the capture to one min, max and mean per pixel.
+        :param start: The absolute index of the first sample.
+        :param stop: The absolute index after the last sample.
+        :param pixel_width: The number of pixels to draw the range on.
+        :param channel: (OPTIONAL) The channel, 1 or 2. Default: 1
+        :return: (mins, maxs, means) arrays of up to pixel_width values: uint8 ADC counts, and float32 mean ADC counts.
+                 Pixels without samples have a min above their max, and a NaN mean.
+        """
+        level = self.choose_level(start, stop, pixel_width)
+        if level < 0 and self.reader is not None:
+            samples = self.reader.read(start, stop)[channel - 1]
+            mins = maxs = samples
+            means = samples.astype(np.float32)
+        else:
+            level = max(level, 0)
+            size = self.bucket_size(level)
+            first = start // size
+            last = min(-(-stop // size), self.counts[level])
+            buckets = self.levels[level][first:last, channel - 1]
+            mins, maxs = buckets['min'], buckets['max']
+            means = buckets['mean'] * np.float32(1.0 / MEAN_SCALE)
+        if not len(mins):
+            return mins, maxs, means
+        pixels = min(pixel_width, len(mins))
+        edges = (np.arange(pixels) * len(mins)) // pixels
+        # Empty buckets (gaps) do not count towards the means.
+        present = maxs >= mins
+        counts = np.add.reduceat(present, edges, dtype=np.float32)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = np.add.reduceat(np.where(present, means, 0), edges, dtype=np.float32) / counts
+        return np.minimum.reduceat(mins, edges), np.maximum.reduceat(maxs, edges), means.astype(np.float32)
+
+
+class OverviewWriter(Overview):
+    """
+    Builds the overview from the blocks of a capture, in memory or in a memory mapped file.
+    """
+
+    def __init__(self, filename, num_channels, max_samples, factor=4, base_factor=256):
+        """
+        :param filename: The file to write the overview to, e.g. the capture's name with '.ovr' appended, or None to
+                         keep it in memory.
+        :param num_channels: The number of channels.
+        :param max_samples: The most samples (per channel) of the capture. The levels are preallocated for it.
+        :param factor: (OPTIONAL) The reduction between levels. Default: 4
+        :param base_factor: (OPTIONAL) The samples per bucket of level 0. Default: 256
+        """
+        assert factor >= 2 and base_factor >= 1, "Each level must reduce the one below."
+        self.filename = filename
+        capacities = []
+        size = base_factor
+        while True:
+            capacities.append(max(1, -(-max_samples // size)))
+            if capacities[-1] == 1:
+                break
+            size *= factor
+        offsets = []
+        position = HEADER_SIZE + len(capacities) * LEVEL_ENTRY.size
+        for capacity in capacities:
+            offsets.append(position)
+            position += capacity * num_channels * BUCKET_DTYPE.itemsize
+        self._offsets = offsets
+        if filename is None:
+            self._map = None
+            levels = [np.zeros((capacity, num_channels), BUCKET_DTYPE) for capacity in capacities]
+        else:
+            with open(filename, 'wb') as overview_file:
+                overview_file.truncate(position)
+            self._map = np.memmap(filename, np.uint8, 'r+')
+            levels = [np.ndarray((capacity, num_channels), BUCKET_DTYPE, self._map, offset)
+                      for capacity, offset in zip(capacities, offsets)]
+        Overview.__init__(self, levels, [0] * len(levels), num_channels, factor, base_factor)
+        self.capacities = capacities
+        self.sample_position = 0
+        # Buckets which did not fit, because the capture ran past max_samples.
+        self.dropped = 0
+        # The partial bucket of every level: samples (or buckets) it spans, those actually present in each channel,
+        # min, max and sum.
+        self._fill = [0] * len(levels)
+        self._present = [np.zeros(num_channels, np.uint64) for _ in levels]
+        self._min = [np.full(num_channels, 255, np.uint8) for _ in levels]
+        self._max = [np.zeros(num_channels, np.uint8) for _ in levels]
+        self._sum = [np.zeros(num_channels, np.uint64) for _ in levels]
+        self._write_header()
+
+    def _write_header(self):
+        if self._map is None:
+            return
+        header = FILE_HEADER.pack(FILE_MAGIC, VERSION, self.num_channels, len(self.levels), self.factor,
+                                  self.base_factor, self.sample_position)
+        table = b''.join(LEVEL_ENTRY.pack(offset, capacity, count)
+                         for offset, capacity, count in zip(self._offsets, self.capacities, self.counts))
+        self._map[:HEADER_SIZE] = np.frombuffer(header.ljust(HEADER_SIZE, b'\x00'), np.uint8)
+        self._map[HEADER_SIZE:HEADER_SIZE + len(table)] = np.frombuffer(table, np.uint8)
+
+    def _close_partial(self, level):
+        """
+        :return: (mins, maxs, means) of the partial bucket of a level, as (1, num_channels) arrays, and reset it.
+        """
+        present = self._present[level]
+        if present.any():
+            scale = MEAN_SCALE if level == 0 else 1
+            means = (self._sum[level] * np.uint64(scale) + present // np.uint64(2)) // np.maximum(present, 1)
+            means[present == 0] = EMPTY_BUCKET[2]
+            bucket = self._min[level][None].copy(), self._max[level][None].copy(), means[None]
+        else:
+            bucket = tuple(np.full((1, self.num_channels), value, dtype)
+                           for value, dtype in zip(EMPTY_BUCKET, BUCKET_TYPES))
+        self._fill[level] = 0
+        self._present[level][:] = 0
+        self._min[level][:] = 255
+        self._max[level][:] = 0
+        self._sum[level][:] = 0
+        return bucket
+
+    def _store(self, level, mins, maxs, means):
+        """
+        Append completed buckets to a level, and reduce them into the next one.
+        """
+        count = len(mins)
+        if not count:
+            return
+        position = self.counts[level]
+        stored = min(count, self.capacities[level] - position)
+        buckets = self.levels[level][position:position + stored]
+        buckets['min'], buckets['max'], buckets['mean'] = mins[:stored], maxs[:stored], means[:stored]
+        self.counts[level] += stored
+        self.dropped += count - stored
+        if level + 1 < len(self.levels):
+            self._reduce(level + 1, mins, maxs, means)
+
+    def _reduce(self, level, mins, maxs, means):
+        """
+        Reduce the next samples (level 0) or buckets of the level below into a level.
+        :param mins: (length, num_channels) minimums, the samples themselves for level 0.
+        :param maxs: (length, num_channels) maximums.
+        :param means: (length, num_channels) means, in ADC counts for level 0, otherwise in 1/256 ADC counts.
+        """
+        length = len(mins)
+        factor = self.factor if level else self.base_factor
+        fill = self._fill[level]
+        head = min((factor - fill) % factor, length)
+        full = (length - head) // factor
+        body_end = head + full * factor
+        completed = []
+        if head:
+            self._add_partial(level, mins[:head], maxs[:head], means[:head])
+            if self._fill[level] == factor:
+                completed.append(self._close_partial(level))
+        if full:
+            body_mins = reduce_buckets(mins[head:body_end], factor, np.minimum)
+            body_maxs = reduce_buckets(maxs[head:body_end], factor, np.maximum)
+            if level == 0:
+                sums = reduce_buckets(means[head:body_end], factor, np.add, np.uint64)
+                body_means = (sums * MEAN_SCALE + factor // 2) // factor
+            else:
+                # Only the buckets below with samples count, empty ones (gaps) are left out of the means.
+                present = maxs[head:body_end] >= mins[head:body_end]
+                sums = reduce_buckets(np.where(present, means[head:body_end], 0), factor, np.add, np.uint64)
+                counts = reduce_buckets(present, factor, np.add, np.uint64)
+                body_means = (sums + counts // 2) // np.maximum(counts, 1)
+                body_means[counts == 0] = EMPTY_BUCKET[2]
+            completed.append((body_mins, body_maxs, body_means))
+        if body_end < length:
+            self._add_partial(level, mins[body_end:], maxs[body_end:], means[body_end:])
+        if completed:
+            self._store(level, *(np.concatenate(parts) if len(completed) > 1 else parts[0] for parts in zip(*completed)))
+
+    def _add_partial(self, level, mins, maxs, means):
+        self._min[level] = np.minimum(self._min[level], mins.min(axis=0))
+        self._max[level] = np.maximum(self._max[level], maxs.max(axis=0))
+        if level == 0:
+            self._sum[level] += means.sum(axis=0, dtype=np.uint64)
+            self._present[level] += np.uint64(len(mins))
+        else:
+            present = maxs >= mins
+            self._sum[level] += np.where(present, means, 0).sum(axis=0, dtype=np.uint64)
+            self._present[level] += present.sum(axis=0, dtype=np.uint64)
+        self._fill[level] += len(mins)
+
+    def skip_to(self, sample_position):
+        """
+        Continue after a gap in the capture: level 0 gets empty buckets for the samples missing.
+        :param sample_position: The absolute index of the next sample.
+        """
+        assert sample_position >= self.sample_position, "The capture can not go back."
+        base = self.base_factor
+        first = self.sample_position // base
+        last = sample_position // base
+        if last > first:
+            buckets = [self._close_partial(0)]
+            if last - first > 1:
+                buckets.append(tuple(np.full((last - first - 1, self.num_channels), value, dtype)
+                                     for value, dtype in zip(EMPTY_BUCKET, BUCKET_TYPES)))
+            self._store(0, *(np.concatenate(parts) for parts in zip(*buckets)))
+            self._fill[0] = sample_position % base
+        else:
+            self._fill[0] += sample_position - self.sample_position
+        self.sample_position = sample_position
+
+    def feed(self, ch1_data, ch2_data=None, sample_offset=None):
+        """
+        Add the next block, e.g. as the callback of read_async.
+        :param ch1_data: The next CH1 samples (bytes, array or NumPy array of ADC counts).
+        :param ch2_data: (OPTIONAL) The CH2 samples of the same block, if num_channels is 2.
+        :param sample_offset: (OPTIONAL) The absolute index of the first sample, as passed by read_async with
+                              sample_offsets. Default: Contiguous
+        """
+        channels = [as_uint8_array(ch1_data)]
+        if self.num_channels == 2:
+            channels.append(as_uint8_array(ch2_data))
+        length = min(len(samples) for samples in channels)
+        self._feed_samples(np.column_stack([samples[:length] for samples in channels]), sample_offset)
+
+    __call__ = feed
+
+    def feed_interleaved(self, data, sample_offset=None):
+        """
+        Add the next block of raw interleaved samples, e.g. as written to a capture file. This needs no copy.
+        """
+        samples = as_uint8_array(data)
+        self._feed_samples(samples[:len(samples) // self.num_channels * self.num_channels]
+                           .reshape(-1, self.num_channels), sample_offset)
+
+    def _feed_samples(self, samples, sample_offset):
+        """
+        :param samples: A (length, num_channels) array of ADC counts.
+        """
+        if sample_offset is not None and sample_offset != self.sample_position:
+            self.skip_to(sample_offset)
+        self._reduce(0, samples, samples, samples)
+        self.sample_position += len(samples)
+
+    def close(self):
+        """
+        Complete the partial buckets of all levels, and write the level table.
+        """
+        if self.sample_position % self.base_factor:
+            self.skip_to(-(-self.sample_position // self.base_factor) * self.base_factor)
+        for level in range(1, len(self.levels)):
+            if self._fill[level]:
+                self._store(level, *self._close_partial(level))
+        self._write_header()
+        if self._map is not None:
+            self._map.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class OverviewReader(Overview):
+    """
+    Memory maps an overview file written by OverviewWriter.
+    """
+
+    def __init__(self, filename, reader=None):
+        """
+        :param filename: The overview file.
+        :param reader: (OPTIONAL) A CaptureFileReader of the capture, for queries finer than level 0.
+        """
+        self.map = np.memmap(filename, dtype=np.uint8, mode='r')
+        magic, version, num_channels, num_levels, factor, base_factor, samples = FILE_HEADER.unpack_from(self.map, 0)
+        assert magic == FILE_MAGIC, "{} is not an overview file.".format(filename)
+        assert version == VERSION, "Unsupported overview file version {}.".format(version)
+        levels, counts = [], []
+        for level in range(num_levels):
+            offset, capacity, count = LEVEL_ENTRY.unpack_from(self.map, HEADER_SIZE + level * LEVEL_ENTRY.size)
+            levels.append(np.ndarray((capacity, num_channels), BUCKET_DTYPE, self.map, offset))
+            counts.append(count)
+        Overview.__init__(self, levels, counts, num_channels, factor, base_factor, reader)
+        self.sample_position = samples
+
+
+def build_overview(reader, filename=None, factor=4, base_factor=256):
+    """
+    Build the overview of an existing capture file.
+    :param reader: A CaptureFileReader.
+    :param filename: (OPTIONAL) The file to write the overview to. Default: Keep it in memory
+    :return: The OverviewWriter, which can be queried right away.
+    """
+    writer = OverviewWriter(filename, reader.num_channels, reader.end_sample, factor, base_factor)
+    writer.reader = reader
+    for start, samples in reader.iter_chunks():
+        writer.feed(samples[0], samples[1] if reader.num_channels == 2 else None, start)
+    writer.close()
+    return writer
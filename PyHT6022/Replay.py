@@ -0,0 +1,317 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# Replays a recorded capture through the regular Oscilloscope API, to develop and benchmark processing pipelines
+# against real signals without hardware:
+#
+#     scope = replay_scope("capture.ht6022", realtime=True)
+#     shutdown_event = scope.read_async(callback, 0x8000, event_thread=True)
+#     scope.start_capture()
+#
+# The recording is served by a SimulatedDevice, so read_async, iter_blocks and stream behave exactly as with the
+# scope: same transfers, block sizes and channel layouts. Gaps in a recording are reinjected as failed iso packets,
+# which the gap tracker of the read counts again.
+
+import bisect
+import mmap
+import struct
+
+from PyHT6022.LibUsbScope import Oscilloscope
+from PyHT6022.SimulatedScope import SimulatedDevice, SimulatedUSBContext, TRANSFER_COMPLETED, TRANSFER_ERROR
+
+
+class Recording(object):
+    """
+    The samples of a recording, as contiguous segments of interleaved ADC counts.
+    """
+
+    def __init__(self, segments, num_channels, sample_rate_index, voltage_ranges=(0x01, 0x01), resources=()):
+        """
+        :param segments: A list of (absolute index of the first sample, buffer of interleaved ADC counts), in order.
+        :param num_channels: The number of interleaved channels.
+        :param sample_rate_index: The sample rate index the recording was captured with.
+        :param voltage_ranges: (OPTIONAL) The voltage range indexes of CH1 and CH2. Default: (0x01, 0x01)
+        :param resources: (OPTIONAL) Objects to keep alive while the segments are used, e.g. an open file.
+        """
+        self.segments = [(start, memoryview(data)) for start, data in segments]
+        self.starts = [start for start, _ in self.segments]
+        self.num_channels = num_channels
+        self.sample_rate_index = sample_rate_index
+        self.voltage_ranges = tuple(voltage_ranges)
+        self.resources = resources
+
+    @property
+    def end_sample(self):
+        """
+        :return: The absolute index after the last sample.
+        """
+        if not self.segments:
+            return 0
+        start, data = self.segments[-1]
+        return start + len(data) // self.num_channels
+
+    def gaps(self):
+        """
+        :return: A list of (sample index, missing samples) between the segments.
+        """
+        gaps = []
+        for (start, data), (next_start, _) in zip(self.segments, self.segments[1:]):
+            end = start + len(data) // self.num_channels
+            if next_start > end:
+                gaps.append((end, next_start - end))
+        return gaps
+
+    def without_gaps(self):
+        """
+        :return: A Recording of the same samples played back to back.
+        """
+        segments, position = [], 0
+        for _, data in self.segments:
+            segments.append((position, data))
+            position += len(data) // self.num_channels
+        return Recording(segments, self.num_channels, self.sample_rate_index, self.voltage_ranges, self.resources)
+
+    def segment_at(self, sample_index):
+        """
+        :return: (segment number, offset in samples) for a sample, or (segment number, None) for samples in a gap.
+        """
+        segment = bisect.bisect_right(self.starts, sample_index) - 1
+        if segment < 0:
+            return segment, None
+        start, data = self.segments[segment]
+        offset = sample_index - start
+        return segment, (offset if offset < len(data) // self.num_channels else None)
+
+    def next_start(self, sample_index):
+        """
+        :return: The start of the first segment after a sample, or end_sample if there is none.
+        """
+        segment = bisect.bisect_right(self.starts, sample_index)
+        return self.starts[segment] if segment < len(self.starts) else self.end_sample
+
+
+def sample_rate_index(sample_rate):
+    """
+    :param sample_rate: A sample rate in samples per second.
+    :return: The sample rate index of the custom firmware for it, the key of the nearest rate in
+             Oscilloscope.SAMPLE_RATES. Rates which are off by more than 1 % (a rounded header) raise a ValueError.
+    """
+    rate_index = min(Oscilloscope.SAMPLE_RATES, key=lambda index: abs(Oscilloscope.SAMPLE_RATES[index][1] -
+                                                                       sample_rate))
+    if abs(Oscilloscope.SAMPLE_RATES[rate_index][1] - sample_rate) > 0.01 * sample_rate:
+        raise ValueError("The firmware can not sample at {} S/s.".format(sample_rate))
+    return rate_index
+
+
+def map_file(filename):
+    with open(filename, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def open_raw(filename, num_channels=2, sample_rate_index=1, voltage_ranges=(0x01, 0x01)):
+    """
+    Open a raw recording (interleaved ADC counts, as written by CaptureRecorder), which has no metadata.
+    """
+    data = map_file(filename)
+    return Recording([(0, data)], num_channels, sample_rate_index, voltage_ranges, (data,))
+
+
+def open_wav(filename, voltage_ranges=(0x01, 0x01)):
+    """
+    Open an 8 bit WAV recording, as written by CaptureRecorder. The sample rate is taken from its header.
+    """
+    data = map_file(filename)
+    assert data[0:4] == b'RIFF' and data[8:12] == b'WAVE', "{} is not a WAV file.".format(filename)
+    position, num_channels, sample_rate = 12, None, None
+    while position + 8 <= len(data):
+        chunk_id, chunk_size = struct.unpack_from('<4sL', data, position)
+        position += 8
+        if chunk_id == b'fmt ':
+            _, num_channels, sample_rate, _, _, bits = struct.unpack_from('<HHLLHH', data, position)
+            assert bits == 8, "Only 8 bit WAV files can be replayed."
+        elif chunk_id == b'data':
+            chunk_size = min(chunk_size, len(data) - position)
+            samples = memoryview(data)[position:position + chunk_size]
+            return Recording([(0, samples)], num_channels, sample_rate_index(sample_rate), voltage_ranges, (data,))
+        position += chunk_size + (chunk_size & 1)
+    raise ValueError("{} has no data.".format(filename))
+
+
+def open_capture(filename):
+    """
+    Open a capture file (see CaptureFile), with its settings and gaps. Requires NumPy.
+    """
+    from PyHT6022.CaptureFile import CaptureFileReader
+    reader = CaptureFileReader(filename)
+    segments = [(int(start), reader.data[chunk, :int(count)].reshape(-1))
+                for chunk, (start, count) in enumerate(zip(reader.start_samples, reader.num_samples))]
+    settings = reader.settings(0) if len(reader) else {'sample_rate_index': 1, 'voltage_ranges': (0x01, 0x01)}
+    return Recording(segments, reader.num_channels, settings['sample_rate_index'] or
+                     sample_rate_index(settings['sample_rate']), settings['voltage_ranges'], (reader,))
+
+
+def open_recording(filename, file_format=None, **options):
+    """
+    Open a recording by its format.
+    :param filename: The file to replay.
+    :param file_format: (OPTIONAL) 'raw', 'wav' or 'capture'. Default: By the extension, as for CaptureRecorder.
+    :param options: (OPTIONAL) For raw files: num_channels, sample_rate_index and voltage_ranges.
+    :return: A Recording.
+    """
+    if file_format is None:
+        from PyHT6022.CaptureRecorder import CaptureRecorder
+        file_format = CaptureRecorder.EXTENSIONS.get(filename[filename.rfind('.'):].lower(), 'raw')
+    if file_format == 'capture':
+        return open_capture(filename)
+    elif file_format == 'wav':
+        return open_wav(filename, **options)
+    assert file_format == 'raw', "Unknown file format {}.".format(file_format)
+    return open_raw(filename, **options)
+
+
+class ReplayDevice(SimulatedDevice):
+    """
+    A SimulatedDevice streaming a recording instead of a generated signal. The recording starts over with every
+    start_capture. When it ends, the device stops capturing and sets finished, unless it loops.
+    """
+
+    def __init__(self, recording, realtime=False, loop=False, reinject_gaps=True, **device_options):
+        """
+        :param recording: The Recording to replay.
+        :param realtime: (OPTIONAL) Pace the replay by the sample rate of the recording. Otherwise it runs as fast as
+                         it is read, e.g. for throughput tests. Default: Off
+        :param loop: (OPTIONAL) Start over at the end of the recording. Default: Off
+        :param reinject_gaps: (OPTIONAL) Replay the gaps of the recording as failed iso packets (and skipped samples
+                              with bulk transfers). If off, the samples are played back to back. Default: On
+        :param device_options: (OPTIONAL) Further SimulatedDevice options, e.g. packet_loss or iso_packet_sizes.
+        """
+        device_options.setdefault('firmware_loaded', True)
+        SimulatedDevice.__init__(self, realtime=realtime, **device_options)
+        self.recording = recording if reinject_gaps else recording.without_gaps()
+        self.loop = loop
+        self.num_channels = recording.num_channels
+        self.sample_rate_id = recording.sample_rate_index
+        self.voltage_ranges = list(recording.voltage_ranges)
+        self.finished = False
+
+    def control_write(self, request, value, index, data):
+        if request == 0xe3 and bytearray(data)[0]:
+            self.finished = False
+        return SimulatedDevice.control_write(self, request, value, index, data)
+
+    def recording_position(self):
+        """
+        :return: The position in the recording of the next sample, or None at the end.
+        """
+        end = self.recording.end_sample
+        if self.loop and end:
+            return self.sample_position % end
+        return self.sample_position if self.sample_position < end else None
+
+    def end_of_recording(self):
+        self.finished = True
+        self.capturing = False
+
+    def fill(self, view):
+        """
+        Copy the next samples of the recording into a buffer, with midscale values for gaps.
+        """
+        num_channels = self.num_channels
+        recording = self.recording
+        done, length = 0, len(view)
+        while done < length:
+            position = self.recording_position()
+            if position is None:
+                view[done:length] = b'\x80' * (length - done)
+                self.sample_position += (length - done) // num_channels
+                break
+            segment, offset = recording.segment_at(position)
+            if offset is None:
+                count = min(length - done, (recording.next_start(position) - position) * num_channels)
+                view[done:done + count] = b'\x80' * count
+            else:
+                data = recording.segments[segment][1]
+                start = offset * num_channels
+                count = min(length - done, len(data) - start)
+                view[done:done + count] = data[start:start + count]
+            done += count
+            self.sample_position += count // num_channels
+
+    def in_gap(self):
+        position = self.recording_position()
+        return position is not None and self.recording.segment_at(position)[1] is None
+
+    def remaining_bytes(self, length):
+        """
+        :return: length, or less if the recording ends (and does not loop) before that.
+        """
+        if self.loop:
+            return length
+        return min(length, (self.recording.end_sample - self.recording_position()) * self.num_channels)
+
+    def read_bulk(self, buffer_view):
+        length = len(buffer_view) - len(buffer_view) % self.num_channels
+        if self.recording_position() is None:
+            self.end_of_recording()
+            return 0
+        length = self.remaining_bytes(length)
+        self.wait_for_data(length)
+        # Bulk transfers can not tell about lost data, the stream just skips the gaps.
+        done = 0
+        while done < length and self.recording_position() is not None:
+            position = self.recording_position()
+            if self.in_gap():
+                self.skip((self.recording.next_start(position) - position) * self.num_channels)
+                continue
+            count = min(length - done, (self.recording.next_start(position) - position) * self.num_channels)
+            self.fill(buffer_view[done:done + count])
+            done += count
+        if self.recording_position() is None:
+            self.end_of_recording()
+        return done
+
+    def read_iso(self, buffer_view, packet_lengths):
+        self.wait_for_data(sum(packet_lengths))
+        results = []
+        position = 0
+        for packet_length in packet_lengths:
+            if self.recording_position() is None:
+                results.append((TRANSFER_COMPLETED, 0))
+            elif self.in_gap() or self.packet_lost():
+                self.lost_packets += 1
+                self.skip(packet_length)
+                results.append((TRANSFER_ERROR, 0))
+            else:
+                actual_length = self.remaining_bytes(packet_length)
+                self.fill(buffer_view[position:position + actual_length])
+                results.append((TRANSFER_COMPLETED, actual_length))
+            position += packet_length
+        if self.recording_position() is None:
+            self.end_of_recording()
+        return results
+
+
+def replay_scope(filename, file_format=None, realtime=False, loop=False, reinject_gaps=True, alt=1,
+                 **recording_options):
+    """
+    Open an Oscilloscope replaying a recording, set up with the settings it was captured with. Its settings must not
+    be changed, the recording only exists in one configuration.
+    :param filename: The file to replay.
+    :param file_format: (OPTIONAL) 'raw', 'wav' or 'capture'. Default: By the extension, as for CaptureRecorder.
+    :param realtime: (OPTIONAL) Pace the replay by the sample rate. Otherwise replay as fast as possible. Default: Off
+    :param loop: (OPTIONAL) Start over at the end of the recording. Default: Off
+    :param reinject_gaps: (OPTIONAL) Replay the gaps of the recording as failed iso packets. Default: On
+    :param alt: (OPTIONAL) The interface to replay through, 0 for bulk or 1 for iso transfers. Default: 1
+    :param recording_options: (OPTIONAL) For raw files: num_channels, sample_rate_index and voltage_ranges.
+    :return: An Oscilloscope with an open handle. Its device attribute is the ReplayDevice.
+    """
+    recording = open_recording(filename, file_format, **recording_options)
+    device = ReplayDevice(recording, realtime=realtime, loop=loop, reinject_gaps=reinject_gaps)
+    scope = Oscilloscope(context=SimulatedUSBContext(device))
+    assert scope.setup() and scope.open_handle()
+    scope.supports_single_channel = True
+    scope.set_interface(alt)
+    scope.set_num_channels(recording.num_channels)
+    scope.set_sample_rate(recording.sample_rate_index)
+    scope.set_ch1_voltage_range(recording.voltage_ranges[0])
+    scope.set_ch2_voltage_range(recording.voltage_ranges[1])
+    return scope
@@ -0,0 +1,142 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# Vectorized (NumPy) helpers for splitting and converting the raw sample stream of the scope.
+# The scope sends one unsigned byte per sample, interleaved CH1, CH2, CH1, CH2, ... when both channels are active.
+
+import numpy as np
+
+
+def as_uint8_array(data):
+    """
+    Wrap raw scope data in a uint8 NumPy array without copying, whenever possible.
+    :param data: A bytestring, bytearray, memoryview, array.array('B') or NumPy array of ADC counts.
+    :return: A one dimensional uint8 array sharing memory with data, if data supports the buffer protocol.
+    """
+    if isinstance(data, np.ndarray):
+        return data if data.dtype == np.uint8 else data.astype(np.uint8)
+    try:
+        return np.frombuffer(data, dtype=np.uint8)
+    except (TypeError, ValueError):
+        # Non-contiguous memoryviews (e.g. a [::2] slice) or plain sequences.
+        return np.asarray(data, dtype=np.uint8)
+
+
+def deinterleave(data, num_channels=2):
+    """
+    Split a raw transfer buffer into per channel samples, without copying.
+    :param data: The raw (interleaved) data read from the scope.
+    :param num_channels: (OPTIONAL) The number of active channels the data was captured with. Default: 2
+    :return: A (num_channels, N) uint8 array, which is a strided view into data. A trailing odd byte is ignored.
+    """
+    samples = as_uint8_array(data)
+    if num_channels == 2:
+        return samples[:len(samples) & ~1].reshape(-1, 2).T
+    return samples.reshape(1, -1)
+
+
+# Conversion tables are tiny (256 entries) and only depend on the settings, so they are built once and shared.
+_conversion_tables = {}
+
+
+def scale_factor(voltage_range, probe_multiplier=1):
+    """
+    :param voltage_range: The voltage range index of the channel, as given to set_ch1_voltage_range.
+    :param probe_multiplier: (OPTIONAL) An additional multiplicative factor for the probe. Default: 1
+    :return: The voltage step of one ADC count.
+    """
+    return (5.0 * probe_multiplier) / (voltage_range << 7)
+
+
+def conversion_table(voltage_range, probe_multiplier=1, dtype=np.float32, offset=0, gain=1.0):
+    """
+    Look up (or build and cache) the table mapping every possible ADC count to its voltage.
+    :param voltage_range: The voltage range index of the channel, as given to set_ch1_voltage_range.
+    :param probe_multiplier: (OPTIONAL) An additional multiplicative factor for the probe. Default: 1
+    :param dtype: (OPTIONAL) The float type of the table. Default: float32
+    :param offset: (OPTIONAL) The zero offset of the channel in ADC counts, subtracted before scaling. Default: 0
+    :param gain: (OPTIONAL) A gain correction factor, applied after scaling. Default: 1.0
+    :return: A read-only array of 256 voltages, indexed by ADC count.
+    """
+    dtype = np.dtype(dtype)
+    key = (voltage_range, probe_multiplier, dtype.char, offset, gain)
+    table = _conversion_tables.get(key)
+    if table is None:
+        table = ((np.arange(256) - (128 + offset)) * (scale_factor(voltage_range, probe_multiplier) * gain)
+                 ).astype(dtype)
+        table.flags.writeable = False
+        _conversion_tables[key] = table
+    return table
+
+
+def scale_samples(data, voltage_range, probe_multiplier=1, out=None, dtype=np.float32):
+    """
+    Convert the ADC counts of one channel to voltages with a single table gather.
+    :param data: The ADC counts, as anything as_uint8_array accepts.
+    :param voltage_range: The voltage range index of the channel, as given to set_ch1_voltage_range.
+    :param probe_multiplier: (OPTIONAL) An additional multiplicative factor for the probe. Default: 1
+    :param out: (OPTIONAL) A preallocated float array of the same length to write the voltages to. Its dtype takes
+                precedence over dtype.
+    :param dtype: (OPTIONAL) The float type of the result, if out is not given. Default: float32
+    :return: The array of voltages (out, if given).
+    """
+    table = conversion_table(voltage_range, probe_multiplier, dtype if out is None else out.dtype)
+    # ADC counts can never index outside the table, so skip the bounds checking (and the temporary it implies).
+    return table.take(as_uint8_array(data), out=out, mode='clip')
+
+
+def raw_to_volts(samples, voltage_ranges, probe_multipliers=1, out=None, dtype=np.float32):
+    """
+    Convert deinterleaved ADC counts to volts, one table gather per channel.
+    :param samples: A (num_channels, N) uint8 array, as returned by deinterleave.
+    :param voltage_ranges: The voltage range index of each channel.
+    :param probe_multipliers: (OPTIONAL) The probe multiplier of each channel, or one value for all. Default: 1
+    :param out: (OPTIONAL) A preallocated float (num_channels, N) array to write the result to.
+    :param dtype: (OPTIONAL) The float type of the result, if out is not given. Default: float32
+    :return: The (num_channels, N) array of voltages.
+    """
+    if not isinstance(probe_multipliers, (list, tuple)):
+        probe_multipliers = [probe_multipliers] * len(samples)
+    dtype = dtype if out is None else out.dtype
+    tables = [conversion_table(voltage_range, probe_multiplier, dtype)
+              for voltage_range, probe_multiplier in zip(voltage_ranges, probe_multipliers)]
+    return apply_tables(samples, tables, out=out)
+
+
+def apply_tables(samples, tables, out=None):
+    """
+    Convert deinterleaved ADC counts with a given conversion table per channel, e.g. calibrated ones.
+    :param samples: A (num_channels, N) uint8 array, as returned by deinterleave.
+    :param tables: One 256 entry conversion table per channel, all of the same dtype.
+    :param out: (OPTIONAL) A preallocated (num_channels, N) array of the tables' dtype to write the result to.
+    :return: The (num_channels, N) array of voltages.
+    """
+    if out is None:
+        out = np.empty(samples.shape, dtype=tables[0].dtype)
+    for channel, table, channel_out in zip(samples, tables, out):
+        table.take(channel, out=channel_out, mode='clip')
+    return out
+
+
+def adc_to_voltage(adc_counts, voltage_range, probe_multiplier=1):
+    """
+    Array version of Oscilloscope.adc_to_voltage.
+    :param adc_counts: An array (or sequence) of ADC counts, which may be fractional.
+    :param voltage_range: The voltage range index of the channel.
+    :param probe_multiplier: (OPTIONAL) An additional multiplicative factor for the probe. Default: 1
+    :return: A float64 array of voltages.
+    """
+    adc_counts = np.asarray(adc_counts)
+    if adc_counts.dtype == np.uint8:
+        return scale_samples(adc_counts, voltage_range, probe_multiplier, dtype=np.float64)
+    return (adc_counts - 128.0) * scale_factor(voltage_range, probe_multiplier)
+
+
+def voltage_to_adc(voltages, voltage_range, probe_multiplier=1):
+    """
+    Array version of Oscilloscope.voltage_to_adc, e.g. to compute many trigger thresholds at once.
+    :param voltages: An array (or sequence) of voltages.
+    :param voltage_range: The voltage range index of the channel.
+    :param probe_multiplier: (OPTIONAL) An additional multiplicative factor for the probe. Default: 1
+    :return: A float64 array of (fractional) ADC counts.
+    """
+    return np.asarray(voltages, dtype=np.float64) / scale_factor(voltage_range, probe_multiplier) + 128
@@ -0,0 +1,138 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# Segmented (sequence) acquisition: thousands of short triggered frames captured straight into one preallocated
+# array, instead of a list of separately allocated frames:
+#
+#     acquisition = SegmentedAcquisition(scope, EdgeTrigger(160), num_segments=10000, segment_length=256,
+#                                        pre_trigger=32)
+#     acquisition.acquire(timeout=10)
+#     pulses = acquisition.segments[:acquisition.num_filled]
+#
+# The trigger engine copies every frame directly into its slot of segments, and the trigger position goes into the
+# parallel sample_offsets and timestamps arrays. Nothing is allocated per segment.
+
+import threading
+
+import numpy as np
+
+from PyHT6022.Trigger import TriggerEngine
+
+
+class SegmentedAcquisition(object):
+    def __init__(self, scope, trigger, num_segments, segment_length, pre_trigger=0, holdoff=None, wrap=False,
+                 as_volts=False, block_size=0x10000, outstanding_transfers=3):
+        """
+        :param scope: An Oscilloscope with an open handle, set up for the capture (interface, channels, rate, ranges).
+        :param trigger: The Trigger condition, e.g. an EdgeTrigger.
+        :param num_segments: The number of segments to capture.
+        :param segment_length: The samples per channel in each segment.
+        :param pre_trigger: (OPTIONAL) The samples before the trigger position in each segment. Default: 0
+        :param holdoff: (OPTIONAL) The samples after a trigger before the next one is accepted.
+                        Default: segment_length, i.e. segments do not overlap.
+        :param wrap: (OPTIONAL) Keep capturing when all segments are filled, overwriting the oldest ones. Otherwise the
+                     acquisition stops by itself. Default: Off
+        :param as_volts: (OPTIONAL) Capture float32 volts instead of uint8 ADC counts. The trigger levels are in
+                         volts then, too. Default: Off
+        :param block_size: (OPTIONAL) The transfer size in bytes, as data_size for read_async. Default: 64 KiB
+        :param outstanding_transfers: (OPTIONAL) The number of transfers to keep in flight. Default: 3
+        """
+        assert 0 <= pre_trigger < segment_length, "The segment must include the trigger position."
+        self.scope = scope
+        self.num_segments = num_segments
+        self.segment_length = segment_length
+        self.num_channels = scope.num_channels
+        self.sample_rate = scope.sample_rate_hz(scope.sample_rate_index)
+        self.wrap = wrap
+        self.as_volts = as_volts
+        self.block_size = block_size
+        self.outstanding_transfers = outstanding_transfers
+        self.segments = np.zeros((num_segments, segment_length, self.num_channels),
+                                 dtype=np.float32 if as_volts else np.uint8)
+        # The absolute sample index of the trigger of each segment, and the same in seconds from the capture start.
+        self.sample_offsets = np.zeros(num_segments, dtype=np.int64)
+        self.timestamps = np.zeros(num_segments, dtype=np.float64)
+        # The number of segments captured so far, including those overwritten when wrapping.
+        self.count = 0
+        self.full = threading.Event()
+        self.shutdown_event = None
+        self.engine = TriggerEngine(trigger, pre_trigger, segment_length - pre_trigger, self.num_channels,
+                                    segment_length if holdoff is None else holdoff,
+                                    frame_buffer=self._next_segment)
+
+    @property
+    def num_filled(self):
+        """
+        :return: The number of valid segments.
+        """
+        return min(self.count, self.num_segments)
+
+    def _next_segment(self, trigger_index):
+        """
+        The frame_buffer of the trigger engine, run on the USB event thread: the slot for the next segment.
+        """
+        if self.count >= self.num_segments and not self.wrap:
+            return None
+        slot = self.count % self.num_segments
+        self.sample_offsets[slot] = trigger_index
+        self.timestamps[slot] = trigger_index / self.sample_rate
+        self.count += 1
+        if self.count == self.num_segments:
+            self.full.set()
+            if not self.wrap:
+                self.shutdown_event.set()
+        # The engine fills (channels, samples), the segments are stored samples first.
+        return self.segments[slot].T
+
+    def start(self):
+        """
+        Start capturing segments, on the event thread.
+        :return: True if successful.
+        """
+        assert self.shutdown_event is None, "The acquisition was already started."
+        self.shutdown_event = self.scope.read_async(self.engine, self.block_size, self.outstanding_transfers,
+                                                    as_numpy=not self.as_volts, as_volts=self.as_volts,
+                                                    event_thread=True, sample_offsets=True)
+        self.scope.start_capture()
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Wait for all segments to be filled.
+        :param timeout: (OPTIONAL) The longest time to wait, in seconds. Default: Until they are filled.
+        :return: True if all segments are filled.
+        """
+        return self.full.wait(timeout)
+
+    def stop(self):
+        """
+        Stop capturing.
+        :return: The number of valid segments.
+        """
+        if self.shutdown_event is not None:
+            self.shutdown_event.set()
+            self.scope.stop_capture()
+        return self.num_filled
+
+    def acquire(self, timeout=None):
+        """
+        Capture until all segments are filled, or for a given time.
+        :param timeout: (OPTIONAL) The longest time to capture for, in seconds. Default: Until they are filled.
+        :return: The number of valid segments.
+        """
+        self.start()
+        try:
+            self.wait(timeout)
+        finally:
+            self.stop()
+        return self.num_filled
+
+    def ordered(self):
+        """
+        :return: (segments, sample_offsets, timestamps) of the valid segments, oldest first. These are views while the
+                 segments have not wrapped around, copies otherwise.
+        """
+        if self.count <= self.num_segments:
+            count = self.count
+            return self.segments[:count], self.sample_offsets[:count], self.timestamps[:count]
+        order = np.roll(np.arange(self.num_segments), -(self.count % self.num_segments))
+        return self.segments[order], self.sample_offsets[order], self.timestamps[order]
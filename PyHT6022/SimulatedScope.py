@@ -0,0 +1,583 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# A simulated 6022BE, standing in for the usb1.USBContext (and the device, handle and transfers that come from it)
+# used by Oscilloscope. It emulates the vendor requests of the custom firmware, bulk endpoint 0x86 and iso endpoint 0x82,
+# so the acquisition paths can be tested and benchmarked without hardware:
+#
+#     scope = Oscilloscope(context=SimulatedUSBContext(SimulatedDevice(signals=(SimulatedSignal('square', 1e3),))))
+#
+# Samples come from a precomputed pattern of a whole number of signal periods, which is copied into the transfer
+# buffers, so generating data costs little more than a memcpy.
+
+import math
+import random
+import struct
+import threading
+import time
+
+from PyHT6022.LibUsbScope import Oscilloscope
+
+# libusb transfer status codes (libusb_transfer_status)
+TRANSFER_COMPLETED = 0
+TRANSFER_ERROR = 1
+TRANSFER_TIMED_OUT = 2
+TRANSFER_CANCELLED = 3
+TRANSFER_STALL = 4
+TRANSFER_NO_DEVICE = 5
+TRANSFER_OVERFLOW = 6
+
+# USB endpoint transfer types (bmAttributes & 0x3)
+TRANSFER_TYPE_ISOCHRONOUS = 1
+TRANSFER_TYPE_BULK = 2
+
+NO_FIRMWARE_VENDOR_ID = 0x04B4
+FIRMWARE_PRESENT_VENDOR_ID = 0x04B5
+MODEL_ID = 0x6022
+
+
+class SimulatedSignal(object):
+    WAVEFORMS = ('sine', 'square', 'triangle', 'sawtooth', 'dc', 'noise')
+
+    def __init__(self, waveform='sine', frequency=1e3, amplitude=1.0, offset=0.0, duty_cycle=0.5, noise=0.0):
+        """
+        A periodic test signal applied to one simulated channel.
+        :param waveform: (OPTIONAL) One of WAVEFORMS. Default: 'sine'
+        :param frequency: (OPTIONAL) The signal frequency in Hz. It is rounded so that a whole number of periods fits
+                          the pattern of the simulated device. Default: 1 kHz
+        :param amplitude: (OPTIONAL) The peak amplitude in V. Default: 1.0 V
+        :param offset: (OPTIONAL) The DC offset in V. Default: 0.0 V
+        :param duty_cycle: (OPTIONAL) The high fraction of each period, for square waves. Default: 0.5
+        :param noise: (OPTIONAL) The standard deviation of added gaussian noise in V. Default: 0.0 V
+        """
+        assert waveform in self.WAVEFORMS, "Unknown waveform {}.".format(waveform)
+        self.waveform = waveform
+        self.frequency = frequency
+        self.amplitude = amplitude
+        self.offset = offset
+        self.duty_cycle = duty_cycle
+        self.noise = noise
+
+    def value(self, phase, rng):
+        """
+        :param phase: The position in the period, 0.0 <= phase < 1.0.
+        :param rng: The random.Random instance used for noise.
+        :return: The signal voltage at that phase.
+        """
+        waveform = self.waveform
+        if waveform == 'sine':
+            value = math.sin(2 * math.pi * phase)
+        elif waveform == 'square':
+            value = 1.0 if phase < self.duty_cycle else -1.0
+        elif waveform == 'triangle':
+            value = 4 * phase - 1 if phase < 0.5 else 3 - 4 * phase
+        elif waveform == 'sawtooth':
+            value = 2 * phase - 1
+        elif waveform == 'noise':
+            value = rng.gauss(0.0, 1.0)
+        else:
+            value = 0.0
+        value = self.offset + self.amplitude * value
+        if self.noise:
+            value += rng.gauss(0.0, self.noise)
+        return value
+
+    def adc_counts(self, num_samples, sample_rate, voltage_range, rng):
+        """
+        Generate a whole number of periods of the signal as ADC counts.
+        :param num_samples: The number of samples to generate.
+        :param sample_rate: The sample rate in samples per second.
+        :param voltage_range: The voltage range index set on the channel.
+        :param rng: The random.Random instance used for noise.
+        :return: A list of num_samples ADC counts, clipped to 0 - 255.
+        """
+        cycles = max(1, int(round(num_samples * self.frequency / sample_rate)))
+        counts_per_volt = (voltage_range << 7) / 5.0
+        counts = []
+        for i in range(num_samples):
+            phase = (i * cycles / float(num_samples)) % 1.0
+            count = int(round(self.value(phase, rng) * counts_per_volt + 128))
+            counts.append(min(255, max(0, count)))
+        return counts
+
+
+class SimulatedEndpoint(object):
+    def __init__(self, address, transfer_type, packet_size):
+        self.address = address
+        self.transfer_type = transfer_type
+        self.packet_size = packet_size
+
+    def getAddress(self):
+        return self.address
+
+    def getAttributes(self):
+        return self.transfer_type
+
+    def getMaxPacketSize(self):
+        # High bandwidth iso endpoints encode (transactions per microframe - 1) in bits 11 and 12.
+        size = min(self.packet_size, 1024)
+        return ((self.packet_size // size - 1) << 11) | size
+
+
+class SimulatedDevice(object):
+    def __init__(self, signals=None, firmware_loaded=False, realtime=False, max_throughput=None, packet_loss=0.0,
+                 iso_packet_sizes=(3 * 1024, 2 * 1024, 1024), pattern_length=1 << 16, calibration_values=None,
+                 seed=0, clock=time):
+        """
+        A simulated 6022BE scope.
+        :param signals: (OPTIONAL) The SimulatedSignal for CH1 and CH2. Default: 1 kHz sine waves on both channels.
+        :param firmware_loaded: (OPTIONAL) Start with the firmware already present. Default: Off
+        :param realtime: (OPTIONAL) Pace the data by the sample rate, like the real device. If the reader falls more
+                         than fifo_size behind, samples are dropped, as with a real FIFO overrun. Otherwise transfers
+                         complete as fast as they are polled. Default: Off
+        :param max_throughput: (OPTIONAL) Limit the delivered data to this many bytes per second. Default: No limit
+        :param packet_loss: (OPTIONAL) Probability of losing each USB packet. Lost iso packets complete with an error
+                            status and no data, lost bulk packets skip their samples in the stream. Default: 0.0
+        :param iso_packet_sizes: (OPTIONAL) The iso packet size (bytes per microframe) of the alternate settings 1,
+                                 2, 3 and so on. Alternate setting 0 is always bulk. Default: 3072, 2048, 1024
+        :param pattern_length: (OPTIONAL) The number of samples per channel in the precomputed signal pattern.
+        :param calibration_values: (OPTIONAL) The 32 calibration bytes in the EEPROM. Default: small offsets.
+        :param seed: (OPTIONAL) The seed for noise and packet loss. Default: 0
+        :param clock: (OPTIONAL) The time() and sleep(seconds) of the realtime and max_throughput pacing, e.g. a fake
+                      clock to test the pacing with. Default: The time module
+        """
+        self.signals = list(signals or (SimulatedSignal(), SimulatedSignal()))
+        while len(self.signals) < 2:
+            self.signals.append(SimulatedSignal('dc'))
+        self.firmware_loaded = firmware_loaded
+        self.realtime = realtime
+        self.clock = clock
+        self.max_throughput = max_throughput
+        self.packet_loss = packet_loss
+        self.pattern_length = pattern_length
+        self.rng = random.Random(seed)
+        self.fifo_size = 512 * 1024
+        self.endpoints = [SimulatedEndpoint(0x86, TRANSFER_TYPE_BULK, 512)]
+        self.endpoints.extend(SimulatedEndpoint(0x82, TRANSFER_TYPE_ISOCHRONOUS, size) for size in iso_packet_sizes)
+        self.ram = bytearray(0x10000)
+        self.eeprom = bytearray(b'\xff' * 256)
+        self.eeprom[0x08:0x28] = bytearray(calibration_values or [129, 127] * 16)
+
+        # Device settings (the custom firmware defaults)
+        self.sample_rate_id = 1
+        self.voltage_ranges = [0x01, 0x01]
+        self.num_channels = 2
+        self.alt_setting = 0
+        self.capturing = False
+        # Stream state
+        self.sample_position = 0
+        self.capture_start = None
+        self.delivered_bytes = 0
+        self.delivery_start = None
+        self.lost_packets = 0
+        self.gap_log = []
+        self._pattern = None
+        self._patterns = {}
+        # The SimulatedUSBContext this device is attached to.
+        self.context = None
+
+    @property
+    def sample_rate(self):
+        return Oscilloscope.sample_rate_hz(self.sample_rate_id)
+
+    def getVendorID(self):
+        return FIRMWARE_PRESENT_VENDOR_ID if self.firmware_loaded else NO_FIRMWARE_VENDOR_ID
+
+    def getProductID(self):
+        return MODEL_ID
+
+    def __getitem__(self, configuration):
+        # device[configuration][interface][alt_setting][endpoint], as used by Oscilloscope.set_interface
+        assert configuration == 0
+        return [[[endpoint] for endpoint in self.endpoints]]
+
+    def open(self):
+        return SimulatedDeviceHandle(self)
+
+    # ---- Vendor requests ----
+
+    def control_write(self, request, value, index, data):
+        data = bytearray(data)
+        if request == 0xa0:
+            self.ram[value:value + len(data)] = data
+            if value == 0xe600 and data == b'\x00':
+                # Releasing the 8051 from reset starts the new firmware, which re-enumerates with a new vendor id.
+                self.firmware_loaded = True
+        elif request == 0xa2:
+            self.eeprom[value:value + len(data)] = data
+        elif request in (0xe0, 0xe1):
+            self.voltage_ranges[request - 0xe0] = data[0]
+            self._pattern = None
+        elif request == 0xe2:
+            # The firmware knows the rates of Oscilloscope.SAMPLE_RATES only.
+            Oscilloscope.sample_rate_hz(data[0])
+            self.sample_rate_id = data[0]
+            self._pattern = None
+        elif request == 0xe3:
+            self.capturing = bool(data[0])
+            if self.capturing:
+                self.capture_start = self.clock.time()
+                self.sample_position = 0
+            if self.context is not None:
+                # Transfers waiting for data can complete now.
+                self.context.wake()
+        elif request == 0xe4:
+            assert data[0] in (1, 2)
+            self.num_channels = data[0]
+            self._pattern = None
+        else:
+            raise ValueError("Unsupported vendor request 0x{:02x}.".format(request))
+        return len(data)
+
+    def control_read(self, request, value, index, length):
+        if request == 0xa0:
+            return bytes(self.ram[value:value + length])
+        elif request == 0xa2:
+            return bytes(self.eeprom[value:value + length])
+        raise ValueError("Unsupported vendor request 0x{:02x}.".format(request))
+
+    # ---- Sample stream ----
+
+    def pattern(self):
+        """
+        :return: The interleaved signal pattern for the current settings, doubled so that any read of up to one
+                 pattern length can be served from a single slice.
+        """
+        if self._pattern is None:
+            # Patterns are cached per setting, as switching back and forth is common in tests and benchmarks.
+            key = (self.sample_rate_id, tuple(self.voltage_ranges), self.num_channels)
+            if key not in self._patterns:
+                channels = [signal.adc_counts(self.pattern_length, self.sample_rate, voltage_range, self.rng)
+                            for signal, voltage_range in zip(self.signals, self.voltage_ranges)][:self.num_channels]
+                interleaved = bytearray(self.pattern_length * self.num_channels)
+                for i, counts in enumerate(channels):
+                    interleaved[i::self.num_channels] = bytearray(counts)
+                self._patterns[key] = memoryview(bytes(interleaved * 2))
+            self._pattern = self._patterns[key]
+        return self._pattern
+
+    def fill(self, view):
+        """
+        Copy the next samples of the stream into a buffer and advance the stream.
+        :param view: A writable memoryview to fill. Its length should be a multiple of the number of channels.
+        """
+        pattern = self.pattern()
+        pattern_bytes = len(pattern) // 2
+        start = (self.sample_position % self.pattern_length) * self.num_channels
+        done, length = 0, len(view)
+        while done < length:
+            chunk = min(length - done, len(pattern) - start)
+            view[done:done + chunk] = pattern[start:start + chunk]
+            done += chunk
+            start = (start + chunk) % pattern_bytes
+        self.sample_position += length // self.num_channels
+
+    def skip(self, num_bytes):
+        """
+        Drop samples from the stream, recording the gap in gap_log as (sample position, number of samples).
+        """
+        samples = num_bytes // self.num_channels
+        self.gap_log.append((self.sample_position, samples))
+        self.sample_position += samples
+
+    def wait_for_data(self, num_bytes):
+        """
+        Block until num_bytes more can be delivered, honoring realtime pacing and max_throughput.
+        """
+        now = self.clock.time()
+        if self.delivery_start is None:
+            self.delivery_start = now
+        if self.max_throughput:
+            ready_at = self.delivery_start + (self.delivered_bytes + num_bytes) / float(self.max_throughput)
+            if ready_at > now:
+                self.clock.sleep(ready_at - now)
+                now = ready_at
+        if self.realtime and self.capture_start is not None:
+            byte_rate = self.sample_rate * self.num_channels
+            produced = (now - self.capture_start) * byte_rate
+            position = self.sample_position * self.num_channels
+            if produced - position > self.fifo_size:
+                # The reader fell behind, the FIFO overflowed and the oldest data is gone.
+                self.skip(int(produced - position - self.fifo_size) // self.num_channels * self.num_channels)
+                position = self.sample_position * self.num_channels
+            ready_at = self.capture_start + (position + num_bytes) / byte_rate
+            if ready_at > now:
+                self.clock.sleep(ready_at - now)
+        self.delivered_bytes += num_bytes
+
+    def packet_lost(self):
+        return self.packet_loss and self.rng.random() < self.packet_loss
+
+    def read_bulk(self, buffer_view):
+        """
+        Fill a bulk transfer buffer, in 512 byte packets.
+        :return: The number of bytes transferred.
+        """
+        length = len(buffer_view) - len(buffer_view) % self.num_channels
+        self.wait_for_data(length)
+        if not self.packet_loss:
+            self.fill(buffer_view[:length])
+            return length
+        for start in range(0, length, 512):
+            while self.packet_lost():
+                self.lost_packets += 1
+                self.skip(512)
+            self.fill(buffer_view[start:min(start + 512, length)])
+        return length
+
+    def read_iso(self, buffer_view, packet_lengths):
+        """
+        Fill an iso transfer buffer, one packet per entry of packet_lengths.
+        :return: A list of (status, actual_length) per packet.
+        """
+        self.wait_for_data(sum(packet_lengths))
+        results = []
+        position = 0
+        for packet_length in packet_lengths:
+            if self.packet_lost():
+                self.lost_packets += 1
+                self.skip(packet_length)
+                results.append((TRANSFER_ERROR, 0))
+            else:
+                self.fill(buffer_view[position:position + packet_length])
+                results.append((TRANSFER_COMPLETED, packet_length))
+            position += packet_length
+        return results
+
+
+class SimulatedTransfer(object):
+    def __init__(self, handle, iso_packets=0):
+        self.handle = handle
+        self.iso_packets = iso_packets
+        self.endpoint = None
+        self.buffer = None
+        self.callback = None
+        self.user_data = None
+        self.is_iso = False
+        self.iso_setup = []
+        self.actual_length = 0
+        self.status = TRANSFER_COMPLETED
+        self.submitted = False
+
+    def _set_buffer(self, buffer_or_len):
+        if isinstance(buffer_or_len, int):
+            buffer_or_len = bytearray(buffer_or_len)
+        self.buffer = buffer_or_len
+
+    def setBulk(self, endpoint, buffer_or_len, callback=None, user_data=None, timeout=0):
+        assert not self.submitted, "Cannot alter a submitted transfer"
+        self._set_buffer(buffer_or_len)
+        self.endpoint, self.callback, self.user_data, self.is_iso = endpoint, callback, user_data, False
+
+    def setIsochronous(self, endpoint, buffer_or_len, callback=None, user_data=None, timeout=0,
+                       iso_transfer_length_list=None):
+        assert not self.submitted, "Cannot alter a submitted transfer"
+        assert self.iso_packets, "This transfer cannot be used for isochronous I/O."
+        self._set_buffer(buffer_or_len)
+        if iso_transfer_length_list is None:
+            iso_length, remainder = divmod(len(self.buffer), self.iso_packets)
+            assert not remainder, "Buffer size cannot be evenly distributed among the iso packets."
+            iso_transfer_length_list = [iso_length] * self.iso_packets
+        self.iso_setup = [{'length': length, 'actual_length': 0, 'status': TRANSFER_COMPLETED}
+                          for length in iso_transfer_length_list]
+        self.endpoint, self.callback, self.user_data, self.is_iso = endpoint, callback, user_data, True
+
+    def submit(self):
+        assert not self.submitted, "Cannot submit a submitted transfer"
+        self.submitted = True
+        self.handle.context.submit(self)
+
+    def cancel(self):
+        self.handle.context.cancel(self)
+
+    def isSubmitted(self):
+        return self.submitted
+
+    def getBuffer(self):
+        return self.buffer
+
+    def getActualLength(self):
+        return self.actual_length
+
+    def getStatus(self):
+        return self.status
+
+    def getUserData(self):
+        return self.user_data
+
+    def getCallback(self):
+        return self.callback
+
+    def getEndpoint(self):
+        return self.endpoint
+
+    def getISOSetupList(self):
+        return [dict(setup) for setup in self.iso_setup]
+
+    def iterISO(self):
+        view = memoryview(self.buffer)
+        position = 0
+        for setup in self.iso_setup:
+            yield setup['status'], view[position:position + setup['actual_length']]
+            position += setup['length']
+
+    def complete(self, device, status=TRANSFER_COMPLETED):
+        """
+        Run the transfer against the device and call its callback, like libusb does on completion.
+        """
+        self.submitted = False
+        self.status = status
+        if status == TRANSFER_COMPLETED:
+            view = memoryview(self.buffer)
+            if self.is_iso:
+                results = device.read_iso(view, [setup['length'] for setup in self.iso_setup])
+                for setup, (packet_status, actual_length) in zip(self.iso_setup, results):
+                    setup['status'], setup['actual_length'] = packet_status, actual_length
+                self.actual_length = sum(actual_length for _, actual_length in results)
+            else:
+                self.actual_length = device.read_bulk(view)
+        else:
+            self.actual_length = 0
+            for setup in self.iso_setup:
+                setup['status'], setup['actual_length'] = status, 0
+        if self.callback is not None:
+            self.callback(self)
+
+
+class SimulatedDeviceHandle(object):
+    def __init__(self, device):
+        self.device = device
+        self.context = device.context
+        self.claimed = set()
+
+    def kernelDriverActive(self, interface):
+        return False
+
+    def detachKernelDriver(self, interface):
+        pass
+
+    def claimInterface(self, interface):
+        self.claimed.add(interface)
+
+    def releaseInterface(self, interface):
+        self.claimed.discard(interface)
+
+    def close(self):
+        if self.context is not None:
+            self.context.close_handle(self)
+
+    def setInterfaceAltSetting(self, interface, alt_setting):
+        assert 0 <= alt_setting < len(self.device.endpoints)
+        self.device.alt_setting = alt_setting
+
+    def controlWrite(self, request_type, request, value, index, data, timeout=0):
+        return self.device.control_write(request, value, index, data)
+
+    def controlRead(self, request_type, request, value, index, length, timeout=0):
+        return self.device.control_read(request, value, index, length)
+
+    def bulkRead(self, endpoint, length, timeout=0):
+        assert endpoint == 0x86
+        data = bytearray(length - length % self.device.num_channels)
+        self.device.read_bulk(memoryview(data))
+        return bytes(data)
+
+    def getTransfer(self, iso_packets=0, short_is_error=False, add_zero_packet=False):
+        return SimulatedTransfer(self, iso_packets)
+
+
+class SimulatedUSBContext(object):
+    # How long handleEvents waits for something to do, like libusb's blocking event handling.
+    EVENT_TIMEOUT = 0.01
+
+    def __init__(self, device=None):
+        """
+        A stand-in for usb1.USBContext with one simulated scope attached.
+        :param device: (OPTIONAL) The SimulatedDevice to attach. Default: a scope without firmware.
+        """
+        self.device = device if device is not None else SimulatedDevice()
+        self.device.context = self
+        self._pending = []
+        self._cancelled = []
+        self._condition = threading.Condition()
+
+    def getByVendorIDAndProductID(self, vendor_id, product_id, skip_on_access_error=False, skip_on_error=False):
+        if (vendor_id, product_id) == (self.device.getVendorID(), self.device.getProductID()):
+            return self.device
+        return None
+
+    def openByVendorIDAndProductID(self, vendor_id, product_id, skip_on_access_error=False, skip_on_error=False):
+        device = self.getByVendorIDAndProductID(vendor_id, product_id)
+        return device.open() if device else None
+
+    def getDeviceList(self, skip_on_access_error=False, skip_on_error=False):
+        return [self.device]
+
+    def submit(self, transfer):
+        with self._condition:
+            self._pending.append(transfer)
+            self._condition.notify_all()
+
+    def cancel(self, transfer):
+        with self._condition:
+            if transfer in self._pending:
+                self._pending.remove(transfer)
+                self._cancelled.append(transfer)
+                self._condition.notify_all()
+
+    def close_handle(self, handle):
+        with self._condition:
+            for transfer in [transfer for transfer in self._pending if transfer.handle is handle]:
+                self._pending.remove(transfer)
+                transfer.submitted = False
+
+    def _ready(self):
+        return self._cancelled or (self._pending and self.device.capturing)
+
+    def handleEventsTimeout(self, tv=0):
+        """
+        Complete the transfers which are ready, waiting up to tv seconds for one to become ready.
+        """
+        with self._condition:
+            if not self._ready() and tv:
+                self._condition.wait(tv)
+            cancelled, self._cancelled = self._cancelled, []
+            ready = list(self._pending) if self.device.capturing else []
+            del self._pending[:len(ready)]
+        try:
+            for transfer in cancelled:
+                transfer.complete(self.device, TRANSFER_CANCELLED)
+            for transfer in ready:
+                transfer.complete(self.device)
+        except Exception:
+            # As with libusb, the transfers not handled yet when a callback raises stay pending.
+            with self._condition:
+                self._cancelled[:0] = [transfer for transfer in cancelled if transfer.submitted]
+                self._pending[:0] = [transfer for transfer in ready
+                                     if transfer.submitted and transfer not in self._pending]
+            raise
+
+    def handleEvents(self):
+        self.handleEventsTimeout(self.EVENT_TIMEOUT)
+
+    def pending_transfers(self):
+        """
+        :return: The number of submitted transfers which have not completed yet.
+        """
+        with self._condition:
+            return len(self._pending) + len(self._cancelled)
+
+    def wake(self):
+        """
+        Wake up a thread waiting in handleEventsTimeout.
+        """
+        with self._condition:
+            self._condition.notify_all()
+
+
+def pack_calibration(offsets):
+    """
+    Build the 32 byte EEPROM calibration block for a SimulatedDevice from zero offsets.
+    :param offsets: A list of 16 (CH1, CH2 per gain step) offsets in ADC counts, used for both sample rate groups.
+    :return: The calibration block as a bytestring.
+    """
+    return struct.pack('32B', *[128 + offset for offset in offsets] * 2)
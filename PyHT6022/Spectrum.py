@@ -0,0 +1,217 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# A streaming spectrum analyzer: Welch's method over the read_async blocks, instead of one FFT of a whole capture:
+#
+#     analyzer = SpectrumAnalyzer.from_scope(scope, fft_size=8192, channel=1)
+#     scope.read_async(analyzer, 0x10000, as_numpy=True, event_thread=True, sample_offsets=True)
+#     ...
+#     plot(analyzer.frequencies, analyzer.psd_db())
+#
+# The stream is cut into overlapping segments of fft_size samples, which are windowed and transformed with one batched
+# real FFT per block. Their power spectra are averaged, either linearly over all segments or exponentially, weighting
+# the newest ones most. The window and its scale factors are cached per (window, size). The result is a one-sided
+# power spectral density in V^2/Hz, from the raw ADC counts and the volts per count of the channel's voltage range.
+# At high sample rates the stream can be decimated first, by averaging a number of samples each.
+
+import numpy as np
+
+from PyHT6022.Overview import reduce_buckets
+from PyHT6022.SampleConversion import as_uint8_array
+
+LINEAR = 'linear'
+EXPONENTIAL = 'exponential'
+
+WINDOWS = {'rectangular': np.ones,
+           'hann': np.hanning,
+           'hamming': np.hamming,
+           'blackman': np.blackman}
+
+# Windows only depend on their name and size, so they are built once and shared.
+_windows = {}
+
+
+def window(name, size):
+    """
+    Look up (or build and cache) a window with its scale factors.
+    :param name: The window, one of WINDOWS.
+    :param size: The number of points.
+    :return: (read-only float32 window, sum of the window, sum of its squares)
+    """
+    key = (name, size)
+    cached = _windows.get(key)
+    if cached is None:
+        assert name in WINDOWS, "Unknown window {}.".format(name)
+        values = WINDOWS[name](size).astype(np.float32)
+        values.flags.writeable = False
+        cached = _windows[key] = (values, float(values.sum(dtype=np.float64)),
+                                  float(np.square(values, dtype=np.float64).sum()))
+    return cached
+
+
+class SpectrumAnalyzer(object):
+    """
+    Averages the power spectral density of one channel of the read_async stream.
+    """
+
+    def __init__(self, sample_rate, volts_per_count=1.0, fft_size=4096, window_name='hann', overlap=0.5,
+                 averaging=LINEAR, alpha=0.1, decimation=1, channel=1, offset=128):
+        """
+        :param sample_rate: The sample rate per channel, in samples per second.
+        :param volts_per_count: (OPTIONAL) The voltage step of one ADC count. Default: 1 (spectra in counts)
+        :param fft_size: (OPTIONAL) The samples per segment, after decimation. Default: 4096
+        :param window_name: (OPTIONAL) The window, one of WINDOWS. Default: 'hann'
+        :param overlap: (OPTIONAL) The fraction of each segment overlapping the next one. Default: 0.5
+        :param averaging: (OPTIONAL) LINEAR to average all segments equally, or EXPONENTIAL. Default: LINEAR
+        :param alpha: (OPTIONAL) The weight of each new segment with EXPONENTIAL averaging. Default: 0.1
+        :param decimation: (OPTIONAL) Average this many samples into one before the FFT, reducing the sample rate (and
+                           the bandwidth) by that factor. Default: 1 (off)
+        :param channel: (OPTIONAL) The channel to analyze, 1 or 2. Default: 1
+        :param offset: (OPTIONAL) The ADC count of 0V. Default: 128
+        """
+        assert 0 <= overlap < 1, "The overlap must be below 1."
+        assert averaging in (LINEAR, EXPONENTIAL), "Unknown averaging {}.".format(averaging)
+        assert channel in (1, 2), "The channel must be 1 or 2."
+        self.decimation = int(decimation)
+        self.sample_rate = float(sample_rate) / self.decimation
+        self.volts_per_count = volts_per_count
+        self.fft_size = fft_size
+        self.window_name = window_name
+        self.window, window_sum, window_power = window(window_name, fft_size)
+        self.hop = max(1, int(round(fft_size * (1 - overlap))))
+        self.averaging = averaging
+        self.alpha = alpha
+        self.channel = channel
+        self.offset = offset
+        # The window applied to the offset, so the offset is removed after windowing.
+        self._window_offset = self.window * np.float32(offset)
+        # From |FFT|^2 to a one-sided density in V^2/Hz, and the noise bandwidth of a bin.
+        self.psd_scale = volts_per_count ** 2 / (self.sample_rate * window_power)
+        self.enbw = self.sample_rate * window_power / window_sum ** 2
+        self.frequencies = np.fft.rfftfreq(fft_size, 1.0 / self.sample_rate)
+        self._one_sided = np.full(len(self.frequencies), 2.0)
+        self._one_sided[0] = 1.0
+        if fft_size % 2 == 0:
+            self._one_sided[-1] = 1.0
+        self.reset()
+
+    @classmethod
+    def from_scope(cls, scope, channel=1, probe_multiplier=1, **kwargs):
+        """
+        Create an analyzer for a channel of an Oscilloscope, with its current sample rate, voltage range and
+        calibration.
+        """
+        sample_rate = scope.sample_rate_hz(scope.sample_rate_index)
+        offset, volts_per_count = scope.channel_scale(channel, probe_multiplier)
+        return cls(sample_rate, volts_per_count, channel=channel, offset=offset, **kwargs)
+
+    def reset(self):
+        """
+        Forget the averaged spectrum and the buffered samples.
+        """
+        self.sample_position = 0
+        self.segments = 0
+        self.gaps = 0
+        self._power = np.zeros(len(self.frequencies), dtype=np.float64)
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._undecimated = np.zeros(0, dtype=np.uint8)
+
+    def skip_to(self, sample_position):
+        """
+        Continue after a gap in the stream. Segments can not span the gap, so the buffered samples are dropped.
+        :param sample_position: The absolute index of the next sample.
+        """
+        self.gaps += 1
+        self.sample_position = sample_position
+        self._pending = self._pending[:0]
+        self._undecimated = self._undecimated[:0]
+
+    def _decimate(self, samples):
+        """
+        :return: The averages of every decimation samples, carrying the rest over to the next block.
+        """
+        if self._undecimated.size:
+            samples = np.concatenate((self._undecimated, samples))
+        full = len(samples) // self.decimation * self.decimation
+        self._undecimated = samples[full:].copy()
+        if samples.dtype == np.uint8:
+            sums = reduce_buckets(samples[:full].reshape(-1, 1), self.decimation, np.add, np.uint32)
+        else:
+            sums = samples[:full].reshape(-1, self.decimation).sum(axis=1, keepdims=True)
+        return sums[:, 0].astype(np.float32) * np.float32(1.0 / self.decimation)
+
+    def feed(self, ch1_data, ch2_data=None, sample_offset=None):
+        """
+        Add the next block, e.g. as the callback of read_async.
+        :param ch1_data: The next CH1 samples (bytes, array or NumPy array of ADC counts).
+        :param ch2_data: (OPTIONAL) The CH2 samples of the same block.
+        :param sample_offset: (OPTIONAL) The absolute index of the first sample, as passed by read_async with
+                              sample_offsets. Default: Contiguous
+        :return: The number of segments added to the average.
+        """
+        data = ch1_data if self.channel == 1 else ch2_data
+        samples = data if isinstance(data, np.ndarray) else as_uint8_array(data)
+        if sample_offset is not None and sample_offset != self.sample_position:
+            self.skip_to(sample_offset)
+        self.sample_position += len(samples)
+        if self.decimation > 1:
+            samples = self._decimate(samples)
+        if self._pending.size:
+            samples = np.concatenate((self._pending, samples))
+        count = (len(samples) - self.fft_size) // self.hop + 1 if len(samples) >= self.fft_size else 0
+        if count:
+            stride = samples.strides[0]
+            segments = np.lib.stride_tricks.as_strided(samples, (count, self.fft_size), (self.hop * stride, stride),
+                                                       writeable=False)
+            windowed = np.multiply(segments, self.window, dtype=np.float32)
+            windowed -= self._window_offset
+            spectra = np.fft.rfft(windowed, axis=1)
+            power = spectra.real ** 2
+            power += spectra.imag ** 2
+            self._average(power)
+        consumed = count * self.hop
+        self._pending = samples[consumed:].astype(np.float32)
+        return count
+
+    __call__ = feed
+
+    def _average(self, power):
+        """
+        Add the |FFT|^2 of a batch of segments to the average.
+        """
+        count = len(power)
+        if self.averaging == LINEAR or not self.segments:
+            if self.averaging == EXPONENTIAL:
+                # Start the exponential average with the first segment, then continue with the rest.
+                self._power[:] = power[0]
+                self.segments = 1
+                if count > 1:
+                    self._average(power[1:])
+                return
+            self._power += power.sum(axis=0)
+        else:
+            decay = 1.0 - self.alpha
+            weights = self.alpha * decay ** np.arange(count - 1, -1, -1)
+            self._power *= decay ** count
+            self._power += np.dot(weights, power)
+        self.segments += count
+
+    @property
+    def psd(self):
+        """
+        :return: The one-sided power spectral density of the averaged segments, in V^2/Hz.
+        """
+        power = self._power / self.segments if self.averaging == LINEAR and self.segments else self._power
+        return power * self._one_sided * self.psd_scale
+
+    def psd_db(self, floor=1e-30):
+        """
+        :param floor: (OPTIONAL) The lowest density, to keep empty bins finite. Default: 1e-30 V^2/Hz
+        :return: The power spectral density in dBV/Hz, i.e. dB relative to 1 V^2/Hz.
+        """
+        return 10 * np.log10(np.maximum(self.psd, floor))
+
+    def power_spectrum(self):
+        """
+        :return: The one-sided power spectrum in V^2 per bin, e.g. to read off the RMS voltage of tones.
+        """
+        return self.psd * self.enbw
@@ -0,0 +1,369 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# Aligning and averaging triggered traces, the bulk of the work in power analysis. Every trace is aligned to a
+# reference by FFT cross-correlation within a bounded shift window, and added to running mean and variance traces:
+#
+#     averager = TraceAverager(reference, max_shift=50, batch_size=1000, processes=4)
+#     engine = TriggerEngine(EdgeTrigger(160), pre_trigger=500, post_trigger=4500, on_frame=averager.add_frame)
+#     ...
+#     averager.close()
+#     plot(averager.mean, averager.std)
+#
+# Traces are processed in batches: one batched real FFT per batch, and the batch statistics are merged into the
+# running ones (Chan et al.), so the variance stays accurate over millions of traces. With processes the batches are
+# aligned in a process pool, and merged in the order they were added.
+
+import collections
+import multiprocessing
+
+import numpy as np
+
+from PyHT6022.Trigger import TriggerEngine
+
+
+def fft_size(length):
+    """
+    :param length: The minimum number of points.
+    :return: The smallest power of two at least length.
+    """
+    return 1 << max(0, int(length) - 1).bit_length()
+
+
+class TraceAligner(object):
+    """
+    Finds the shift of traces against a reference by cross-correlation, with the FFT of the reference cached.
+    """
+
+    def __init__(self, reference, max_shift, window=None):
+        """
+        :param reference: The reference trace.
+        :param max_shift: The largest shift searched for, in samples either way.
+        :param window: (OPTIONAL) (start, stop) of the part of the reference to align on, e.g. a distinctive pattern.
+                       Default: The whole trace
+        """
+        reference = np.asarray(reference, dtype=np.float32)
+        self.length = len(reference)
+        assert 0 <= max_shift < self.length, "The shift window must be shorter than the trace."
+        self.max_shift = max_shift
+        self.window = (0, self.length) if window is None else tuple(window)
+        start, stop = self.window
+        assert 0 <= start < stop <= self.length, "The window is outside the trace."
+        # Samples past the end correlate with the zero padding, not with the other end of the trace.
+        self.size = fft_size(self.length + max_shift)
+        pattern = np.zeros(self.length, dtype=np.float32)
+        pattern[start:stop] = reference[start:stop] - reference[start:stop].mean()
+        self.pattern = pattern[start:stop]
+        self.reference_fft = np.conj(np.fft.rfft(pattern, self.size))
+        self._lags = np.arange(-max_shift, max_shift + 1)
+
+    def shifts(self, traces):
+        """
+        :param traces: A (N, length) array of traces.
+        :return: An int64 array of the shift of each trace: trace[i + shift] lines up with reference[i].
+        """
+        traces = np.asarray(traces, dtype=np.float32)
+        traces = traces - traces.mean(axis=1, keepdims=True)
+        correlation = np.fft.irfft(np.fft.rfft(traces, self.size, axis=1) * self.reference_fft, self.size, axis=1)
+        # Negative lags wrap around to the end.
+        max_shift = self.max_shift
+        lags = np.concatenate((correlation[:, self.size - max_shift:], correlation[:, :max_shift + 1]), axis=1)
+        return self._lags[np.argmax(lags, axis=1)]
+
+    def align(self, traces, shifts=None, out=None):
+        """
+        Shift traces onto the reference. Samples shifted in at the ends repeat the first or last sample.
+        :param traces: A (N, length) array of traces.
+        :param shifts: (OPTIONAL) The shift of each trace. Default: Found by shifts()
+        :param out: (OPTIONAL) A (N, length) array to write the aligned traces to.
+        :return: (aligned traces, shifts)
+        """
+        traces = np.asarray(traces)
+        if shifts is None:
+            shifts = self.shifts(traces)
+        indexes = np.clip(np.arange(self.length) + shifts[:, None], 0, self.length - 1)
+        aligned = np.take_along_axis(traces, indexes, axis=1)
+        if out is not None:
+            out[...] = aligned
+            aligned = out
+        return aligned, shifts
+
+    def correlations(self, aligned):
+        """
+        :param aligned: A (N, length) array of aligned traces.
+        :return: The correlation coefficient of each trace with the reference, within the window.
+        """
+        start, stop = self.window
+        traces = np.asarray(aligned[:, start:stop], dtype=np.float32)
+        traces = traces - traces.mean(axis=1, keepdims=True)
+        norms = np.sqrt(np.einsum('ij,ij->i', traces, traces) * np.dot(self.pattern, self.pattern))
+        return np.dot(traces, self.pattern) / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+class TraceAccumulator(object):
+    """
+    Running mean and variance of traces, updated a batch at a time.
+    """
+
+    def __init__(self, length):
+        """
+        :param length: The samples per trace.
+        """
+        self.length = length
+        self.count = 0
+        self.mean = np.zeros(length, dtype=np.float64)
+        # The sum of squared differences from the mean.
+        self.m2 = np.zeros(length, dtype=np.float64)
+
+    def add(self, traces):
+        """
+        :param traces: A (N, length) array of traces.
+        """
+        if len(traces):
+            traces = np.asarray(traces, dtype=np.float64)
+            mean = traces.mean(axis=0)
+            self.merge(len(traces), mean, ((traces - mean) ** 2).sum(axis=0))
+
+    def merge(self, count, mean, m2):
+        """
+        Add the statistics of another set of traces, e.g. of a batch processed elsewhere.
+        :param count: The number of traces.
+        :param mean: Their mean trace.
+        :param m2: Their sum of squared differences from the mean.
+        """
+        if not count:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * (float(count) / total)
+        self.m2 += m2 + delta ** 2 * (float(self.count) * count / total)
+        self.count = total
+
+    @property
+    def variance(self):
+        """
+        :return: The sample variance of each point.
+        """
+        return self.m2 / max(self.count - 1, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+def _process_batch(aligner, traces, min_correlation):
+    """
+    Align a batch and return its statistics: (count, mean, m2, shifts, accepted).
+    """
+    if aligner is not None:
+        traces, shifts = aligner.align(traces)
+    else:
+        shifts = np.zeros(len(traces), dtype=np.int64)
+    accepted = np.ones(len(traces), dtype=bool)
+    if aligner is not None and min_correlation is not None:
+        accepted = aligner.correlations(traces) >= min_correlation
+        traces = traces[accepted]
+    batch = TraceAccumulator(traces.shape[1])
+    batch.add(traces)
+    return batch.count, batch.mean, batch.m2, shifts, accepted
+
+
+# The aligner of a pool worker, sent once when the worker starts rather than with every batch.
+_worker_aligner = None
+
+
+def _init_worker(aligner):
+    global _worker_aligner
+    _worker_aligner = aligner
+
+
+def _process_worker_batch(traces, min_correlation):
+    return _process_batch(_worker_aligner, traces, min_correlation)
+
+
+class TraceAverager(object):
+    """
+    Collects traces into batches, aligns them and accumulates the mean and variance of the aligned traces.
+    """
+
+    def __init__(self, reference=None, max_shift=0, window=None, channel=1, batch_size=1000, processes=None,
+                 min_correlation=None):
+        """
+        :param reference: (OPTIONAL) The trace to align to. Default: The first trace added
+        :param max_shift: (OPTIONAL) The largest shift searched for, in samples either way. 0 averages without
+                          aligning. Default: 0
+        :param window: (OPTIONAL) (start, stop) of the part of the reference to align on. Default: The whole trace
+        :param channel: (OPTIONAL) The channel add_frame takes from the frames, 1 or 2. Default: 1
+        :param batch_size: (OPTIONAL) The number of traces aligned at once. Default: 1000
+        :param processes: (OPTIONAL) The number of worker processes to align batches in. Default: In this process
+        :param min_correlation: (OPTIONAL) Leave out traces correlating less with the reference after alignment, e.g.
+                                0.8. Default: Keep all traces
+        """
+        assert channel in (1, 2), "The channel must be 1 or 2."
+        self.max_shift = max_shift
+        self.window = window
+        self.channel = channel
+        self.batch_size = batch_size
+        self.processes = processes
+        self.min_correlation = min_correlation
+        self.aligner = None
+        self.accumulator = None
+        self.rejected = 0
+        self._shifts = []
+        self._batch = None
+        self._fill = 0
+        self._pool = None
+        self._pending = collections.deque()
+        if reference is not None:
+            self._start(np.asarray(reference))
+
+    def _start(self, reference):
+        if self.max_shift:
+            self.aligner = TraceAligner(reference, self.max_shift, self.window)
+        self.accumulator = TraceAccumulator(len(reference))
+        if self.processes:
+            self._pool = multiprocessing.Pool(self.processes, _init_worker, (self.aligner,))
+
+    @property
+    def count(self):
+        """
+        :return: The number of traces accumulated, not counting the ones still in a batch.
+        """
+        return self.accumulator.count if self.accumulator is not None else 0
+
+    @property
+    def mean(self):
+        return self.accumulator.mean
+
+    @property
+    def variance(self):
+        return self.accumulator.variance
+
+    @property
+    def std(self):
+        return self.accumulator.std
+
+    @property
+    def shifts(self):
+        """
+        :return: The shift of every trace processed so far, in the order they were added.
+        """
+        return np.concatenate(self._shifts) if self._shifts else np.zeros(0, dtype=np.int64)
+
+    def add_frame(self, trigger_index, frame):
+        """
+        Add the trace of a TriggerEngine frame, as its on_frame callback.
+        :param trigger_index: The absolute sample index of the trigger.
+        :param frame: The (num_channels, samples) frame.
+        """
+        self.add_trace(frame[self.channel - 1])
+
+    def add_trace(self, trace):
+        """
+        :param trace: One trace.
+        """
+        if self.accumulator is None:
+            self._start(np.asarray(trace))
+        if self._batch is None:
+            self._batch = np.empty((self.batch_size, self.accumulator.length), dtype=np.asarray(trace).dtype)
+        self._batch[self._fill] = trace
+        self._fill += 1
+        if self._fill == self.batch_size:
+            self.flush()
+
+    def add(self, traces):
+        """
+        Add many traces, e.g. the segments of a SegmentedAcquisition channel. Full batches are taken without copying.
+        :param traces: A (N, samples) array of traces.
+        """
+        position = 0
+        while position < len(traces) and (self._fill or self.accumulator is None):
+            self.add_trace(traces[position])
+            position += 1
+        for start in range(position, len(traces) - self.batch_size + 1, self.batch_size):
+            self._submit(traces[start:start + self.batch_size])
+            position = start + self.batch_size
+        for trace in traces[position:]:
+            self.add_trace(trace)
+
+    def flush(self):
+        """
+        Process the traces of the partial batch.
+        """
+        if self._fill:
+            batch = self._batch[:self._fill]
+            # The pool pickles the batch later, so it needs a buffer of its own.
+            self._batch = None if self._pool is not None else self._batch
+            self._fill = 0
+            self._submit(batch)
+
+    def _submit(self, traces):
+        if self._pool is None:
+            self._merge(_process_batch(self.aligner, traces, self.min_correlation))
+            return
+        self._pending.append(self._pool.apply_async(_process_worker_batch, (traces, self.min_correlation)))
+        # Keep a couple of batches per worker queued, but do not let them pile up in memory.
+        while self._pending and (self._pending[0].ready() or len(self._pending) > 2 * self.processes):
+            self._merge(self._pending.popleft().get())
+
+    def _merge(self, result):
+        count, mean, m2, shifts, accepted = result
+        self.accumulator.merge(count, mean, m2)
+        self._shifts.append(shifts)
+        self.rejected += len(accepted) - count
+
+    def wait(self):
+        """
+        Process all traces added so far.
+        """
+        self.flush()
+        while self._pending:
+            self._merge(self._pending.popleft().get())
+
+    def close(self):
+        """
+        Process all traces added so far, and stop the worker processes.
+        """
+        self.wait()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def capture_frames(reader, trigger, pre_trigger=1000, post_trigger=1000, holdoff=None):
+    """
+    Run a trigger over a recorded capture file, to get its triggered frames.
+    :param reader: A CaptureFileReader.
+    :param trigger: The Trigger condition, e.g. an EdgeTrigger.
+    :param pre_trigger: (OPTIONAL) The samples before the trigger position in each frame. Default: 1000
+    :param post_trigger: (OPTIONAL) The samples from the trigger position on in each frame. Default: 1000
+    :param holdoff: (OPTIONAL) The samples after a trigger before the next one is accepted. Default: The frame length
+    :return: A generator of (trigger index, (num_channels, pre_trigger + post_trigger) frame).
+    """
+    engine = TriggerEngine(trigger, pre_trigger, post_trigger, reader.num_channels, holdoff)
+    for start, samples in reader.iter_chunks():
+        for frame in engine.feed(samples[0], samples[1] if reader.num_channels == 2 else None, start):
+            yield frame
+
+
+def average_traces(traces, reference=None, max_shift=0, window=None, channel=1, batch_size=1000, processes=None,
+                   min_correlation=None):
+    """
+    Align and average an array of traces, or the frames of capture_frames.
+    :param traces: A (N, samples) array of traces, or an iterable of (trigger index, frame).
+    :return: The TraceAverager holding the results.
+    See TraceAverager for the other parameters.
+    """
+    with TraceAverager(reference, max_shift, window, channel, batch_size, processes, min_correlation) as averager:
+        if isinstance(traces, np.ndarray):
+            averager.add(traces)
+        else:
+            for trigger_index, frame in traces:
+                averager.add_frame(trigger_index, frame)
+    return averager
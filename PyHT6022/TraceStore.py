@@ -0,0 +1,278 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# A store for millions of fixed length triggered traces, which does not need to fit in memory:
+#
+#     with TraceStore("traces.ht6022t", trace_length=5000, voltage_ranges=(0x0a, 0x01), trigger_offset=500) as store:
+#         engine = TriggerEngine(EdgeTrigger(160), pre_trigger=500, post_trigger=4500, num_channels=1,
+#                                frame_buffer=store.frame_buffer)
+#         ...
+#     store = TraceStore("traces.ht6022t", readonly=True)
+#     averager.add(store.traces[100000:200000, 0])
+#
+# The traces are kept as raw ADC counts, one byte per sample, in a memory mapped (traces, channels, samples) array.
+# Per trace metadata (host timestamp, trigger sample index, trigger offset within the trace, voltage ranges and a user
+# tag, e.g. the input the trace was captured for) goes into a side index file of fixed size records. Both files grow
+# by doubling while appending and are truncated to the traces written at close. All numbers are little endian.
+#
+#     traces file    64 byte header: magic "HT6022TS", version, channels, samples per trace, tag size, trace count,
+#                    the voltage ranges of CH1 and CH2 and the trigger offset recorded for traces appended without
+#                    them (0 if unknown), then the traces
+#     index file     64 byte header: magic "HTTSIDX\0", then one record per trace
+
+import os
+import struct
+import time
+
+import numpy as np
+
+from PyHT6022.SampleConversion import conversion_table
+
+FILE_MAGIC = b'HT6022TS'
+INDEX_MAGIC = b'HTTSIDX\x00'
+VERSION = 1
+FILE_HEADER = struct.Struct('<8sHHIIQBBI')
+HEADER_SIZE = 64
+# The trace count field of the header.
+COUNT_OFFSET = 20
+# The voltage ranges and trigger offset fields of the header.
+SETTINGS = struct.Struct('<BBI')
+SETTINGS_OFFSET = 28
+INDEX_SUFFIX = '.idx'
+
+
+def index_dtype(tag_size=16):
+    """
+    :param tag_size: The size of the user tag in bytes.
+    :return: The record of the index file.
+    """
+    return np.dtype([('timestamp', '<f8'), ('trigger_index', '<i8'), ('trigger_offset', '<u4'),
+                     ('ch1_voltage_range', 'u1'), ('ch2_voltage_range', 'u1'), ('tag', 'S{}'.format(tag_size))])
+
+
+class TraceStore(object):
+    """
+    Appends traces to, or reads traces from, a memory mapped trace file and its index.
+    """
+
+    def __init__(self, filename, trace_length=None, num_channels=1, tag_size=16, voltage_ranges=None,
+                 trigger_offset=None, readonly=False, capacity=1024):
+        """
+        :param filename: The trace file. The index is kept next to it, with '.idx' appended. An existing store is opened
+                         and appended to, otherwise a new one is created.
+        :param trace_length: The samples per channel in each trace. Only needed for a new store.
+        :param num_channels: (OPTIONAL) The channels per trace, for a new store. Default: 1
+        :param tag_size: (OPTIONAL) The size of the user tag in bytes, for a new store. Default: 16
+        :param voltage_ranges: (OPTIONAL) The voltage range indexes of CH1 and CH2 recorded for traces appended without
+                               them. They are kept in the store. Default: As stored, (0x01, 0x01) for a new store
+        :param trigger_offset: (OPTIONAL) The index of the trigger sample within the traces, recorded for traces
+                               appended without it, e.g. the pre_trigger of a TriggerEngine. It is kept in the store.
+                               Default: As stored, 0 for a new store
+        :param readonly: (OPTIONAL) Open an existing store for reading only. Default: Off
+        :param capacity: (OPTIONAL) The number of traces to preallocate room for when appending. Default: 1024
+        """
+        self.filename = filename
+        self.index_filename = filename + INDEX_SUFFIX
+        self.readonly = readonly
+        if os.path.exists(filename):
+            with open(filename, 'rb') as trace_file:
+                (magic, version, num_channels, length, tag_size, count, ch1_voltage_range, ch2_voltage_range,
+                 stored_trigger_offset) = FILE_HEADER.unpack(trace_file.read(FILE_HEADER.size))
+            assert magic == FILE_MAGIC, "{} is not a trace store.".format(filename)
+            assert version == VERSION, "Unsupported trace store version {}.".format(version)
+            assert trace_length in (None, length), "The store holds traces of {} samples.".format(length)
+            trace_length = length
+            capacity = count if readonly else max(count, capacity)
+            # Stores written before the settings were kept have zeros there.
+            if voltage_ranges is None and ch1_voltage_range and ch2_voltage_range:
+                voltage_ranges = (ch1_voltage_range, ch2_voltage_range)
+            if trigger_offset is None:
+                trigger_offset = stored_trigger_offset
+        else:
+            assert not readonly, "{} does not exist.".format(filename)
+            assert trace_length, "A new store needs the trace length."
+            count = 0
+            with open(filename, 'wb') as trace_file:
+                trace_file.write(FILE_HEADER.pack(FILE_MAGIC, VERSION, num_channels, trace_length, tag_size, 0, 0, 0,
+                                                  0).ljust(HEADER_SIZE, b'\x00'))
+            with open(self.index_filename, 'wb') as index_file:
+                index_file.write(INDEX_MAGIC.ljust(HEADER_SIZE, b'\x00'))
+        self.voltage_ranges = tuple(voltage_ranges) if voltage_ranges is not None else (0x01, 0x01)
+        self.trigger_offset = trigger_offset or 0
+        self.num_channels = num_channels
+        self.trace_length = trace_length
+        self.tag_size = tag_size
+        self.index_dtype = index_dtype(tag_size)
+        self.count = count
+        self._map(capacity)
+        if not readonly:
+            self._header[SETTINGS_OFFSET:SETTINGS_OFFSET + SETTINGS.size] = np.frombuffer(
+                SETTINGS.pack(self.voltage_ranges[0], self.voltage_ranges[1], self.trigger_offset), np.uint8)
+
+    def _map(self, capacity):
+        """
+        (Re)map both files with room for capacity traces. Views returned earlier keep the old maps alive.
+        """
+        trace_bytes = self.num_channels * self.trace_length
+        if not self.readonly:
+            for filename, size in ((self.filename, trace_bytes), (self.index_filename, self.index_dtype.itemsize)):
+                with open(filename, 'r+b') as store_file:
+                    store_file.truncate(HEADER_SIZE + capacity * size)
+        self.capacity = capacity
+        mode = 'r' if self.readonly else 'r+'
+        self._header = np.memmap(self.filename, np.uint8, mode, 0, (HEADER_SIZE,))
+        if not capacity:
+            # An empty file can not be mapped.
+            self._traces = np.zeros((0, self.num_channels, self.trace_length), dtype=np.uint8)
+            self._index = np.zeros(0, dtype=self.index_dtype)
+            return
+        self._traces = np.memmap(self.filename, np.uint8, mode, HEADER_SIZE,
+                                 (capacity, self.num_channels, self.trace_length))
+        self._index = np.memmap(self.index_filename, self.index_dtype, mode, HEADER_SIZE, (capacity,))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def traces(self):
+        """
+        :return: A (count, num_channels, trace_length) uint8 view of all traces. Slicing it reads only those traces.
+        """
+        return self._traces[:self.count]
+
+    @property
+    def metadata(self):
+        """
+        :return: The index records of all traces, with the fields timestamp, trigger_index, trigger_offset,
+                 ch1_voltage_range, ch2_voltage_range and tag.
+        """
+        return self._index[:self.count]
+
+    def read(self, start, stop):
+        """
+        :param start: The index of the first trace.
+        :param stop: The index after the last trace.
+        :return: (traces, metadata) of a range of traces, as views into the files.
+        """
+        stop = min(stop, self.count)
+        return self._traces[start:stop], self._index[start:stop]
+
+    def iter_batches(self, batch_size=1000, start=0, stop=None):
+        """
+        :param batch_size: (OPTIONAL) The number of traces per batch. Default: 1000
+        :param start: (OPTIONAL) The first trace. Default: 0
+        :param stop: (OPTIONAL) The trace after the last one. Default: All traces
+        :return: A generator of (index of the first trace, (N, num_channels, trace_length) view).
+        """
+        stop = self.count if stop is None else min(stop, self.count)
+        for batch_start in range(start, stop, batch_size):
+            yield batch_start, self._traces[batch_start:min(batch_start + batch_size, stop)]
+
+    def volts(self, start, stop, channel=1):
+        """
+        :param start: The index of the first trace.
+        :param stop: The index after the last trace.
+        :param channel: (OPTIONAL) The channel, 1 or 2. Default: 1
+        :return: A (N, trace_length) float32 array of the channel's traces in volts, converted with the voltage range
+                 each trace was captured with.
+        """
+        traces, metadata = self.read(start, stop)
+        samples = traces[:, channel - 1]
+        ranges = metadata['ch{}_voltage_range'.format(channel)]
+        out = np.empty(samples.shape, dtype=np.float32)
+        for voltage_range in np.unique(ranges):
+            selected = ranges == voltage_range
+            out[selected] = conversion_table(int(voltage_range)).take(samples[selected], mode='clip')
+        return out
+
+    def _reserve(self, count):
+        """
+        :return: The index of the first of count new traces, growing the files as needed.
+        """
+        assert not self.readonly, "The store is read only."
+        if self.count + count > self.capacity:
+            self._map(max(self.count + count, 2 * self.capacity))
+        first = self.count
+        self.count += count
+        self._header[COUNT_OFFSET:COUNT_OFFSET + 8] = np.frombuffer(struct.pack('<Q', self.count), np.uint8)
+        return first
+
+    def append(self, traces, timestamps=None, trigger_indexes=0, trigger_offsets=None, voltage_ranges=None,
+               tags=b''):
+        """
+        Append a batch of traces.
+        :param traces: A (N, num_channels, trace_length) array of ADC counts, or (N, trace_length) for one channel.
+        :param timestamps: (OPTIONAL) The host time of each trace, or one for all. Default: Now
+        :param trigger_indexes: (OPTIONAL) The absolute sample index of each trace's trigger. Default: 0
+        :param trigger_offsets: (OPTIONAL) The index of the trigger sample within the traces. Default: trigger_offset
+        :param voltage_ranges: (OPTIONAL) The voltage range indexes of CH1 and CH2. Default: voltage_ranges
+        :param tags: (OPTIONAL) The user tag of each trace, or one for all. Default: Empty
+        :return: The index of the first trace appended.
+        """
+        traces = np.asarray(traces, dtype=np.uint8)
+        if traces.ndim == 2:
+            traces = traces[:, None]
+        assert traces.shape[1:] == (self.num_channels, self.trace_length), \
+            "The traces must be (N, {}, {}).".format(self.num_channels, self.trace_length)
+        first = self._reserve(len(traces))
+        self._traces[first:self.count] = traces
+        records = self._index[first:self.count]
+        records['timestamp'] = time.time() if timestamps is None else timestamps
+        records['trigger_index'] = trigger_indexes
+        records['trigger_offset'] = self.trigger_offset if trigger_offsets is None else trigger_offsets
+        ch1_voltage_range, ch2_voltage_range = self.voltage_ranges if voltage_ranges is None else voltage_ranges
+        records['ch1_voltage_range'] = ch1_voltage_range
+        records['ch2_voltage_range'] = ch2_voltage_range
+        records['tag'] = tags
+        return first
+
+    def frame_buffer(self, trigger_index, tag=b''):
+        """
+        The frame_buffer of a TriggerEngine: the slot for the next trace, so frames are copied straight into the map.
+        The trigger engine's pre_trigger should be the trigger_offset of the store.
+        :param trigger_index: The absolute sample index of the trigger.
+        :param tag: (OPTIONAL) The user tag of the trace. Default: Empty
+        :return: The (num_channels, trace_length) view to fill.
+        """
+        slot = self._reserve(1)
+        record = self._index[slot]
+        record['timestamp'] = time.time()
+        record['trigger_index'] = trigger_index
+        record['trigger_offset'] = self.trigger_offset
+        record['ch1_voltage_range'], record['ch2_voltage_range'] = self.voltage_ranges
+        record['tag'] = tag
+        return self._traces[slot]
+
+    def add_frame(self, trigger_index, frame):
+        """
+        Append a TriggerEngine frame, as its on_frame callback.
+        """
+        self.append(frame[None], trigger_indexes=trigger_index)
+
+    def flush(self):
+        """
+        Write the changes to disk.
+        """
+        if not self.readonly and self.capacity:
+            self._header.flush()
+            self._traces.flush()
+            self._index.flush()
+
+    def close(self):
+        """
+        Flush, and truncate the files to the traces written.
+        """
+        if self._traces is None:
+            return
+        self.flush()
+        self._header = self._traces = self._index = None
+        if not self.readonly:
+            for filename, size in ((self.filename, self.num_channels * self.trace_length),
+                                   (self.index_filename, self.index_dtype.itemsize)):
+                with open(filename, 'r+b') as store_file:
+                    store_file.truncate(HEADER_SIZE + self.count * size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,88 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+import threading
+
+
+class TransferBufferPool(object):
+    """
+    A fixed pool of preallocated, reusable transfer buffers for zero-copy asynchronous reads.
+
+    Every outstanding USB transfer owns one buffer from the pool for its whole lifetime. When a transfer completes,
+    its buffer is held while the consumer looks at it (through memoryviews), and the transfer is only resubmitted
+    once the buffer is released again. No sample data is allocated or copied on the completion path.
+    """
+
+    def __init__(self, num_buffers, buffer_size, shutdown_event=None):
+        """
+        :param num_buffers: The number of buffers to preallocate, usually one per outstanding transfer.
+        :param buffer_size: The size of each buffer in bytes.
+        :param shutdown_event: (OPTIONAL) An event which, once set, stops released transfers from being resubmitted.
+        """
+        self.buffer_size = buffer_size
+        self.buffers = [bytearray(buffer_size) for _ in range(num_buffers)]
+        self.shutdown_event = shutdown_event or threading.Event()
+        self._transfers = {}
+        self._held = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def __iter__(self):
+        return iter(self.buffers)
+
+    def attach(self, buffer, transfer):
+        """
+        Bind a pool buffer to the transfer that fills it.
+        :param buffer: One of the buffers of this pool.
+        :param transfer: The transfer using that buffer.
+        """
+        self._transfers[id(buffer)] = transfer
+
+    def hold(self, buffer):
+        """
+        Mark a buffer as handed out to the consumer. Its transfer will not be resubmitted until it is released.
+        :param buffer: The pool buffer of a completed transfer.
+        """
+        with self._lock:
+            self._held.add(id(buffer))
+
+    def release(self, block):
+        """
+        Return a held buffer to the pool and resubmit its transfer, unless the shutdown event has been set.
+        Any memoryview of the buffer must not be used after this call, as the data will be overwritten.
+        :param block: The pool buffer, or any memoryview or NumPy view into it (such as the blocks handed to the
+                      callback).
+        :return: True if the transfer was resubmitted, False otherwise.
+        """
+        key = id(self.buffer_of(block))
+        with self._lock:
+            if key not in self._held:
+                return False
+            self._held.discard(key)
+        if self.shutdown_event.is_set():
+            return False
+        self._transfers[key].submit()
+        return True
+
+    @staticmethod
+    def buffer_of(block):
+        """
+        :param block: A buffer, or a view into it: a memoryview, or a NumPy array viewing it, possibly through
+                      further views.
+        :return: The underlying buffer.
+        """
+        while True:
+            if isinstance(block, memoryview):
+                block = block.obj
+            elif getattr(block, 'base', None) is not None:
+                block = block.base
+            else:
+                return block
+
+    @property
+    def held_count(self):
+        """
+        :return: The number of buffers currently held by the consumer.
+        """
+        return len(self._held)
@@ -0,0 +1,335 @@
+__author__ = 'Robert Cope', 'Jochen Hoenicke'
+
+# Software triggering over the streaming blocks of read_async. The scope itself has no trigger, so this searches the
+# stream for trigger events with a few whole-block NumPy passes and cuts fixed length frames around them:
+#
+#     level = scope.voltage_to_adc(0.5, scope.ch1_voltage_range)
+#     engine = TriggerEngine(EdgeTrigger(level, hysteresis=4), pre_trigger=500, post_trigger=1500,
+#                            num_channels=scope.num_channels, on_frame=show)
+#     scope.read_async(engine, 0x10000, as_numpy=True, event_thread=True)
+#
+# Trigger levels are in the units of the data, i.e. ADC counts unless the read converts to volts. The trigger state is
+# kept between blocks, so events straddling a block boundary are found like any other, and the last samples are kept
+# in a ring buffer for the pre-trigger part of the frames.
+
+import numpy as np
+
+from PyHT6022.SampleConversion import as_uint8_array
+
+RISING = 'rising'
+FALLING = 'falling'
+POSITIVE = 'positive'
+NEGATIVE = 'negative'
+ENTER = 'enter'
+EXIT = 'exit'
+
+EMPTY = np.zeros(0, dtype=np.int64)
+
+
+class Hysteresis(object):
+    """
+    A comparator with hysteresis: the signal is high once it reaches upper, and low once it drops below lower.
+    """
+
+    def __init__(self, upper, lower):
+        assert lower <= upper, "The lower threshold must not be above the upper one."
+        self.upper = upper
+        self.lower = lower
+        self.reset()
+
+    def reset(self):
+        # 1 if the signal was last high, -1 if low, 0 if it was not outside the band yet.
+        self.state = 0
+
+    def transitions(self, samples):
+        """
+        :param samples: The next samples of the signal.
+        :return: (rising, falling) arrays with the sample indexes where the signal turns high and low.
+        """
+        codes = (samples >= self.upper).view(np.int8) - (samples < self.lower).view(np.int8)
+        events = np.flatnonzero(codes)
+        if not len(events):
+            return EMPTY, EMPTY
+        levels = codes[events]
+        changes = np.flatnonzero(levels[1:] != levels[:-1]) + 1
+        if self.state and levels[0] != self.state:
+            changes = np.concatenate(([0], changes))
+        self.state = int(levels[-1])
+        changes = events[changes]
+        high = codes[changes] > 0
+        return changes[high], changes[~high]
+
+
+class Trigger(object):
+    """
+    The base of the trigger conditions, holding the trigger channel. A trigger condition also implements
+
+        find(samples, start)
+
+    which is given the next block of samples of the trigger channel and the absolute index of its first sample, and
+    returns a sorted int64 array of the absolute sample indexes the trigger fires at. State carried from one block to
+    the next is cleared by reset, which the TriggerEngine calls at gaps.
+    """
+
+    def __init__(self, channel=1):
+        """
+        :param channel: (OPTIONAL) The channel to trigger on, 1 or 2. Default: 1
+        """
+        assert channel in (1, 2), "The trigger channel must be 1 or 2."
+        self.channel = channel
+
+    def reset(self):
+        pass
+
+
+class EdgeTrigger(Trigger):
+    def __init__(self, level, slope=RISING, hysteresis=0, channel=1):
+        """
+        Fire when the signal crosses a level.
+        :param level: The trigger level.
+        :param slope: (OPTIONAL) RISING or FALLING. Default: RISING
+        :param hysteresis: (OPTIONAL) How far the signal must have been on the other side of the level to re-arm the
+                           trigger, to keep noise from firing it repeatedly. Default: 0
+        :param channel: (OPTIONAL) The channel to trigger on, 1 or 2. Default: 1
+        """
+        Trigger.__init__(self, channel)
+        assert slope in (RISING, FALLING), "Unknown slope {}.".format(slope)
+        self.slope = slope
+        if slope == RISING:
+            self.comparator = Hysteresis(level, level - hysteresis)
+        else:
+            self.comparator = Hysteresis(level + hysteresis, level)
+
+    def reset(self):
+        self.comparator.reset()
+
+    def find(self, samples, start):
+        rising, falling = self.comparator.transitions(samples)
+        return (rising if self.slope == RISING else falling) + start
+
+
+class PulseWidthTrigger(Trigger):
+    def __init__(self, level, min_width=0, max_width=None, polarity=POSITIVE, hysteresis=0, channel=1):
+        """
+        Fire at the end of a pulse whose width is within limits.
+        :param level: The level separating high from low.
+        :param min_width: (OPTIONAL) The shortest pulse to fire on, in samples. Default: 0
+        :param max_width: (OPTIONAL) The longest pulse to fire on, in samples. Default: No limit
+        :param polarity: (OPTIONAL) POSITIVE for high pulses, NEGATIVE for low ones. Default: POSITIVE
+        :param hysteresis: (OPTIONAL) The width of the band below level the signal must leave to count as low.
+                           Default: 0
+        :param channel: (OPTIONAL) The channel to trigger on, 1 or 2. Default: 1
+        """
+        Trigger.__init__(self, channel)
+        assert polarity in (POSITIVE, NEGATIVE), "Unknown polarity {}.".format(polarity)
+        self.min_width = min_width
+        self.max_width = max_width
+        self.polarity = polarity
+        self.comparator = Hysteresis(level, level - hysteresis)
+        self.reset()
+
+    def reset(self):
+        self.comparator.reset()
+        # The absolute start of a pulse which has not ended yet.
+        self.pulse_start = None
+
+    def find(self, samples, start):
+        rising, falling = self.comparator.transitions(samples)
+        starts, ends = (rising, falling) if self.polarity == POSITIVE else (falling, rising)
+        starts, ends = starts + start, ends + start
+        # Starts and ends alternate, so every end belongs to the start right before it.
+        previous = np.searchsorted(starts, ends) - 1
+        pulse_starts = starts[np.maximum(previous, 0)] if len(starts) else np.zeros(len(ends), dtype=np.int64)
+        valid = previous >= 0
+        if self.pulse_start is not None and len(ends):
+            pulse_starts[0] = self.pulse_start if previous[0] < 0 else pulse_starts[0]
+            valid[0] = True
+        widths = ends - pulse_starts
+        valid &= widths >= self.min_width
+        if self.max_width is not None:
+            valid &= widths <= self.max_width
+        if len(starts) and (not len(ends) or starts[-1] > ends[-1]):
+            self.pulse_start = int(starts[-1])
+        elif len(ends):
+            self.pulse_start = None
+        return ends[valid]
+
+
+class WindowTrigger(Trigger):
+    def __init__(self, low, high, mode=ENTER, channel=1):
+        """
+        Fire when the signal enters or leaves a window.
+        :param low: The lower bound of the window.
+        :param high: The upper bound of the window (inclusive).
+        :param mode: (OPTIONAL) ENTER or EXIT. Default: ENTER
+        :param channel: (OPTIONAL) The channel to trigger on, 1 or 2. Default: 1
+        """
+        Trigger.__init__(self, channel)
+        assert low <= high, "The window is empty."
+        assert mode in (ENTER, EXIT), "Unknown mode {}.".format(mode)
+        self.low = low
+        self.high = high
+        self.mode = mode
+        self.reset()
+
+    def reset(self):
+        self.inside = None
+
+    def find(self, samples, start):
+        if not len(samples):
+            return EMPTY
+        inside = (samples >= self.low) & (samples <= self.high)
+        changes = np.flatnonzero(inside[1:] != inside[:-1]) + 1
+        if self.inside is not None and inside[0] != self.inside:
+            changes = np.concatenate(([0], changes))
+        self.inside = bool(inside[-1])
+        entered = inside[changes]
+        return (changes[entered] if self.mode == ENTER else changes[~entered]) + start
+
+
+class TriggerEngine(object):
+    """
+    Runs a trigger over the stream of read_async blocks and cuts a frame of pre_trigger + post_trigger samples per
+    channel around every trigger position. Frames are emitted once their post-trigger samples have arrived.
+    """
+
+    def __init__(self, trigger, pre_trigger=1000, post_trigger=1000, num_channels=2, holdoff=None, on_frame=None,
+                 frame_buffer=None):
+        """
+        :param trigger: The Trigger condition, e.g. an EdgeTrigger.
+        :param pre_trigger: (OPTIONAL) The samples before the trigger position in each frame. Default: 1000
+        :param post_trigger: (OPTIONAL) The samples from the trigger position on in each frame. Default: 1000
+        :param num_channels: (OPTIONAL) The number of channels the read delivers, 1 or 2. Default: 2
+        :param holdoff: (OPTIONAL) The samples after a trigger before the next one is accepted.
+                        Default: pre_trigger + post_trigger, i.e. frames do not overlap.
+        :param on_frame: (OPTIONAL) Called as on_frame(trigger_index, frame) for every frame, with the absolute sample
+                         index of the trigger and a (num_channels, pre_trigger + post_trigger) array.
+        :param frame_buffer: (OPTIONAL) Called as frame_buffer(trigger_index) for the (num_channels, pre_trigger +
+                             post_trigger) array to copy a frame into, or None to drop the frame. Default: A new array
+                             per frame.
+        """
+        assert num_channels in (1, 2), "Only one or two channels are supported."
+        assert trigger.channel <= num_channels, "The trigger channel is not captured."
+        assert pre_trigger >= 0 and post_trigger > 0, "The frame must include the trigger position."
+        self.trigger = trigger
+        self.pre_trigger = pre_trigger
+        self.post_trigger = post_trigger
+        self.frame_length = pre_trigger + post_trigger
+        self.num_channels = num_channels
+        self.holdoff = self.frame_length if holdoff is None else holdoff
+        self.on_frame = on_frame
+        self.frame_buffer = frame_buffer
+        self._ring = None
+        self.reset()
+
+    def reset(self):
+        """
+        Start over at sample 0 with an empty history, e.g. for a new capture.
+        """
+        self.trigger.reset()
+        self.sample_position = 0
+        self.triggers = 0
+        # Trigger positions whose post-trigger samples are still to come.
+        self.pending = []
+        # The first position the trigger may fire at: a frame needs its full pre-trigger history.
+        self.next_allowed = self.pre_trigger
+        self.gaps = 0
+        self.dropped_frames = 0
+
+    def _ensure_capacity(self, block_length, dtype):
+        # Holds the pre-trigger history and post-trigger samples of pending frames, plus the new block.
+        capacity = self.frame_length + block_length
+        ring = self._ring
+        if ring is not None and ring.shape[1] >= capacity and ring.dtype == dtype:
+            return
+        self._ring = np.zeros((self.num_channels, max(capacity, 2 * ring.shape[1] if ring is not None else 0)), dtype)
+        if ring is not None:
+            kept = min(self.sample_position, ring.shape[1])
+            history = np.empty((self.num_channels, kept), ring.dtype)
+            self._copy_out(ring, self.sample_position - kept, kept, history)
+            self._copy_in(self._ring, self.sample_position - kept, history, kept)
+
+    @staticmethod
+    def _copy_out(ring, start, length, out):
+        capacity = ring.shape[1]
+        offset = start % capacity
+        first = min(length, capacity - offset)
+        out[:, :first] = ring[:, offset:offset + first]
+        out[:, first:length] = ring[:, :length - first]
+
+    @staticmethod
+    def _copy_in(ring, start, channels, length):
+        capacity = ring.shape[1]
+        offset = start % capacity
+        first = min(length, capacity - offset)
+        for channel_ring, samples in zip(ring, channels):
+            channel_ring[offset:offset + first] = samples[:first]
+            channel_ring[:length - first] = samples[first:length]
+
+    def _accept(self, candidates):
+        """
+        Apply the holdoff to the candidate positions, jumping from one accepted trigger to the next.
+        """
+        accepted = []
+        index = np.searchsorted(candidates, self.next_allowed)
+        while index < len(candidates):
+            position = int(candidates[index])
+            accepted.append(position)
+            self.next_allowed = position + max(self.holdoff, 1)
+            index = np.searchsorted(candidates, self.next_allowed)
+        return accepted
+
+    def skip_to(self, sample_position):
+        """
+        Continue after a gap in the stream. The frames around the gap are lost, the trigger re-arms once there is a
+        full pre-trigger history again.
+        :param sample_position: The absolute index of the next sample.
+        """
+        self.gaps += 1
+        self.dropped_frames += len(self.pending)
+        self.pending = []
+        self.trigger.reset()
+        self.sample_position = sample_position
+        self.next_allowed = max(self.next_allowed, sample_position + self.pre_trigger)
+
+    def feed(self, ch1_data, ch2_data=None, sample_offset=None):
+        """
+        Process the next block, e.g. as the callback of read_async.
+        :param ch1_data: The next CH1 samples (bytes, array or NumPy array).
+        :param ch2_data: (OPTIONAL) The CH2 samples of the same block, if num_channels is 2.
+        :param sample_offset: (OPTIONAL) The absolute index of the first sample, as passed by read_async with
+                              sample_offsets. Samples lost before it are skipped in the timeline. Default: Contiguous
+        :return: A list of (trigger index, frame) for the frames completed by this block.
+        """
+        if sample_offset is not None and sample_offset != self.sample_position:
+            self.skip_to(sample_offset)
+        channels = [ch1_data if isinstance(ch1_data, np.ndarray) else as_uint8_array(ch1_data)]
+        if self.num_channels == 2:
+            channels.append(ch2_data if isinstance(ch2_data, np.ndarray) else as_uint8_array(ch2_data))
+        length = min(len(samples) for samples in channels)
+        start = self.sample_position
+        self._ensure_capacity(length, channels[0].dtype)
+        self._copy_in(self._ring, start, channels, length)
+        candidates = self.trigger.find(channels[self.trigger.channel - 1][:length], start)
+        if len(candidates):
+            accepted = self._accept(candidates)
+            self.triggers += len(accepted)
+            self.pending.extend(accepted)
+        self.sample_position = end = start + length
+        frames = []
+        while self.pending and self.pending[0] + self.post_trigger <= end:
+            position = self.pending.pop(0)
+            if self.frame_buffer is None:
+                frame = np.empty((self.num_channels, self.frame_length), self._ring.dtype)
+            else:
+                frame = self.frame_buffer(position)
+                if frame is None:
+                    self.dropped_frames += 1
+                    continue
+            self._copy_out(self._ring, position - self.pre_trigger, self.frame_length, frame)
+            frames.append((position, frame))
+            if self.on_frame is not None:
+                self.on_frame(position, frame)
+        return frames
+
+    __call__ = feed
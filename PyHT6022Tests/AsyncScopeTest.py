@@ -0,0 +1,61 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+import asyncio
+import time
+
+from PyHT6022.AsyncScope import AsyncOscilloscope, OverrunError, DROP_NEWEST, STOP
+from PyHT6022Tests.SimulatedScopeTest import build_scope
+
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+class AsyncScopeTests(TestCase):
+    def test_stream(self):
+        print("Testing streaming blocks to a coroutine.")
+        scope = build_scope()
+
+        async def consume():
+            async with AsyncOscilloscope(scope) as ascope:
+                assert await ascope.set_interface(1)
+                assert await ascope.set_sample_rate(0x10)
+                blocks = []
+                async with ascope.stream(0x8000, as_numpy=True) as stream:
+                    async for ch1_data, ch2_data in stream:
+                        blocks.append((ch1_data, ch2_data))
+                        if len(blocks) == 20:
+                            break
+                return blocks, stream
+        blocks, stream = run(consume())
+        assert len(blocks) == 20
+        assert all(len(ch1_data) == len(ch2_data) > 0 for ch1_data, ch2_data in blocks)
+        assert stream.received >= 20
+        assert not scope.device_handle
+
+    def test_overrun_policies(self):
+        print("Testing the drop newest and stop overrun policies with a slow consumer.")
+        scope = build_scope()
+        assert scope.set_interface(1)
+
+        async def consume_slowly(overrun):
+            blocks = 0
+            async with scope.stream(0x8000, max_buffered=4, overrun=overrun, raw=True) as stream:
+                try:
+                    async for _ in stream:
+                        blocks += 1
+                        time.sleep(0.01)
+                        if blocks == 20:
+                            break
+                except OverrunError:
+                    return blocks, stream, True
+            return blocks, stream, False
+        blocks, stream, overrun = run(consume_slowly(DROP_NEWEST))
+        assert blocks == 20 and not overrun
+        assert stream.dropped
+        blocks, stream, overrun = run(consume_slowly(STOP))
+        assert overrun
+        # The blocks buffered before the overrun are still delivered.
+        assert blocks >= 4
+        assert scope.close_handle()
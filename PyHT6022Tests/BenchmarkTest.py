@@ -0,0 +1,68 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+
+from PyHT6022 import Benchmark
+from PyHT6022Tests.SimulatedScopeTest import build_scope
+
+
+class BenchmarkTests(TestCase):
+    def test_percentile(self):
+        print("Testing nearest rank percentiles.")
+        values = list(range(101))
+        assert Benchmark.percentile(values, 0.5) == 50
+        assert Benchmark.percentile(values, 0.99) == 99
+        assert Benchmark.percentile([], 0.5) is None
+
+    def test_compare(self):
+        print("Testing comparison against a baseline.")
+        baseline = [{'name': 'a', 'throughput_mb_s': 100.0}, {'name': 'b', 'throughput_mb_s': 100.0}]
+        results = [{'name': 'a', 'throughput_mb_s': 80.0}, {'name': 'b', 'throughput_mb_s': 95.0},
+                   {'name': 'c', 'throughput_mb_s': 1.0}]
+        comparison = dict((name, regressed) for name, _, _, _, regressed in Benchmark.compare(results, baseline))
+        assert comparison == {'a': True, 'b': False}
+
+    def test_simulated_scenarios(self):
+        print("Testing benchmark scenarios against the simulated scope.")
+        scope = Benchmark.build_scope(simulated=True)
+        benchmark = Benchmark.AcquisitionBenchmark(scope, duration=0.05)
+        result = benchmark.run_read_data(0x1000, 2, Benchmark.CONVERSIONS[0], iterations=5)
+        assert result['bytes'] == 5 * 0x2000 and result['gaps'] is None
+        result = benchmark.run_read_async(True, 0x6000, 1, Benchmark.CONVERSIONS[1], 4)
+        assert result['bytes']
+        assert result['gaps'] == 0
+        assert result['latency_p50_ms'] is not None
+        assert scope.close_handle()
+
+    def test_gaps(self):
+        print("Testing the gaps of a scenario are counted by the gap tracker of its read.")
+        scope = build_scope(packet_loss=0.05)
+        scope.set_sample_rate(24)
+        benchmark = Benchmark.AcquisitionBenchmark(scope, duration=0.05)
+        result = benchmark.run_read_async(True, 0x6000, 2, Benchmark.CONVERSIONS[0], 4)
+        assert result['gaps'] == len(scope.gap_tracker.gaps) > 0
+        assert result['gaps'] <= scope.device.lost_packets
+        result = benchmark.run_read_async(False, 0x6000, 2, Benchmark.CONVERSIONS[0], 4)
+        assert result['gaps'] == 0
+        assert scope.close_handle()
+
+    def test_processing(self):
+        print("Testing the recording and signal processing scenarios.")
+        scope = Benchmark.build_scope(simulated=True)
+        benchmark = Benchmark.AcquisitionBenchmark(scope, duration=0.1)
+        results = dict((result['name'], result) for result in benchmark.run_all_processing(num_samples=1 << 16))
+        assert scope.close_handle()
+        assert set(results) == {'record/raw/1ch', 'replay/realtime/2ch/14', 'processing/envelope', 'processing/overview',
+                                'processing/overview_query', 'processing/spectrum', 'processing/trigger',
+                                'processing/measurements', 'processing/filter_fir', 'processing/filter_iir',
+                                'processing/channel_math', 'processing/channel_delay',
+                                'processing/channel_delay_estimate', 'processing/histogram'}
+        assert results['record/raw/1ch']['bytes'] > 0 and results['record/raw/1ch']['gaps'] == 0
+        replay = results['replay/realtime/2ch/14']
+        assert replay['bytes'] > 0 and replay['gaps'] == 0 and replay['pace'] is not None
+        assert results['processing/envelope']['bytes'] == 2 << 16 and results['processing/envelope']['blocks'] == 2
+        assert results['processing/overview_query']['blocks'] == 20
+        for name, result in results.items():
+            if name.startswith('processing/'):
+                assert result['gaps'] is None
+                assert result['keeps_up'] in ((None,) if name.endswith(('query', 'estimate')) else (True, False))
@@ -0,0 +1,68 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+import time
+
+from PyHT6022.BlockRingBuffer import BlockRingBuffer, BufferOverrunError
+from PyHT6022Tests.SimulatedScopeTest import build_scope
+
+
+class BlockRingBufferTests(TestCase):
+    def test_ring_buffer(self):
+        print("Testing blocks wrap around the ring and overruns are reported.")
+        ring = BlockRingBuffer(4, 3)
+        assert ring.write(bytearray(range(0, 6)))
+        assert ring.write(bytearray(range(6, 12)))
+        assert not ring.write(bytearray(range(12, 14)))
+        block, dropped = ring.read_block()
+        assert bytes(block) == bytes(bytearray(range(0, 4))) and dropped == 0
+        block, dropped = ring.read_block()
+        assert bytes(block) == bytes(bytearray(range(4, 8))) and dropped == 0
+        # The first block is free again, so this write wraps around.
+        assert ring.write(bytearray(range(14, 18)))
+        block, dropped = ring.read_block()
+        assert bytes(block) == bytes(bytearray([8, 9, 10, 11])) and dropped == 0
+        block, dropped = ring.read_block()
+        assert bytes(block) == bytes(bytearray(range(14, 18))) and dropped == 2
+        assert ring.read_block(timeout=0.01) == (None, 0)
+        ring.close()
+        assert ring.read_block() == (None, 0)
+        assert ring.overruns == 1 and ring.overrun_log == [(12, 2)]
+
+    def test_iter_blocks(self):
+        print("Testing iterating over fixed size blocks from the simulated scope.")
+        scope = build_scope(realtime=True)
+        assert scope.set_sample_rate(0x10)
+        for alt in (0, 1):
+            for num_channels in (1, 2):
+                assert scope.set_interface(alt)
+                assert scope.set_num_channels(num_channels)
+                # Let the simulator build its signal pattern before the clock starts.
+                scope.read_data(0x400)
+                blocks = 0
+                for ch1_data, ch2_data in scope.iter_blocks(10000, timeout=1.0):
+                    assert len(ch1_data) == 10000
+                    assert len(ch2_data) == (10000 if num_channels == 2 else 0)
+                    blocks += 1
+                    if blocks == 10:
+                        break
+                assert blocks == 10
+                assert not scope.block_ring_buffer.overruns
+        assert scope.close_handle()
+
+    def test_iter_blocks_overrun(self):
+        print("Testing a slow consumer gets an overrun error.")
+        scope = build_scope()
+        assert scope.set_interface(1)
+        blocks = 0
+        try:
+            for _ in scope.iter_blocks(0x8000, max_buffered=4, as_numpy=True, timeout=1.0):
+                blocks += 1
+                time.sleep(0.05)
+            assert False, "No overrun."
+        except BufferOverrunError:
+            pass
+        # The blocks before the first gap are delivered.
+        assert 0 < blocks <= 4
+        assert scope.block_ring_buffer.overruns
+        assert scope.close_handle()
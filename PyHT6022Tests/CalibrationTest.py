@@ -0,0 +1,33 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+
+import numpy as np
+
+from PyHT6022.Calibration import CalibrationModel
+from PyHT6022 import SampleConversion
+
+
+class CalibrationTests(TestCase):
+    def test_decode_eeprom(self):
+        print("Testing decoding the calibration EEPROM block.")
+        cal_values = bytearray([0xff] * 32)
+        cal_values[0:2] = [130, 125]     # x10 gain step, CH1 and CH2
+        cal_values[10:12] = [127, 0xff]  # x1 gain step, CH2 unprogrammed
+        cal_values[16] = 140             # x10 gain step CH1 at fast sample rates
+        calibration = CalibrationModel.from_eeprom(cal_values)
+        assert calibration.offset(1, 0x0a) == 2
+        assert calibration.offset(2, 0x0a) == -3
+        assert calibration.offset(1, 0x01) == -1
+        assert calibration.offset(2, 0x01) == 0
+        assert calibration.offset(1, 0x0a, sample_rate_index=48) == 12
+
+    def test_corrected_table(self):
+        print("Testing offset and gain correction folded into the conversion table.")
+        calibration = CalibrationModel({(1, 0x01, False): 4})
+        calibration.set_gain(1, 0x01, 1.5)
+        table = calibration.conversion_table(1, 0x01)
+        plain = SampleConversion.conversion_table(0x01)
+        assert table[132] == 0.0
+        assert np.isclose(table[200], plain[196] * 1.5)
+        assert calibration.conversion_table(2, 0x01) is plain
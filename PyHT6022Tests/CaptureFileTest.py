@@ -0,0 +1,89 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from PyHT6022.CaptureFile import CaptureFileWriter, CaptureFileReader, GAP_BEFORE, PARTIAL
+
+
+def interleaved(start, stop):
+    samples = np.arange(start, stop)
+    return np.column_stack([samples & 0xff, (samples >> 8) & 0xff]).astype(np.uint8).ravel()
+
+
+class CaptureFileTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'capture.ht6022')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_contiguous(self):
+        print("Testing reading sample ranges from a capture without gaps.")
+        with CaptureFileWriter(self.filename, chunk_samples=1000, sample_rate=1e6, sample_rate_index=1,
+                               voltage_ranges=(0x0a, 0x02)) as writer:
+            for start in range(0, 10500, 700):
+                writer.write(interleaved(start, start + 700))
+        reader = CaptureFileReader(self.filename)
+        assert len(reader) == 11 and reader.contiguous and reader.end_sample == 10500
+        assert reader.chunk_index(9999) == 9 and reader.chunk_index(10500) == -1
+        view = reader.read(2100, 2900)
+        assert view.base is not None and not view.flags.writeable
+        assert np.array_equal(view.T.ravel(), interleaved(2100, 2900))
+        assert np.array_equal(reader.read(500, 10500).T.ravel(), interleaved(500, 10500))
+        assert reader.headers['flags'][-1] == PARTIAL
+        assert reader.settings(5000)['voltage_ranges'] == (0x0a, 0x02)
+        assert reader.gaps() == []
+        reader.close()
+
+    def test_gaps(self):
+        print("Testing gaps start a new chunk and read back as midscale.")
+        with CaptureFileWriter(self.filename, chunk_samples=1000) as writer:
+            writer.write(interleaved(0, 1500))
+            writer.write(interleaved(1800, 2500), sample_offset=1800)
+            writer.write(interleaved(2500, 3000), sample_offset=2500)
+        reader = CaptureFileReader(self.filename)
+        assert not reader.contiguous
+        assert list(reader.start_samples) == [0, 1000, 1800, 2800]
+        assert reader.gaps() == [(1500, 300)]
+        assert reader.headers['flags'][2] == GAP_BEFORE
+        assert reader.chunk_index(1600) == -1 and reader.chunk_index(2799) == 2
+        samples = reader.read(1400, 1900)
+        assert np.array_equal(samples[:, :100].T.ravel(), interleaved(1400, 1500))
+        assert np.all(samples[:, 100:400] == 128)
+        assert np.array_equal(samples[:, 400:].T.ravel(), interleaved(1800, 1900))
+        assert [start for start, _ in reader.iter_chunks(1200, 2900)] == [1200, 1800, 2800]
+        reader.close()
+
+    def test_index(self):
+        print("Testing closed files are laid out from the index, without reading the chunk headers.")
+        with CaptureFileWriter(self.filename, chunk_samples=1000) as writer:
+            writer.write(interleaved(0, 1500))
+            writer.write(interleaved(1800, 3000), sample_offset=1800)
+        # Break the magic of every chunk header, which an unclosed file would stop at.
+        with open(self.filename, 'r+b') as capture:
+            for chunk in range(4):
+                capture.seek(64 + chunk * (64 + 2000))
+                capture.write(b'XXXX')
+        reader = CaptureFileReader(self.filename)
+        assert len(reader) == 4 and list(reader.start_samples) == [0, 1000, 1800, 2800]
+        assert list(reader.num_samples) == [1000, 500, 1000, 200] and reader.end_sample == 3000
+        assert list(reader.flags) == [0, PARTIAL, GAP_BEFORE, PARTIAL] and reader.gaps() == [(1500, 300)]
+        assert np.array_equal(reader.read(1400, 2000).T.ravel()[-400:], interleaved(1800, 2000))
+        reader.close()
+
+    def test_unclosed_file(self):
+        print("Testing reading the complete chunks of a file which was never closed.")
+        writer = CaptureFileWriter(self.filename, num_channels=1, chunk_samples=1000)
+        writer.write(np.arange(2500, dtype=np.uint32).astype(np.uint8))
+        writer._file.flush()
+        reader = CaptureFileReader(self.filename)
+        assert len(reader) == 2 and reader.end_sample == 2000
+        assert np.array_equal(reader.read(990, 1010)[0], np.arange(990, 1010).astype(np.uint8))
+        reader.close()
+        writer.close()
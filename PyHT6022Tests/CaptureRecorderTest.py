@@ -0,0 +1,67 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import wave
+
+from PyHT6022.CaptureRecorder import CaptureRecorder
+from PyHT6022.SimulatedScope import SimulatedSignal
+from PyHT6022Tests.SimulatedScopeTest import build_scope
+
+
+class CaptureRecorderTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_record_wav(self):
+        print("Testing recording a WAV file until it is full.")
+        scope = build_scope(signals=(SimulatedSignal('square', frequency=1e5, amplitude=2.5),
+                                     SimulatedSignal('dc', offset=1.25)))
+        assert scope.set_interface(1)
+        assert scope.set_sample_rate(16)
+        filename = os.path.join(self.directory, 'capture.wav')
+        recorder = CaptureRecorder(scope, filename, max_samples=1000000)
+        assert recorder.record(duration=5.0) == 1000000
+        assert recorder.truncated
+        wav_file = wave.open(filename)
+        assert wav_file.getnchannels() == 2 and wav_file.getsampwidth() == 1
+        assert wav_file.getframerate() == 16000000 and wav_file.getnframes() == 1000000
+        frames = wav_file.readframes(1000)
+        assert set(bytearray(frames[::2])) == {64, 192}
+        assert set(bytearray(frames[1::2])) == {160}
+        wav_file.close()
+        assert scope.close_handle()
+
+    def test_record_raw(self):
+        print("Testing streaming a raw file from the iso interface until it is full.")
+        scope = build_scope()
+        assert scope.set_interface(1)
+        assert scope.set_num_channels(1)
+        filename = os.path.join(self.directory, 'capture.raw')
+        recorder = CaptureRecorder(scope, filename, max_samples=1 << 20)
+        assert recorder.record(duration=5.0) == 1 << 20
+        assert os.path.getsize(filename) == recorder.written == 1 << 20
+        assert scope.gap_tracker.gaps == [] and scope.gap_tracker.lost_bytes == 0
+        assert scope.close_handle()
+
+    def test_record_capture_file(self):
+        print("Testing recording lossy iso transfers into a capture file keeps the gaps.")
+        from PyHT6022.CaptureFile import CaptureFileReader
+        scope = build_scope(packet_loss=0.01)
+        assert scope.set_interface(1)
+        assert scope.set_ch1_voltage_range(0x05)
+        filename = os.path.join(self.directory, 'capture.ht6022')
+        recorder = CaptureRecorder(scope, filename, max_samples=4000000)
+        assert recorder.record(duration=5.0) == 4000000
+        reader = CaptureFileReader(filename)
+        assert reader.gaps() == scope.gap_tracker.gaps[:len(reader.gaps())]
+        assert reader.gaps()
+        assert reader.settings(0)['voltage_ranges'] == (0x05, 0x01)
+        assert int(reader.num_samples.sum()) == 4000000
+        reader.close()
+        assert scope.close_handle()
@@ -0,0 +1,77 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+
+import numpy as np
+
+from PyHT6022.ChannelDelay import ChannelDelayEstimator
+from PyHT6022.Filters import fir_lowpass
+from PyHT6022.Spectrum import EXPONENTIAL
+from PyHT6022.SimulatedScope import SimulatedSignal
+from PyHT6022Tests.SimulatedScopeTest import build_scope
+
+
+def delayed_noise(length, delay, seed=0):
+    """
+    Band limited noise as ADC counts on CH1, and the same noise delayed by a fractional number of samples, with another
+    offset and amplitude, on CH2.
+    """
+    noise = np.convolve(np.random.RandomState(seed).randn(length), fir_lowpass(0.2, 1.0, 63), 'same')
+    frequencies = np.fft.rfftfreq(length)
+    delayed = np.fft.irfft(np.fft.rfft(noise) * np.exp(-2j * np.pi * frequencies * delay), length)
+    ch1 = np.clip(np.round(128 + 30 * noise), 0, 255).astype(np.uint8)
+    ch2 = np.clip(np.round(150 + 20 * delayed), 0, 255).astype(np.uint8)
+    return ch1, ch2
+
+
+class ChannelDelayTests(TestCase):
+    def test_delay(self):
+        print("Testing sub-sample delays between the channels, independent of the block size.")
+        for delay in (0.0, 3.3, -7.25, 0.4, 100.5):
+            ch1, ch2 = delayed_noise(1 << 17, delay)
+            for block_size in (1000, 4096, 1 << 17):
+                estimator = ChannelDelayEstimator(1e6, fft_size=1024)
+                for start in range(0, len(ch1), block_size):
+                    estimator.feed(ch1[start:start + block_size], ch2[start:start + block_size])
+                assert estimator.segments == (len(ch1) - 1024) // 512 + 1
+                assert abs(estimator.delay_samples() - delay) < 0.01, (delay, block_size)
+                assert abs(estimator.delay() - delay * 1e-6) < 1e-8
+            # Longer delays leave less of each segment in common.
+            assert estimator.coherence()[10:100].min() > 0.95 - abs(delay) / 1024
+        assert ChannelDelayEstimator(1e6).delay() is None
+        # The phase transform suits white signals.
+        noise = np.random.RandomState(1).randint(0, 256, 1 << 16).astype(np.uint8)
+        estimator = ChannelDelayEstimator(1e6, fft_size=1024)
+        estimator.feed(noise[20:], noise[:-20])
+        assert abs(estimator.delay_samples(phat=True) - 20) < 1e-3 and abs(estimator.delay_samples() - 20) < 1e-3
+
+    def test_phase(self):
+        print("Testing the phase between the channels at a tone, with exponential averaging and gaps.")
+        t = np.arange(1 << 16)
+        ch1 = np.round(128 + 100 * np.sin(2 * np.pi * 0.01 * t)).astype(np.uint8)
+        ch2 = np.round(128 + 50 * np.sin(2 * np.pi * 0.01 * t - 1.0)).astype(np.uint8)
+        estimator = ChannelDelayEstimator(1e6, fft_size=1024, averaging=EXPONENTIAL)
+        estimator.feed(ch1[:30000], ch2[:30000], sample_offset=0)
+        estimator.feed(ch1[30100:], ch2[30100:], sample_offset=30100)
+        assert estimator.gaps == 1 and estimator.segments == 57 + 68
+        assert abs(estimator.phase(1e4) + 1.0) < 0.01
+        assert abs(estimator.phase(1e4, degrees=True) + np.degrees(1.0)) < 0.5
+        # A tone alone gives the delay modulo its period.
+        assert abs(estimator.delay_samples() - 100 / (2 * np.pi)) < 0.2
+
+    def test_read_async(self):
+        print("Testing the estimator as read_async callback, measuring the phase of a triangle against a sine.")
+        # The fundamental of the triangle is a negative cosine, a quarter period behind the sine.
+        scope = build_scope(signals=(SimulatedSignal('sine', frequency=1e6 / 50, amplitude=1.0),
+                                     SimulatedSignal('triangle', frequency=1e6 / 50, amplitude=0.5)))
+        estimator = ChannelDelayEstimator.from_scope(scope, fft_size=1000)
+        assert estimator.sample_rate == 1e6
+        shutdown_event = scope.read_async(estimator, 0x1000, as_numpy=True, sample_offsets=True)
+        scope.start_capture()
+        while estimator.segments < 20:
+            scope.poll()
+        shutdown_event.set()
+        scope.poll()
+        scope.stop_capture()
+        assert abs(estimator.phase(20e3, degrees=True) + 90) < 1 and abs(estimator.delay_samples() - 12.5) < 0.5
+        assert scope.close_handle()
@@ -0,0 +1,67 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+
+import numpy as np
+
+from PyHT6022.ChannelMath import ChannelMath, compile_expression
+from PyHT6022.SampleConversion import conversion_table
+from PyHT6022.SimulatedScope import SimulatedSignal
+from PyHT6022Tests.SimulatedScopeTest import build_scope
+
+
+class ChannelMathTests(TestCase):
+    def test_expressions(self):
+        print("Testing channel math expressions against a conversion to volts of each channel.")
+        raw = np.random.RandomState(0).randint(0, 256, 20000).astype(np.uint8)
+        ch1 = conversion_table(0x02, dtype=np.float64)[raw[0::2]]
+        ch2 = conversion_table(0x05, 10, np.float64)[raw[1::2]]
+        for expression, expected in (('CH1 - CH2', ch1 - ch2),
+                                     ('CH1 * CH2', ch1 * ch2),
+                                     ('(CH1 + 0.5) * 2', (ch1 + 0.5) * 2),
+                                     ('-CH2 / 4 + abs(CH1)', -ch2 / 4 + np.abs(ch1)),
+                                     ('max(CH1, CH2) ** 2', np.maximum(ch1, ch2) ** 2),
+                                     ('sqrt(CH1 ** 2 + CH2 ** 2)', np.sqrt(ch1 ** 2 + ch2 ** 2))):
+            math = ChannelMath(expression, voltage_ranges=(0x02, 0x05), probe_multipliers=(1, 10))
+            converted = math.convert(raw)
+            assert converted.dtype == np.float32 and len(converted) == 10000
+            assert np.allclose(converted, expected, rtol=1e-6, atol=1e-6), expression
+            assert np.array_equal(math.evaluate(raw[0::2], raw[1::2]), converted)
+            # Other buffer types, non contiguous samples, and preallocated output.
+            assert np.array_equal(math.convert(bytearray(raw.tobytes())), converted)
+            assert np.array_equal(math.convert(np.repeat(raw, 2)[::2]), converted)
+            out = np.empty(5000, dtype=np.float32)
+            assert math.convert(raw[:10000], out=out) is out and np.array_equal(out, converted[:5000])
+        single = ChannelMath('CH1 * 2 - 1', voltage_ranges=(0x01, 0x01))
+        assert single.lookup_table().shape == (256,)
+        one_channel = conversion_table(0x01, dtype=np.float64)[raw] * 2 - 1
+        assert np.allclose(single.convert(raw, num_channels=1), one_channel, atol=1e-6)
+        assert np.allclose(single.convert(raw), one_channel[0::2], atol=1e-6)
+        self.assertRaises(AssertionError, ChannelMath('CH2').convert, raw, 1)
+        for invalid in ('CH3', 'CH1 +', 'open(CH1)', 'CH1.real', '"1"', 'CH1 if CH2 else 0', 'abs(x=CH1)',
+                        'min(CH1)', 'sqrt(CH1, CH2)', 'abs(CH1, 2)', 'max()', 'exp()'):
+            self.assertRaises(ValueError, compile_expression, invalid)
+        assert compile_expression('CH2 * 3')[1] == {'CH2'}
+
+    def test_read_async(self):
+        print("Testing channel math as read_async callback, following the voltage ranges of the scope.")
+        scope = build_scope(signals=(SimulatedSignal('dc', offset=1.0), SimulatedSignal('dc', offset=-0.5)))
+        difference = ChannelMath('CH1 - CH2', scope=scope)
+        traces = []
+        shutdown_event = scope.read_async(difference.callback(lambda trace, offset: traces.append((trace, offset))),
+                                          0x1000, interleaved=True, sample_offsets=True)
+        scope.start_capture()
+        while len(traces) < 4:
+            scope.poll()
+        assert scope.set_ch1_voltage_range(0x02) and scope.set_ch2_voltage_range(0x02)
+        count = len(traces)
+        while len(traces) < count + 4:
+            scope.poll()
+        shutdown_event.set()
+        scope.poll()
+        scope.stop_capture()
+        assert traces[0][1] == 0 and all(len(trace) == 0x800 for trace, _ in traces)
+        # Both at the coarse and at the fine range.
+        coarse, fine = traces[0][0].mean(), traces[-1][0].mean()
+        assert abs(coarse - 1.5) < 0.1 and abs(fine - 1.5) < 0.03 and abs(fine - 1.5) <= abs(coarse - 1.5)
+        assert scope.close_handle()
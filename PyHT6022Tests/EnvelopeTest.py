@@ -0,0 +1,70 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+
+import numpy as np
+
+from PyHT6022.Envelope import EnvelopeDecimator, minmax
+from PyHT6022.SimulatedScope import SimulatedSignal
+from PyHT6022Tests.SimulatedScopeTest import build_scope
+
+
+class EnvelopeTests(TestCase):
+    def test_blocks(self):
+        print("Testing min/max buckets are the same for any block sizes.")
+        rng = np.random.RandomState(0)
+        channels = rng.randint(0, 256, (2, 10007)).astype(np.uint8)
+        expected_mins, expected_maxs = minmax(channels, 100)
+        assert expected_mins.shape == (2, 101)
+        for block_sizes in ([10007], [1, 99, 100, 7, 1000], [333], [50]):
+            decimator = EnvelopeDecimator(100)
+            start = 0
+            while start < channels.shape[1]:
+                for size in block_sizes:
+                    decimator.feed(*channels[:, start:start + size])
+                    start += size
+            decimator.flush()
+            first, mins, maxs = decimator.envelope()
+            assert first == 0 and mins.dtype == np.uint8
+            assert np.array_equal(mins, expected_mins) and np.array_equal(maxs, expected_maxs)
+        # A single glitch survives decimation.
+        samples = np.full(100000, 128, dtype=np.uint8)
+        samples[54321] = 250
+        decimator = EnvelopeDecimator.for_rate(1e6, 1e3, num_channels=1)
+        first, mins, maxs = decimator.feed(samples)
+        assert decimator.factor == 1000 and maxs.shape == (1, 100)
+        assert np.flatnonzero(maxs[0] != 128).tolist() == [54]
+
+    def test_gaps_and_history(self):
+        print("Testing buckets stay aligned to the sample index across gaps, and the history limit.")
+        samples = np.arange(1000, dtype=np.uint8)
+        decimator = EnvelopeDecimator(10, num_channels=1, max_buckets=50)
+        decimator.feed(samples[:205], None, 0)
+        first, mins, maxs = decimator.feed(samples[237:500], None, 237)
+        # The bucket at 200 is partial, 210 - 230 are empty, 230 has the samples from 237 on.
+        assert first == 20
+        assert mins[0, :5].tolist() == [200, 255, 255, 237, 240]
+        assert maxs[0, :5].tolist() == [204, 0, 0, 239, 249]
+        first, mins, maxs = decimator.envelope()
+        assert first + mins.shape[1] == decimator.bucket_position == 50 and mins.shape[1] >= 30
+        decimator.feed(samples[500:])
+        first, mins, maxs = decimator.envelope()
+        assert first + mins.shape[1] == 100 and mins.shape[1] >= 50
+        assert mins[0, -1] == (990 & 0xff)
+
+    def test_read_async(self):
+        print("Testing the decimator as read_async callback.")
+        scope = build_scope(signals=(SimulatedSignal('square', frequency=1e6 / 128, amplitude=2.5),
+                                     SimulatedSignal('dc', offset=1.25)))
+        decimator = EnvelopeDecimator(256)
+        shutdown_event = scope.read_async(decimator, 0x1000, as_numpy=True, sample_offsets=True)
+        scope.start_capture()
+        while decimator.bucket_position < 100:
+            scope.poll()
+        shutdown_event.set()
+        scope.poll()
+        scope.stop_capture()
+        first, mins, maxs = decimator.envelope()
+        assert np.all(mins[0] == 64) and np.all(maxs[0] == 192)
+        assert np.all(mins[1] == 160) and np.all(maxs[1] == 160)
+        assert scope.close_handle()
@@ -0,0 +1,58 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+import time
+
+from PyHT6022Tests.SimulatedScopeTest import build_scope
+
+
+class EventThreadTests(TestCase):
+    def test_read_async_without_poll(self):
+        print("Testing async reads with the USB event thread instead of polling.")
+        scope = build_scope()
+        for alt in (0, 1):
+            assert scope.set_interface(alt)
+            blocks = []
+            shutdown_event = scope.read_async(lambda ch1_data, ch2_data: blocks.append(len(ch1_data)), 0x8000,
+                                              outstanding_transfers=4, raw=True, event_thread=True)
+            scope.start_capture()
+            time.sleep(0.2)
+            shutdown_event.set()
+            scope.stop_capture()
+            assert blocks
+            assert scope.reap_transfers(grace_period=0.05)
+            assert not scope.context.pending_transfers()
+            assert not len(scope.async_reads)
+        assert scope.close_handle()
+
+    def test_close_handle_reaps_transfers(self):
+        print("Testing close_handle cancels and reaps transfers left in flight.")
+        scope = build_scope()
+        blocks = []
+        scope.read_async(lambda ch1_data, ch2_data: blocks.append(len(ch1_data)), 0x8000, outstanding_transfers=4,
+                         zero_copy=True, event_thread=True)
+        event_thread = scope.event_thread
+        scope.start_capture()
+        time.sleep(0.1)
+        # Stopping the capture first leaves all transfers waiting for data, until they are cancelled.
+        scope.stop_capture()
+        assert scope.close_handle()
+        assert not event_thread.is_alive()
+        assert not scope.context.pending_transfers()
+        # The cancelled transfers never reach the callback.
+        assert blocks and all(blocks)
+
+    def test_restart_event_thread(self):
+        print("Testing a new event thread is started once the previous one has exited.")
+        scope = build_scope()
+        assert scope.set_interface(1)
+        for _ in range(2):
+            shutdown_event = scope.read_async(lambda ch1_data, ch2_data: None, 0x8000, event_thread=True)
+            event_thread = scope.event_thread
+            scope.start_capture()
+            time.sleep(0.05)
+            shutdown_event.set()
+            event_thread.join(2.0)
+            assert not event_thread.is_alive()
+            scope.stop_capture()
+        assert scope.close_handle()
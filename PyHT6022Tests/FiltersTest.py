@@ -0,0 +1,144 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+import time
+
+import numpy as np
+
+from PyHT6022.Filters import FIRFilter, SOSFilter, fir_lowpass, fir_highpass, fir_bandpass, fir_bandstop, biquad, \
+    butterworth, frequency_response, BANDPASS, HIGHPASS, NOTCH
+from PyHT6022.SampleConversion import scale_factor
+from PyHT6022.SimulatedScope import SimulatedSignal
+from PyHT6022Tests.SimulatedScopeTest import build_scope
+
+
+def reference_sos(sos, samples):
+    """
+    The cascade, one sample at a time.
+    """
+    for b0, b1, b2, a0, a1, a2 in sos:
+        output = np.zeros(len(samples))
+        x1 = x2 = y1 = y2 = 0.0
+        for n, x in enumerate(samples):
+            y = (b0 * x + b1 * x1 + b2 * x2 - a1 * y1 - a2 * y2) / a0
+            x2, x1, y2, y1 = x1, x, y1, y
+            output[n] = y
+        samples = output
+    return samples
+
+
+def feed_blocks(stream_filter, samples, block_size):
+    return np.concatenate([stream_filter.feed(samples[start:start + block_size])
+                           for start in range(0, len(samples), block_size)])
+
+
+class FilterDesignTests(TestCase):
+    def test_fir_designs(self):
+        print("Testing the windowed sinc FIR designs.")
+        rate = 1e6
+        lowpass = fir_lowpass(100e3, rate)
+        assert abs(frequency_response(lowpass, [0], rate)[0] - 1) < 1e-12
+        assert abs(abs(frequency_response(lowpass, [100e3], rate)[0]) - 0.5) < 0.01
+        assert abs(frequency_response(lowpass, [200e3], rate)[0]) < 0.01
+        highpass = fir_highpass(100e3, rate)
+        assert abs(frequency_response(highpass, [0], rate)[0]) < 1e-12
+        assert abs(abs(frequency_response(highpass, [300e3], rate)[0]) - 1) < 0.01
+        bandpass = fir_bandpass(100e3, 200e3, rate)
+        gains = abs(frequency_response(bandpass, [0, 150e3, 350e3], rate))
+        assert gains[0] < 0.01 and abs(gains[1] - 1) < 1e-9 and gains[2] < 0.01
+        bandstop = fir_bandstop(100e3, 200e3, rate)
+        gains = abs(frequency_response(bandstop, [0, 150e3, 350e3], rate))
+        assert abs(gains[0] - 1) < 1e-12 and gains[1] < 0.01 and abs(gains[2] - 1) < 0.01
+        assert np.allclose(lowpass, lowpass[::-1])
+
+    def test_iir_designs(self):
+        print("Testing the biquad and Butterworth designs.")
+        rate = 1e6
+        for order in range(1, 9):
+            for kind in ('lowpass', HIGHPASS):
+                sections = butterworth(order, 50e3, rate, kind)
+                assert len(sections) == (order + 1) // 2
+                gain = abs(frequency_response(sections, [50e3], rate)[0])
+                assert abs(gain - np.sqrt(0.5)) < 1e-9, (order, kind)
+        lowpass = abs(frequency_response(butterworth(4, 50e3, rate), [0, 100e3], rate))
+        assert abs(lowpass[0] - 1) < 1e-12 and abs(20 * np.log10(lowpass[1]) + 24) < 1.5
+        notch = abs(frequency_response(biquad(NOTCH, 50e3, rate, 10), [50e3, 40e3, 60e3], rate))
+        assert notch[0] < 1e-9 and notch[1] > 0.8 and notch[2] > 0.8
+        bandpass = abs(frequency_response(biquad(BANDPASS, 50e3, rate, 10), [50e3, 10e3], rate))
+        assert abs(bandpass[0] - 1) < 1e-9 and bandpass[1] < 0.1
+
+
+class StreamingFilterTests(TestCase):
+    def test_fir_blocks_and_decimation(self):
+        print("Testing overlap-save FIR filtering, with and without polyphase decimation, against a direct convolution.")
+        samples = np.random.RandomState(0).randint(0, 256, 50000).astype(np.uint8)
+        taps = fir_lowpass(100e3, 1e6, 63)
+        volts_per_count = scale_factor(0x01)
+        expected = np.convolve((samples - 128.0) * volts_per_count, taps)[:len(samples)]
+        for decimation in (1, 3, 8):
+            for block_size in (1, 100, 4096, 50000):
+                stream_filter = FIRFilter(taps, decimation, volts_per_count=volts_per_count, fft_size=256)
+                filtered = feed_blocks(stream_filter, samples[:2000] if block_size == 1 else samples, block_size)
+                assert filtered.dtype == np.float32
+                assert np.allclose(filtered, expected[::decimation][:len(filtered)], atol=1e-5), \
+                    (decimation, block_size)
+                assert stream_filter.output_position == len(filtered)
+            assert len(filtered) == -(-len(samples) // decimation)
+
+    def test_fir_gap(self):
+        print("Testing the FIR filter restarts at rest after a gap, with aligned decimated outputs.")
+        samples = np.random.RandomState(1).randint(0, 256, 3000).astype(np.uint8)
+        taps = fir_lowpass(50e3, 1e6, 31)
+        stream_filter = FIRFilter(taps, decimation=4)
+        stream_filter.feed(samples[:1000], sample_offset=0)
+        filtered = stream_filter.feed(samples[1000:], sample_offset=1503)
+        assert stream_filter.gaps == 1 and stream_filter.output_position == -(-3503 // 4)
+        expected = np.convolve(samples[1000:].astype(np.float64), taps)[1:][::4]
+        assert np.allclose(filtered, expected[:len(filtered)], atol=1e-3)
+
+    def test_sos_blocks(self):
+        print("Testing the chunked IIR cascade against a sample by sample recursion.")
+        samples = np.random.RandomState(2).randint(0, 256, 8000).astype(np.uint8)
+        sos = np.concatenate((butterworth(5, 50e3, 1e6), biquad(NOTCH, 100e3, 1e6, 30)))
+        volts_per_count = scale_factor(0x02)
+        expected = reference_sos(sos, (samples - 128.0) * volts_per_count)
+        for block_size in (1, 2, 97, 256, 8000):
+            stream_filter = SOSFilter(sos, volts_per_count=volts_per_count, chunk_size=256)
+            filtered = feed_blocks(stream_filter, samples, block_size)
+            assert np.allclose(filtered, expected, atol=1e-6), block_size
+        decimated = feed_blocks(SOSFilter(sos, decimation=5, volts_per_count=volts_per_count), samples, 999)
+        assert np.allclose(decimated, expected[::5], atol=1e-6)
+        # Unnormalized sections work as well, and unstable ones are refused.
+        assert np.allclose(feed_blocks(SOSFilter(sos * 2, volts_per_count=volts_per_count), samples, 1000), expected,
+                           atol=1e-6)
+        self.assertRaises(AssertionError, SOSFilter, [[1, 0, 0, 1, -2.5, 1.5]])
+
+    def test_read_async(self):
+        print("Testing a filter as read_async callback, removing a tone.")
+        scope = build_scope(signals=(SimulatedSignal('sine', frequency=1e6 / 20, amplitude=1.0, offset=0.5),))
+        assert scope.set_ch1_voltage_range(0x02)
+        notch = SOSFilter.from_scope(scope, biquad(NOTCH, 1e6 / 20, 1e6, 5))
+        outputs = []
+        shutdown_event = scope.read_async(lambda ch1, ch2, offset: outputs.append(notch(ch1, ch2, offset)), 0x1000,
+                                          as_numpy=True, sample_offsets=True)
+        scope.start_capture()
+        while sum(len(output) for output in outputs) < 0x8000:
+            scope.poll()
+        shutdown_event.set()
+        scope.poll()
+        scope.stop_capture()
+        filtered = np.concatenate(outputs)[-0x4000:]
+        # Only the DC offset passes.
+        assert abs(filtered.mean() - 0.5) < 0.05 and filtered.std() < 0.05
+        assert scope.close_handle()
+
+    def test_calibration(self):
+        print("Testing a filter from a calibrated scope filters volts like its conversion table gives them.")
+        scope = build_scope()
+        assert scope.set_ch1_voltage_range(0x02)
+        scope.load_calibration().set_gain(1, 0x02, 1.2)
+        stream_filter = FIRFilter.from_scope(scope, [1.0])
+        assert stream_filter.offset == 129
+        counts = np.arange(256, dtype=np.uint8)
+        assert np.allclose(stream_filter.feed(counts), scope.conversion_table(1), atol=1e-5)
+        assert scope.close_handle()
@@ -0,0 +1,67 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+
+from PyHT6022.GapTracker import GapTracker
+from PyHT6022Tests.SimulatedScopeTest import build_scope, run_async
+
+
+def merge_gaps(gap_log):
+    gaps = []
+    for sample_index, missing in gap_log:
+        if gaps and sum(gaps[-1]) == sample_index:
+            gaps[-1] = (gaps[-1][0], gaps[-1][1] + missing)
+        else:
+            gaps.append((sample_index, missing))
+    return gaps
+
+
+class GapTrackerTests(TestCase):
+    def test_counting(self):
+        print("Testing the sample counter and gap map.")
+        tracker = GapTracker(num_channels=2, packet_size=1024)
+        assert tracker.iso_packet(0, 1024) == 0
+        assert tracker.iso_packet(1, 0) == 1024
+        assert tracker.iso_packet(1, 0) == 1536
+        assert tracker.iso_packet(0, 100) == 1536
+        assert tracker.sample_position == 1586
+        assert tracker.gap_map() == [(512, 1024)]
+        assert tracker.gap_map(sample_rate=1024) == [(0.5, 1.0)]
+        counters = tracker.counters()
+        assert counters['lost_packets'] == 2 and counters['short_packets'] == 1
+        assert counters['missing_samples'] == 1024
+
+    def test_gap_map_matches_device(self):
+        print("Testing the gap map matches the packets dropped by the simulated scope.")
+        for zero_copy in (False, True):
+            scope = build_scope(packet_loss=0.02, seed=zero_copy)
+            assert scope.set_interface(1)
+            offsets = []
+
+            def callback(ch1_data, ch2_data, sample_offset):
+                offsets.append((sample_offset, len(ch1_data)))
+            shutdown_event = scope.read_async(callback, 0x8000, outstanding_transfers=4, zero_copy=zero_copy,
+                                              sample_offsets=True)
+            scope.start_capture()
+            for _ in range(50):
+                scope.poll()
+            shutdown_event.set()
+            scope.poll()
+            scope.stop_capture()
+            tracker = scope.gap_tracker
+            assert tracker.lost_packets == scope.device.lost_packets > 0
+            assert tracker.gaps == merge_gaps(scope.device.gap_log)
+            # Every block starts right after the previous one, plus the samples lost in between.
+            for (offset, length), (next_offset, _) in zip(offsets, offsets[1:]):
+                missing = sum(gap for sample_index, gap in tracker.gaps if offset <= sample_index < next_offset)
+                assert next_offset == offset + length + missing
+            assert scope.close_handle()
+
+    def test_bulk_offsets(self):
+        print("Testing sample offsets of bulk reads.")
+        scope = build_scope()
+        blocks = run_async(scope, 0x8000, raw=True)
+        assert blocks
+        assert scope.gap_tracker.sample_position == sum(len(ch1_data) for ch1_data, _ in blocks)
+        assert not scope.gap_tracker.gaps
+        assert scope.close_handle()
@@ -0,0 +1,98 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+
+import numpy as np
+
+from PyHT6022.Histogram import ADCHistogram, histogram_statistics
+from PyHT6022.SampleConversion import scale_factor
+from PyHT6022.SimulatedScope import SimulatedSignal
+from PyHT6022Tests.SimulatedScopeTest import build_scope
+
+
+class HistogramTests(TestCase):
+    def test_statistics(self):
+        print("Testing the statistics from a histogram against the samples.")
+        samples = np.random.RandomState(0).randint(0, 256, 10000).astype(np.uint8)
+        statistics = histogram_statistics(np.bincount(samples, minlength=256))
+        assert statistics['count'] == 10000 and statistics['min'] == samples.min()
+        assert statistics['max'] == samples.max()
+        assert abs(statistics['mean'] - samples.mean()) < 1e-9 and abs(statistics['std'] - samples.std()) < 1e-9
+        assert abs(statistics['rms'] - np.sqrt(np.mean(samples.astype(np.float64) ** 2))) < 1e-9
+        assert statistics['clipped'] == np.mean((samples == 0) | (samples == 255))
+        volts = (samples - 128.0) * scale_factor(0x02)
+        statistics = histogram_statistics(np.bincount(samples, minlength=256), scale_factor(0x02))
+        assert abs(statistics['mean'] - volts.mean()) < 1e-9 and abs(statistics['std'] - volts.std()) < 1e-9
+        assert abs(statistics['rms'] - np.sqrt(np.mean(volts ** 2))) < 1e-9 and statistics['min'] == volts.min()
+        assert histogram_statistics(np.zeros(256, dtype=np.int64))['mean'] is None
+
+    def test_window(self):
+        print("Testing the cumulative and sliding window histograms, independent of the block size and across gaps.")
+        samples = np.random.RandomState(1).randint(0, 256, (2, 20000)).astype(np.uint8)
+        for block_size in (1, 333, 1000, 20000):
+            histogram = ADCHistogram(1000.0, window=2.0, slices=4)
+            for start in range(0, samples.shape[1], block_size):
+                histogram.feed(samples[0, start:start + block_size], samples[1, start:start + block_size])
+            for channel in (1, 2):
+                assert np.array_equal(histogram.counts(channel), np.bincount(samples[channel - 1], minlength=256))
+                # Four slices of 500 samples, the newest one full.
+                assert np.array_equal(histogram.counts(channel, windowed=True),
+                                      np.bincount(samples[channel - 1, -2000:], minlength=256)), block_size
+        histogram.feed(samples[0, :700], samples[1, :700], sample_offset=20700)
+        assert histogram.gaps == 1 and histogram.sample_position == 21400
+        # Slices 39 (samples 19500 - 19999, before the gap) to 42 are in the window.
+        assert np.array_equal(histogram.counts(2, windowed=True),
+                              np.bincount(np.concatenate((samples[1, -500:], samples[1, :700])), minlength=256))
+        assert histogram.counts(1).sum() == 20700
+        # One channel only.
+        single = ADCHistogram(1000.0)
+        single.feed(samples[0], np.zeros(0, dtype=np.uint8))
+        assert single.statistics(1)['count'] == 20000 and single.statistics(2)['count'] == 0
+
+    def test_clipping(self):
+        print("Testing the clipping detection.")
+        samples = np.clip(np.round(128 + 140 * np.sin(np.arange(100000) * 0.01)), 0, 255).astype(np.uint8)
+        histogram = ADCHistogram(1e6, window=0.01)
+        histogram.feed(samples, np.full(100000, 128, dtype=np.uint8))
+        low, high = histogram.clipping(1)
+        assert low > 0.1 and high > 0.1 and histogram.is_clipping(1) and not histogram.is_clipping(2)
+        assert abs(histogram.statistics(1, windowed=True)['clipped'] - (low + high)) < 1e-12
+        histogram.feed(np.full(20000, 128, dtype=np.uint8), np.full(20000, 128, dtype=np.uint8))
+        # Gone from the window, not from the cumulative counts.
+        assert not histogram.is_clipping(1) and histogram.is_clipping(1, windowed=False)
+
+    def test_read_async(self):
+        print("Testing the histograms as read_async callback, in volts from the scope settings.")
+        scope = build_scope(signals=(SimulatedSignal('square', frequency=1e3, amplitude=1.0),
+                                     SimulatedSignal('dc', offset=4.0)))
+        assert scope.set_ch1_voltage_range(0x02) and scope.set_ch2_voltage_range(0x02)
+        histogram = ADCHistogram.from_scope(scope)
+        shutdown_event = scope.read_async(histogram, 0x1000, as_numpy=True, sample_offsets=True)
+        scope.start_capture()
+        while histogram.sample_position < 0x10000:
+            scope.poll()
+        shutdown_event.set()
+        scope.poll()
+        scope.stop_capture()
+        statistics = histogram.statistics(1)
+        assert abs(statistics['rms'] - 1.0) < 0.03 and abs(statistics['mean']) < 0.05
+        assert not histogram.is_clipping(1)
+        # 4 V is beyond the 2.5 V range.
+        assert histogram.is_clipping(2) and histogram.clipping(2)[1] == 1.0
+        assert scope.close_handle()
+
+    def test_calibration(self):
+        print("Testing histograms from a calibrated scope give statistics in calibrated volts, per channel.")
+        scope = build_scope()
+        assert scope.set_ch1_voltage_range(0x02) and scope.set_ch2_voltage_range(0x02)
+        scope.load_calibration().set_gain(2, 0x02, 1.1)
+        histogram = ADCHistogram.from_scope(scope)
+        assert histogram.offset == (129, 127)
+        samples = np.random.RandomState(3).randint(0, 256, 1000).astype(np.uint8)
+        histogram.feed(samples, samples)
+        for channel in (1, 2):
+            volts = scope.conversion_table(channel, dtype=np.float64)[samples]
+            statistics = histogram.statistics(channel)
+            assert abs(statistics['mean'] - volts.mean()) < 1e-9
+            assert abs(statistics['rms'] - np.sqrt(np.mean(volts ** 2))) < 1e-9
+        assert scope.close_handle()
@@ -0,0 +1,122 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+
+import numpy as np
+
+from PyHT6022.Measurements import WaveformMeasurements, estimate_levels
+from PyHT6022.SampleConversion import scale_factor
+from PyHT6022.SimulatedScope import SimulatedSignal
+from PyHT6022Tests.SimulatedScopeTest import build_scope
+
+
+def pulse_train(length, period, high, rise, fall, base=60.0, top=200.0, overshoot=0.0, dtype=np.float64):
+    """
+    Trapezoid pulses: rise samples from base to top, high samples at top (with an overshoot spike after the rise),
+    fall samples back to base, and base for the rest of the period.
+    """
+    phase = np.arange(length) % period
+    amplitude = top - base
+    ramp_up = np.clip(phase / rise, 0, 1)
+    ramp_down = np.clip((phase - rise - high) / fall, 0, 1)
+    signal = base + amplitude * (ramp_up - ramp_down)
+    signal += overshoot * amplitude * ((phase >= rise) & (phase < rise + 2))
+    return np.round(signal).astype(dtype) if dtype == np.uint8 else signal
+
+
+class MeasurementsTests(TestCase):
+    def test_pulse_measurements(self):
+        print("Testing period, pulse widths, rise and fall times and overshoot of a pulse train.")
+        samples = pulse_train(100000, 100, 30, 10, 5, overshoot=0.1)
+        measurements = WaveformMeasurements()
+        measurements.feed(samples)
+        results = measurements.results()
+        assert measurements.levels == estimate_levels(samples)
+        assert abs(measurements.levels[0] - 60) < 1 and abs(measurements.levels[1] - 200) < 1
+        assert results['period']['count'] == 999 and abs(results['period']['mean'] - 100) < 1e-9
+        assert results['period']['std'] < 1e-6 and abs(results['frequency'] - 0.01) < 1e-12
+        # 10% to 90% of the linear ramps.
+        assert abs(results['rise_time']['mean'] - 8) < 0.1 and results['rise_time']['count'] >= 999
+        assert abs(results['fall_time']['mean'] - 4) < 0.1
+        # The pulses are measured at the middle level: half the rise, the top, and half the fall.
+        assert abs(results['high_width']['mean'] - (5 + 30 + 2.5)) < 1
+        assert abs(results['duty_cycle'] - 0.375) < 0.01
+        assert abs(results['high_width']['mean'] + results['low_width']['mean'] - 100) < 1e-6
+        assert abs(results['overshoot']['mean'] - 10) < 1 and results['undershoot']['max'] < 1
+        assert abs(results['max'] - 214) < 1 and results['min'] == 60
+        assert abs(results['peak_to_peak'] - 154) < 1
+        counts, edges = measurements.distribution('rise_time', 10)
+        assert counts.sum() == results['rise_time']['count']
+
+    def test_blocks_and_raw_counts(self):
+        print("Testing the measurements do not depend on the block size, in volts for raw ADC counts.")
+        samples = pulse_train(1 << 17, 97.3, 20, 3, 2, overshoot=0.05, dtype=np.uint8)
+        volts_per_count = scale_factor(0x02)
+        whole = WaveformMeasurements(sample_rate=1e6, volts_per_count=volts_per_count)
+        whole.feed(samples)
+        for block_size in (1, 7, 100, 4096):
+            blocks = WaveformMeasurements(levels=whole.levels, sample_rate=1e6, volts_per_count=volts_per_count)
+            for start in range(0, len(samples) if block_size > 1 else 5000, block_size):
+                blocks.feed(samples[start:start + block_size])
+            for name in whole.statistics:
+                expected = whole.statistics[name].values[:blocks.statistics[name].count]
+                assert np.allclose(blocks.statistics[name].values, expected), (block_size, name)
+        results = whole.results()
+        assert abs(results['frequency'] - 1e6 / 97.3) < 10
+        levels = (np.array(whole.levels) - 128) * volts_per_count
+        assert np.allclose(results['levels'], levels)
+        converted = (samples.astype(np.float64) - 128) * volts_per_count
+        assert abs(results['mean'] - converted.mean()) < 1e-9
+        assert abs(results['rms'] - np.sqrt(np.mean(converted ** 2))) < 1e-9
+        assert abs(results['peak_to_peak'] - (samples.max() - samples.min()) * volts_per_count) < 1e-9
+
+    def test_gaps(self):
+        print("Testing pulses and periods spanning a gap are not measured.")
+        samples = pulse_train(2000, 100, 30, 10, 5)
+        measurements = WaveformMeasurements(levels=(60, 200))
+        measurements.feed(samples, sample_offset=0)
+        measurements.feed(samples[:1000], sample_offset=5050)
+        assert measurements.gaps == 1
+        assert measurements.statistics['period'].count == 19 + 9
+        assert np.allclose(measurements.statistics['period'].values, 100)
+        assert np.allclose(measurements.statistics['rise_time'].values, 8)
+        # An all flat block does not set the levels.
+        flat = WaveformMeasurements()
+        flat.feed(np.full(100, 128, dtype=np.uint8))
+        assert flat.levels is None and flat.results()['frequency'] is None and flat.results()['rms'] == 128
+
+    def test_large_blocks(self):
+        print("Testing the measurements over a long stream in large blocks.")
+        samples = pulse_train(1 << 20, 240, 100, 4, 4, dtype=np.uint8)
+        measurements = WaveformMeasurements(sample_rate=24e6)
+        for start in range(0, len(samples), 0x10000):
+            measurements.feed(samples[start:start + 0x10000])
+        assert abs(measurements.results()['frequency'] - 1e5) < 1
+
+    def test_read_async(self):
+        print("Testing the measurements as read_async callback, in seconds and volts from the scope settings.")
+        scope = build_scope(signals=(SimulatedSignal('square', frequency=1e6 / 50, amplitude=1.0, duty_cycle=0.3),))
+        assert scope.set_ch1_voltage_range(0x02)
+        measurements = WaveformMeasurements.from_scope(scope)
+        shutdown_event = scope.read_async(measurements, 0x1000, as_numpy=True, sample_offsets=True)
+        scope.start_capture()
+        while measurements.statistics['period'].count < 200:
+            scope.poll()
+        shutdown_event.set()
+        scope.poll()
+        scope.stop_capture()
+        results = measurements.results()
+        assert abs(results['frequency'] / 20e3 - 1) < 1e-3 and abs(results['duty_cycle'] - 0.3) < 0.02
+        assert abs(results['levels'][1] - 1.0) < 0.05 and abs(results['levels'][0] + 1.0) < 0.05
+        assert scope.close_handle()
+
+    def test_calibration(self):
+        print("Testing measurements from a calibrated scope scale the counts like its conversion table.")
+        scope = build_scope()
+        assert scope.set_ch1_voltage_range(0x02)
+        scope.load_calibration().set_gain(1, 0x02, 1.1)
+        measurements = WaveformMeasurements.from_scope(scope, probe_multiplier=10)
+        assert measurements.offset == 129
+        assert np.allclose((np.arange(256) - measurements.offset) * measurements.volts_per_count,
+                           scope.conversion_table(1, probe_multiplier=10), atol=1e-5)
+        assert scope.close_handle()
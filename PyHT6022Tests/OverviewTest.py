@@ -0,0 +1,116 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from PyHT6022.CaptureFile import CaptureFileWriter, CaptureFileReader
+from PyHT6022.CaptureRecorder import CaptureRecorder
+from PyHT6022.Envelope import minmax
+from PyHT6022.Overview import OverviewWriter, OverviewReader, build_overview, MEAN_SCALE
+from PyHT6022.SimulatedScope import SimulatedSignal
+from PyHT6022Tests.SimulatedScopeTest import build_scope
+
+
+class OverviewTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_levels(self):
+        print("Testing every level holds the min, max and mean of its buckets, for any block sizes.")
+        rng = np.random.RandomState(0)
+        channels = rng.randint(0, 256, (2, 100000)).astype(np.uint8)
+        filename = os.path.join(self.directory, 'capture.ovr')
+        with OverviewWriter(filename, 2, 100000, factor=4, base_factor=16) as writer:
+            start = 0
+            while start < channels.shape[1]:
+                for size in (1, 1000, 4097, 333):
+                    writer.feed(*channels[:, start:start + size])
+                    start += size
+        overview = OverviewReader(filename)
+        assert len(overview.levels) == 8 and overview.sample_position == 100000
+        for level in range(len(overview.levels)):
+            size = overview.bucket_size(level)
+            buckets = overview.level(level)
+            mins, maxs = minmax(channels, size)
+            assert np.array_equal(buckets['min'].T, mins) and np.array_equal(buckets['max'].T, maxs)
+            if level < 4:
+                full = 100000 // size
+                means = channels[:, :full * size].reshape(2, full, size).mean(axis=2)
+                assert np.abs(buckets['mean'][:full].T / float(MEAN_SCALE) - means).max() < 0.01
+        assert overview.counts[-1] == 1
+
+    def test_gap_means(self):
+        print("Testing empty buckets of a gap do not count towards the means of the levels and queries.")
+        writer = OverviewWriter(None, 1, 20000, factor=4, base_factor=16)
+        samples = np.full(10000, 10, dtype=np.uint8)
+        writer.feed(samples[:5000], sample_offset=0)
+        writer.feed(samples[5000:], sample_offset=7048)
+        writer.close()
+        for level in range(len(writer.levels)):
+            buckets = writer.level(level)[:, 0]
+            present = buckets['max'] >= buckets['min']
+            assert np.all(buckets['mean'][present] == 10 * MEAN_SCALE), level
+            assert present.all() == (level >= 4)
+        assert writer.level(len(writer.levels) - 1)['mean'][0, 0] == 10 * MEAN_SCALE
+        mins, maxs, means = writer.query(0, 17048, 100)
+        empty = mins > maxs
+        assert empty.any() and np.all(means[~empty] == 10) and np.all(np.isnan(means[empty]))
+
+    def test_large_buckets(self):
+        print("Testing the means of level 0 buckets with many samples do not overflow.")
+        writer = OverviewWriter(None, 1, 1 << 19, base_factor=1 << 17)
+        writer.feed(np.full(1 << 19, 255, dtype=np.uint8))
+        writer.close()
+        assert np.all(writer.level(0)['mean'] == 255 * MEAN_SCALE)
+
+    def test_query(self):
+        print("Testing queries pick a level by the pixel width, and fall back to the capture for close zooms.")
+        filename = os.path.join(self.directory, 'capture.ht6022')
+        samples = np.tile(np.repeat(np.array([10, 200], dtype=np.uint8), 500), 1000)
+        samples[123456] = 255
+        with CaptureFileWriter(filename, num_channels=1, chunk_samples=1 << 16) as writer:
+            writer.write(samples[:500000])
+            writer.write(samples[600000:], 600000)
+        reader = CaptureFileReader(filename)
+        overview = build_overview(reader, os.path.join(self.directory, 'capture.ovr'), base_factor=64)
+        assert overview.choose_level(0, 1000000, 1000) == 1
+        assert overview.choose_level(0, 1000000, 100) == 3
+        mins, maxs, means = overview.query(0, 1000000, 1000)
+        assert len(mins) == 1000
+        assert maxs.max() == 255 and np.all(mins[:500] == 10) and np.all(mins[600:] == 10)
+        # The gap has empty buckets.
+        assert np.all(mins[501:599] > maxs[501:599]) and np.all(mins[:500] <= maxs[:500])
+        assert abs(means[:500].mean() - 105) < 1
+        mins, maxs, means = overview.query(123400, 123500, 50)
+        assert overview.choose_level(123400, 123500, 50) == -1
+        assert len(mins) == 50 and maxs.tolist().count(255) == 1
+
+    def test_record(self):
+        print("Testing recording builds the overview, and queries it at any zoom.")
+        scope = build_scope(signals=(SimulatedSignal('square', frequency=1e5, amplitude=2.5),
+                                     SimulatedSignal('dc', offset=1.25)))
+        assert scope.set_interface(1)
+        filename = os.path.join(self.directory, 'capture.ht6022')
+        recorder = CaptureRecorder(scope, filename, max_samples=2000000, overview=True)
+        assert recorder.record(duration=5.0) == 2000000
+        overview = OverviewReader(filename + '.ovr', CaptureFileReader(filename))
+        assert overview.sample_position >= 2000000
+        assert overview.counts[0] == -(-overview.sample_position // overview.base_factor)
+        assert overview.counts[-1] == 1
+        mins, maxs, means = overview.query(0, 2000000, 2000, channel=1)
+        assert set(mins[mins <= maxs].tolist()) == {64} and set(maxs[mins <= maxs].tolist()) == {192}
+        mins, maxs, means = overview.query(0, 2000000, 2000, channel=2)
+        assert set(mins[mins <= maxs].tolist()) == {160}
+        for zoom in range(20):
+            mins, maxs, means = overview.query(1000, 1000 + (2000000 >> zoom), 1920)
+            present = mins <= maxs
+            assert len(mins) == min(1920, 2000000 >> zoom)
+            assert np.all(mins[present] >= 64) and np.all(maxs[present] <= 192)
+        assert scope.close_handle()
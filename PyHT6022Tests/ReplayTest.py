@@ -0,0 +1,128 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from PyHT6022.CaptureFile import CaptureFileWriter
+from PyHT6022.CaptureRecorder import wav_header
+from PyHT6022.Replay import replay_scope, sample_rate_index
+
+
+def replay_all(scope, data_size, timeout=5.0):
+    blocks = []
+
+    def callback(data, _, sample_offset):
+        blocks.append((sample_offset, bytes(data)))
+
+    shutdown_event = scope.read_async(callback, data_size, interleaved=True, sample_offsets=True)
+    scope.start_capture()
+    start_time = time.time()
+    while not scope.device.finished and time.time() - start_time < timeout:
+        scope.poll()
+    shutdown_event.set()
+    scope.poll()
+    scope.stop_capture()
+    return blocks
+
+
+class FakeClock(object):
+    """
+    A clock for the pacing of a SimulatedDevice, which sleeps without waiting.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class ReplayTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sample_rate_index(self):
+        print("Testing sample rates are looked up in the rates of the firmware.")
+        assert sample_rate_index(200e3) == 0x14 and sample_rate_index(48e6) == 0x30
+        assert sample_rate_index(500000) == 0x32 and sample_rate_index(999999) == 0x01
+        for sample_rate in (44100, 3e6, 100e6):
+            self.assertRaises(ValueError, sample_rate_index, sample_rate)
+
+    def test_replay_raw(self):
+        print("Testing replaying a raw file through bulk transfers, as fast as possible.")
+        samples = (np.arange(100000) * 7).astype(np.uint8)
+        filename = os.path.join(self.directory, 'capture.raw')
+        samples.tofile(filename)
+        scope = replay_scope(filename, alt=0, num_channels=2, sample_rate_index=24)
+        assert scope.num_channels == 2 and scope.sample_rate_index == 24
+        blocks = replay_all(scope, 0x4000)
+        assert b''.join(data for _, data in blocks) == samples.tobytes()
+        assert [offset for offset, _ in blocks][:3] == [0, 0x2000, 0x4000]
+        assert scope.gap_tracker.gaps == []
+        assert scope.close_handle()
+
+    def test_replay_gaps(self):
+        print("Testing gaps of a capture file are replayed as lost iso packets.")
+        # One channel, 3072 byte iso packets: the gaps are whole packets.
+        stream = (np.arange(300000) // 3).astype(np.uint8)
+        filename = os.path.join(self.directory, 'capture.ht6022')
+        with CaptureFileWriter(filename, num_channels=1, chunk_samples=50000, sample_rate=8e6, sample_rate_index=8,
+                               voltage_ranges=(0x02, 0x05)) as writer:
+            writer.write(stream[:3072 * 10])
+            writer.write(stream[3072 * 12:3072 * 40], sample_offset=3072 * 12)
+            writer.write(stream[3072 * 41:3072 * 90], sample_offset=3072 * 41)
+        scope = replay_scope(filename)
+        assert scope.num_channels == 1 and scope.sample_rate_index == 8
+        assert (scope.ch1_voltage_range, scope.ch2_voltage_range) == (0x02, 0x05)
+        blocks = replay_all(scope, 3072 * 8)
+        assert scope.gap_tracker.gaps == [(3072 * 10, 3072 * 2), (3072 * 40, 3072)]
+        replayed = np.full(3072 * 90, 128, dtype=np.uint8)
+        for offset, data in blocks:
+            # Zero copy blocks close up their lost packets, but these gaps end a block.
+            replayed[offset:offset + len(data)] = np.frombuffer(data, dtype=np.uint8)
+        recorded = np.full(3072 * 90, 128, dtype=np.uint8)
+        recorded[:3072 * 10] = stream[:3072 * 10]
+        recorded[3072 * 12:3072 * 40] = stream[3072 * 12:3072 * 40]
+        recorded[3072 * 41:] = stream[3072 * 41:3072 * 90]
+        assert np.array_equal(replayed, recorded)
+        assert scope.close_handle()
+
+    def test_replay_wav_realtime(self):
+        print("Testing replaying a WAV file paced by its sample rate.")
+        filename = os.path.join(self.directory, 'capture.wav')
+        samples = np.tile(np.array([10, 200], dtype=np.uint8), 40000)
+        with open(filename, 'wb') as wav_file:
+            wav_file.write(wav_header(len(samples), 2, 200e3))
+            wav_file.write(samples.tobytes())
+        scope = replay_scope(filename, realtime=True, loop=True)
+        assert scope.sample_rate_index == 20
+        scope.device.clock = clock = FakeClock()
+        blocks = []
+
+        def callback(data, _):
+            blocks.append(bytes(data))
+
+        shutdown_event = scope.read_async(callback, 0x2000, interleaved=True)
+        scope.start_capture()
+        while scope.gap_tracker.received_bytes < 2 * len(samples):
+            scope.poll()
+        shutdown_event.set()
+        scope.poll()
+        scope.stop_capture()
+        # The recording looped after 200 ms and every transfer waited for its samples, so the FIFO never overflowed.
+        received_bytes = scope.gap_tracker.received_bytes
+        assert sum(len(data) for data in blocks) == received_bytes and scope.gap_tracker.gaps == []
+        assert abs(clock.now - received_bytes / 400e3) < 1e-6
+        assert all(set(bytearray(data[0::2])) == {10} and set(bytearray(data[1::2])) == {200} for data in blocks)
+        assert scope.close_handle()
@@ -0,0 +1,54 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+import array
+
+import numpy as np
+
+from PyHT6022 import SampleConversion
+
+
+class SampleConversionTests(TestCase):
+    def test_deinterleave_is_view(self):
+        print("Testing de-interleaving two channels without copying.")
+        data = bytearray(range(16))
+        samples = SampleConversion.deinterleave(data, 2)
+        assert samples.shape == (2, 8)
+        assert list(samples[0]) == list(range(0, 16, 2))
+        assert list(samples[1]) == list(range(1, 16, 2))
+        data[2] = 200
+        assert samples[0][1] == 200
+
+    def test_deinterleave_single_channel(self):
+        print("Testing de-interleaving a single channel.")
+        samples = SampleConversion.deinterleave(array.array('B', [1, 2, 3]), 1)
+        assert samples.shape == (1, 3)
+
+    def test_raw_to_volts(self):
+        print("Testing vectorized conversion to volts.")
+        samples = SampleConversion.deinterleave(bytes(bytearray([0, 128, 128, 255])), 2)
+        volts = SampleConversion.raw_to_volts(samples, [0x01, 0x0a])
+        assert volts.dtype == np.float32
+        assert np.allclose(volts[0], [-5.0, 0.0])
+        assert np.allclose(volts[1], [0.0, 127 * 0.00390625])
+
+    def test_conversion_table_is_cached(self):
+        print("Testing the conversion table cache.")
+        table = SampleConversion.conversion_table(0x02, 10)
+        assert table is SampleConversion.conversion_table(0x02, 10)
+        assert table is not SampleConversion.conversion_table(0x02, 10, np.float64)
+        assert len(table) == 256
+
+    def test_scale_samples_into_out(self):
+        print("Testing table based scaling into a preallocated output.")
+        data = np.arange(256, dtype=np.uint8)
+        out = np.empty(256, dtype=np.float64)
+        result = SampleConversion.scale_samples(data, 0x05, out=out)
+        assert result is out
+        assert np.allclose(out, [(datum - 128) * 5.0 / (0x05 << 7) for datum in range(256)])
+
+    def test_adc_voltage_round_trip(self):
+        print("Testing bulk ADC count and voltage conversion.")
+        voltages = [-1.0, 0.0, 0.5]
+        adc_counts = SampleConversion.voltage_to_adc(voltages, 0x02)
+        assert np.allclose(SampleConversion.adc_to_voltage(adc_counts, 0x02), voltages)
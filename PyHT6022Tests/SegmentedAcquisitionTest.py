@@ -0,0 +1,54 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+import time
+
+import numpy as np
+
+from PyHT6022.SegmentedAcquisition import SegmentedAcquisition
+from PyHT6022.SimulatedScope import SimulatedSignal
+from PyHT6022.Trigger import EdgeTrigger
+from PyHT6022Tests.SimulatedScopeTest import build_scope
+
+
+def build_square_scope():
+    # 128 samples per period at 1 MS/s, so the simulated pattern repeats seamlessly.
+    return build_scope(signals=(SimulatedSignal('square', frequency=1e6 / 128, amplitude=2.5),
+                                SimulatedSignal('dc', offset=1.25)))
+
+
+class SegmentedAcquisitionTests(TestCase):
+    def test_acquire(self):
+        print("Testing segmented acquisition stops when all segments are filled.")
+        scope = build_square_scope()
+        acquisition = SegmentedAcquisition(scope, EdgeTrigger(128), num_segments=200, segment_length=64,
+                                           pre_trigger=16)
+        assert acquisition.segments.shape == (200, 64, 2)
+        assert acquisition.acquire(timeout=10.0) == 200
+        assert acquisition.count == 200
+        assert np.all(acquisition.segments[:, :16, 0] == 64) and np.all(acquisition.segments[:, 16:, 0] == 192)
+        assert np.all(acquisition.segments[:, :, 1] == 160)
+        assert np.all(np.diff(acquisition.sample_offsets) % 128 == 0)
+        assert np.all(np.diff(acquisition.sample_offsets) > 0)
+        assert np.allclose(acquisition.timestamps, acquisition.sample_offsets / 1e6)
+        segments, sample_offsets, _ = acquisition.ordered()
+        assert segments.base is acquisition.segments and len(sample_offsets) == 200
+        assert scope.close_handle()
+
+    def test_wrap(self):
+        print("Testing segmented acquisition overwrites the oldest segments when wrapping.")
+        scope = build_square_scope()
+        assert scope.set_num_channels(1)
+        acquisition = SegmentedAcquisition(scope, EdgeTrigger(128), num_segments=10, segment_length=32, wrap=True,
+                                           block_size=0x800)
+        acquisition.start()
+        start_time = time.time()
+        while acquisition.count < 25 and time.time() - start_time < 10.0:
+            time.sleep(0.01)
+        acquisition.stop()
+        assert acquisition.count >= 25 and acquisition.num_filled == 10
+        segments, sample_offsets, timestamps = acquisition.ordered()
+        assert segments.shape == (10, 32, 1)
+        assert np.all(np.diff(sample_offsets) == 128)
+        assert np.all(segments[:, :, 0] == 192)
+        assert scope.close_handle()
@@ -0,0 +1,127 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+import time
+
+from PyHT6022.LibUsbScope import Oscilloscope
+from PyHT6022.SimulatedScope import SimulatedUSBContext, SimulatedDevice, SimulatedSignal
+
+
+def build_scope(**device_options):
+    device_options.setdefault('firmware_loaded', True)
+    scope = Oscilloscope(context=SimulatedUSBContext(SimulatedDevice(**device_options)))
+    assert scope.setup()
+    assert scope.open_handle()
+    scope.supports_single_channel = True
+    return scope
+
+
+def run_async(scope, data_size, duration=0.2, **read_options):
+    blocks = []
+
+    def callback(ch1_data, ch2_data):
+        blocks.append((bytes(ch1_data), bytes(ch2_data)))
+
+    shutdown_event = scope.read_async(callback, data_size, **read_options)
+    scope.start_capture()
+    start_time = time.time()
+    while time.time() - start_time < duration:
+        scope.poll()
+    shutdown_event.set()
+    scope.poll()
+    scope.stop_capture()
+    return blocks
+
+
+class SimulatedScopeTests(TestCase):
+    def test_flash_firmware(self):
+        print("Testing flashing firmware to the simulated scope.")
+        scope = build_scope(firmware_loaded=False)
+        assert not scope.is_device_firmware_present
+        assert scope.flash_firmware()
+        assert scope.close_handle()
+
+    def test_eeprom(self):
+        print("Testing reading and writing the simulated EEPROM.")
+        scope = build_scope()
+        assert len(scope.get_calibration_values()) == 32
+        assert scope.set_calibration_values([130] * 32)
+        assert list(scope.get_calibration_values()) == [130] * 32
+        assert scope.close_handle()
+
+    def test_read_data(self):
+        print("Testing reading a square wave from the simulated scope.")
+        scope = build_scope(signals=(SimulatedSignal('square', frequency=1e5, amplitude=2.5),
+                                     SimulatedSignal('dc', offset=1.25)))
+        assert scope.set_sample_rate(1)
+        ch1_data, ch2_data = scope.read_data(0x1000)
+        assert len(ch1_data) == len(ch2_data) == 0x1000
+        assert set(ch1_data) == {64, 192}
+        assert set(ch2_data) == {160}
+        assert scope.close_handle()
+
+    def test_sample_rates(self):
+        print("Testing the simulated firmware knows the sample rates of the scope, and no others.")
+        scope = build_scope()
+        for rate_index, (_, sample_rate) in scope.SAMPLE_RATES.items():
+            assert scope.set_sample_rate(rate_index)
+            assert scope.device.sample_rate == sample_rate
+        self.assertRaises(AssertionError, scope.set_sample_rate, 3)
+        assert scope.device.sample_rate_id == rate_index
+        assert scope.close_handle()
+
+    def test_read_async_bulk_and_iso(self):
+        print("Testing async reads over bulk and iso with one and two channels.")
+        scope = build_scope()
+        for alt in (0, 1):
+            for num_channels in (1, 2):
+                assert scope.set_interface(alt)
+                assert scope.set_num_channels(num_channels)
+                blocks = run_async(scope, 0x8000, outstanding_transfers=4, raw=True)
+                assert blocks
+                assert all(len(ch1_data) for ch1_data, _ in blocks)
+                assert all(bool(ch2_data) == (num_channels == 2) for _, ch2_data in blocks)
+        assert scope.close_handle()
+
+    def test_iso_packet_loss(self):
+        print("Testing injected iso packet loss.")
+        scope = build_scope(packet_loss=0.05)
+        assert scope.set_interface(1)
+        blocks = run_async(scope, 0x8000, outstanding_transfers=4, zero_copy=True)
+        assert blocks
+        assert scope.device.lost_packets
+        assert len(scope.device.gap_log) == scope.device.lost_packets
+        assert scope.close_handle()
+
+    def test_generator_zero_copy(self):
+        print("Testing the simulated scope delivers every sample of zero copy iso reads, without gaps.")
+        scope = build_scope()
+        assert scope.set_interface(1)
+        blocks = run_async(scope, 0x8000, outstanding_transfers=8, zero_copy=True)
+        total = sum(len(ch1_data) + len(ch2_data) for ch1_data, ch2_data in blocks)
+        assert total and total == scope.gap_tracker.received_bytes == 2 * scope.gap_tracker.sample_position
+        assert scope.gap_tracker.gaps == [] and not scope.device.lost_packets
+        assert scope.close_handle()
+
+    def test_release_numpy_blocks(self):
+        print("Testing zero copy NumPy blocks are released to the pool and their transfers resubmitted.")
+        scope = build_scope()
+        for alt in (0, 1):
+            assert scope.set_interface(alt)
+            blocks = []
+            shutdown_event = scope.read_async(lambda ch1_data, ch2_data: blocks.append((ch1_data, ch2_data)), 0x4000,
+                                              outstanding_transfers=2, zero_copy=True, auto_release=False,
+                                              as_numpy=True)
+            scope.start_capture()
+            released = 0
+            while len(blocks) < 10:
+                scope.poll()
+                for ch1_data, ch2_data in blocks[released:]:
+                    assert scope.transfer_buffer_pool.held_count
+                    assert scope.release_buffer(ch1_data if released % 2 else ch2_data)
+                    released += 1
+            shutdown_event.set()
+            scope.poll()
+            scope.stop_capture()
+            assert not scope.release_buffer(blocks[0][0])
+        assert scope.close_handle()
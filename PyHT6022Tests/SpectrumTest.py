@@ -0,0 +1,84 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+
+import numpy as np
+
+from PyHT6022.SampleConversion import scale_factor
+from PyHT6022.SimulatedScope import SimulatedSignal
+from PyHT6022.Spectrum import SpectrumAnalyzer, EXPONENTIAL, window
+from PyHT6022Tests.SimulatedScopeTest import build_scope
+
+
+def sine_counts(length, frequency, sample_rate, amplitude, noise=0.0, seed=0):
+    rng = np.random.RandomState(seed)
+    signal = 128 + amplitude * np.sin(2 * np.pi * frequency / sample_rate * np.arange(length))
+    return np.clip(np.round(signal + rng.normal(0, noise, length) if noise else signal), 0, 255).astype(np.uint8)
+
+
+class SpectrumTests(TestCase):
+    def test_tone_and_noise(self):
+        print("Testing the spectrum of a tone in noise, independent of the block sizes.")
+        samples = sine_counts(1 << 18, 125e3, 1e6, 100, noise=10)
+        volts_per_count = scale_factor(0x01)
+        whole = SpectrumAnalyzer(1e6, volts_per_count, fft_size=1024)
+        whole.feed(samples)
+        blocks = SpectrumAnalyzer(1e6, volts_per_count, fft_size=1024)
+        for start in range(0, len(samples), 3000):
+            blocks.feed(samples[start:start + 3000])
+        assert whole.segments == blocks.segments == 511
+        assert np.allclose(whole.psd, blocks.psd)
+        peak = int(np.argmax(whole.psd))
+        assert whole.frequencies[peak] == 125e3
+        # The tone's power is (100 counts)^2 / 2, spread over the bins of the window's main lobe.
+        tone = whole.power_spectrum()[peak - 2:peak + 3].sum() / (whole.enbw / whole.sample_rate * 1024)
+        assert abs(tone / (volts_per_count * 100) ** 2 * 2 - 1) < 0.05
+        # White noise of 10 counts RMS has a flat density of 2 * sigma^2 / fs.
+        noise = np.median(whole.psd[50:200]) / (2 * (10 * volts_per_count) ** 2 / 1e6)
+        assert 0.8 < noise < 1.2
+        assert abs(whole.psd_db()[peak] - 10 * np.log10(whole.psd[peak])) < 1e-9
+
+    def test_decimation_and_exponential(self):
+        print("Testing decimation and exponential averaging.")
+        samples = sine_counts(1 << 18, 10e3, 24e6 / 16, 50)
+        analyzer = SpectrumAnalyzer(24e6 / 16, fft_size=512, decimation=8, overlap=0.75)
+        for start in range(0, len(samples), 10001):
+            analyzer.feed(samples[start:start + 10001])
+        assert analyzer.sample_rate == 24e6 / 128 and analyzer.frequencies[-1] == analyzer.sample_rate / 2
+        assert abs(analyzer.frequencies[np.argmax(analyzer.psd)] - 10e3) < analyzer.sample_rate / 512
+        exponential = SpectrumAnalyzer(1e6, fft_size=256, overlap=0, averaging=EXPONENTIAL, alpha=0.5)
+        exponential.feed(sine_counts(256 * 20, 100e3, 1e6, 50))
+        exponential.feed(np.full(256 * 20, 128, dtype=np.uint8))
+        # After 20 silent segments only 2^-20 of the tone is left.
+        assert exponential.psd.max() < 1e-5 * SpectrumAnalyzer(1e6, fft_size=256).psd_scale * 50 ** 2 * 256 ** 2
+        assert window('hann', 256)[0] is exponential.window
+
+    def test_read_async(self):
+        print("Testing the analyzer as read_async callback, in volts from the scope settings.")
+        scope = build_scope(signals=(SimulatedSignal('sine', frequency=1e6 / 64, amplitude=1.0),))
+        assert scope.set_ch1_voltage_range(0x02)
+        analyzer = SpectrumAnalyzer.from_scope(scope, fft_size=1024)
+        assert analyzer.sample_rate == 1e6 and analyzer.volts_per_count == scale_factor(0x02)
+        shutdown_event = scope.read_async(analyzer, 0x1000, as_numpy=True, sample_offsets=True)
+        scope.start_capture()
+        while analyzer.segments < 50:
+            scope.poll()
+        shutdown_event.set()
+        scope.poll()
+        scope.stop_capture()
+        peak = int(np.argmax(analyzer.psd))
+        assert analyzer.frequencies[peak] == 1e6 / 64
+        # A 1V amplitude sine is 0.5 V^2.
+        assert abs(analyzer.power_spectrum()[peak - 2:peak + 3].sum() / 1.5 - 0.5) < 0.05
+        assert scope.close_handle()
+
+    def test_calibration(self):
+        print("Testing an analyzer from a calibrated scope scales the counts like its conversion table.")
+        scope = build_scope()
+        assert scope.set_ch2_voltage_range(0x05)
+        scope.load_calibration().set_gain(2, 0x05, 0.9)
+        analyzer = SpectrumAnalyzer.from_scope(scope, channel=2, fft_size=256)
+        assert analyzer.offset == 127
+        assert np.allclose((np.arange(256) - analyzer.offset) * analyzer.volts_per_count, scope.conversion_table(2),
+                           atol=1e-6)
+        assert scope.close_handle()
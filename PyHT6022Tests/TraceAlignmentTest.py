@@ -0,0 +1,88 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from PyHT6022.CaptureFile import CaptureFileWriter, CaptureFileReader
+from PyHT6022.TraceAlignment import TraceAligner, TraceAccumulator, TraceAverager, average_traces, capture_frames
+from PyHT6022.Trigger import EdgeTrigger
+
+
+def jittered_traces(count, length=400, max_jitter=20, seed=0):
+    """
+    A pulse pattern at random offsets, with noise: returns (traces, offsets, the pattern), where
+    trace[i] = pattern[i + offset].
+    """
+    rng = np.random.RandomState(seed)
+    pattern = np.full(length + 2 * max_jitter, 128.0)
+    for start, width, height in [(100, 10, 60), (160, 30, -40), (250, 5, 90), (300, 40, 30)]:
+        pattern[max_jitter + start:max_jitter + start + width] += height
+    offsets = rng.randint(-max_jitter, max_jitter + 1, count)
+    traces = np.array([pattern[max_jitter + offset:max_jitter + offset + length] for offset in offsets])
+    traces += rng.normal(0, 3, traces.shape)
+    return np.clip(traces, 0, 255).astype(np.uint8), offsets, pattern[max_jitter:max_jitter + length]
+
+
+class TraceAlignmentTests(TestCase):
+    def test_aligner(self):
+        print("Testing traces are aligned to the reference within the shift window.")
+        traces, offsets, pattern = jittered_traces(200)
+        aligner = TraceAligner(pattern, max_shift=25)
+        assert np.array_equal(aligner.shifts(traces), -offsets)
+        aligned, shifts = aligner.align(traces)
+        assert np.abs(aligned[:, 30:370].astype(float) - pattern[30:370]).max() < 20
+        assert np.all(aligner.correlations(aligned) > 0.95)
+        # Aligning on a window only looks at that part of the reference.
+        aligner = TraceAligner(pattern, max_shift=25, window=(240, 350))
+        assert np.array_equal(aligner.shifts(traces), -offsets)
+
+    def test_accumulator(self):
+        print("Testing running mean and variance over batches.")
+        rng = np.random.RandomState(1)
+        traces = rng.normal(5.0, 2.0, (1000, 50))
+        accumulator = TraceAccumulator(50)
+        for start in range(0, 1000, 137):
+            accumulator.add(traces[start:start + 137])
+        assert accumulator.count == 1000
+        assert np.allclose(accumulator.mean, traces.mean(axis=0))
+        assert np.allclose(accumulator.variance, traces.var(axis=0, ddof=1))
+
+    def test_averager(self):
+        print("Testing aligned averaging, in this process and in a process pool.")
+        traces, offsets, pattern = jittered_traces(1050)
+        averager = average_traces(traces, pattern, max_shift=25, batch_size=100)
+        assert averager.count == 1050 and np.array_equal(averager.shifts, -offsets)
+        assert np.abs(averager.mean[30:370] - pattern[30:370]).max() < 1.0
+        pooled = average_traces(traces, pattern, max_shift=25, batch_size=100, processes=2)
+        assert np.array_equal(pooled.shifts, -offsets)
+        assert np.allclose(pooled.mean, averager.mean) and np.allclose(pooled.variance, averager.variance)
+        # Without alignment the jitter smears the pulses.
+        unaligned = average_traces(traces, batch_size=100)
+        assert np.abs(unaligned.mean[30:370] - pattern[30:370]).max() > 10
+        # Traces which do not match the reference are left out.
+        traces[::10] = 128
+        averager = TraceAverager(pattern, max_shift=25, batch_size=64, min_correlation=0.8)
+        for trace in traces:
+            averager.add_frame(0, trace.reshape(1, -1))
+        averager.close()
+        assert averager.rejected == 105 and averager.count == 945
+
+    def test_capture_frames(self):
+        print("Testing averaging the triggered frames of a capture file.")
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'capture.ht6022')
+            signal = np.tile(np.where(np.arange(1000) % 1000 < 500, 60, 200).astype(np.uint8), 50)
+            with CaptureFileWriter(filename, num_channels=1, chunk_samples=4096) as writer:
+                writer.write(signal)
+            with CaptureFileReader(filename) as reader:
+                averager = average_traces(capture_frames(reader, EdgeTrigger(128), 100, 100), max_shift=10,
+                                          batch_size=16)
+            assert averager.count == 50
+            assert averager.mean.tolist() == [60.0] * 100 + [200.0] * 100
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,75 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from PyHT6022.SampleConversion import conversion_table
+from PyHT6022.TraceStore import TraceStore, HEADER_SIZE
+from PyHT6022.Trigger import TriggerEngine, EdgeTrigger
+
+
+class TraceStoreTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'traces.ht6022t')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_and_read(self):
+        print("Testing batched appends growing the store, and reading trace ranges back.")
+        traces = np.random.RandomState(0).randint(0, 256, (2500, 2, 100)).astype(np.uint8)
+        with TraceStore(self.filename, trace_length=100, num_channels=2, tag_size=4, capacity=16,
+                        voltage_ranges=(0x0a, 0x02), trigger_offset=20) as store:
+            for start in range(0, 2500, 300):
+                batch = traces[start:start + 300]
+                store.append(batch, timestamps=float(start), trigger_indexes=np.arange(start, start + len(batch)),
+                             tags=[b'%04d' % index for index in range(start, start + len(batch))])
+            assert len(store) == 2500 and store.capacity >= 2500
+            assert np.array_equal(store.traces, traces)
+        # Closing truncates the files to the traces written: one byte per sample.
+        assert os.path.getsize(self.filename) == HEADER_SIZE + 2500 * 200
+        store = TraceStore(self.filename, readonly=True)
+        assert (store.num_channels, store.trace_length, store.tag_size) == (2, 100, 4)
+        assert store.voltage_ranges == (0x0a, 0x02) and store.trigger_offset == 20
+        batch, metadata = store.read(1000, 1010)
+        assert np.array_equal(batch, traces[1000:1010])
+        assert metadata['trigger_index'].tolist() == list(range(1000, 1010))
+        assert metadata['tag'][0] == b'1000' and metadata['timestamp'][0] == 900.0
+        assert np.all(metadata['trigger_offset'] == 20) and np.all(metadata['ch1_voltage_range'] == 0x0a)
+        assert [start for start, _ in store.iter_batches(1000)] == [0, 1000, 2000]
+        volts = store.volts(0, 10, channel=2)
+        assert np.array_equal(volts, conversion_table(0x02)[traces[:10, 1]])
+        store.close()
+
+    def test_reopen_and_frame_buffer(self):
+        print("Testing the trigger engine writing frames straight into the store, and appending after reopening.")
+        signal = np.where(np.arange(10000) % 100 < 50, 0, 255).astype(np.uint8)
+        with TraceStore(self.filename, trace_length=20, trigger_offset=5, capacity=8) as store:
+            engine = TriggerEngine(EdgeTrigger(128), pre_trigger=5, post_trigger=15, num_channels=1,
+                                   frame_buffer=store.frame_buffer)
+            engine.feed(signal[:5000])
+            assert len(store) == 50
+        with TraceStore(self.filename) as store:
+            # The trigger offset and voltage ranges are kept in the store.
+            assert store.trigger_offset == 5 and store.voltage_ranges == (0x01, 0x01)
+            engine = TriggerEngine(EdgeTrigger(128), pre_trigger=5, post_trigger=15, num_channels=1,
+                                   on_frame=store.add_frame)
+            engine.feed(signal[5000:])
+            assert len(store) == 100
+        store = TraceStore(self.filename, readonly=True)
+        assert np.all(store.traces[:, 0] == [0] * 5 + [255] * 15)
+        assert store.metadata['trigger_index'][:3].tolist() == [50, 150, 250]
+        assert np.all(store.metadata['trigger_offset'] == 5)
+        store.close()
+        # Settings given when reopening replace the stored ones.
+        with TraceStore(self.filename, voltage_ranges=(0x05, 0x02), trigger_offset=3) as store:
+            store.append(np.zeros((1, 20), dtype=np.uint8))
+        store = TraceStore(self.filename, readonly=True)
+        assert store.voltage_ranges == (0x05, 0x02) and store.trigger_offset == 3
+        assert store.metadata[-1]['trigger_offset'] == 3 and store.metadata[-1]['ch1_voltage_range'] == 0x05
+        store.close()
@@ -0,0 +1,69 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+import threading
+
+import numpy as np
+
+from PyHT6022.SampleConversion import deinterleave
+from PyHT6022.TransferBufferPool import TransferBufferPool
+
+
+class FakeTransfer(object):
+    def __init__(self):
+        self.submitted = 0
+
+    def submit(self):
+        self.submitted += 1
+
+
+def build_pool(num_buffers=3, buffer_size=0x200, shutdown_event=None):
+    pool = TransferBufferPool(num_buffers, buffer_size, shutdown_event)
+    transfers = [FakeTransfer() for _ in pool]
+    for buffer, transfer in zip(pool, transfers):
+        pool.attach(buffer, transfer)
+    return pool, transfers
+
+
+class TransferBufferPoolTests(TestCase):
+    def test_hold_release_and_resubmit(self):
+        print("Testing holding a buffer and resubmitting its transfer on release.")
+        pool, transfers = build_pool()
+        assert len(pool) == 3 and all(len(buffer) == 0x200 for buffer in pool)
+        assert len(set(id(buffer) for buffer in pool)) == 3
+        buffer = pool.buffers[1]
+        # Buffers which are not held are not resubmitted.
+        assert not pool.release(buffer) and transfers[1].submitted == 0
+        pool.hold(buffer)
+        assert pool.held_count == 1
+        assert pool.release(buffer)
+        assert pool.held_count == 0 and [transfer.submitted for transfer in transfers] == [0, 1, 0]
+        # A second release of the same block does nothing.
+        assert not pool.release(buffer) and transfers[1].submitted == 1
+
+    def test_release_after_shutdown(self):
+        print("Testing released buffers are not resubmitted after shutdown.")
+        shutdown_event = threading.Event()
+        pool, transfers = build_pool(shutdown_event=shutdown_event)
+        for buffer in pool:
+            pool.hold(buffer)
+        shutdown_event.set()
+        assert not any(pool.release(buffer) for buffer in pool)
+        assert pool.held_count == 0 and not any(transfer.submitted for transfer in transfers)
+
+    def test_release_views(self):
+        print("Testing releasing a buffer through memoryviews and NumPy views of it.")
+        pool, transfers = build_pool()
+        buffer = pool.buffers[2]
+        samples = np.frombuffer(memoryview(buffer)[0:0x100], dtype=np.uint8)
+        views = (memoryview(buffer)[0:0x100][::2], memoryview(buffer)[1::2], samples, samples[1::2],
+                 deinterleave(memoryview(buffer)[0:0x100], 2)[1], deinterleave(samples, 1)[0][:0])
+        for view in views:
+            assert TransferBufferPool.buffer_of(view) is buffer
+            pool.hold(buffer)
+            assert pool.release(view)
+        assert transfers[2].submitted == len(views) and pool.held_count == 0
+        # Copies do not refer to the buffer.
+        pool.hold(buffer)
+        assert not pool.release(samples.copy()) and not pool.release(bytes(buffer))
+        assert pool.held_count == 1
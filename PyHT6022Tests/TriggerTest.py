@@ -0,0 +1,115 @@
+__author__ = 'Robert Cope'
+
+from unittest import TestCase
+
+import numpy as np
+
+from PyHT6022.SimulatedScope import SimulatedSignal
+from PyHT6022.Trigger import (TriggerEngine, EdgeTrigger, PulseWidthTrigger, WindowTrigger, FALLING, NEGATIVE,
+                              EXIT)
+from PyHT6022Tests.SimulatedScopeTest import build_scope
+
+
+def feed_blocks(engine, channels, block_sizes):
+    frames, start = [], 0
+    while start < channels.shape[1]:
+        for size in block_sizes:
+            frames.extend(engine.feed(*channels[:, start:start + size]))
+            start += size
+    return frames
+
+
+class TriggerTests(TestCase):
+    def test_edge_trigger(self):
+        print("Testing edge triggers with hysteresis across block boundaries.")
+        rng = np.random.RandomState(0)
+        square = np.where(np.arange(20000) % 1000 < 500, 60, 200)
+        ch1 = (square + rng.randint(-5, 6, len(square))).astype(np.uint8)
+        channels = np.vstack([ch1, np.arange(20000).astype(np.uint8)])
+        engine = TriggerEngine(EdgeTrigger(128, hysteresis=20), pre_trigger=100, post_trigger=600, holdoff=0)
+        frames = feed_blocks(engine, channels, [333, 1, 4096, 77])
+        assert [position for position, _ in frames] == list(range(500, 19500, 1000))
+        for position, frame in frames:
+            assert frame.shape == (2, 700)
+            assert np.array_equal(frame, channels[:, position - 100:position + 600])
+        # A trigger whose post-trigger samples have not arrived yet.
+        assert engine.pending == [19500]
+        engine = TriggerEngine(EdgeTrigger(128, FALLING, hysteresis=20, channel=2), pre_trigger=100, post_trigger=100)
+        frames = feed_blocks(engine, channels, [1000])
+        assert [position for position, _ in frames] == list(range(256, 19800, 256))
+        # Without hysteresis the noise at the level fires the trigger repeatedly.
+        noisy = np.array([127, 129] * 50, dtype=np.uint8)
+        engine = TriggerEngine(EdgeTrigger(128), pre_trigger=0, post_trigger=1, num_channels=1, holdoff=0)
+        assert len(engine.feed(noisy)) == 50
+
+    def test_pulse_width_trigger(self):
+        print("Testing pulse width triggers only fire on pulses within the limits.")
+        signal = np.zeros(3000, dtype=np.uint8)
+        for start, width in [(100, 5), (500, 20), (990, 25), (1500, 50), (2000, 15)]:
+            signal[start:start + width] = 255
+        engine = TriggerEngine(PulseWidthTrigger(128, min_width=10, max_width=30), pre_trigger=10, post_trigger=10,
+                               num_channels=1)
+        frames = feed_blocks(engine, signal.reshape(1, -1), [1000])
+        assert [position for position, _ in frames] == [520, 1015, 2015]
+        engine = TriggerEngine(PulseWidthTrigger(128, min_width=100, polarity=NEGATIVE), pre_trigger=10,
+                               post_trigger=10, num_channels=1)
+        frames = feed_blocks(engine, signal.reshape(1, -1), [7])
+        assert [position for position, _ in frames] == [500, 990, 1500, 2000]
+
+    def test_window_trigger(self):
+        print("Testing window triggers on entering and leaving the window.")
+        signal = np.array([0, 50, 100, 150, 200, 250] * 10, dtype=np.uint8)
+        engine = TriggerEngine(WindowTrigger(90, 160), pre_trigger=2, post_trigger=2, num_channels=1, holdoff=0)
+        assert [position for position, _ in feed_blocks(engine, signal.reshape(1, -1), [3, 5])] == \
+            list(range(2, 57, 6))
+        engine = TriggerEngine(WindowTrigger(90, 160, EXIT), pre_trigger=2, post_trigger=2, num_channels=1, holdoff=0)
+        assert [position for position, _ in feed_blocks(engine, signal.reshape(1, -1), [3, 5])] == \
+            list(range(4, 59, 6))
+
+    def test_long_stream(self):
+        print("Testing the trigger engine over a long stream in large blocks.")
+        samples = (128 + 100 * np.sin(np.arange(1 << 20) * 2e-3)).astype(np.uint8)
+        engine = TriggerEngine(EdgeTrigger(128, hysteresis=4), pre_trigger=1000, post_trigger=3000, num_channels=1,
+                               holdoff=0)
+        frames = 0
+        for start in range(0, len(samples), 0x10000):
+            frames += len(engine.feed(samples[start:start + 0x10000]))
+        # One rising edge every 2 pi / 2e-3 samples.
+        assert frames == engine.triggers - len(engine.pending) > 300
+
+    def test_read_async(self):
+        print("Testing the trigger engine as read_async callback.")
+        # 128 samples per period at 1 MS/s, so the simulated pattern repeats seamlessly.
+        scope = build_scope(signals=(SimulatedSignal('square', frequency=1e6 / 128, amplitude=2.5),
+                                     SimulatedSignal('dc', offset=1.25)))
+        frames = []
+        engine = TriggerEngine(EdgeTrigger(128), pre_trigger=20, post_trigger=20,
+                               on_frame=lambda position, frame: frames.append(frame))
+        shutdown_event = scope.read_async(engine, 0x1000, as_numpy=True)
+        scope.start_capture()
+        while len(frames) < 100:
+            scope.poll()
+        shutdown_event.set()
+        scope.poll()
+        scope.stop_capture()
+        assert all(np.all(frame[0, :20] == 64) and np.all(frame[0, 20:] == 192) for frame in frames)
+        assert all(np.all(frame[1] == 160) for frame in frames)
+        assert scope.close_handle()
+
+    def test_gaps_and_frame_buffer(self):
+        print("Testing frames around gaps are dropped and frames are copied into given buffers.")
+        signal = np.where(np.arange(4000) % 100 < 50, 0, 255).astype(np.uint8)
+        segments = np.zeros((100, 20, 1), dtype=np.uint8)
+        engine = TriggerEngine(EdgeTrigger(128), pre_trigger=10, post_trigger=10, num_channels=1,
+                               frame_buffer=lambda position: segments[position // 100].T)
+        engine.feed(signal[:1000], None, 0)
+        # Samples 1000 - 1195 were lost: the frame at 1050 is gone, and the one at 1150 has no pre-trigger history.
+        engine.feed(signal[1195:2000], None, 1195)
+        engine.feed(signal[2000:2045], None, 2000)
+        engine.feed(signal[2045:], None, 2045)
+        assert engine.gaps == 1 and engine.dropped_frames == 0
+        filled = [index for index in range(100) if segments[index].any()]
+        assert filled == list(range(0, 10)) + list(range(12, 40))
+        assert segments[0, :, 0].tolist() == [0] * 10 + [255] * 10
+        assert all(np.array_equal(segments[index, :, 0], signal[index * 100 + 40:index * 100 + 60])
+                   for index in filled[1:])
@@ -1,34 +1,15 @@
 __author__ = 'rcope'
 
 from PyHT6022.LibUsbScope import Oscilloscope
+from PyHT6022.Envelope import minmax
+from PyHT6022.Measurements import WaveformMeasurements
+from PyHT6022.Spectrum import SpectrumAnalyzer
 import matplotlib.pyplot as plt
 import time
 import numpy as np
 from collections import deque
 
 
-def build_stability_array(data, threshold=1.0):
-    initial = True
-    running = False
-    current = 0
-    stability = []
-    for entry in data:
-        if initial and entry > threshold:
-            continue
-        elif initial and entry < threshold:
-            initial = False
-        elif entry > threshold and not running:
-            running = True
-            current = 0
-        elif entry > threshold and running:
-            current += 1
-        elif entry < threshold and running:
-            stability.append(current)
-            running = False
-        else:
-            continue
-    return stability[1:-1]
-
 sample_rate_index = 0x1E
 voltage_range = 0x01
 data_points = 3 * 1024
@@ -72,13 +53,29 @@ scaled_data = scope.scale_read_data(data, voltage_range)
 with open('/tmp/continuous_read.out','wt') as ouf:
     ouf.write(str(scaled_data[:2^16])[1:-1].replace(', ',chr(10)))
 plt.figure(0)
-plt.plot(scaled_data)
+# Plot the min/max envelope of the raw samples, a few thousand buckets instead of millions of points.
+raw_data = np.fromiter(data, dtype=np.uint8, count=len(data))
+bucket_size = max(1, len(raw_data) // 4000)
+mins, maxs = minmax(raw_data, bucket_size)
+plt.fill_between(np.arange(len(mins)) * bucket_size,
+                 scope.scale_read_data(mins, voltage_range), scope.scale_read_data(maxs, voltage_range))
 plt.figure(1)
-plt.plot(np.fft.fft(scaled_data).real)
+# Welch averaged power spectral density, instead of the real part of one FFT over the whole capture.
+analyzer = SpectrumAnalyzer.from_scope(scope, fft_size=4096)
+analyzer.feed(raw_data)
+plt.plot(analyzer.frequencies, analyzer.psd_db())
+plt.xlabel("Hz")
+plt.ylabel("dBV/Hz")
 #plt.show()
-stab = build_stability_array(scaled_data, threshold=np.average(scaled_data[:2048]))
-stab_avg, stab_std = np.average(stab), np.std(stab)
+# Pulse width statistics, from the interpolated edges of a comparator with hysteresis around the middle level.
+measurements = WaveformMeasurements.from_scope(scope)
+measurements.feed(raw_data)
+stab = measurements.statistics['high_width'].values
+results = measurements.results()
+stab_avg, stab_std = results['high_width']['mean'], results['high_width']['std']
 print("Stability", stab_avg, "+/-", stab_std, "({}% deviance)".format(100.0*stab_std/stab_avg))
-bad_pulse_count = len([p for p in stab if abs(stab_avg - p) >= stab_std])
+print("Frequency {} Hz, duty cycle {}, rise time {} s".format(results['frequency'], results['duty_cycle'],
+                                                             results['rise_time']['mean']))
+bad_pulse_count = np.count_nonzero(np.abs(stab - np.mean(stab)) >= np.std(stab))
 print("Pulses more than 1 std dev out: {}/{} ({} %)".format(bad_pulse_count, len(stab), 100.0*bad_pulse_count/len(stab)))
 plt.show()
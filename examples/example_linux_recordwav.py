@@ -5,12 +5,11 @@ __author__ = 'Robert Cope', 'Jochen Hoenicke'
 # See more: http://johoe.mooo.com/trezor-power-analysis/
 # Original Author: Jochen Hoenicke
 
-from struct import pack
 import sys
 import time
-from collections import deque
 
 from PyHT6022.LibUsbScope import Oscilloscope
+from PyHT6022.CaptureRecorder import CaptureRecorder
 
 voltagerange = 10       # 1 (5V), 2 (2.6V), 5 or 10
 samplerate = 24         # sample rate in MHz or in 10khz
@@ -45,39 +44,11 @@ for x in range(3):
     time.sleep(1)
 print("now")
 
-data = []
-data_extend = data.append
-def extend_callback(ch1_data, _):
-    global data_extend
-    data_extend(ch1_data)
-
-start_time = time.time()
-print("Clearing FIFO and starting data transfer...")
-shutdown_event = scope.read_async(extend_callback, blocksize, outstanding_transfers=10,raw=True)
-scope.start_capture()
-while time.time() - start_time < numseconds:
-    scope.poll()
-print("Stopping new transfers.")
-#scope.stop_capture()
-shutdown_event.set()
-time.sleep(1)
-scope.stop_capture()
-scope.close_handle()
-
-total = sum(len(block) for block in data)
-
 filename = "test.wav"
-print("Writing out data from scope to {}".format(filename))
-with open(filename, "wb") as wf:
-    wf.write(b"RIFF")
-    wf.write(pack("<L", 44 + total - 8))
-    wf.write(b"WAVE")
-    wf.write(b"fmt \x10\x00\x00\x00\x01\x00\x01\x00")
-    wf.write(pack("<L", samplerate))
-    wf.write(pack("<L", samplerate))
-    wf.write(b"\x01\x00\x08\x00")
-    wf.write(b"data")
-    wf.write(pack("<L", total))
-    for block in data:
-        wf.write(block)
+print("Clearing FIFO and streaming data from scope to {}...".format(filename))
+# The samples go straight to disk, so the capture does not need to fit in memory.
+numsamples = int(numseconds * scope.sample_rate_hz(scope.sample_rate_index))
+recorder = CaptureRecorder(scope, filename, max_samples=numsamples, block_size=blocksize, wav_sample_rate=samplerate)
+recorder.record()
+scope.close_handle()
 print("Done")
@@ -1,17 +1,11 @@
 __author__ = 'Robert Cope'
 
 from PyHT6022.LibUsbScope import Oscilloscope
+from PyHT6022.Filters import FIRFilter, fir_lowpass
 import pylab
 import time
 import sys
 
-def apply_data_smoothing(data, window=1):
-    new_data = data[:window]
-    for i, point in enumerate(data[window:-window]):
-        new_data.append(sum(data[i-window:i+window+1])/(2*window+1))
-    new_data.extend(data[-window:])
-    return new_data
-
 sample_rate_index = 0x04
 voltage_range = 0x01
 data_points = 0x2000
@@ -42,7 +36,13 @@ with open('/tmp/scopevis.dat', 'wt') as ouf:
 
 pylab.title('Scope Visualization Example')
 pylab.plot(timing_data, voltage_data, color='#009900', label='Raw Trace')
-pylab.plot(timing_data, apply_data_smoothing(voltage_data, window=3), color='#0033CC', label='Smoothed Trace')
+# A linear phase low-pass filter on the raw samples, converted to volts on the way. Its output lags the input by
+# half its length, so the smoothed trace is shifted back for the plot.
+smoothing = FIRFilter.from_scope(scope, fir_lowpass(scope.sample_rate_hz(sample_rate_index) / 20,
+                                                    scope.sample_rate_hz(sample_rate_index), taps=31))
+smoothed_data = smoothing.feed(ch1_data)
+delay = int(smoothing.delay)
+pylab.plot(timing_data[:len(smoothed_data) - delay], smoothed_data[delay:], color='#0033CC', label='Smoothed Trace')
 pylab.xlabel('Time (s)')
 pylab.ylabel('Voltage (V)')
 pylab.grid()
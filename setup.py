@@ -18,4 +18,5 @@ setup(name='Python Hantek 6022BE Wrapper',
                                  os.path.join('HantekFirmware', 'modded', 'mod_fw_iso.ihex'),
                                  os.path.join('HantekFirmware', 'stock', 'stock_fw.ihex'),]},
       include_package_data=True,
-      install_requires=['libusb1'])
+      install_requires=['libusb1'],
+      extras_require={'numpy': ['numpy']})